@@ -0,0 +1,71 @@
+'''
+Make calls concurrently in a thread pool
+
+All concurrent calls of the process share MAX_THREADS threads. When all threads are in use, e.g., by the outer of
+nested concurrent calls, the calls are made one after the other in the calling thread, so nesting concurrentMap does
+not multiply the number of threads or the load on the services that are called.
+'''
+
+import threading
+from multiprocessing.pool import ThreadPool
+
+__RCSID__ = "$Id$"
+
+#: default maximum number of calls made at the same time
+DEFAULT_WORKERS = 4
+#: maximum number of threads used for concurrent calls in the whole process
+MAX_THREADS = 16
+
+_threads = threading.BoundedSemaphore(MAX_THREADS)
+
+
+def _reserveThreads(wanted):
+  """Reserve up to wanted threads, without waiting for threads in use elsewhere.
+
+  :returns: number of reserved threads
+  """
+  reserved = 0
+  while reserved < wanted and _threads.acquire(False):
+    reserved += 1
+  return reserved
+
+
+def _releaseThreads(reserved):
+  """Give back the reserved threads."""
+  for _ in range(reserved):
+    _threads.release()
+
+
+def concurrentMap(function, items, workers=DEFAULT_WORKERS, unordered=False):
+  """Yield function(item) for all items, calling function for up to workers items at the same time.
+
+  If the iteration is stopped before all results were obtained, the remaining calls are abandoned. Exceptions raised
+  by the function are raised when its result is reached.
+
+  :param function: function taking a single item
+  :param items: iterable of items
+  :param int workers: maximum number of calls made at the same time
+  :param bool unordered: if True yield the results as soon as they are available, otherwise in the order of the items
+  """
+  items = list(items)
+  reserved = _reserveThreads(min(workers, len(items))) if workers > 1 and len(items) > 1 else 0
+  if reserved < 2:
+    _releaseThreads(reserved)
+    for item in items:
+      yield function(item)
+    return
+
+  pool = ThreadPool(reserved)
+  finished = False
+  try:
+    results = pool.imap_unordered(function, items) if unordered else pool.imap(function, items)
+    for result in results:
+      yield result
+    finished = True
+  finally:
+    if finished:
+      pool.close()
+    else:
+      pool.terminate()
+    pool.join()
+    _releaseThreads(reserved)
@@ -0,0 +1,66 @@
+'''
+ADLER32 checksums of local files
+
+The checksums are kept for the lifetime of the process, keyed on the real path, size and modification time of the
+file, so that the different workflow modules preparing the upload of the same output files only read them once. The
+checksums of several files are calculated concurrently. Only reading the files overlaps, zlib.adler32 holds the
+interpreter lock on python 2.7, so the gain is limited to the time spent waiting for the disk.
+'''
+
+import os
+import threading
+
+from DIRAC import gLogger
+from DIRAC.Core.Utilities.Adler import fileAdler
+
+from ILCDIRAC.Core.Utilities.Concurrency import DEFAULT_WORKERS, concurrentMap
+
+LOG = gLogger.getSubLogger(__name__)
+__RCSID__ = "$Id$"
+
+_checksumCache = {}
+_cacheLock = threading.Lock()
+
+
+def _fileKey(path):
+  """Return the key identifying the current content of the file."""
+  fileStat = os.stat(path)
+  return (os.path.realpath(path), fileStat.st_size, fileStat.st_mtime)
+
+
+def getChecksum(path):
+  """Return the ADLER32 checksum of the file, calculated only if the file changed since it was last calculated.
+
+  :param str path: path to the file
+  :returns: checksum as returned by :func:`~DIRAC.Core.Utilities.Adler.fileAdler`, False if it cannot be calculated
+  """
+  try:
+    key = _fileKey(path)
+  except OSError as err:
+    LOG.error('Cannot access file for checksum', '%s: %s' % (path, err))
+    return False
+  with _cacheLock:
+    if key in _checksumCache:
+      return _checksumCache[key]
+  checksum = fileAdler(path)
+  if checksum is not False:
+    with _cacheLock:
+      _checksumCache[key] = checksum
+  return checksum
+
+
+def getChecksums(paths, workers=DEFAULT_WORKERS):
+  """Return the ADLER32 checksums of all files, calculating up to workers checksums at the same time.
+
+  :param list paths: paths to the files
+  :param int workers: maximum number of concurrent calculations
+  :returns: dictionary of path to checksum, False for files whose checksum cannot be calculated
+  """
+  paths = list(paths)
+  return dict(zip(paths, concurrentMap(getChecksum, paths, workers)))
+
+
+def clearChecksumCache():
+  """Forget all checksums."""
+  with _cacheLock:
+    _checksumCache.clear()
@@ -0,0 +1,96 @@
+'''
+Metadata fields defined in the file catalog
+
+The metadata fields are obtained from the catalog once and kept for METADATA_FIELDS_TTL seconds for the whole process,
+so that all productions and queries created by a script share them. The field names are indexed in lower case to check
+the spelling of metadata keys without going through all fields.
+'''
+
+import threading
+import time
+
+from DIRAC import S_OK, S_ERROR, gLogger
+
+LOG = gLogger.getSubLogger(__name__)
+__RCSID__ = "$Id$"
+
+#: time in seconds after which the metadata fields are obtained again from the catalog
+METADATA_FIELDS_TTL = 3600
+
+_fieldsCache = {}
+_cacheLock = threading.Lock()
+
+
+class MetadataFields(object):
+  """The directory and file metadata fields with their types."""
+
+  def __init__(self, fields):
+    """Index the fields.
+
+    :param dict fields: the value returned by getMetadataFields of the catalog
+    """
+    self.directoryFields = dict(fields.get('DirectoryMetaFields', {}))
+    self.fileFields = dict(fields.get('FileMetaFields', {}))
+    self._directoryIndex = dict((name.lower(), name) for name in self.directoryFields)
+    self._fileIndex = dict((name.lower(), name) for name in self.fileFields)
+
+  def getFieldName(self, key, includeFileFields=False):
+    """Return the name of the field matching the key ignoring the case.
+
+    :param str key: metadata key
+    :param bool includeFileFields: also look for the key in the file metadata fields
+    :returns: name of the field, None if there is no such field
+    """
+    if key in self.directoryFields or (includeFileFields and key in self.fileFields):
+      return key
+    name = self._directoryIndex.get(key.lower())
+    if name is None and includeFileFields:
+      name = self._fileIndex.get(key.lower())
+    return name
+
+  def getFieldNames(self, includeFileFields=False):
+    """Return the names of all directory fields, and of the file fields if includeFileFields."""
+    names = list(self.directoryFields)
+    if includeFileFields:
+      names.extend(self.fileFields)
+    return names
+
+  def getTypes(self):
+    """Return dictionary of field name to type for all fields, directory fields take precedence."""
+    types = dict(self.fileFields)
+    types.update(self.directoryFields)
+    return types
+
+
+def _catalogKey(catalog):
+  """Return the key identifying the catalog service, clients of the same service share the fields."""
+  serverURL = getattr(catalog, 'serverURL', None)
+  return serverURL if isinstance(serverURL, basestring) else id(catalog)
+
+
+def getMetadataFields(catalog):
+  """Return the metadata fields of the catalog, obtained at most once every METADATA_FIELDS_TTL seconds.
+
+  :param catalog: catalog client, e.g. :class:`~DIRAC.Resources.Catalog.FileCatalogClient.FileCatalogClient`
+  :returns: S_OK with :class:`MetadataFields`, S_ERROR if the fields cannot be obtained
+  """
+  key = _catalogKey(catalog)
+  with _cacheLock:
+    if key in _fieldsCache and time.time() - _fieldsCache[key][0] < METADATA_FIELDS_TTL:
+      return S_OK(_fieldsCache[key][1])
+  result = catalog.getMetadataFields()
+  if not result['OK']:
+    LOG.error('Failed to get the metadata fields', result['Message'])
+    return result
+  if not result['Value']:
+    return S_ERROR('No metadata fields available')
+  fields = MetadataFields(result['Value'])
+  with _cacheLock:
+    _fieldsCache[key] = (time.time(), fields)
+  return S_OK(fields)
+
+
+def clearMetadataFieldsCache():
+  """Forget all metadata fields."""
+  with _cacheLock:
+    _fieldsCache.clear()
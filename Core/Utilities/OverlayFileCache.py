@@ -0,0 +1,233 @@
+'''
+Cache for overlay files shared by all jobs running on the same node
+
+The files are stored in the cache directory under a name derived from the LFN. Jobs get a hard link to the cached
+file in their job directory, or a copy of it if the cache is on a different file system. A symbolic link is not used,
+because the cached file could be evicted while the job still reads it. The ADLER32 checksum of each file is stored
+next to it when it is added and compared when the file is used again. If the size of the cache exceeds the limit,
+the least recently used files, which are not hard linked by a job directory, are removed.
+
+All changes to an entry are done while holding a lock on the lock file of the entry, so that concurrent jobs asking
+for the same file wait for the one downloading it.
+'''
+
+import errno
+import fcntl
+import hashlib
+import os
+import shutil
+from contextlib import contextmanager
+
+from DIRAC import gLogger, S_OK, S_ERROR
+from DIRAC.Core.Utilities.Adler import fileAdler
+
+LOG = gLogger.getSubLogger(__name__)
+__RCSID__ = "$Id$"
+
+CHECKSUM_SUFFIX = '.adler32'
+LOCK_SUFFIX = '.lock'
+CACHE_LOCK = '.cache.lock'
+
+
+@contextmanager
+def lockFile(path, blocking=True):
+  """Hold an exclusive lock on the file at path, yields False if not blocking and the lock is held by someone else.
+
+  :param str path: path to the lock file, created if it does not exist
+  :param bool blocking: wait for the lock if True
+  """
+  with open(path, 'a') as lock:
+    try:
+      fcntl.flock(lock, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+    except IOError as err:
+      if err.errno not in (errno.EAGAIN, errno.EACCES):
+        raise
+      yield False
+      return
+    try:
+      yield True
+    finally:
+      fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+class OverlayFileCache(object):
+  """Node local cache of overlay files.
+
+  :param str cacheDir: directory holding the cached files
+  :param int maxSize: maximum size of the cache in bytes
+  :param bool validate: compare the checksum of cached files every time they are used
+  """
+
+  def __init__(self, cacheDir, maxSize, validate=True):
+    self.cacheDir = cacheDir
+    self.maxSize = maxSize
+    self.validate = validate
+    self.hits = 0
+    self.misses = 0
+
+  @classmethod
+  def fromConfig(cls, ops, site):
+    """Create the cache from the Operations configuration, return None if no cache is configured for the site.
+
+    The options are read from `/Overlay/Sites/<site>/Cache` and `/Overlay/Cache`: `Directory`, `MaxSize` in GB and
+    `Validate`.
+    """
+    def getValue(option, default):
+      """Return the site specific value, or the general one."""
+      return ops.getValue('/Overlay/Sites/%s/Cache/%s' % (site, option),
+                          ops.getValue('/Overlay/Cache/%s' % option, default))
+
+    cacheDir = os.path.expandvars(getValue('Directory', ''))
+    if not cacheDir:
+      return None
+    cacheDir = os.path.abspath(cacheDir)
+    try:
+      if not os.path.isdir(cacheDir):
+        os.makedirs(cacheDir)
+    except OSError as err:
+      if not os.path.isdir(cacheDir):
+        LOG.warn('Cannot create overlay cache directory, not using it', '%s: %s' % (cacheDir, err))
+        return None
+    if not os.access(cacheDir, os.W_OK):
+      LOG.warn('Overlay cache directory is not writable, not using it', cacheDir)
+      return None
+    return cls(cacheDir, int(float(getValue('MaxSize', 50)) * 1024**3), getValue('Validate', True))
+
+  def entryPath(self, lfn):
+    """Return the path of the cached file for the LFN."""
+    lfnHash = hashlib.md5(lfn.encode('utf-8')).hexdigest()
+    return os.path.join(self.cacheDir, lfnHash[:2], '%s_%s' % (lfnHash, os.path.basename(lfn)))
+
+  def getFile(self, lfn, destDir, download):
+    """Put the file for the LFN into destDir, from the cache if possible.
+
+    :param str lfn: LFN of the file
+    :param str destDir: directory where the file is needed
+    :param download: function without arguments, which downloads the file into destDir, returns S_OK or S_ERROR
+    :returns: S_OK with the path of the file in destDir, or the result of download if it failed
+    """
+    entry = self.entryPath(lfn)
+    localPath = os.path.join(destDir, os.path.basename(lfn))
+    if not os.path.isdir(os.path.dirname(entry)):
+      try:
+        os.makedirs(os.path.dirname(entry))
+      except OSError:
+        pass  # created concurrently
+
+    with lockFile(entry + LOCK_SUFFIX):
+      if os.path.exists(entry):
+        if self._isValid(entry):
+          try:
+            self._link(entry, localPath)
+            os.utime(entry, None)
+            self.hits += 1
+            LOG.info('Using cached overlay file', lfn)
+            return S_OK(localPath)
+          except (OSError, IOError) as err:
+            LOG.warn('Could not use cached overlay file', '%s: %s' % (lfn, err))
+        else:
+          LOG.warn('Removing corrupted overlay file from the cache', lfn)
+          self._remove(entry)
+
+      self.misses += 1
+      res = download()
+      if not res['OK']:
+        return res
+      if not os.path.exists(localPath):
+        return S_ERROR('Downloaded file not found: %s' % localPath)
+      try:
+        self._store(localPath, entry)
+      except (OSError, IOError) as err:
+        LOG.warn('Could not add file to the overlay cache', '%s: %s' % (lfn, err))
+        self._remove(entry)
+
+    self.evict()
+    return S_OK(localPath)
+
+  def evict(self):
+    """Remove the least recently used files until the cache is smaller than the maximum size.
+
+    Files that are still hard linked by a job directory are kept. If another job is already cleaning the cache,
+    nothing is done.
+    """
+    with lockFile(os.path.join(self.cacheDir, CACHE_LOCK), blocking=False) as locked:
+      if not locked:
+        return S_OK(0)
+      entries = []
+      totalSize = 0
+      for dirpath, _dirnames, filenames in os.walk(self.cacheDir):
+        for filename in filenames:
+          if filename.endswith((CHECKSUM_SUFFIX, LOCK_SUFFIX, '.tmp')) or filename == CACHE_LOCK:
+            continue
+          path = os.path.join(dirpath, filename)
+          try:
+            stat = os.stat(path)
+          except OSError:
+            continue
+          totalSize += stat.st_size
+          entries.append((stat.st_mtime, stat.st_nlink, stat.st_size, path))
+
+      removed = 0
+      for _mtime, nlink, size, path in sorted(entries):
+        if totalSize <= self.maxSize:
+          break
+        if nlink > 1:
+          continue
+        with lockFile(path + LOCK_SUFFIX, blocking=False) as entryLocked:
+          if not entryLocked:
+            continue
+          self._remove(path)
+        totalSize -= size
+        removed += 1
+      if removed:
+        LOG.info('Removed %d files from the overlay cache, size is now %d bytes' % (removed, totalSize))
+      return S_OK(removed)
+
+  def _isValid(self, entry):
+    """Check the checksum of the cached file against the one stored when it was added."""
+    try:
+      with open(entry + CHECKSUM_SUFFIX) as checksumFile:
+        storedChecksum = checksumFile.read().strip()
+    except IOError:
+      return False
+    if not self.validate:
+      return True
+    return storedChecksum == str(fileAdler(entry))
+
+  @staticmethod
+  def _link(entry, localPath):
+    """Hard link the cached file to localPath, or copy it if a hard link is not possible.
+
+    Evicting the cached file does not affect the job in either case, a hard link keeps the file alive and is never
+    evicted, a copy is independent of the cache.
+    """
+    if os.path.lexists(localPath):
+      os.remove(localPath)
+    try:
+      os.link(entry, localPath)
+    except OSError:
+      shutil.copy2(entry, localPath)
+
+  @staticmethod
+  def _store(localPath, entry):
+    """Add the downloaded file to the cache, by hard link if possible, otherwise by copying it."""
+    checksum = fileAdler(localPath)
+    if not checksum:
+      raise IOError('Could not calculate the checksum of %s' % localPath)
+    tmpEntry = '%s.%d.tmp' % (entry, os.getpid())
+    try:
+      os.link(localPath, tmpEntry)
+    except OSError:
+      shutil.copy2(localPath, tmpEntry)
+    os.rename(tmpEntry, entry)
+    with open(entry + CHECKSUM_SUFFIX, 'w') as checksumFile:
+      checksumFile.write(str(checksum))
+
+  @staticmethod
+  def _remove(entry):
+    """Remove the cached file and its checksum."""
+    for path in (entry, entry + CHECKSUM_SUFFIX):
+      try:
+        os.remove(path)
+      except OSError:
+        pass
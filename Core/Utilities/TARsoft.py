@@ -11,10 +11,10 @@ __RCSID__ = "$Id$"
 from DIRAC import gLogger, S_OK, S_ERROR
 from ILCDIRAC.Core.Utilities.ResolveDependencies            import resolveDeps
 from ILCDIRAC.Core.Utilities.PrepareLibs                    import removeLibc, getLibsToIgnore
+from ILCDIRAC.Core.Utilities.Concurrency                    import concurrentMap
 from DIRAC.DataManagementSystem.Client.DataManager          import DataManager
 from DIRAC.ConfigurationSystem.Client.Helpers.Operations    import Operations
-from ILCDIRAC.Core.Utilities.WasteCPU                       import wasteCPUCycles
-import os, urllib, tarfile, subprocess, shutil, time
+import errno, os, socket, threading, urllib, tarfile, subprocess, shutil, time
 from tarfile import TarError
 try:                      #FIXME: Deprecated import?
   import hashlib as md5
@@ -23,56 +23,159 @@ except ImportError:
 
 LOG = gLogger.getSubLogger(__name__)
 
+#: size of the blocks read to compute the md5 sums
+HASH_BLOCK_SIZE = 2**20
+#: seconds between updates of the lock file by the installing job
+LOCK_HEARTBEAT = 10
+#: seconds after which a lock that was not updated is considered stale
+LOCK_STALE_AGE = 120
+#: seconds after which a lock without owner, written by older versions, is considered stale
+LEGACY_LOCK_AGE = 30 * 60
+#: seconds between checks of a lock held by another job
+LOCK_POLL_INTERVAL = 5
+#: maximum time in seconds to wait for a lock
+LOCK_MAX_WAIT = 60 * 60
+#: number of attempts to lock an installation that other jobs are locking at the same time
+LOCK_ATTEMPTS = 3
+#: file marking an installation as verified, contains the md5 sum of its md5_checksum.md5 file
+VERIFIED_MARKER = '.md5_verified'
+
+
+def fileMd5(path):
+  """ Return the md5 sum of the file, reading it in blocks
+  """
+  fileHash = md5.md5()
+  with open(path, 'rb') as theFile:
+    for block in iter(lambda: theFile.read(HASH_BLOCK_SIZE), b''):
+      fileHash.update(block)
+  return fileHash.hexdigest()
+
+
+_heartbeats = {}
+_heartbeatsLock = threading.Lock()
+
+
+def _lockOwner():
+  """ Return the owner written into lock files by this process
+  """
+  return '%s %d' % (socket.gethostname(), os.getpid())
+
+def _heartbeat(lockPath, stopEvent):
+  """ Update the modification time of the lock file until stopEvent is set
+  """
+  while not stopEvent.wait(LOCK_HEARTBEAT):
+    try:
+      os.utime(lockPath, None)
+    except OSError as e:
+      # the lock can be missing for a moment while another job checks if it is stale
+      LOG.warn("Failed to update lock", "%s: %s" % (lockPath, str(e)))
 
 def createLock(lockname):
   """ Need to lock the area to prevent 2 jobs to write in the same area
+
+  The lock file is created atomically and contains the host name and process ID of the job. Until the lock is
+  cleared its modification time is updated every LOCK_HEARTBEAT seconds.
+
+  :returns: S_OK(True) if the lock was created, S_OK(False) if another job holds the lock, S_ERROR otherwise
   """
   try:
-    with open(lockname,"w") as lock:
-      lock.write("Locking this directory\n")
-  except IOError as e:
+    lockFd = os.open(lockname, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+  except OSError as e:
+    if e.errno == errno.EEXIST:
+      LOG.info("Lock is held by another job:", lockname)
+      return S_OK(False)
     LOG.error("Failed creating lock")
-    return S_ERROR("Not allowed to write here: IOError %s" % (str(e)))
-  return S_OK()
+    return S_ERROR("Not allowed to write here: OSError %s" % (str(e)))
+  with os.fdopen(lockFd, 'w') as lock:
+    lock.write(_lockOwner() + '\n')
+  lockPath = os.path.abspath(lockname)
+  stopEvent = threading.Event()
+  heartbeat = threading.Thread(target=_heartbeat, args=(lockPath, stopEvent), name='InstallLockHeartbeat')
+  heartbeat.daemon = True
+  with _heartbeatsLock:
+    _heartbeats[lockPath] = stopEvent
+  heartbeat.start()
+  return S_OK(True)
+
+def isStaleLock(lockname):
+  """ Check if the job holding the lock is gone
+
+  A lock is stale if it was not updated for LOCK_STALE_AGE seconds, LEGACY_LOCK_AGE for locks without owner. The
+  owner's process ID is not used: jobs running in containers have their own PID namespace on the same host.
+  """
+  try:
+    lockAge = time.time() - os.stat(lockname).st_mtime
+    with open(lockname) as lock:
+      owner = lock.read().split()
+  except (IOError, OSError):
+    # lock is gone
+    return False
+  if len(owner) != 2 or not owner[1].isdigit():
+    return lockAge > LEGACY_LOCK_AGE
+  return lockAge > LOCK_STALE_AGE
+
+def removeStaleLock(lockname):
+  """ Remove a stale lock, unless another job removed it first
+
+  The lock is renamed to a name unique to this job, so that only one of the jobs waiting for the lock removes it.
+  If the renamed lock is not stale, another job replaced the stale lock in the meantime, and its lock is put back.
+
+  :returns: True if this job removed the stale lock, False otherwise
+  """
+  takenLock = '%s.%s' % (lockname, _lockOwner().replace(' ', '.'))
+  try:
+    os.rename(lockname, takenLock)
+  except OSError as e:
+    LOG.info("Lock was removed by another job:", "%s: %s" % (lockname, str(e)))
+    return False
+  if isStaleLock(takenLock):
+    try:
+      os.unlink(takenLock)
+    except OSError as e:
+      LOG.warn("Failed cleaning stale lock", "%s: %s" % (takenLock, str(e)))
+    return True
+  LOG.info("Lock was replaced by another job, putting it back:", lockname)
+  try:
+    # does not overwrite a lock created in the meantime
+    os.link(takenLock, lockname)
+  except OSError as e:
+    LOG.error("Failed to put back lock", "%s: %s" % (lockname, str(e)))
+  try:
+    os.unlink(takenLock)
+  except OSError as e:
+    LOG.warn("Failed cleaning lock", "%s: %s" % (takenLock, str(e)))
+  return False
 
 def checkLockAge(lockname):
-  """ Check if there is a lock, and in that case deal with it, potentially remove it after n minutes
+  """ Check if there is a lock, and in that case wait until it is gone, or remove it if it is stale
+
+  :returns: S_OK(True) if a stale lock was removed, S_OK(False) if there is no lock, S_ERROR if the lock did not go
+     away after LOCK_MAX_WAIT seconds
   """
   overwrite = False
-  count = 0
-  while True:
-    if not os.path.exists(lockname):
-      break
-    count += 1
-    LOG.warn("Will wait one minute before proceeding")
-    res = wasteCPUCycles(60)
-    if not res['OK']:
-      continue
-    last_touch = time.time()
-    try:
-      stat = os.stat(lockname)
-      last_touch = stat.st_atime
-    except OSError as x:
-      LOG.warn("File not available: %s %s, assume removed" % (OSError, str(x)))
-      break
-    loc_time = time.time()
-    if loc_time-last_touch > 30*60: ##this is where I say the file is too old to still be valid (30 minutes)
-      LOG.info("File is %s seconds old" % str(loc_time - last_touch))
-      overwrite = True
-      res = clearLock(lockname)
-      if res['OK']:
+  start = time.time()
+  while os.path.exists(lockname):
+    if isStaleLock(lockname):
+      LOG.info("Removing stale lock", lockname)
+      if removeStaleLock(lockname):
+        overwrite = True
         break
-    if count > 60: #We have been waiting for 60 minutes, something is wrong, kill it
+    if time.time() - start > LOCK_MAX_WAIT:
       LOG.error("Seems file stat is wrong, assume buggy, will fail installation")
-      #overwrite = True
       res = clearLock(lockname)
       return S_ERROR("Buggy lock, removed: %s" % res['OK'])
-      
+    LOG.verbose("Waiting for lock", lockname)
+    time.sleep(LOCK_POLL_INTERVAL)
+
   return S_OK(overwrite)
-  
+
 def clearLock(lockname):
   """ And we need to clear the lock once the operation is done
   """
+  with _heartbeatsLock:
+    stopEvent = _heartbeats.pop(os.path.abspath(lockname), None)
+  if stopEvent is not None:
+    stopEvent.set()
   try:
     os.unlink(lockname)
   except OSError as e:
@@ -130,8 +233,7 @@ def tarMd5Check(app_tar_base, md5sum ):
   ##Tar ball is obtained, need to check its md5 sum
   tar_ball_md5 = ''
   try:
-    with open(app_tar_base) as myFile:
-      tar_ball_md5 = md5.md5(myFile.read()).hexdigest()
+    tar_ball_md5 = fileMd5(app_tar_base)
   except IOError:
     LOG.warn("Failed to get tar ball md5, try without")
     md5sum = ''
@@ -218,30 +320,37 @@ def install(app, app_tar, tarballURL, overwrite, md5sum, area):
   ###########################################
   ##Handle the locking
   lockname = folder_name+".lock"
-  #Make sure the lock is not too old, or wait until it's gone
-  res = checkLockAge(lockname)
-  if not res['OK']:
-    LOG.error("Something uncool happened with the lock, will kill installation")
-    LOG.error("Message: %s" % res['Message'])
-    return S_ERROR("Failed lock checks")
+  for _attempt in range(LOCK_ATTEMPTS):
+    #Make sure the lock is not too old, or wait until it's gone
+    res = checkLockAge(lockname)
+    if not res['OK']:
+      LOG.error("Something uncool happened with the lock, will kill installation")
+      LOG.error("Message: %s" % res['Message'])
+      return S_ERROR("Failed lock checks")
 
-  if 'Value' in res and res['Value']: #this means the lock file was very old, meaning that the installation failed elsewhere
-    overwrite = True
+    if 'Value' in res and res['Value']: #this means the lock file was very old, meaning that the installation failed elsewhere
+      overwrite = True
 
-  #Check if the application is here and not to be overwritten
-  if os.path.exists(folder_name):
-    appli_exists = True
-    if not overwrite:
-      LOG.info("Folder or file %s found in %s, skipping install !" % (folder_name, area))
-      return S_OK([folder_name, app_tar_base])
-  
-  ## If we are here, it means the application was never installed OR its overwrite flag is true
-    
-  #Now lock the area
-  res = createLock(lockname)##This will fail if not allowed to write here
-  if not res['OK']:
-    LOG.error(res['Message'])
-    return res
+    #Check if the application is here and not to be overwritten
+    if os.path.exists(folder_name):
+      appli_exists = True
+      if not overwrite:
+        LOG.info("Folder or file %s found in %s, skipping install !" % (folder_name, area))
+        return S_OK([folder_name, app_tar_base])
+
+    ## If we are here, it means the application was never installed OR its overwrite flag is true
+
+    #Now lock the area
+    res = createLock(lockname)##This will fail if not allowed to write here
+    if not res['OK']:
+      LOG.error(res['Message'])
+      return res
+    if res['Value'] is not False:
+      break
+    ## Another job locked the area first, wait for it
+  else:
+    LOG.error("Failed to lock the installation area", lockname)
+    return S_ERROR("Failed to lock the installation area")
   
   ## Cleanup old version in case it has to be overwritten (implies it's already here)
   ## In particular the jar file of LCSIM
@@ -348,38 +457,90 @@ def check(app, area, res_from_install):
     #This is the case of LCSIM that's a jar file
     return S_OK([basefolder])
   
-  if os.path.exists(os.path.join(basefolder,'md5_checksum.md5')):
-    with open(os.path.join(basefolder,'md5_checksum.md5'), 'r') as md5file:
-      for line in md5file:
-        line = line.rstrip()
-        md5sum, fin = line.split()
-        if fin=='-' or fin.count("md5_checksum.md5"):
-          continue
-        found_lib_to_ignore = False
-        for lib in getLibsToIgnore():
-          if fin.count(lib):
-            found_lib_to_ignore = True
-        if found_lib_to_ignore:
-          continue
-        fin = os.path.join(basefolder, fin.replace("./",""))
-        if not os.path.exists(fin):
-          LOG.error("File missing :", fin)
-          return S_ERROR("Incomplete install: The file %s is missing" % fin)
-        fmd5 = ''
-        try:
-          fmd5 = md5.md5(open(fin).read()).hexdigest()
-        except IOError:
-          LOG.error("Failed to compute md5 sum")
-          return S_ERROR("Failed to compute md5 sum")
-        if md5sum != fmd5:
-          LOG.error("File has wrong checksum :", fin)
-          LOG.error("Found %s, expected %s" % (fmd5, md5sum))
-          return S_ERROR("Corrupted install: File %s has a wrong sum" % fin)
-  else:
+  md5File = os.path.join(basefolder, 'md5_checksum.md5')
+  if not os.path.exists(md5File):
     LOG.warn("The application does not come with md5 checksum file:", app)
-  
+    return S_OK([basefolder])
+
+  try:
+    verifiedKey = fileMd5(md5File)
+  except IOError:
+    LOG.error("Failed to compute md5 sum")
+    return S_ERROR("Failed to compute md5 sum")
+  if isVerified(basefolder, verifiedKey):
+    LOG.info("Installation was already verified:", basefolder)
+    return S_OK([basefolder])
+
+  filesToCheck = []
+  with open(md5File, 'r') as md5file:
+    for line in md5file:
+      line = line.rstrip()
+      md5sum, fin = line.split()
+      if fin=='-' or fin.count("md5_checksum.md5"):
+        continue
+      found_lib_to_ignore = False
+      for lib in getLibsToIgnore():
+        if fin.count(lib):
+          found_lib_to_ignore = True
+      if found_lib_to_ignore:
+        continue
+      fin = os.path.join(basefolder, fin.replace("./",""))
+      if not os.path.exists(fin):
+        LOG.error("File missing :", fin)
+        return S_ERROR("Incomplete install: The file %s is missing" % fin)
+      filesToCheck.append((fin, md5sum))
+
+  res = checkFileSums(filesToCheck)
+  if not res['OK']:
+    return res
+  setVerified(basefolder, verifiedKey)
   return S_OK([basefolder])
 
+def _fileMd5OrNone(path):
+  """ Return the md5 sum of the file, or None if it cannot be read
+  """
+  try:
+    return fileMd5(path)
+  except IOError as err:
+    LOG.error("Failed to read file:", "%s: %s" % (path, err))
+    return None
+
+def checkFileSums(filesToCheck):
+  """ Compare the md5 sums of the files to the expected ones, computing several sums at the same time
+
+  :param list filesToCheck: list of tuples of path and expected md5 sum
+  """
+  fileSums = concurrentMap(_fileMd5OrNone, [fin for fin, _ in filesToCheck])
+  for (fin, md5sum), fmd5 in zip(filesToCheck, fileSums):
+    if fmd5 is None:
+      LOG.error("Failed to compute md5 sum")
+      fileSums.close()
+      return S_ERROR("Failed to compute md5 sum")
+    if md5sum != fmd5:
+      LOG.error("File has wrong checksum :", fin)
+      LOG.error("Found %s, expected %s" % (fmd5, md5sum))
+      fileSums.close()
+      return S_ERROR("Corrupted install: File %s has a wrong sum" % fin)
+  return S_OK()
+
+def isVerified(basefolder, verifiedKey):
+  """ Check if the installation was already verified with the same md5_checksum.md5 file
+  """
+  try:
+    with open(os.path.join(basefolder, VERIFIED_MARKER)) as marker:
+      return marker.read().strip() == verifiedKey
+  except IOError:
+    return False
+
+def setVerified(basefolder, verifiedKey):
+  """ Mark the installation as verified, so other jobs do not have to compute the md5 sums again
+  """
+  try:
+    with open(os.path.join(basefolder, VERIFIED_MARKER), 'w') as marker:
+      marker.write(verifiedKey)
+  except IOError as err:
+    LOG.verbose("Cannot mark installation as verified:", "%s: %s" % (basefolder, err))
+
 def configure(app, area, res_from_check):
   """ Configure our applications: set the proper env variables
   """
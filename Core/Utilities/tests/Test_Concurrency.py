@@ -0,0 +1,95 @@
+'''
+
+tests for the Concurrency module
+
+'''
+
+import threading
+import time
+import unittest
+
+from mock import patch
+
+from ILCDIRAC.Core.Utilities import Concurrency as module
+
+__RCSID__ = "$Id$"
+
+
+class TestConcurrentMap(unittest.TestCase):
+  """Test the concurrent calls"""
+
+  def setUp(self):
+    self.threadsPatch = patch('%s._threads' % module.__name__, new=threading.BoundedSemaphore(4))
+    self.threads = self.threadsPatch.start()
+    self.lock = threading.Lock()
+    self.running = 0
+    self.maxRunning = 0
+
+  def tearDown(self):
+    self.threadsPatch.stop()
+
+  def call(self, item):
+    """count the calls running at the same time"""
+    with self.lock:
+      self.running += 1
+      self.maxRunning = max(self.maxRunning, self.running)
+    time.sleep(0.01)
+    with self.lock:
+      self.running -= 1
+    return item * 2
+
+  def assertThreadsReleased(self):
+    """all threads can be reserved again"""
+    self.assertEqual(module._reserveThreads(5), 4)  # pylint: disable=protected-access
+    module._releaseThreads(4)  # pylint: disable=protected-access
+
+  def test_ordered(self):
+    """the results are in the order of the items"""
+    self.assertEqual(list(module.concurrentMap(self.call, range(10), workers=3)), [2 * item for item in range(10)])
+    self.assertIn(self.maxRunning, (2, 3))
+    self.assertThreadsReleased()
+
+  def test_unordered(self):
+    """all results are returned"""
+    self.assertEqual(sorted(module.concurrentMap(self.call, range(10), unordered=True)),
+                     [2 * item for item in range(10)])
+    self.assertIn(self.maxRunning, (2, 3, 4))
+    self.assertThreadsReleased()
+
+  def test_sequential(self):
+    """single workers and single items are called in the calling thread"""
+    threads = set()
+
+    def callerThread(item):
+      """remember the thread making the call"""
+      threads.add(threading.current_thread())
+      return item
+    self.assertEqual(list(module.concurrentMap(callerThread, range(5), workers=1)), list(range(5)))
+    self.assertEqual(list(module.concurrentMap(callerThread, [7])), [7])
+    self.assertEqual(list(module.concurrentMap(callerThread, [])), [])
+    self.assertEqual(threads, set([threading.current_thread()]))
+
+  def test_nested(self):
+    """nested calls share the threads of the process"""
+    def outer(item):
+      """make concurrent calls from a concurrent call"""
+      return sum(module.concurrentMap(self.call, range(item, item + 4)))
+    self.assertEqual(list(module.concurrentMap(outer, range(3))), [12, 20, 28])
+    self.assertLessEqual(self.maxRunning, 4)
+    self.assertThreadsReleased()
+
+  def test_stopped(self):
+    """the threads are released if the iteration is stopped or a call fails"""
+    results = module.concurrentMap(self.call, range(10))
+    self.assertEqual(next(results), 0)
+    results.close()
+    self.assertThreadsReleased()
+
+    def failing(item):
+      """fail for one item"""
+      if item == 3:
+        raise ValueError('bad item')
+      return item
+    with self.assertRaises(ValueError):
+      list(module.concurrentMap(failing, range(10)))
+    self.assertThreadsReleased()
@@ -0,0 +1,78 @@
+'''
+
+tests for the FileChecksum module
+
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+import zlib
+
+from mock import patch, MagicMock as Mock
+
+from ILCDIRAC.Core.Utilities import FileChecksum as module
+
+__RCSID__ = "$Id$"
+
+
+def adler(path):
+  """calculate the checksum like DIRAC would"""
+  with open(path, 'rb') as theFile:
+    return '%08x' % (zlib.adler32(theFile.read()) & 0xffffffff)
+
+
+class TestFileChecksum(unittest.TestCase):
+  """Test the cached checksum calculation"""
+
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.paths = []
+    for index in range(5):
+      self.paths.append(os.path.join(self.tmpdir, 'file%d.slcio' % index))
+      with open(self.paths[-1], 'w') as outFile:
+        outFile.write('events %d' % index * (index + 1))
+    module.clearChecksumCache()
+    self.adlerMock = Mock(side_effect=adler)
+    self.adlerPatch = patch('%s.fileAdler' % module.__name__, new=self.adlerMock)
+    self.adlerPatch.start()
+
+  def tearDown(self):
+    self.adlerPatch.stop()
+    module.clearChecksumCache()
+    shutil.rmtree(self.tmpdir)
+
+  def test_getChecksum(self):
+    """calculate the checksum only once"""
+    self.assertEqual(module.getChecksum(self.paths[0]), adler(self.paths[0]))
+    self.assertEqual(module.getChecksum(self.paths[0]), adler(self.paths[0]))
+    self.assertEqual(self.adlerMock.call_count, 1)
+
+  def test_getChecksum_changed(self):
+    """calculate the checksum again when the file changed"""
+    module.getChecksum(self.paths[0])
+    with open(self.paths[0], 'a') as outFile:
+      outFile.write('more events')
+    self.assertEqual(module.getChecksum(self.paths[0]), adler(self.paths[0]))
+    self.assertEqual(self.adlerMock.call_count, 2)
+
+  def test_getChecksum_fails(self):
+    """do not keep failed checksums, missing files have no checksum"""
+    self.adlerMock.side_effect = None
+    self.adlerMock.return_value = False
+    self.assertFalse(module.getChecksum(self.paths[0]))
+    self.assertFalse(module.getChecksum(self.paths[0]))
+    self.assertEqual(self.adlerMock.call_count, 2)
+    self.assertFalse(module.getChecksum(os.path.join(self.tmpdir, 'missing')))
+    self.assertEqual(self.adlerMock.call_count, 2)
+
+  def test_getChecksums(self):
+    """calculate the checksums of all files concurrently, reusing known checksums"""
+    module.getChecksum(self.paths[1])
+    checksums = module.getChecksums(self.paths, workers=3)
+    self.assertEqual(checksums, dict((path, adler(path)) for path in self.paths))
+    self.assertEqual(self.adlerMock.call_count, len(self.paths))
+    self.assertEqual(module.getChecksums(self.paths[:1], workers=3), {self.paths[0]: adler(self.paths[0])})
+    self.assertEqual(module.getChecksums([]), {})
+    self.assertEqual(self.adlerMock.call_count, len(self.paths))
@@ -0,0 +1,101 @@
+'''
+
+tests for the MetadataFields module
+
+'''
+
+import unittest
+
+from mock import patch, MagicMock as Mock
+
+from DIRAC import S_OK, S_ERROR
+
+from ILCDIRAC.Core.Utilities import MetadataFields as module
+
+__RCSID__ = "$Id$"
+
+FIELDS = {'DirectoryMetaFields': {'ProdID': 'INT', 'EvtType': 'VARCHAR(128)', 'Energy': 'VARCHAR(128)'},
+          'FileMetaFields': {'RunNumber': 'INT', 'Energy': 'FLOAT'}}
+
+
+def catalogMock(serverURL=None):
+  """return a mocked catalog client"""
+  catalog = Mock(name='FileCatalogClient')
+  catalog.serverURL = serverURL
+  catalog.getMetadataFields.return_value = S_OK(FIELDS)
+  return catalog
+
+
+class TestMetadataFields(unittest.TestCase):
+  """Test the cached metadata fields"""
+
+  def setUp(self):
+    module.clearMetadataFieldsCache()
+
+  def tearDown(self):
+    module.clearMetadataFieldsCache()
+
+  def test_cached(self):
+    """the fields are obtained once per catalog"""
+    catalog = catalogMock()
+    for _ in range(3):
+      res = module.getMetadataFields(catalog)
+      self.assertTrue(res['OK'])
+      self.assertEqual(res['Value'].directoryFields, FIELDS['DirectoryMetaFields'])
+    self.assertEqual(catalog.getMetadataFields.call_count, 1)
+
+    otherCatalog = catalogMock()
+    self.assertTrue(module.getMetadataFields(otherCatalog)['OK'])
+    self.assertEqual(otherCatalog.getMetadataFields.call_count, 1)
+
+  def test_shared_service(self):
+    """clients of the same service share the fields"""
+    catalog = catalogMock('dips://some.host:9197/DataManagement/FileCatalog')
+    otherCatalog = catalogMock('dips://some.host:9197/DataManagement/FileCatalog')
+    self.assertTrue(module.getMetadataFields(catalog)['OK'])
+    self.assertTrue(module.getMetadataFields(otherCatalog)['OK'])
+    self.assertEqual(catalog.getMetadataFields.call_count, 1)
+    self.assertEqual(otherCatalog.getMetadataFields.call_count, 0)
+
+  def test_expired(self):
+    """the fields are obtained again after METADATA_FIELDS_TTL"""
+    catalog = catalogMock()
+    with patch('%s.time.time' % module.__name__, new=Mock(side_effect=[1000, 1100, 5000, 5000])):
+      for _ in range(3):
+        self.assertTrue(module.getMetadataFields(catalog)['OK'])
+    self.assertEqual(catalog.getMetadataFields.call_count, 2)
+
+  def test_failures(self):
+    """failures and empty fields are not kept"""
+    catalog = catalogMock()
+    catalog.getMetadataFields.return_value = S_ERROR('No connection')
+    res = module.getMetadataFields(catalog)
+    self.assertFalse(res['OK'])
+    self.assertEqual(res['Message'], 'No connection')
+    catalog.getMetadataFields.return_value = S_OK({})
+    res = module.getMetadataFields(catalog)
+    self.assertFalse(res['OK'])
+    self.assertEqual(res['Message'], 'No metadata fields available')
+    catalog.getMetadataFields.return_value = S_OK(FIELDS)
+    self.assertTrue(module.getMetadataFields(catalog)['OK'])
+    self.assertTrue(module.getMetadataFields(catalog)['OK'])
+    self.assertEqual(catalog.getMetadataFields.call_count, 3)
+
+  def test_fieldNames(self):
+    """the names are found ignoring the case"""
+    fields = module.MetadataFields(FIELDS)
+    self.assertEqual(fields.getFieldName('ProdID'), 'ProdID')
+    self.assertEqual(fields.getFieldName('prodid'), 'ProdID')
+    self.assertEqual(fields.getFieldName('EVTTYPE'), 'EvtType')
+    self.assertIsNone(fields.getFieldName('Detector'))
+    self.assertIsNone(fields.getFieldName('runnumber'))
+    self.assertEqual(fields.getFieldName('runnumber', includeFileFields=True), 'RunNumber')
+    self.assertEqual(sorted(fields.getFieldNames()), ['Energy', 'EvtType', 'ProdID'])
+    self.assertEqual(sorted(fields.getFieldNames(includeFileFields=True)),
+                     ['Energy', 'Energy', 'EvtType', 'ProdID', 'RunNumber'])
+
+  def test_types(self):
+    """directory fields take precedence over file fields"""
+    types = module.MetadataFields(FIELDS).getTypes()
+    self.assertEqual(types, {'ProdID': 'INT', 'EvtType': 'VARCHAR(128)', 'Energy': 'VARCHAR(128)', 'RunNumber': 'INT'})
+    self.assertEqual(module.MetadataFields({'DirectoryMetaFields': {'ProdID': 'INT'}}).getTypes(), {'ProdID': 'INT'})
@@ -0,0 +1,137 @@
+'''
+
+tests for the OverlayFileCache module
+
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+import zlib
+
+from mock import patch, MagicMock as Mock
+
+from DIRAC import S_OK, S_ERROR
+
+from ILCDIRAC.Core.Utilities import OverlayFileCache as module
+from ILCDIRAC.Tests.Utilities.GeneralUtils import assertDiracSucceedsWith_equals, assertDiracFailsWith
+
+__RCSID__ = "$Id$"
+
+
+def adler(path):
+  """calculate the checksum like DIRAC would"""
+  with open(path, 'rb') as theFile:
+    return '%08x' % (zlib.adler32(theFile.read()) & 0xffffffff)
+
+
+class TestOverlayFileCache(unittest.TestCase):
+  """Test the node local overlay file cache"""
+
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.cacheDir = os.path.join(self.tmpdir, 'cache')
+    os.mkdir(self.cacheDir)
+    self.jobDirs = []
+    for index in range(3):
+      self.jobDirs.append(os.path.join(self.tmpdir, 'job%d' % index))
+      os.mkdir(self.jobDirs[-1])
+    self.cache = module.OverlayFileCache(self.cacheDir, 1000)
+    self.adlerPatch = patch('%s.fileAdler' % module.__name__, new=Mock(side_effect=adler))
+    self.adlerPatch.start()
+
+  def tearDown(self):
+    self.adlerPatch.stop()
+    shutil.rmtree(self.tmpdir)
+
+  @staticmethod
+  def downloader(destDir, lfn, content='overlay events'):
+    """return a download function, writing content to the basename of the lfn in destDir"""
+    download = Mock()
+
+    def writeFile():
+      """write the file"""
+      with open(os.path.join(destDir, os.path.basename(lfn)), 'w') as theFile:
+        theFile.write(content)
+      return S_OK()
+    download.side_effect = writeFile
+    return download
+
+  def test_miss_then_hit(self):
+    lfn = '/ilc/prod/overlay/file1.slcio'
+    download = self.downloader(self.jobDirs[0], lfn)
+    assertDiracSucceedsWith_equals(self.cache.getFile(lfn, self.jobDirs[0], download),
+                                   os.path.join(self.jobDirs[0], 'file1.slcio'), self)
+    self.assertEqual(download.call_count, 1)
+    self.assertTrue(os.path.exists(self.cache.entryPath(lfn)))
+
+    secondDownload = self.downloader(self.jobDirs[1], lfn)
+    localPath = os.path.join(self.jobDirs[1], 'file1.slcio')
+    assertDiracSucceedsWith_equals(self.cache.getFile(lfn, self.jobDirs[1], secondDownload), localPath, self)
+    secondDownload.assert_not_called()
+    with open(localPath) as theFile:
+      self.assertEqual(theFile.read(), 'overlay events')
+    self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+  def test_corrupted_entry(self):
+    lfn = '/ilc/prod/overlay/file1.slcio'
+    self.cache.getFile(lfn, self.jobDirs[0], self.downloader(self.jobDirs[0], lfn))
+    shutil.rmtree(self.jobDirs[0])  # drop the hard link so the entry can be changed in place
+    with open(self.cache.entryPath(lfn), 'w') as theFile:
+      theFile.write('garbage')
+    download = self.downloader(self.jobDirs[1], lfn)
+    assertDiracSucceedsWith_equals(self.cache.getFile(lfn, self.jobDirs[1], download),
+                                   os.path.join(self.jobDirs[1], 'file1.slcio'), self)
+    self.assertEqual(download.call_count, 1)
+    with open(self.cache.entryPath(lfn)) as theFile:
+      self.assertEqual(theFile.read(), 'overlay events')
+
+  def test_download_fails(self):
+    lfn = '/ilc/prod/overlay/file1.slcio'
+    assertDiracFailsWith(self.cache.getFile(lfn, self.jobDirs[0], Mock(return_value=S_ERROR('no replica'))),
+                         'no replica', self)
+    self.assertFalse(os.path.exists(self.cache.entryPath(lfn)))
+    assertDiracFailsWith(self.cache.getFile(lfn, self.jobDirs[0], Mock(return_value=S_OK())),
+                         'downloaded file not found', self)
+
+  def test_evict(self):
+    lfns = ['/ilc/prod/overlay/file%d.slcio' % index for index in range(4)]
+    for index, lfn in enumerate(lfns):
+      self.cache.getFile(lfn, self.jobDirs[0], self.downloader(self.jobDirs[0], lfn, 'x' * 400))
+      os.utime(self.cache.entryPath(lfn), (1000 + index, 1000 + index))
+    # job0 still holds all files, nothing can be removed
+    self.assertEqual(self.cache.evict()['Value'], 0)
+    shutil.rmtree(self.jobDirs[0])
+    self.assertEqual(self.cache.evict()['Value'], 2)
+    self.assertEqual([os.path.exists(self.cache.entryPath(lfn)) for lfn in lfns], [False, False, True, True])
+
+  def test_other_filesystem(self):
+    """the cached file is copied if it cannot be hard linked, so that evicting it does not affect the job"""
+    lfn = '/ilc/prod/overlay/file1.slcio'
+    self.cache.getFile(lfn, self.jobDirs[0], self.downloader(self.jobDirs[0], lfn, 'x' * 600))
+    shutil.rmtree(self.jobDirs[0])
+    localPath = os.path.join(self.jobDirs[1], 'file1.slcio')
+    with patch('%s.os.link' % module.__name__, new=Mock(side_effect=OSError('Invalid cross-device link'))):
+      assertDiracSucceedsWith_equals(self.cache.getFile(lfn, self.jobDirs[1], Mock()), localPath, self)
+    self.assertFalse(os.path.islink(localPath))
+    self.cache.maxSize = 100
+    self.assertEqual(self.cache.evict()['Value'], 1)
+    self.assertFalse(os.path.exists(self.cache.entryPath(lfn)))
+    with open(localPath) as theFile:
+      self.assertEqual(theFile.read(), 'x' * 600)
+
+  def test_fromConfig(self):
+    ops = Mock()
+    ops.getValue.side_effect = lambda key, default: {'/Overlay/Cache/Directory': os.path.join(self.tmpdir, 'new'),
+                                                     '/Overlay/Sites/Site2/Cache/Directory': '',
+                                                     '/Overlay/Cache/MaxSize': 2}.get(key, default)
+    cache = module.OverlayFileCache.fromConfig(ops, 'Site1')
+    self.assertEqual(cache.cacheDir, os.path.join(self.tmpdir, 'new'))
+    self.assertEqual(cache.maxSize, 2 * 1024**3)
+    self.assertTrue(os.path.isdir(cache.cacheDir))
+    self.assertIsNone(module.OverlayFileCache.fromConfig(ops, 'Site2'))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -1,15 +1,18 @@
 #!/usr/bin/env python
 """Test the TAR Software class"""
 
+import hashlib
+import shutil
+import tempfile
+import time
 import unittest
 import os
 import sys
-from mock import mock_open, patch, MagicMock as Mock
+from mock import patch, MagicMock as Mock
 
 from DIRAC import S_OK, S_ERROR
 from ILCDIRAC.Tests.Utilities.GeneralUtils import assertEqualsImproved, assertDiracFailsWith, \
   assertDiracSucceeds, assertDiracSucceedsWith_equals, assertMockCalls
-from ILCDIRAC.Tests.Utilities.FileUtils import FileUtil
 
 __RCSID__ = "$Id$"
 
@@ -25,8 +28,10 @@ class TestTARsoft( unittest.TestCase ): #pylint: disable=too-many-public-methods
     sys.modules['DIRAC.DataManagementSystem.Client.DataManager'] = dataman_import_mock
     global dataman_mock
     dataman_mock = Mock()
+    self.tmpdir = tempfile.mkdtemp()
 
   def tearDown( self ):
+    shutil.rmtree( self.tmpdir )
     if self.dm_backup != -1:
       sys.modules['DIRAC.DataManagementSystem.Client.DataManager'] = self.dm_backup
     else:
@@ -57,26 +62,49 @@ class TestTARsoft( unittest.TestCase ): #pylint: disable=too-many-public-methods
     builtins.__import__ = backup_import
 
   def test_createlock( self ):
+    from ILCDIRAC.Core.Utilities.TARsoft import createLock, clearLock
+    import socket
+    lockname = os.path.join( self.tmpdir, 'testfile.lock' )
+    with patch('%s.LOCK_HEARTBEAT' % MODULE_NAME, new=0.01):
+      assertDiracSucceedsWith_equals( createLock( lockname ), True, self )
+      assertDiracSucceedsWith_equals( createLock( lockname ), False, self )
+      with open( lockname ) as lock:
+        self.assertEqual( lock.read(), '%s %d\n' % ( socket.gethostname(), os.getpid() ) )
+      os.utime( lockname, ( 0, 0 ) )
+      for _ in range( 100 ):
+        if os.stat( lockname ).st_mtime:
+          break
+        time.sleep( 0.01 )
+      self.assertTrue( os.stat( lockname ).st_mtime ) # updated by the heartbeat
+      assertDiracSucceeds( clearLock( lockname ), self )
+    self.assertFalse( os.path.exists( lockname ) )
+
+  def test_createlock_oserr( self ):
     from ILCDIRAC.Core.Utilities.TARsoft import createLock
-    file_contents = [[]]
-    handles = FileUtil.getMultipleReadHandles( file_contents )
-    with patch('%s.open' % MODULE_NAME, mock_open(), create=True) as mo:
-      mo.side_effect = ( h for h in handles )
-      assertDiracSucceeds( createLock( 'testfile.py' ), self )
-      mo.assert_called_once_with( 'testfile.py', 'w' )
-      expected = [ [ 'Locking this directory\n' ] ]
-      self.assertEquals(len(file_contents), len(expected))
-      for (index, handle) in enumerate(handles):
-        cur_handle = handle.__enter__()
-        self.assertEquals(len(expected[index]), handle.__enter__.return_value.write.call_count)
-        for entry in expected[index]:
-          cur_handle.write.assert_any_call(entry)
-
-  def test_createlock_ioerr( self ):
-    from ILCDIRAC.Core.Utilities.TARsoft import createLock
-    with patch('%s.open' % MODULE_NAME, new=Mock(side_effect=IOError('some_test_open_error')), create=True):
+    with patch('%s.os.open' % MODULE_NAME, new=Mock(side_effect=OSError(13, 'some_test_open_error'))):
       assertDiracFailsWith( createLock('myfile.txt'),
-                            'not allowed to write here: ioerror some_test_open_error', self )
+                            'not allowed to write here: oserror', self )
+
+  def test_is_stale_lock( self ):
+    from ILCDIRAC.Core.Utilities.TARsoft import isStaleLock
+    import socket
+    lockname = os.path.join( self.tmpdir, 'app.lock' )
+    self.assertFalse( isStaleLock( lockname ) )
+    with open( lockname, 'w' ) as lock:
+      lock.write( '%s %d\n' % ( socket.gethostname(), os.getpid() ) )
+    self.assertFalse( isStaleLock( lockname ) )
+    os.utime( lockname, ( time.time() - 121, time.time() - 121 ) )
+    self.assertTrue( isStaleLock( lockname ) )
+    with open( lockname, 'w' ) as lock:
+      lock.write( '%s %d\n' % ( socket.gethostname(), 123456 ) )
+    # only the age counts, the process of the owner can be in another PID namespace
+    self.assertFalse( isStaleLock( lockname ) )
+    with open( lockname, 'w' ) as lock:
+      lock.write( 'Locking this directory\n' )
+    os.utime( lockname, ( time.time() - 1000, time.time() - 1000 ) )
+    self.assertFalse( isStaleLock( lockname ) )
+    os.utime( lockname, ( time.time() - 1801, time.time() - 1801 ) )
+    self.assertTrue( isStaleLock( lockname ) )
 
   def test_check_lock_age_no_lock( self ):
     from ILCDIRAC.Core.Utilities.TARsoft import checkLockAge
@@ -84,34 +112,52 @@ class TestTARsoft( unittest.TestCase ): #pylint: disable=too-many-public-methods
       result = checkLockAge( 'mylockfile.txt' )
       assertDiracSucceedsWith_equals( result, False, self )
 
-  def test_check_lock_age_stat_fails( self ):
+  def test_check_lock_age_wait( self ):
     from ILCDIRAC.Core.Utilities.TARsoft import checkLockAge
-    with patch('%s.os.path.exists' % MODULE_NAME, new=Mock(return_value=True)), \
-         patch('%s.os.stat' % MODULE_NAME, new=Mock(side_effect=OSError('some_test_stat_error'))), \
-         patch('%s.wasteCPUCycles' % MODULE_NAME, new=Mock(return_value=S_OK())):
+    with patch('%s.os.path.exists' % MODULE_NAME, new=Mock(side_effect=[True, True, False])), \
+         patch('%s.isStaleLock' % MODULE_NAME, new=Mock(return_value=False)), \
+         patch('%s.time.sleep' % MODULE_NAME) as sleep_mock:
       result = checkLockAge( 'mylockfile.txt' )
       assertDiracSucceedsWith_equals( result, False, self )
+      self.assertEqual( sleep_mock.call_count, 2 )
 
   def test_check_lock_age_clear_lock_success( self ):
-    import time
     from ILCDIRAC.Core.Utilities.TARsoft import checkLockAge
-    stat_mock = Mock()
-    stat_mock.st_atime = time.time() - 1801 # lastTouch old enough
     with patch('%s.os.path.exists' % MODULE_NAME, new=Mock(return_value=True)), \
-         patch('%s.os.stat' % MODULE_NAME, new=Mock(return_value=stat_mock)), \
-         patch('%s.wasteCPUCycles' % MODULE_NAME, new=Mock(side_effect=[S_ERROR(), S_OK(), S_OK()])), \
-         patch('%s.clearLock' % MODULE_NAME, new=Mock(side_effect=[S_ERROR(), S_OK(True)])):
+         patch('%s.isStaleLock' % MODULE_NAME, new=Mock(side_effect=[False, True, True])), \
+         patch('%s.time.sleep' % MODULE_NAME), \
+         patch('%s.removeStaleLock' % MODULE_NAME, new=Mock(side_effect=[False, True])) as remove_mock:
       result = checkLockAge( 'mylockfile.txt' )
       assertDiracSucceedsWith_equals( result, True, self )
+      self.assertEqual( remove_mock.call_count, 2 )
+
+  def test_remove_stale_lock( self ):
+    from ILCDIRAC.Core.Utilities.TARsoft import removeStaleLock
+    lockname = os.path.join( self.tmpdir, 'app.lock' )
+    self.assertFalse( removeStaleLock( lockname ) )
+    with open( lockname, 'w' ) as lock:
+      lock.write( 'otherhost 123\n' )
+    os.utime( lockname, ( time.time() - 121, time.time() - 121 ) )
+    self.assertTrue( removeStaleLock( lockname ) )
+    self.assertEqual( os.listdir( self.tmpdir ), [] )
+
+  def test_remove_stale_lock_replaced( self ):
+    from ILCDIRAC.Core.Utilities.TARsoft import removeStaleLock
+    lockname = os.path.join( self.tmpdir, 'app.lock' )
+    # another job removed the stale lock and created its own before we renamed it
+    with open( lockname, 'w' ) as lock:
+      lock.write( 'otherhost 123\n' )
+    self.assertFalse( removeStaleLock( lockname ) )
+    self.assertEqual( os.listdir( self.tmpdir ), [ 'app.lock' ] )
+    with open( lockname ) as lock:
+      self.assertEqual( lock.read(), 'otherhost 123\n' )
 
   def test_check_lock_age_timeout( self ):
-    import time
     from ILCDIRAC.Core.Utilities.TARsoft import checkLockAge
-    stat_mock = Mock()
-    stat_mock.st_atime = time.time()
     with patch('%s.os.path.exists' % MODULE_NAME, new=Mock(return_value=True)), \
-         patch('%s.os.stat' % MODULE_NAME, new=Mock(return_value=stat_mock)), \
-         patch('%s.wasteCPUCycles' % MODULE_NAME, new=Mock(return_value=S_OK())), \
+         patch('%s.isStaleLock' % MODULE_NAME, new=Mock(return_value=False)), \
+         patch('%s.time.sleep' % MODULE_NAME), \
+         patch('%s.time.time' % MODULE_NAME, new=Mock(side_effect=[0, 10, 3601])), \
          patch('%s.clearLock' % MODULE_NAME, new=Mock(return_value=S_OK(True))):
       result = checkLockAge( 'mylockfile.txt' )
       assertDiracFailsWith( result, 'buggy lock, removed: True', self )
@@ -216,14 +262,10 @@ class TestTARsoft( unittest.TestCase ): #pylint: disable=too-many-public-methods
 
   def test_md5_check( self ):
     from ILCDIRAC.Core.Utilities.TARsoft import tarMd5Check
-    file_contents = [ ['849utj429foemfi84j92fno;(*ME(FOJN$EO&*R#BNOFMN(OJIm'] ]
+    tarball = self.makeFile( 'tarball.tgz', '849utj429foemfi84j92fno;(*ME(FOJN$EO&*R#BNOFMN(OJIm' )
     expected_hash = 'dab9783374461a26e100164747e84e63' # Precalculated
-    handles = FileUtil.getMultipleReadHandles( file_contents )
-    with patch('%s.open' % MODULE_NAME, mock_open(), create=True) as mo:
-      mo.side_effect = (h for h in handles)
-      result = tarMd5Check( '/my/app/tarball.tgz', expected_hash )
-      mo.assert_called_once_with( '/my/app/tarball.tgz' )
-      assertDiracSucceeds( result, self )
+    with patch('%s.HASH_BLOCK_SIZE' % MODULE_NAME, new=7):
+      assertDiracSucceeds( tarMd5Check( tarball, expected_hash ), self )
 
   def test_md5_check_io_err( self ):
     from ILCDIRAC.Core.Utilities.TARsoft import tarMd5Check
@@ -235,15 +277,9 @@ class TestTARsoft( unittest.TestCase ): #pylint: disable=too-many-public-methods
 
   def test_md5_check_hash_wrong( self ):
     from ILCDIRAC.Core.Utilities.TARsoft import tarMd5Check
-    file_contents = [ [ '2984jt4gomrfg8924jgnm', '1938jhfo9coiemc0m90pn@O*E&HQRF(*IONU)',
-                        ')(DCIFUJE*FIUEqf9oi1mnf)' ] ]
+    tarball = self.makeFile( 'tarball.tgz', '2984jt4gomrfg8924jgnm\n1938jhfo9coiemc0m90pn@O*E&HQRF(*IONU)' )
     expected_hash = '0981u3jr9831rkjopk,f90381'
-    handles = FileUtil.getMultipleReadHandles( file_contents )
-    with patch('%s.open' % MODULE_NAME, mock_open(), create=True) as mo:
-      mo.side_effect = (h for h in handles)
-      result = tarMd5Check( '/my/app/tarball.tgz', expected_hash )
-      mo.assert_called_once_with( '/my/app/tarball.tgz' )
-      assertDiracFailsWith( result, 'hash does not correspond', self )
+    assertDiracFailsWith( tarMd5Check( tarball, expected_hash ), 'hash does not correspond', self )
 
   def test_install_deps( self ):
     from ILCDIRAC.Core.Utilities.TARsoft import installDependencies
@@ -333,42 +369,54 @@ class TestTARsoft( unittest.TestCase ): #pylint: disable=too-many-public-methods
       result = getTarBallLocation( ('complicated_app', 'v201'), 'config', 'dummy_area' )
       assertDiracFailsWith( result, 'could not find tarballurl in cs', self )
 
+  def makeFile( self, name, content ):
+    """ create a file in the temporary directory and return its path """
+    path = os.path.join( self.tmpdir, name )
+    if not os.path.isdir( os.path.dirname( path ) ):
+      os.makedirs( os.path.dirname( path ) )
+    with open( path, 'w' ) as newFile:
+      newFile.write( content )
+    return path
+
+  def makeInstallation( self, checksums=None ):
+    """ create an installed application with a md5_checksum.md5 file, return its folder """
+    files = { 'appfile1.txt' : 'appfile1r0984u3jriumfilf42890tjr742tu',
+              'appfile2.ppt' : 'appfile29031i4rt498jnyfouf908j248f4298fn24iuyf',
+              'myapp/importantfile.bin' : 'importf90ui4j9rf41f09j14fiun41 fp1,cmic13',
+              'otherdir/main.py' : 'MAIN()@KJR(*@KRE)+@MOUFRIN@FR*YB^ B* @HE)J @E( HG!V!UYNEJ)(!))))' }
+    lines = [ 'HelloWorld -', 'mychecksum md5_checksum.md5' ]
+    for name, content in sorted( files.items() ):
+      self.makeFile( os.path.join( 'app', name ), content )
+      lines.append( '%s ./%s' % ( ( checksums or {} ).get( name, hashlib.md5( content.encode() ).hexdigest() ),
+                                  name ) )
+    lines.extend( [ 'abc libstdc++.so', 'def myapp/libgcc_s.so.1', 'ignoreme ./other_dir/libc-2.5' ] )
+    self.makeFile( 'app/md5_checksum.md5', '\n'.join( lines ) + '\n' )
+    return os.path.join( self.tmpdir, 'app' )
+
   def test_check( self ):
     from ILCDIRAC.Core.Utilities.TARsoft import check
-    # Different treatment of with open() and open().read().....
-    file_contents = [ [ 'HelloWorld -', 'mychecksum md5_checksum.md5',
-                        'ef7493baf5582b41cd4fcaa25124c3d9 ./appfile1.txt',
-                        '6fe635186392d43f0ae5728e41a92f96 appfile2.ppt',
-                        'e10dab217514cf7f2166d87fb5d04d5c ./myapp/importantfile.bin',
-                        'a51999cbc7ee434ee95b33f1d18c7210 otherdir/main.py',
-                        'abc libstdc++.so', 'def myapp/libgcc_s.so.1', 'ignoreme ./other_dir/libc-2.5' ] ]
-    other_file_contents = [
-      'appfile1r0984u3jriumfilf42890tjr742tu', 'appfile29031i4rt498jnyfouf908j248f4298fn24iuyf',
-      'importf90ui4j9rf41f09j14fiun41 fp1,cmic13',
-      'MAIN()@KJR(*@KRE)+@MOUFRIN@FR*YB^ B* @HE)J @E( HG!V!UYNEJ)(!))))' ]
-    handles = FileUtil.getMultipleReadHandles( file_contents )
+    basefolder = self.makeInstallation()
     with patch('%s.os.chdir' % MODULE_NAME, new=Mock(return_value=True)) as chdir_mock, \
-         patch('%s.os.path.isfile' % MODULE_NAME, new=Mock(return_value=False)) as isfile_mock, \
-         patch('%s.os.path.exists' % MODULE_NAME, new=Mock(return_value=True)) as exists_mock, \
-         patch('%s.open' % MODULE_NAME, mock_open(), create=True) as mo:
-      mysideeff = [ handles[0] ]
-      for i in xrange(0, len(other_file_contents)):
-        other_read_mock = Mock()
-        other_read_mock.read.return_value = other_file_contents[i]
-        mysideeff.append( other_read_mock )
-      mo.side_effect = tuple( mysideeff )
-      result = check( ('appname', 'version'), 'mytestarea398', ['/my/basefolder', 'res_from_install[1]'] )
-      expected_open_calls = [ ( '/my/basefolder/md5_checksum.md5', 'r' ), '/my/basefolder/appfile1.txt',
-                              '/my/basefolder/appfile2.ppt', '/my/basefolder/myapp/importantfile.bin',
-                              '/my/basefolder/otherdir/main.py' ]
-      expected = [[]]
-      FileUtil.checkFileInteractions( self, mo, expected_open_calls, expected, handles )
-      assertDiracSucceedsWith_equals( result, [ '/my/basefolder' ], self )
+         patch('%s.HASH_BLOCK_SIZE' % MODULE_NAME, new=16):
+      result = check( ('appname', 'version'), 'mytestarea398', [basefolder, 'res_from_install[1]'] )
+      assertDiracSucceedsWith_equals( result, [ basefolder ], self )
       chdir_mock.assert_called_once_with( 'mytestarea398' )
-      isfile_mock.assert_called_once_with( '/my/basefolder' )
-      assertMockCalls( exists_mock, [ '/my/basefolder/md5_checksum.md5', '/my/basefolder/appfile1.txt',
-                                      '/my/basefolder/appfile2.ppt', '/my/basefolder/myapp/importantfile.bin',
-                                      '/my/basefolder/otherdir/main.py' ], self )
+    self.assertTrue( os.path.exists( os.path.join( basefolder, '.md5_verified' ) ) )
+
+  def test_check_verified( self ):
+    from ILCDIRAC.Core.Utilities.TARsoft import check
+    basefolder = self.makeInstallation()
+    with patch('%s.os.chdir' % MODULE_NAME, new=Mock(return_value=True)):
+      assertDiracSucceeds( check( ('appname', 'version'), 'area', [basefolder, ''] ), self )
+      with patch('%s.checkFileSums' % MODULE_NAME, new=Mock(return_value=S_OK())) as sums_mock:
+        assertDiracSucceedsWith_equals( check( ('appname', 'version'), 'area', [basefolder, ''] ),
+                                        [ basefolder ], self )
+        self.assertFalse( sums_mock.called )
+        # a different checksum file invalidates the marker
+        with open( os.path.join( basefolder, 'md5_checksum.md5' ), 'a' ) as md5file:
+          md5file.write( 'xyz ./lib/libc-2.5\n' )
+        assertDiracSucceeds( check( ('appname', 'version'), 'area', [basefolder, ''] ), self )
+        self.assertTrue( sums_mock.called )
 
   def test_check_lcsim_jar( self ):
     from ILCDIRAC.Core.Utilities.TARsoft import check
@@ -381,33 +429,12 @@ class TestTARsoft( unittest.TestCase ): #pylint: disable=too-many-public-methods
 
   def test_check_corrupt_checksum( self ):
     from ILCDIRAC.Core.Utilities.TARsoft import check
-    # Different treatment of with open() and open().read().....
-    file_contents = [ ['HelloWorld -', 'mychecksum md5_checksum.md5',
-                       'ef7493baf5582b41cd4fcaa25124c3d9 ./appfile1.txt', 'CORRUPT_CHECKSUM appfile2.ppt',
-                       'e10dab217514cf7f2166d87fb5d04d5c ./myapp/importantfile.bin',
-                       'a51999cbc7ee434ee95b33f1d18c7210 otherdir/main.py', 'abc libstdc++.so',
-                       'def myapp/libgcc_s.so.1', 'ignoreme ./other_dir/libc-2.5' ] ]
-    other_file_contents = [ 'appfile1r0984u3jriumfilf42890tjr742tu',
-                            'appfile29031i4rt498jnyfouf908j248f4298fn24iuyf',
-                            'importf90ui4j9rf41f09j14fiun41 fp1,cmic13',
-                            'MAIN()@KJR(*@KRE)+@MOUFRIN@FR*YB^ B* @HE)J @E( HG!V!UYNEJ)(!))))' ]
-    handles = FileUtil.getMultipleReadHandles( file_contents )
-    with patch('%s.os.chdir' % MODULE_NAME, new=Mock(return_value=True)) as chdir_mock, \
-         patch('%s.os.path.isfile' % MODULE_NAME, new=Mock(return_value=False)) as isfile_mock, \
-         patch('%s.os.path.exists' % MODULE_NAME, new=Mock(return_value=True)) as exists_mock, \
-         patch('%s.open' % MODULE_NAME, mock_open(), create=True) as mo:
-      mysideeff = [ handles[0] ]
-      for i in xrange(0, len(other_file_contents)):
-        other_read_mock = Mock()
-        other_read_mock.read.return_value = other_file_contents[i]
-        mysideeff.append( other_read_mock )
-      mo.side_effect = tuple( mysideeff )
-      result = check( ('appname', 'version'), 'mytestarea398', ['/my/otherfolder', 'res_from_install[1]'] )
-      assertDiracFailsWith( result, 'corrupted install: file /my/otherfolder/appfile2.ppt', self )
+    basefolder = self.makeInstallation( { 'appfile2.ppt' : 'CORRUPT_CHECKSUM' } )
+    with patch('%s.os.chdir' % MODULE_NAME, new=Mock(return_value=True)) as chdir_mock:
+      result = check( ('appname', 'version'), 'mytestarea398', [basefolder, 'res_from_install[1]'] )
+      assertDiracFailsWith( result, 'corrupted install: file %s/appfile2.ppt' % basefolder.lower(), self )
       chdir_mock.assert_called_once_with( 'mytestarea398' )
-      isfile_mock.assert_called_once_with( '/my/otherfolder' )
-      assertMockCalls( exists_mock, [ '/my/otherfolder/md5_checksum.md5', '/my/otherfolder/appfile1.txt',
-                                      '/my/otherfolder/appfile2.ppt' ], self )
+    self.assertFalse( os.path.exists( os.path.join( basefolder, '.md5_verified' ) ) )
 
   def test_check_no_checksum_file( self ):
     from ILCDIRAC.Core.Utilities.TARsoft import check
@@ -425,93 +452,40 @@ class TestTARsoft( unittest.TestCase ): #pylint: disable=too-many-public-methods
 
   def test_check_ioerr( self ):
     from ILCDIRAC.Core.Utilities.TARsoft import check
-    # Different treatment of with open() and open().read().....
-    file_contents = [ [ 'ef7493baf5582b41cd4fcaa25124c3d9 ./appfile1.txt',
-                        '6fe635186392d43f0ae5728e41a92f96 appfile2.ppt',
-                        'e10dab217514cf7f2166d87fb5d04d5c ./myapp/importantfile.bin',
-                        'a51999cbc7ee434ee95b33f1d18c7210 otherdir/main.py', 'abc libstdc++.so',
-                        'def myapp/libgcc_s.so.1', 'ignoreme ./other_dir/libc-2.5' ] ]
-    other_file_contents = [ 'appfile1r0984u3jriumfilf42890tjr742tu', IOError('md5_read_err'),
-                            'importf90ui4j9rf41f09j14fiun41 fp1,cmic13',
-                            'MAIN()@KJR(*@KRE)+@MOUFRIN@FR*YB^ B* @HE)J @E( HG!V!UYNEJ)(!))))' ]
-    handles = FileUtil.getMultipleReadHandles( file_contents )
-    with patch('%s.os.chdir' % MODULE_NAME, new=Mock(return_value=True)) as chdir_mock, \
-         patch('%s.os.path.isfile' % MODULE_NAME, new=Mock(return_value=False)) as isfile_mock, \
-         patch('%s.os.path.exists' % MODULE_NAME, new=Mock(return_value=True)) as exists_mock, \
-         patch('%s.open' % MODULE_NAME, mock_open(), create=True) as mo:
-      mysideeff = [ handles[0] ]
-      for i in xrange(0, len(other_file_contents)):
-        other_read_mock = Mock()
-        if isinstance(other_file_contents[i], basestring):
-          other_read_mock.read.side_effect = [ other_file_contents[i] ]
-        else:
-          other_read_mock.read.side_effect = other_file_contents[i]
-        mysideeff.append( other_read_mock )
-      mo.side_effect = tuple( mysideeff )
-      result = check( ('appname', 'version'), 'mytestarea398', ['/my/basefolder', 'res_from_install[1]'] )
-      expected_open_calls = [ ( '/my/basefolder/md5_checksum.md5', 'r' ), '/my/basefolder/appfile1.txt',
-                              '/my/basefolder/appfile2.ppt' ]
-      expected = [[]]
+    basefolder = self.makeInstallation()
+    def fileMd5( path ):
+      """ fail to read appfile2 """
+      if path.endswith( 'appfile2.ppt' ):
+        raise IOError( 'md5_read_err' )
+      with open( path ) as theFile:
+        return hashlib.md5( theFile.read().encode() ).hexdigest()
+    with patch('%s.os.chdir' % MODULE_NAME, new=Mock(return_value=True)), \
+         patch('%s.fileMd5' % MODULE_NAME, new=Mock(side_effect=fileMd5)):
+      result = check( ('appname', 'version'), 'mytestarea398', [basefolder, 'res_from_install[1]'] )
       assertDiracFailsWith( result, 'failed to compute md5 sum', self )
-      FileUtil.checkFileInteractions( self, mo, expected_open_calls, expected, handles )
-      chdir_mock.assert_called_once_with( 'mytestarea398' )
-      isfile_mock.assert_called_once_with( '/my/basefolder' )
-      assertMockCalls( exists_mock, [ '/my/basefolder/md5_checksum.md5', '/my/basefolder/appfile1.txt',
-                                      '/my/basefolder/appfile2.ppt' ], self )
 
   def test_check_empty_checksum_file( self ):
     from ILCDIRAC.Core.Utilities.TARsoft import check
-    file_contents = [[]]
-    handles = FileUtil.getMultipleReadHandles( file_contents )
+    self.makeFile( 'app/md5_checksum.md5', '' )
+    basefolder = os.path.join( self.tmpdir, 'app' )
     with patch('%s.os.chdir' % MODULE_NAME, new=Mock(return_value=True)) as chdir_mock, \
-        patch('%s.os.path.isfile' % MODULE_NAME, new=Mock(return_value=False)) as isfile_mock, \
-        patch('%s.os.path.exists' % MODULE_NAME, new=Mock(return_value=True)) as exists_mock, \
-        patch('%s.open' % MODULE_NAME, mock_open(), create=True) as mo, \
             patch('%s.LOG.warn' % MODULE_NAME) as warn_mock:
-      mo.side_effect = (h for h in handles)
-      result = check( ('appname', 'version'), 'mytestarea398', ['/my/basefolder', 'res_from_install[1]'] )
-      expected_open_calls = [( '/my/basefolder/md5_checksum.md5', 'r' )]
-      expected = [[]]
-      FileUtil.checkFileInteractions( self, mo, expected_open_calls, expected, handles )
-      assertDiracSucceedsWith_equals( result, ['/my/basefolder'], self )
+      result = check( ('appname', 'version'), 'mytestarea398', [basefolder, 'res_from_install[1]'] )
+      assertDiracSucceedsWith_equals( result, [basefolder], self )
       chdir_mock.assert_called_once_with( 'mytestarea398' )
       self.assertFalse( warn_mock.called )
-      isfile_mock.assert_called_once_with( '/my/basefolder' )
-      exists_mock.assert_called_once_with( '/my/basefolder/md5_checksum.md5' )
 
   def test_check_missing_file( self ):
     from ILCDIRAC.Core.Utilities.TARsoft import check
-    # Different treatment of with open() and open().read().....
-    file_contents = [ ['HelloWorld -', 'mychecksum md5_checksum.md5',
-                       'ef7493baf5582b41cd4fcaa25124c3d9 ./appfile1.txt',
-                       '6fe635186392d43f0ae5728e41a92f96 appfile2.ppt',
-                       'e10dab217514cf7f2166d87fb5d04d5c ./myapp/importantfile.bin',
-                       'a51999cbc7ee434ee95b33f1d18c7210 otherdir/main.py', 'abc libstdc++.so',
-                       'def myapp/libgcc_s.so.1', 'ignoreme ./other_dir/libc-2.5' ] ]
-    other_file_contents = [ 'appfile1r0984u3jriumfilf42890tjr742tu',
-                            'appfile29031i4rt498jnyfouf908j248f4298fn24iuyf',
-                            'importf90ui4j9rf41f09j14fiun41 fp1,cmic13',
-                            'MAIN()@KJR(*@KRE)+@MOUFRIN@FR*YB^ B* @HE)J @E( HG!V!UYNEJ)(!))))' ]
-    handles = FileUtil.getMultipleReadHandles( file_contents )
+    basefolder = self.makeInstallation()
+    os.remove( os.path.join( basefolder, 'appfile2.ppt' ) )
     with patch('%s.os.chdir' % MODULE_NAME, new=Mock(return_value=True)) as chdir_mock, \
-         patch('%s.os.path.isfile' % MODULE_NAME, new=Mock(return_value=False)) as isfile_mock, \
-         patch('%s.os.path.exists' % MODULE_NAME, new=Mock(side_effect=[True, True, False])) as exists_mock, \
-         patch('%s.open' % MODULE_NAME, mock_open(), create=True) as mo:
-      mysideeff = [ handles[0] ]
-      for i in xrange(0, len(other_file_contents)):
-        other_read_mock = Mock()
-        other_read_mock.read.return_value = other_file_contents[i]
-        mysideeff.append( other_read_mock )
-      mo.side_effect = tuple( mysideeff )
-      result = check( ('appname', 'version'), 'mytestarea398', ['/hidden/dir', 'res_from_install[1]'] )
-      expected_open_calls = [ ( '/hidden/dir/md5_checksum.md5', 'r' ), '/hidden/dir/appfile1.txt' ]
-      expected = [[]]
-      FileUtil.checkFileInteractions( self, mo, expected_open_calls, expected, handles )
-      assertDiracFailsWith( result, 'incomplete install: the file /hidden/dir/appfile2.ppt is missing', self )
+         patch('%s.checkFileSums' % MODULE_NAME) as sums_mock:
+      result = check( ('appname', 'version'), 'mytestarea398', [basefolder, 'res_from_install[1]'] )
+      assertDiracFailsWith( result, 'incomplete install: the file %s/appfile2.ppt is missing' % basefolder.lower(),
+                            self )
       chdir_mock.assert_called_once_with( 'mytestarea398' )
-      isfile_mock.assert_called_once_with( '/hidden/dir' )
-      assertMockCalls( exists_mock, [ '/hidden/dir/md5_checksum.md5', '/hidden/dir/appfile1.txt',
-                                      '/hidden/dir/appfile2.ppt' ], self )
+      self.assertFalse( sums_mock.called )
 
   def test_configure_slic( self ):
     from ILCDIRAC.Core.Utilities.TARsoft import configure
@@ -36,6 +36,11 @@ Requirements/Assumptions:
   Transformations are only treated, if during the last pass changes
   were performed, or the number of Failed and Done jobs has changed.
 
+  The results of the checks are kept in the work directory of the agent. Jobs which were consistent, or which were
+  kept because other tasks processed the same input, are not checked again as long as their status and the
+  transformation file status of their input files do not change, or until the result is older than
+  `JobResultMaxAge`. The results of transformations which are no longer selected are removed.
+
 
 .. literalinclude:: ../ConfigTemplate.cfg
   :start-after: ##BEGIN DataRecoveryAgent
@@ -46,6 +51,8 @@ Requirements/Assumptions:
 """
 
 from collections import defaultdict
+import hashlib
+import os
 import time
 import itertools
 
@@ -58,8 +65,11 @@ from DIRAC.TransformationSystem.Client.TransformationClient import Transformatio
 from DIRAC.RequestManagementSystem.Client.ReqClient import ReqClient
 from DIRAC.FrameworkSystem.Client.NotificationClient import NotificationClient
 
+from ILCDIRAC.Core.Utilities.Concurrency import concurrentMap
 from ILCDIRAC.ILCTransformationSystem.Utilities.TransformationInfo import TransformationInfo
 from ILCDIRAC.ILCTransformationSystem.Utilities.JobInfo import TaskInfoException
+from ILCDIRAC.ILCTransformationSystem.Utilities.JobResultCache import JobResultCache, pruneResultFiles, \
+    CONSISTENT, KEEP, RESULT_FILE
 from ILCDIRAC.Interfaces.API.DiracILC import DiracILC
 
 __RCSID__ = "$Id$"
@@ -68,6 +78,7 @@ AGENT_NAME = 'Transformation/DataRecoveryAgent'
 MAXRESET = 10  # FIXME get this number from somewhere else
 
 ASSIGNEDSTATES = ['Assigned', 'Processed']
+FINISHED_REQUEST_STATES = ('Done', 'Canceled')
 
 class DataRecoveryAgent( AgentModule ):
   """Data Recovery Agent"""
@@ -112,7 +123,7 @@ class DataRecoveryAgent( AgentModule ):
                  [ \
                      # must always be first!
                      dict(Message="One of many Successful: clean others",
-                          ShortMessage="Other Tasks --> Keep",
+                          ShortMessage=KEEP,
                           Counter=0,
                           Check=lambda job: job.allFilesExist() and job.otherTasks and \
                           not set(job.inputFiles).issubset(self.inputFilesProcessed),
@@ -265,6 +276,16 @@ class DataRecoveryAgent( AgentModule ):
                 }
     self.jobCache = defaultdict(lambda: (0, 0))
     self.printEveryNJobs = self.am_getOption('PrintEvery', 200)
+    self.jdlWorkers = self.am_getOption('JDLWorkers', 10)
+    self.jdlChunkSize = self.am_getOption('JDLChunkSize', 100)
+    self.jdlRetries = self.am_getOption('JDLRetries', 3)
+    self.existsWorkers = self.am_getOption('ExistsWorkers', 5)
+    self.existsChunkSize = self.am_getOption('ExistsChunkSize', 200)
+    self.existsRetries = self.am_getOption('ExistsRetries', 5)
+    self.existsBackoff = self.am_getOption('ExistsBackoff', 2)
+    self.useJobResultCache = self.am_getOption('UseJobResultCache', True)
+    self.jobResultMaxAge = self.am_getOption('JobResultMaxAge', 86400)
+    self.jobResults = None
     # Notification options
     self.notesToSend = ""
     self.addressTo = self.am_getOption('MailTo', [])
@@ -288,6 +309,15 @@ class DataRecoveryAgent( AgentModule ):
     self.addressTo = self.am_getOption('MailTo', self.addressTo)
     self.addressFrom = self.am_getOption('MailFrom', self.addressFrom)
     self.printEveryNJobs = self.am_getOption('PrintEvery', self.printEveryNJobs)
+    self.jdlWorkers = self.am_getOption('JDLWorkers', self.jdlWorkers)
+    self.jdlChunkSize = self.am_getOption('JDLChunkSize', self.jdlChunkSize)
+    self.jdlRetries = self.am_getOption('JDLRetries', self.jdlRetries)
+    self.existsWorkers = self.am_getOption('ExistsWorkers', self.existsWorkers)
+    self.existsChunkSize = self.am_getOption('ExistsChunkSize', self.existsChunkSize)
+    self.existsRetries = self.am_getOption('ExistsRetries', self.existsRetries)
+    self.existsBackoff = self.am_getOption('ExistsBackoff', self.existsBackoff)
+    self.useJobResultCache = self.am_getOption('UseJobResultCache', self.useJobResultCache)
+    self.jobResultMaxAge = self.am_getOption('JobResultMaxAge', self.jobResultMaxAge)
 
     return S_OK()
   #############################################################################
@@ -300,7 +330,7 @@ class DataRecoveryAgent( AgentModule ):
     if not transformations['OK']:
       self.log.error( "Failure to get transformations", transformations['Message'] )
       return S_ERROR( "Failure to get transformations" )
-    for prodID, transInfoDict in transformations['Value'].iteritems():
+    for prodID, transInfoDict in transformations['Value'].items():
       if prodID in self.productionsToIgnore:
         self.log.notice( "Ignoring Production: %s " % prodID )
         continue
@@ -310,6 +340,9 @@ class DataRecoveryAgent( AgentModule ):
       self.treatProduction(int(prodID), transInfoDict)
       self.sendNotification(prodID, transInfoDict)
 
+    if self.useJobResultCache:
+      pruneResultFiles(self.am_getWorkDirectory(),
+                       [prodID for prodID in transformations['Value'] if prodID not in self.productionsToIgnore])
     return S_OK()
 
   def getEligibleTransformations( self, status, typeList ):
@@ -348,11 +381,59 @@ class DataRecoveryAgent( AgentModule ):
                           for taskDict in taskDicts
                           ])
 
-    self.checkAllJobs(jobs, tInfo, tasksDict, lfnTaskDict)
+    self.jobResults = None
+    if self.useJobResultCache:
+      self.jobResults = JobResultCache(os.path.join(self.am_getWorkDirectory(), RESULT_FILE % prodID),
+                                       self.jobResultMaxAge)
+      allJobIDs = list(jobs)
+      jobs = self.removeSettledJobs(jobs, tasksDict, lfnTaskDict)
+
+    try:
+      self.checkAllJobs(jobs, tInfo, tasksDict, lfnTaskDict)
+    except RuntimeError as e:
+      self.log.error('Failed to check the jobs, will try again next cycle', str(e))
+      del self.jobCache[prodID]
+      self.jobResults = None
+      return
     self.printSummary()
+    if self.jobResults is not None:
+      self.jobResults.save(allJobIDs)
+      self.jobResults = None
+
+  def removeSettledJobs(self, jobs, tasksDict, lfnTaskDict):
+    """Return the jobs which have to be checked, based on the results of the previous checks.
+
+    The information from the JDL is filled from the previous results for all jobs. The input files of settled jobs
+    which were kept because other tasks processed the same input are marked as processed, like the check would.
+    """
+    toCheck = type(jobs)()
+    for jobID, job in jobs.items():
+      if not self.jobResults.fillJobInformation(job) or \
+         not self.jobResults.isSettled(job, self.getFingerprint(job, tasksDict, lfnTaskDict)):
+        toCheck[jobID] = job
+      elif self.jobResults.getVerdict(job) == KEEP:
+        self.inputFilesProcessed.update(job.inputFiles)
+    self.log.notice('Checking %d of %d jobs, the others did not change since the last check' %
+                    (len(toCheck), len(jobs)))
+    return toCheck
+
+  @staticmethod
+  def getFingerprint(job, tasksDict, lfnTaskDict):
+    """Return a hash of the transformation file status of the input files of the job."""
+    if not (tasksDict and lfnTaskDict):
+      return ''
+    states = []
+    for lfn in job.inputFiles:
+      taskID = lfnTaskDict.get(lfn)
+      states.extend('%s:%s:%s:%s' % (taskID, lfn, taskDict['Status'], taskDict['ErrorCount'])
+                    for taskDict in tasksDict.get(taskID, []) if taskDict['LFN'] == lfn)
+    return hashlib.md5(';'.join(sorted(states)).encode('utf-8')).hexdigest()
 
   def checkJob( self, job, tInfo ):
-    """Deal with the job."""
+    """Deal with the job.
+
+    :returns: the ShortMessage of the check that matched the job, or 'Consistent' if none matched
+    """
     checks = self.todo['NoInputFiles'] if job.tType in self.transNoInput else self.todo['InputFiles']
     for do in checks:
       self.log.verbose('Testing: ', do['Message'])
@@ -363,22 +444,63 @@ class DataRecoveryAgent( AgentModule ):
         self.notesToSend += do['Message'] + '\n'
         self.notesToSend += str(job) + '\n'
         do['Actions'](job, tInfo)
-        return
+        return do['ShortMessage']
+    return CONSISTENT
+
+  def getJDLs(self, jobIDs):
+    """Get the JDL parameters of the jobs.
+
+    The jobs are treated in chunks of `JDLChunkSize` jobs by `JDLWorkers` threads. The jobs of a chunk for which the
+    JDL could not be obtained are tried again up to `JDLRetries` times.
+
+    :param list jobIDs: list of job IDs
+    :returns: dictionary of jobID to JDL parameters, jobs whose JDL could not be obtained are missing
+    """
+    jdls = {}
+    if not jobIDs:
+      return jdls
+    chunks = breakListIntoChunks(jobIDs, self.jdlChunkSize)
+    jdlStart = time.time()
+    for chunkJDLs in concurrentMap(self._getJDLChunk, chunks, self.jdlWorkers, unordered=True):
+      jdls.update(chunkJDLs)
+      self.log.notice('Getting JDLs: %d/%d: %3.1fs' % (len(jdls), len(jobIDs), float(time.time() - jdlStart)))
+    if len(jdls) < len(jobIDs):
+      self.log.warn('Could not get the JDL for %d jobs' % (len(jobIDs) - len(jdls)))
+    return jdls
+
+  def _getJDLChunk(self, jobIDs):
+    """Get the JDL parameters for a chunk of jobs, retrying the failed ones."""
+    jdls = {}
+    toGet = list(jobIDs)
+    for _attempt in range(self.jdlRetries + 1):
+      failed = []
+      for jobID in toGet:
+        res = self.diracILC.getJobJDL(int(jobID))
+        if res['OK']:
+          jdls[jobID] = res['Value']
+        else:
+          failed.append(jobID)
+      if not failed:
+        break
+      self.log.verbose('Failed to get %d JDLs, trying again' % len(failed))
+      toGet = failed
+    return jdls
 
   def getLFNStatus(self, jobs):
     """Get all the LFNs for the jobs and get their status."""
     self.log.notice('Collecting LFNs...')
-    lfnExistence = {}
     lfnCache = []
     counter = 0
     jobInfoStart = time.time()
+    jdls = self.getJDLs([job.jobID for job in jobs.values() if not job.hasJobInformation()])
     for counter, job in enumerate(jobs.values()):
       if counter % self.printEveryNJobs == 0:
         self.log.notice('Getting JobInfo: %d/%d: %3.1fs' %
                         (counter, len(jobs), float(time.time() - jobInfoStart)))
       while True:
         try:
-          job.getJobInformation(self.diracILC, self.jobMon)
+          # jobs without JDL from the bulk query fall back to getting it one by one
+          job.getJobInformation(self.diracILC, self.jobMon, jdlParameters=jdls.get(job.jobID))
           lfnCache.extend(job.inputFiles)
           lfnCache.extend(job.outputFiles)
           break
@@ -387,49 +509,83 @@ class DataRecoveryAgent( AgentModule ):
           self.log.error('+++++ Exception: ', str(e))
 
     timeSpent = float(time.time() - jobInfoStart)
-    self.log.notice('Getting JobInfo Done: %3.1fs (%3.3fs per job)' % (timeSpent, timeSpent / counter))
+    self.log.notice('Getting JobInfo Done: %3.1fs (%3.3fs per job)' % (timeSpent, timeSpent / max(len(jobs), 1)))
 
-    counter = 0
+    return self.getFileExistence(lfnCache)
+
+  def getFileExistence(self, lfns):
+    """Check if the files exist in the FileCatalog.
+
+    Each LFN is only checked once. The LFNs are checked in chunks of `ExistsChunkSize` by `ExistsWorkers` threads. A
+    chunk that fails is tried again after an exponentially growing wait, at most `ExistsRetries` times.
+
+    :param list lfns: list of LFNs, can contain duplicates
+    :returns: dictionary of LFN to existence
+    :raises: RuntimeError if the existence of a chunk of files could not be checked
+    """
+    lfns = list(set(lfns))
+    lfnExistence = {}
+    if not lfns:
+      return lfnExistence
+    chunks = breakListIntoChunks(lfns, self.existsChunkSize)
+    chunkTimes = []
+    failedChunks = []
     fileInfoStart = time.time()
-    for lfnChunk in breakListIntoChunks(list(lfnCache), 200):
-      counter += 200
-      if counter % 1000 == 0:
+    for res, duration in concurrentMap(self._checkExistenceChunk, chunks, self.existsWorkers, unordered=True):
+      chunkTimes.append(duration)
+      if not res['OK']:
+        failedChunks.append(res['Message'])
+        continue
+      lfnExistence.update(res['Value'])
+      if len(chunkTimes) % max(1, 1000 // self.existsChunkSize) == 0:
         self.log.notice('Getting FileInfo: %d/%d: %3.1fs' %
-                        (counter, len(lfnCache), float(time.time() - fileInfoStart)))
-      while True:
-        try:
-          reps = self.fcClient.exists(lfnChunk)
-          if not reps['OK']:
-            self.log.error('Failed to check file existence, try again...', reps['Message'])
-            raise RuntimeError('Try again')
-          statuses = reps['Value']
-          lfnExistence.update(statuses['Successful'])
-          break
-        except RuntimeError:  # try again
-          pass
-    self.log.notice('Getting FileInfo Done: %3.1fs' % (float(time.time() - fileInfoStart)))
-
+                        (len(lfnExistence), len(lfns), float(time.time() - fileInfoStart)))
+    self.log.notice('Getting FileInfo Done: %d files in %d chunks: %3.1fs (chunk min/avg/max %3.1f/%3.1f/%3.1fs)' %
+                    (len(lfns), len(chunks), float(time.time() - fileInfoStart),
+                     min(chunkTimes), sum(chunkTimes) / len(chunkTimes), max(chunkTimes)))
+    if failedChunks:
+      self.log.error('Failed to check file existence for %d chunks' % len(failedChunks), failedChunks[0])
+      raise RuntimeError('Failed to check file existence: %s' % failedChunks[0])
     return lfnExistence
 
+  def _checkExistenceChunk(self, lfnChunk):
+    """Check the existence of a chunk of files, retrying with exponential backoff.
+
+    :returns: tuple of S_OK with the existence of the files or S_ERROR, and the time spent
+    """
+    chunkStart = time.time()
+    for attempt in range(self.existsRetries + 1):
+      if attempt:
+        time.sleep(min(self.existsBackoff * 2 ** (attempt - 1), 60))
+      res = self.fcClient.exists(lfnChunk)
+      if res['OK']:
+        return S_OK(res['Value']['Successful']), time.time() - chunkStart
+      self.log.error('Failed to check file existence, attempt %d' % (attempt + 1), res['Message'])
+    return res, time.time() - chunkStart
+
   def setPendingRequests(self, jobs):
-    """Loop over all the jobs and get requests, if any."""
+    """Loop over all the jobs and get requests, if any.
+
+    The status of the request objects is derived from their operations, so it cannot tell if a request was canceled.
+    Only requests which are not finished according to the object are checked in the RequestDB.
+    """
     for jobChunk in breakListIntoChunks(jobs.values(), 1000):
-      jobIDs = [job.jobID for job in jobChunk]
+      jobsByID = dict((job.jobID, job) for job in jobChunk)
       while True:
-        result = self.reqClient.readRequestsForJobs(jobIDs)
+        result = self.reqClient.readRequestsForJobs(list(jobsByID))
         if result['OK']:
           break
         self.log.error('Failed to read requests', result['Message'])
         # repeat
-      for jobID in result['Value']['Successful']:
-        request = result['Value']['Successful'][jobID]
-        requestID = request.RequestID
-        dbStatus = self.reqClient.getRequestStatus(requestID).get('Value', 'Unknown')
-        for job in jobChunk:
-          if job.jobID == jobID:
-            job.pendingRequest = dbStatus not in ('Done', 'Canceled')
-            self.log.notice('Found %s request for job %d' % ('pending' if job.pendingRequest else 'finished', jobID))
-            break
+      for jobID, request in result['Value']['Successful'].items():
+        job = jobsByID.get(int(jobID))
+        if job is None:
+          continue
+        status = request.Status
+        if status not in FINISHED_REQUEST_STATES:
+          status = self.reqClient.getRequestStatus(request.RequestID).get('Value', 'Unknown')
+        job.pendingRequest = status not in FINISHED_REQUEST_STATES
+        self.log.notice('Found %s request for job %d' % ('pending' if job.pendingRequest else 'finished', jobID))
 
   def checkAllJobs(self, jobs, tInfo, tasksDict=None, lfnTaskDict=None):
     """run over all jobs and do checks"""
@@ -447,6 +603,7 @@ class DataRecoveryAgent( AgentModule ):
         try:
           if job.pendingRequest:
             self.log.warn('Job has Pending requests:\n%s' % job)
+            self.__setJobResult(job, 'PendingRequest', tasksDict, lfnTaskDict)
             break
           job.checkFileExistence(lfnExistence)
           if tasksDict and lfnTaskDict:
@@ -454,12 +611,13 @@ class DataRecoveryAgent( AgentModule ):
               job.getTaskInfo(tasksDict, lfnTaskDict, self.transWithInput)
             except TaskInfoException as e:
               self.log.error(" Skip Task, due to TaskInfoException: %s" % e )
+              self.__setJobResult(job, 'TaskInfoException', tasksDict, lfnTaskDict)
               if not job.inputFiles and job.tType in self.transWithInput:
                 self.__failJobHard(job, tInfo)
               break
             for inputFile in job.inputFiles:
               fileJobDict[inputFile].append(job.jobID)
-          self.checkJob( job, tInfo )
+          self.__setJobResult(job, self.checkJob(job, tInfo), tasksDict, lfnTaskDict)
           break # get out of the while loop
         except RuntimeError as e:
           self.log.error( "+++++ Failure for job: %d " % job.jobID )
@@ -478,11 +636,16 @@ class DataRecoveryAgent( AgentModule ):
 
   def __resetCounters( self ):
     """ reset counters for modified jobs """
-    for _name, checks in self.todo.iteritems():
+    for _name, checks in self.todo.items():
       for do in checks:
         do['Counter'] = 0
 
 
+  def __setJobResult(self, job, verdict, tasksDict, lfnTaskDict):
+    """Store the result of the check of the job, if the results are kept."""
+    if self.jobResults is not None:
+      self.jobResults.setResult(job, verdict, self.getFingerprint(job, tasksDict, lfnTaskDict))
+
   def __failJobHard( self, job, tInfo ):
     """ set job to failed and remove output files if there are any """
     if job.inputFiles:
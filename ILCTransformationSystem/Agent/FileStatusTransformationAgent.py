@@ -19,7 +19,10 @@ FileStatusTransformation Agent performs the following actions:
 
 """
 
+import ast
 import json
+import threading
+import time
 from collections import defaultdict
 
 from DIRAC import S_OK, S_ERROR
@@ -33,6 +36,8 @@ from DIRAC.RequestManagementSystem.Client.ReqClient import ReqClient
 from DIRAC.Resources.Catalog.FileCatalogClient import FileCatalogClient
 from DIRAC.Resources.Storage.StorageElement import StorageElement
 
+from ILCDIRAC.Core.Utilities.Concurrency import concurrentMap
+
 __RCSID__ = "$Id$"
 
 AGENT_NAME = 'ILCTransformation/FileStatusTransformationAgent'
@@ -66,6 +71,18 @@ class FileStatusTransformationAgent(AgentModule):
 
     self.accounting = defaultdict(list)
     self.errors = []
+    self.taskChunkSize = 1000
+    # request status of the tasks of the transformation being processed
+    self.requestStatusCache = {}
+    self.seChunkSize = 200
+    self.seWorkers = 4
+    # idle StorageElement objects and semaphores limiting the concurrent checks, per storage element and VO
+    self.storageElements = {}
+    self.seSemaphores = {}
+    self.seLock = threading.Lock()
+    self.filesPageSize = 10000
+    # time in seconds needed to process each transformation in this cycle
+    self.cycleTimes = {}
 
     self.fcClient = FileCatalogClient()
     self.tClient = TransformationClient()
@@ -93,7 +110,15 @@ class FileStatusTransformationAgent(AgentModule):
     self.addressFrom = self.am_getOption('MailFrom', "ilcdirac-admin@cern.ch")
 
     self.transformationFileStatuses = filter(self.checkFileStatusFuncExists, self.transformationFileStatuses)
+    self.taskChunkSize = self.am_getOption('TaskChunkSize', 1000)
+    self.seChunkSize = self.am_getOption('SEChunkSize', 200)
+    self.seWorkers = self.am_getOption('SEWorkers', 4)
+    self.filesPageSize = self.am_getOption('FilesPageSize', 10000)
     self.accounting.clear()
+    self.requestStatusCache.clear()
+    self.storageElements.clear()
+    self.seSemaphores.clear()
+    self.cycleTimes.clear()
 
     return S_OK()
 
@@ -112,8 +137,11 @@ class FileStatusTransformationAgent(AgentModule):
     if targetSEs:
       emailBody += "Target SE: %s\n\n" % (" ".join(str(target) for target in targetSEs))
 
+    if transID in self.cycleTimes:
+      emailBody += "Processing time: %.1f s\n" % self.cycleTimes[transID]
+
     rows = []
-    for action, transFiles in self.accounting.iteritems():
+    for action, transFiles in self.accounting.items():
       emailBody += "Total number of files with action %s: %s\n" % (action, len(transFiles))
       for transFile in transFiles:
         rows.append([[transFile['LFN']], [str(transFile['AvailableOnSource'])],
@@ -186,32 +214,28 @@ class FileStatusTransformationAgent(AgentModule):
     return S_OK()
 
   def getTransformations(self, transID=None):
-    """ returns transformations of a given type and status """
-    res = None
-    if transID:
-      res = self.tClient.getTransformations(
-          condDict={'TransformationID': transID,
-                    'Status': self.transformationStatuses,
-                    'Type': self.transformationTypes})
-    else:
-      res = self.tClient.getTransformations(
-          condDict={'Status': self.transformationStatuses, 'Type': self.transformationTypes})
+    """ returns transformations of a given type and status
 
+    The SourceSE and TargetSE parameters and the Body of all transformations are obtained with the same query.
+    """
+    condDict = {'Status': self.transformationStatuses, 'Type': self.transformationTypes}
+    if transID:
+      condDict['TransformationID'] = transID
+    res = self.tClient.getTransformations(condDict=condDict, extraParams=True)
     if not res['OK']:
       return res
 
     result = res['Value']
     for trans in result:
-      res = self.tClient.getTransformationParameters(trans['TransformationID'], ['SourceSE', 'TargetSE'])
-      if not res['OK']:
+      if 'SourceSE' not in trans or 'TargetSE' not in trans:
         self.log.error('Failure to get SourceSE and TargetSE parameters for Transformation ID:',
                        trans['TransformationID'])
         continue
 
-      trans['SourceSE'] = eval(res['Value']['SourceSE'])
-      trans['TargetSE'] = eval(res['Value']['TargetSE'])
+      trans['SourceSE'] = self.getSEList(trans['SourceSE'])
+      trans['TargetSE'] = self.getSEList(trans['TargetSE'])
 
-      res = self.getDataTransformationType(trans['TransformationID'])
+      res = self.getDataTransformationType(trans['TransformationID'], trans.get('Body'))
       if not res['OK']:
         self.log.error('Failure to determine Data Transformation Type', "%s: %s"
                        % (trans['TransformationID'], res['Message']))
@@ -221,43 +245,71 @@ class FileStatusTransformationAgent(AgentModule):
 
     return S_OK(result)
 
+  @staticmethod
+  def getSEList(seParameter):
+    """ returns the list of storage elements stored in the SourceSE or TargetSE transformation parameter """
+    if isinstance(seParameter, (list, tuple)):
+      return list(seParameter)
+    try:
+      seList = ast.literal_eval(seParameter)
+    except (SyntaxError, ValueError):
+      seList = seParameter.split(',')
+    if isinstance(seList, basestring):
+      seList = [seList]
+    return [se.strip() for se in seList if se.strip()]
+
   def getRequestStatus(self, transID, taskIDs):
-    """ returns request statuses for a given list of task IDs """
-    res = self.tClient.getTransformationTasks(condDict={'TransformationID': transID, 'TaskID': taskIDs})
-    if not res['OK']:
-      self.log.error('Failure to get Transformation Tasks for Transformation ID:', transID)
-      return res
+    """ returns request statuses for a given list of task IDs
+
+    The tasks are looked up in chunks of `TaskChunkSize`, the statuses are kept until the next transformation is
+    processed.
+    """
+    if not isinstance(taskIDs, (list, tuple, set)):
+      taskIDs = [taskIDs]
+    cachedStatus = self.requestStatusCache.setdefault(transID, {})
+    requestStatus = dict((taskID, cachedStatus[taskID]) for taskID in taskIDs if taskID in cachedStatus)
+    missingTaskIDs = sorted(set(taskID for taskID in taskIDs if taskID is not None and taskID not in cachedStatus))
+
+    for taskChunk in breakListIntoChunks(missingTaskIDs, self.taskChunkSize):
+      res = self.tClient.getTransformationTasks(condDict={'TransformationID': transID, 'TaskID': taskChunk})
+      if not res['OK']:
+        self.log.error('Failure to get Transformation Tasks for Transformation ID:', transID)
+        return res
 
-    result = res['Value']
-    requestStatus = {}
-    for task in result:
-      requestStatus[task['TaskID']] = {'RequestStatus': task['ExternalStatus'], 'RequestID': long(task['ExternalID'])}
+      for task in res['Value']:
+        requestStatus[task['TaskID']] = cachedStatus[task['TaskID']] = {'RequestStatus': task['ExternalStatus'],
+                                                                        'RequestID': long(task['ExternalID'])}
 
     return S_OK(requestStatus)
 
-  def getDataTransformationType(self, transID):
-    """ returns transformation types Replication/Moving/Unknown for a given transformation """
-    res = self.tClient.getTransformationParameters(transID, 'Body')
-    if not res['OK']:
-      return res
+  def getDataTransformationType(self, transID, transBody=None):
+    """ returns transformation types Replication/Moving/Unknown for a given transformation
+
+    :param transBody: Body of the transformation, if it is not given it is obtained from the TransformationSystem
+    """
+    if transBody is None:
+      res = self.tClient.getTransformationParameters(transID, 'Body')
+      if not res['OK']:
+        return res
+      transBody = res['Value']
 
     # if body is empty then we assume that it is a replication transformation
-    if not res['Value']:
+    if not transBody:
       return S_OK(REPLICATION_TRANS)
 
     replication = False
     rmReplica = False
     try:
-      body = json.loads(res['Value'])
+      body = json.loads(transBody)
       for operation in body:
         if 'ReplicateAndRegister' in operation:
           replication = True
         if 'RemoveReplica' in operation:
           rmReplica = True
     except ValueError:
-      if 'ReplicateAndRegister' in res['Value']:
+      if 'ReplicateAndRegister' in transBody:
         replication = True
-        if 'RemoveReplica' in res['Value']:
+        if 'RemoveReplica' in transBody:
           rmReplica = True
 
     if rmReplica and replication:
@@ -266,7 +318,7 @@ class FileStatusTransformationAgent(AgentModule):
     if replication:
       return S_OK(REPLICATION_TRANS)
 
-    return S_ERROR("Unknown Transformation Type '%r'" % res['Value'])
+    return S_ERROR("Unknown Transformation Type '%r'" % transBody)
 
   def setFileStatus(self, transID, transFiles, status):
     """ sets transformation file status  """
@@ -288,18 +340,15 @@ class FileStatusTransformationAgent(AgentModule):
                                         'AvailableOnTarget': transFile['AvailableOnTarget']})
     return S_OK()
 
-  def selectFailedRequests(self, transFile):
-    """ returns True if transformation file has a failed request otherwise returns False """
-    res = self.getRequestStatus(transFile['TransformationID'], transFile['TaskID'])
+  def selectFailedRequestFiles(self, transID, transFiles):
+    """ returns the transformation files which have a failed request, looking up the requests of all files at once """
+    res = self.getRequestStatus(transID, [transFile['TaskID'] for transFile in transFiles])
     if not res['OK']:
-      self.log.error('Failure to get Request Status for Assigned File')
-      return False
-    result = res['Value']
-
-    if result[transFile['TaskID']]['RequestStatus'] == 'Failed':
-      return True
-
-    return False
+      self.log.error('Failure to get Request Status for Assigned Files')
+      return []
+    requestStatus = res['Value']
+    return [transFile for transFile in transFiles
+            if requestStatus.get(transFile['TaskID'], {}).get('RequestStatus') == 'Failed']
 
   def retryStrategyForFiles(self, transID, transFiles):
     """ returns retryStrategy Reset Request if a request is found in RMS, otherwise returns set file status to unused"""
@@ -431,7 +480,7 @@ class FileStatusTransformationAgent(AgentModule):
 
   def applyActions(self, transID, actions):
     """ sets new file statuses and resets requests """
-    for action, transFiles in actions.iteritems():
+    for action, transFiles in actions.items():
       if action == SET_PROCESSED and transFiles:
         self.setFileStatus(transID, transFiles, 'Processed')
 
@@ -453,7 +502,7 @@ class FileStatusTransformationAgent(AgentModule):
     result['Failed'] = {}
     setOfSEs = set(storageElements)
 
-    for lfn, msg in res['Value']['Failed'].iteritems():
+    for lfn, msg in res['Value']['Failed'].items():
       if msg == 'No such file or directory':
         result['Successful'][lfn] = False
       else:
@@ -461,96 +510,163 @@ class FileStatusTransformationAgent(AgentModule):
 
     # check if all replicas are registered in FC
     filesFoundInFC = res['Value']['Successful']
-    for lfn, replicas in filesFoundInFC.iteritems():
+    for lfn, replicas in filesFoundInFC.items():
       result['Successful'][lfn] = setOfSEs.issubset(replicas.keys())
 
     return S_OK(result)
 
+  def _checkChunkOnSE(self, se, voName, lfnChunk):
+    """ checks if the files exist on one storage element, reusing the StorageElement objects
+
+    At most `SEWorkers` chunks are checked at the same time on each storage element.
+    """
+    with self.seLock:
+      semaphore = self.seSemaphores.setdefault((se, voName), threading.Semaphore(self.seWorkers))
+      idleStorageElements = self.storageElements.setdefault((se, voName), [])
+
+    with semaphore:
+      with self.seLock:
+        storageElement = idleStorageElements.pop() if idleStorageElements else StorageElement(se, vo=voName)
+      try:
+        self.log.notice('Checking LFNs at', '%s: %s' % (se, len(lfnChunk)))
+        return storageElement.exists(lfnChunk)
+      finally:
+        with self.seLock:
+          idleStorageElements.append(storageElement)
+
+  def checkFilesOnSEs(self, lfnsPerSE, transInfoDict):
+    """ checks concurrently if the files exist physically on the storage elements
+
+    :param dict lfnsPerSE: list of LFNs to check for each storage element
+    :param dict transInfoDict: transformation information with the AuthorDN and AuthorGroup
+    :returns: S_OK with a dictionary of 'Successful' and 'Failed' LFNs for each storage element
+    """
+    result = dict((se, {'Successful': {}, 'Failed': {}}) for se in lfnsPerSE)
+    chunks = [(se, lfnChunk) for se, lfns in lfnsPerSE.items()
+              for lfnChunk in breakListIntoChunks(lfns, self.seChunkSize)]
+    voName = chunks[0][1][0].split('/')[1] if chunks else None
+
+    with UserProxy(proxyUserDN=transInfoDict['AuthorDN'],
+                   proxyUserGroup=transInfoDict['AuthorGroup']) as proxyResult:
+      if not proxyResult['OK']:
+        return S_ERROR('Failed to get a proxy: %s' % proxyResult['Message'])
+      if not chunks:
+        return S_OK(result)
+
+      error = None
+      for se, res in concurrentMap(lambda seChunk: (seChunk[0], self._checkChunkOnSE(seChunk[0], voName, seChunk[1])),
+                                   chunks, self.seWorkers * len(lfnsPerSE), unordered=True):
+        if not res['OK']:
+          error = error or res
+          continue
+        result[se]['Successful'].update(res['Value']['Successful'])
+        result[se]['Failed'].update(res['Value']['Failed'])
+
+    if error:
+      return error
+    return S_OK(result)
+
   def existsOnSE(self, storageElements, lfns, transInfoDict):
     """ checks if the given files exist physically on a list of storage elements"""
 
     result = {}
     result['Failed'] = {}
     result['Successful'] = {}
-    authorDN = transInfoDict['AuthorDN']
-    authorGroup = transInfoDict['AuthorGroup']
 
     if not lfns:
       return S_OK(result)
 
-    voName = lfns[0].split('/')[1]
-    with UserProxy(proxyUserDN=authorDN, proxyUserGroup=authorGroup) as proxyResult:
-      if not proxyResult['OK']:
-        return S_ERROR('Failed to get a proxy: %s' % proxyResult['Message'])
-      for se in storageElements:
-        for lfnChunk in breakListIntoChunks(lfns, 200):
-          self.log.notice('Checking LFNs at', '%s: %s' % (se, len(lfnChunk)))
-          res = StorageElement(se, vo=voName).exists(lfnChunk)
-          if not res['OK']:
-            return res
-          for lfn, status in res['Value']['Successful'].iteritems():
-            if lfn not in result['Successful']:
-              result['Successful'][lfn] = status
-            if not status:
-              result['Successful'][lfn] = False
-          result['Failed'].setdefault(se, {}).update(res['Value']['Failed'])
+    res = self.checkFilesOnSEs(dict((se, lfns) for se in storageElements), transInfoDict)
+    if not res['OK']:
+      return res
+
+    for se in storageElements:
+      for lfn, status in res['Value'][se]['Successful'].items():
+        result['Successful'][lfn] = result['Successful'].get(lfn, True) and status
+      result['Failed'][se] = res['Value'][se]['Failed']
 
     return S_OK(result)
 
-  def exists(self, storageElements, lfns, transInfoDict):
-    """ checks if files exists on both file catalog and storage elements """
+  def existsForSEGroups(self, seGroups, lfns, transInfoDict):
+    """ checks if files exist on both file catalog and storage elements, for several groups of storage elements
 
-    fcRes = self.existsInFC(storageElements, lfns)
-    if not fcRes['OK']:
-      self.logError('Failure to determine if files exists in File Catalog ', "%s" % fcRes['Message'])
-      return fcRes
+    The files are checked on the storage elements of all groups at the same time.
 
-    if fcRes['Value']['Failed']:
-      self.logError("Failed FileCatalog Response ", "%s" % fcRes['Value']['Failed'])
+    :param list seGroups: list of lists of storage elements, e.g. the source and target storage elements
+    :returns: S_OK with a list of 'Successful' and 'Failed' LFNs for each group of storage elements
+    """
+    fcResults = []
+    lfnsPerSE = defaultdict(set)
+    for storageElements in seGroups:
+      fcRes = self.existsInFC(storageElements, lfns)
+      if not fcRes['OK']:
+        self.logError('Failure to determine if files exists in File Catalog ', "%s" % fcRes['Message'])
+        return fcRes
 
-    # check if files found in file catalog also exist on SE
-    checkLFNsOnStorage = [lfn for lfn in fcRes['Value']['Successful'] if fcRes['Value']['Successful'][lfn]]
+      if fcRes['Value']['Failed']:
+        self.logError("Failed FileCatalog Response ", "%s" % fcRes['Value']['Failed'])
+
+      # check if files found in file catalog also exist on SE
+      fcResults.append(fcRes['Value'])
+      for se in storageElements:
+        lfnsPerSE[se].update(lfn for lfn, found in fcRes['Value']['Successful'].items() if found)
 
     # no files were found in FC, return the result instead of verifying them on SE
-    if not checkLFNsOnStorage:
-      return fcRes
+    lfnsPerSE = dict((se, sorted(seLFNs)) for se, seLFNs in lfnsPerSE.items() if seLFNs)
+    if not lfnsPerSE:
+      return S_OK(fcResults)
 
-    seRes = self.existsOnSE(storageElements, checkLFNsOnStorage, transInfoDict)
+    seRes = self.checkFilesOnSEs(lfnsPerSE, transInfoDict)
     if not seRes['OK']:
       self.logError('Failure to determine if files exist on SE ', "%s" % seRes['Message'])
       return seRes
 
-    for se in storageElements:
-      if seRes['Value']['Failed'][se]:
-        self.logError('Failed to determine if files exist on SE ', "%s %s" % (se, seRes['Value']['Failed'][se]))
+    for se in lfnsPerSE:
+      if seRes['Value'][se]['Failed']:
+        self.logError('Failed to determine if files exist on SE ', "%s %s" % (se, seRes['Value'][se]['Failed']))
         return S_ERROR()
 
-    fcResult = fcRes['Value']['Successful']
-    seResult = seRes['Value']['Successful']
-    for lfn in fcResult:
-      if fcResult[lfn] and not seResult[lfn]:
-        fcRes['Value']['Successful'][lfn] = False
+    for storageElements, fcResult in zip(seGroups, fcResults):
+      for lfn in fcResult['Successful']:
+        if fcResult['Successful'][lfn] and not all(seRes['Value'][se]['Successful'].get(lfn)
+                                                   for se in storageElements):
+          fcResult['Successful'][lfn] = False
 
-    return fcRes
+    return S_OK(fcResults)
+
+  def exists(self, storageElements, lfns, transInfoDict):
+    """ checks if files exists on both file catalog and storage elements """
+    res = self.existsForSEGroups([storageElements], lfns, transInfoDict)
+    if not res['OK']:
+      return res
+    return S_OK(res['Value'][0])
 
   def processTransformation(self, transID, sourceSE, targetSEs, transType, transInfoDict):
     """ process transformation for a given transformation ID """
+    startTime = time.time()
 
     actions = {}
     actions[SET_PROCESSED] = []
     actions[RETRY] = []
     actions[SET_DELETED] = []
+    self.requestStatusCache.clear()
 
-    for status in self.transformationFileStatuses:
-      res = self.tClient.getTransformationFiles(condDict={'TransformationID': transID, 'Status': status})
-      if not res['OK']:
-        errStr = 'Failure to get Transformation Files, Status: %s Transformation ID: %s Message: %s' % (status,
-                                                                                                        transID,
-                                                                                                        res['Message'])
-        self.logError(errStr)
-        continue
+    # get the files with all statuses at once, in pages of FilesPageSize files
+    res = self.tClient.getTransformationFiles(condDict={'TransformationID': transID,
+                                                        'Status': self.transformationFileStatuses},
+                                              limit=self.filesPageSize)
+    if not res['OK']:
+      errStr = 'Failure to get Transformation Files, Transformation ID: %s Message: %s' % (transID, res['Message'])
+      self.logError(errStr)
+      self.sendNotification(transID, transType, sourceSE, targetSEs)
+      return res
+
+    filesByStatus = defaultdict(list)
+    for transFile in res['Value']:
+      filesByStatus[transFile['Status']].append(transFile)
 
-      transFiles = res['Value']
+    for status in self.transformationFileStatuses:
+      transFiles = filesByStatus[status]
       if not transFiles:
         self.log.notice("No Transformation Files found with status %s for Transformation ID %d" % (status, transID))
         continue
@@ -558,23 +674,19 @@ class FileStatusTransformationAgent(AgentModule):
       self.log.notice("Processing Transformation Files with status %s for TransformationID %d " % (status, transID))
 
       if status == 'Assigned':
-        transFiles = filter(self.selectFailedRequests, transFiles)
+        transFiles = self.selectFailedRequestFiles(transID, transFiles)
 
       lfns = [transFile['LFN'] for transFile in transFiles]
 
       if not lfns:
         continue
 
-      res = self.exists(sourceSE, lfns, transInfoDict)
+      res = self.existsForSEGroups([sourceSE, targetSEs], lfns, transInfoDict)
       if not res['OK']:
         continue
 
-      resultSourceSe = res['Value']['Successful']
-
-      res = self.exists(targetSEs, lfns, transInfoDict)
-      if not res['OK']:
-        continue
-      resultTargetSEs = res['Value']['Successful']
+      resultSourceSe = res['Value'][0]['Successful']
+      resultTargetSEs = res['Value'][1]['Successful']
 
       for transFile in transFiles:
         lfn = transFile['LFN']
@@ -586,6 +698,8 @@ class FileStatusTransformationAgent(AgentModule):
       checkFiles(actions, transFiles, transType)
 
     self.applyActions(transID, actions)
+    self.cycleTimes[transID] = time.time() - startTime
+    self.log.notice('Processed transformation', '%s in %.1f s' % (transID, self.cycleTimes[transID]))
     self.sendNotification(transID, transType, sourceSE, targetSEs)
 
     return S_OK()
@@ -0,0 +1,114 @@
+"""Benchmark DataRecoveryAgent.setPendingRequests for large productions.
+
+Runs the current and the previous implementation of setPendingRequests for a synthetic production against a stub
+ReqClient, which simulates the latency of the service calls, and reports the time and the number of calls.
+
+Usage::
+
+  python Benchmark_setPendingRequests.py [nJobs] [requestFraction] [latencyInMs]
+
+"""
+
+from __future__ import print_function
+
+import sys
+import time
+from collections import OrderedDict
+
+from mock import patch, MagicMock as Mock
+
+from DIRAC import S_OK
+from DIRAC.Core.Utilities.List import breakListIntoChunks
+
+from ILCDIRAC.ILCTransformationSystem.Agent.DataRecoveryAgent import DataRecoveryAgent
+from ILCDIRAC.ILCTransformationSystem.Utilities.JobInfo import JobInfo
+
+__RCSID__ = "$Id$"
+
+
+class StubRequest(object):
+  """Request as returned by readRequestsForJobs."""
+
+  def __init__(self, requestID, status):
+    self.RequestID = requestID
+    self.Status = status
+
+
+class StubReqClient(object):
+  """ReqClient with requests for a fraction of the jobs, every service call takes latency seconds."""
+
+  def __init__(self, requestFraction, latency):
+    self.every = max(1, int(round(1. / requestFraction)))
+    self.latency = latency
+    self.calls = 0
+
+  def readRequestsForJobs(self, jobIDs):
+    """Return requests for every n-th job, most of them Done."""
+    self.calls += 1
+    time.sleep(self.latency)
+    requests = {}
+    for jobID in jobIDs:
+      if jobID % self.every == 0:
+        requests[jobID] = StubRequest(jobID * 10, 'Waiting' if jobID % (self.every * 10) == 0 else 'Done')
+    return S_OK({'Successful': requests, 'Failed': {}})
+
+  def getRequestStatus(self, requestID):
+    """Return the status of the request in the DB."""
+    self.calls += 1
+    time.sleep(self.latency)
+    return S_OK('Waiting' if requestID % (self.every * 100) == 0 else 'Done')
+
+
+def legacySetPendingRequests(dra, jobs):
+  """The previous implementation: one status call per request and a linear search for the job."""
+  for jobChunk in breakListIntoChunks(jobs.values(), 1000):
+    jobIDs = [job.jobID for job in jobChunk]
+    while True:
+      result = dra.reqClient.readRequestsForJobs(jobIDs)
+      if result['OK']:
+        break
+    for jobID in result['Value']['Successful']:
+      request = result['Value']['Successful'][jobID]
+      requestID = request.RequestID
+      dbStatus = dra.reqClient.getRequestStatus(requestID).get('Value', 'Unknown')
+      for job in jobChunk:
+        if job.jobID == jobID:
+          job.pendingRequest = dbStatus not in ('Done', 'Canceled')
+          break
+
+
+def makeJobs(nJobs):
+  """Create a synthetic production."""
+  return OrderedDict((jobID, JobInfo(jobID, 'Done', 1234, 'MCSimulation')) for jobID in range(1, nJobs + 1))
+
+
+def runBenchmark(nJobs, requestFraction, latency):
+  """Run both implementations and print the results."""
+  with patch('DIRAC.Core.Base.AgentModule.PathFinder', new=Mock()), \
+       patch('DIRAC.ConfigurationSystem.Client.PathFinder.getSystemInstance', new=Mock()), \
+       patch('ILCDIRAC.ILCTransformationSystem.Agent.DataRecoveryAgent.ReqClient', new=Mock()):
+    dra = DataRecoveryAgent(agentName='ILCTransformationSystem/DataRecoveryAgent', loadName='Benchmark')
+  dra.log = Mock()
+
+  results = {}
+  for name, function in (('legacy', lambda jobs: legacySetPendingRequests(dra, jobs)),
+                         ('current', dra.setPendingRequests)):
+    jobs = makeJobs(nJobs)
+    dra.reqClient = StubReqClient(requestFraction, latency)
+    start = time.time()
+    function(jobs)
+    results[name] = (time.time() - start, dra.reqClient.calls, sorted(job.jobID for job in jobs.values()
+                                                                         if job.pendingRequest))
+    print('%-8s %8.2fs %8d calls %6d pending' % (name, results[name][0], results[name][1], len(results[name][2])))
+  print('speedup  %8.1fx' % (results['legacy'][0] / results['current'][0]))
+  if results['legacy'][2] != results['current'][2]:
+    print('ERROR: the implementations found different pending requests')
+    return 1
+  return 0
+
+
+if __name__ == '__main__':
+  NJOBS = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+  FRACTION = float(sys.argv[2]) if len(sys.argv) > 2 else 0.2
+  LATENCY = float(sys.argv[3]) / 1000. if len(sys.argv) > 3 else 0.5 / 1000.
+  sys.exit(runBenchmark(NJOBS, FRACTION, LATENCY))
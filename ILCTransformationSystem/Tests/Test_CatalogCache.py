@@ -0,0 +1,105 @@
+"""Test the CatalogCache."""
+
+import pytest
+from mock import MagicMock as Mock
+
+from DIRAC import S_OK, S_ERROR
+
+from ILCDIRAC.ILCTransformationSystem.Utilities.CatalogCache import CatalogCache
+
+__RCSID__ = "$Id$"
+
+
+@pytest.fixture
+def catalog():
+  """Return a mocked catalog client."""
+  fcMock = Mock(name='FileCatalogClient')
+  fcMock.getMetadataFields.return_value = S_OK({'DirectoryMetaFields': {'ProdID': 'INT'}, 'FileMetaFields': {}})
+  fcMock.findDirectoriesByMetadata.side_effect = lambda meta: S_OK({1: '/ilc/prod/%s' % meta['ProdID']})
+  fcMock.getDirectoryUserMetadata.side_effect = lambda path: S_OK({'Path': path})
+  fcMock.setMetadataBulk.return_value = S_OK({'Successful': {}, 'Failed': {}})
+  return fcMock
+
+
+def test_lookups(catalog):
+  """Call the catalog once for identical lookups, return copies of the results."""
+  cache = CatalogCache(catalog)
+  assert cache.findDirectoriesByMetadata({'ProdID': 1, 'Energy': '3tev'})['Value'] == {1: '/ilc/prod/1'}
+  assert cache.findDirectoriesByMetadata({'Energy': '3tev', 'ProdID': 1})['Value'] == {1: '/ilc/prod/1'}
+  assert cache.findDirectoriesByMetadata({'ProdID': 2})['Value'] == {1: '/ilc/prod/2'}
+  assert catalog.findDirectoriesByMetadata.call_count == 2
+
+  res = cache.getDirectoryUserMetadata('/ilc/prod/1')
+  res['Value'].update({'Energy': '3tev'})
+  assert cache.getDirectoryUserMetadata('/ilc/prod/1')['Value'] == {'Path': '/ilc/prod/1'}
+  assert catalog.getDirectoryUserMetadata.call_count == 1
+  assert (cache.hits, cache.misses) == (2, 3)
+
+
+def test_failed_lookups(catalog):
+  """Do not keep failed lookups."""
+  cache = CatalogCache(catalog)
+  catalog.getMetadataFields.return_value = S_ERROR('No connection')
+  assert not cache.getMetadataFields()['OK']
+  catalog.getMetadataFields.return_value = S_OK({'DirectoryMetaFields': {}, 'FileMetaFields': {}})
+  assert cache.getMetadataFields()['OK']
+  assert cache.getMetadataFields()['OK']
+  assert catalog.getMetadataFields.call_count == 2
+
+
+def test_modifying_calls(catalog):
+  """Forget the directories and their metadata after the catalog was changed, keep the metadata fields."""
+  cache = CatalogCache(catalog)
+  cache.getMetadataFields()
+  cache.findDirectoriesByMetadata({'ProdID': 1})
+  cache.getDirectoryUserMetadata('/ilc/prod/1')
+  assert cache.setMetadataBulk({'/ilc/prod/1': {'ProdID': 1}})['OK']
+  cache.getMetadataFields()
+  cache.findDirectoriesByMetadata({'ProdID': 1})
+  cache.getDirectoryUserMetadata('/ilc/prod/1')
+  assert catalog.getMetadataFields.call_count == 1
+  assert catalog.findDirectoriesByMetadata.call_count == 2
+  assert catalog.getDirectoryUserMetadata.call_count == 2
+
+  cache.clear()
+  cache.getMetadataFields()
+  assert catalog.getMetadataFields.call_count == 2
+
+
+def test_changed_during_lookup(catalog):
+  """Do not keep the result of a lookup made while the catalog was changed."""
+  cache = CatalogCache(catalog)
+
+  def lookupWhileChanging(path):
+    """Change the catalog while the lookup is running."""
+    cache.setMetadataBulk({path: {'ProdID': 1}})
+    return S_OK({'Path': path})
+  catalog.getDirectoryUserMetadata.side_effect = lookupWhileChanging
+  cache.getDirectoryUserMetadata('/ilc/prod/1')
+  cache.getDirectoryUserMetadata('/ilc/prod/1')
+  assert catalog.getDirectoryUserMetadata.call_count == 2
+
+
+def test_other_calls(catalog):
+  """Pass on the calls which do not change the catalog without clearing the cache."""
+  cache = CatalogCache(catalog)
+  cache.getDirectoryUserMetadata('/ilc/prod/1')
+  catalog.isDirectory.return_value = S_OK({'Successful': {'/ilc/prod/1': True}, 'Failed': {}})
+  assert cache.isDirectory('/ilc/prod/1')['Value']['Successful'] == {'/ilc/prod/1': True}
+  cache.getReplicas('/ilc/prod/1/file.slcio')
+  cache.getMetadataSet('someSet', True)
+  cache.getDirectoryUserMetadata('/ilc/prod/1')
+  assert catalog.getDirectoryUserMetadata.call_count == 1
+  assert catalog.isDirectory.call_count == 1
+  cache.createDirectory('/ilc/prod/2')
+  cache.getDirectoryUserMetadata('/ilc/prod/1')
+  assert catalog.getDirectoryUserMetadata.call_count == 2
+
+
+def test_field_calls(catalog):
+  """Forget the metadata fields after they were changed."""
+  cache = CatalogCache(catalog)
+  cache.getMetadataFields()
+  cache.addMetadataField('Detector', 'VARCHAR(128)')
+  cache.getMetadataFields()
+  assert catalog.getMetadataFields.call_count == 2
@@ -1,7 +1,10 @@
 """Test the DataRecoveryAgent"""
 
+import os
+import shutil
+import tempfile
 import unittest
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from mock import MagicMock as Mock, patch, ANY
 
 from parameterized import parameterized, param
@@ -32,6 +35,8 @@ class TestDRA( unittest.TestCase ):
     self.dra.fcClient=Mock( name="fcMock", spec=DIRAC.Resources.Catalog.FileCatalogClient.FileCatalogClient )
     self.dra.jobMon=Mock( name="jobMonMock", spec=DIRAC.WorkloadManagementSystem.Client.JobMonitoringClient.JobMonitoringClient)
     self.dra.printEveryNJobs = 10
+    self.dra.useJobResultCache = False
+    self.dra.existsBackoff = 0
     self.dra.log = Mock( name="LogMock" )
     self.dra.addressTo = 'myself'
     self.dra.addressFrom = 'me'
@@ -415,6 +420,7 @@ class TestDRA( unittest.TestCase ):
     mockJobs = dict((i, self.getTestMock(jobID=i)) for i in xrange(11))
     reqMock = Mock()
     reqMock.RequestID = 666
+    reqMock.Status = 'Waiting'
     reqClient = Mock(name="reqMock", spec=DIRAC.RequestManagementSystem.Client.ReqClient.ReqClient)
     reqClient.readRequestsForJobs.return_value = S_OK({"Successful": {6: reqMock}})
     reqClient.getRequestStatus.return_value = {'Value': 'Done'}
@@ -429,6 +435,7 @@ class TestDRA( unittest.TestCase ):
     mockJobs = dict((i, self.getTestMock(jobID=i)) for i in xrange(11))
     reqMock = Mock()
     reqMock.RequestID = 555
+    reqMock.Status = 'Waiting'
     reqClient = Mock(name="reqMock", spec=DIRAC.RequestManagementSystem.Client.ReqClient.ReqClient)
     reqClient.readRequestsForJobs.return_value = S_OK({'Successful': {5: reqMock}})
     reqClient.getRequestStatus.return_value = {'Value': 'Pending'}
@@ -470,3 +477,184 @@ class TestDRA( unittest.TestCase ):
     lfnExistence = self.dra.getLFNStatus(mockJobs)
     self.assertEqual(lfnExistence, {'/my/stupid/file.lfn': True,
                                     '/my/stupid/file2.lfn': True})
+
+  def test_getLFNStatus_jdls(self):
+    """Check that getLFNStatus passes the JDLs obtained in bulk to the jobs."""
+    mockJobs = dict((i, self.getTestMock(jobID=i)) for i in xrange(5))
+    for job in mockJobs.values():
+      job.hasJobInformation.return_value = job.jobID != 3
+    self.dra.fcClient.exists.return_value = S_OK({'Successful': {}})
+    self.dra.diracILC = Mock(name='diracILCMock')
+    self.dra.diracILC.getJobJDL.side_effect = lambda jobID: S_OK({'JobID': jobID})
+    self.dra.getLFNStatus(mockJobs)
+    self.dra.diracILC.getJobJDL.assert_called_once_with(3)
+    mockJobs[3].getJobInformation.assert_called_once_with(self.dra.diracILC, self.dra.jobMon,
+                                                          jdlParameters={'JobID': 3})
+    mockJobs[1].getJobInformation.assert_called_once_with(self.dra.diracILC, self.dra.jobMon, jdlParameters=None)
+
+  def test_getJDLs(self):
+    """Check the getJDLs function."""
+    self.dra.jdlWorkers = 3
+    self.dra.jdlChunkSize = 4
+    self.dra.jdlRetries = 2
+    self.dra.diracILC = Mock(name='diracILCMock')
+    failures = defaultdict(int)
+
+    def getJobJDL(jobID):
+      """fail once for job 5, always for job 7"""
+      if jobID == 7 or (jobID == 5 and not failures[jobID]):
+        failures[jobID] += 1
+        return S_ERROR('timeout')
+      return S_OK({'JobID': jobID})
+    self.dra.diracILC.getJobJDL.side_effect = getJobJDL
+    jdls = self.dra.getJDLs(range(10))
+    self.assertEqual(sorted(jdls), [0, 1, 2, 3, 4, 5, 6, 8, 9])
+    self.assertEqual(jdls[5], {'JobID': 5})
+    self.assertEqual(failures[7], 3)
+    self.assertEqual(self.dra.diracILC.getJobJDL.call_count, 13)
+    self.assertEqual(self.dra.getJDLs([]), {})
+
+  def test_treatProduction_jobResults(self):
+    """Check that only jobs which changed are checked when the job results are kept."""
+    from ILCDIRAC.ILCTransformationSystem.Utilities.JobInfo import JobInfo
+    tmpdir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, tmpdir)
+    self.dra.useJobResultCache = True
+    self.dra.am_getWorkDirectory = Mock(return_value=tmpdir)
+    tasksDict = {1: [dict(FileID=1, LFN='/in/1', Status='Processed', ErrorCount=0)],
+                 2: [dict(FileID=2, LFN='/in/2', Status='Processed', ErrorCount=0)]}
+    transInfoDict = dict(TransformationID=1234, TransformationName="TestProd12", Type="MCSimulation",
+                         AuthorDN='/some/cert/owner', AuthorGroup='Test_Prod')
+
+    def getJobs(**_kwargs):
+      """return two fresh jobs"""
+      return OrderedDict((jobID, JobInfo(jobID, 'Done', 1234, 'MCSimulation')) for jobID in (1, 2)), 2, 0
+
+    def checkAllJobs(jobs, *_args):
+      """fill the job information like the real check would, job 2 needs an action"""
+      for job in jobs.values():
+        job.inputFiles = ['/in/%d' % job.jobID]
+        job.outputFiles = ['/out/%d' % job.jobID]
+        job.taskID = job.jobID
+        self.dra._DataRecoveryAgent__setJobResult(job, 'Consistent' if job.jobID == 1 else 'Action',
+                                                 tasksDict, {'/in/1': 1, '/in/2': 2})
+    self.dra.checkAllJobs = Mock(side_effect=checkAllJobs)
+    tInfoMock = Mock(name='tInfoMock')
+    tInfoMock.getJobs.side_effect = getJobs
+    tInfoMock.checkTasksStatus.return_value = tasksDict
+    with patch('%s.TransformationInfo' % MODULE_NAME, new=Mock(return_value=tInfoMock)):
+      self.dra.treatProduction(1234, transInfoDict)
+      self.assertEqual(list(self.dra.checkAllJobs.call_args[0][0]), [1, 2])
+      self.assertTrue(os.path.exists(os.path.join(tmpdir, 'JobResults_00001234.json')))
+
+      self.dra.jobCache.clear()
+      self.dra.treatProduction(1234, transInfoDict)
+      self.assertEqual(list(self.dra.checkAllJobs.call_args[0][0]), [2])
+      # the information from the JDL is filled for the jobs to check
+      self.assertEqual(self.dra.checkAllJobs.call_args[0][0][2].outputFiles, ['/out/2'])
+
+      # status of the input file changed
+      tasksDict[1][0]['Status'] = 'Unused'
+      self.dra.jobCache.clear()
+      self.dra.treatProduction(1234, transInfoDict)
+      self.assertEqual(list(self.dra.checkAllJobs.call_args[0][0]), [1, 2])
+
+  def test_removeSettledJobs_keep(self):
+    """Check that the input files of settled jobs which were kept are marked as processed."""
+    from ILCDIRAC.ILCTransformationSystem.Utilities.JobInfo import JobInfo
+    self.dra.jobResults = Mock(name='jobResults')
+    self.dra.jobResults.fillJobInformation.return_value = True
+    self.dra.jobResults.isSettled.side_effect = lambda job, _fingerprint: job.jobID != 3
+    self.dra.jobResults.getVerdict.side_effect = lambda job: 'Other Tasks --> Keep' if job.jobID == 1 else 'Consistent'
+    jobs = OrderedDict((jobID, JobInfo(jobID, 'Done', 1234, 'MCSimulation')) for jobID in (1, 2, 3))
+    for job in jobs.values():
+      job.inputFiles = ['/in/%d' % job.jobID]
+    self.dra.inputFilesProcessed = set()
+    self.assertEqual(list(self.dra.removeSettledJobs(jobs, None, None)), [3])
+    self.assertEqual(self.dra.inputFilesProcessed, set(['/in/1']))
+
+  def test_execute_pruneResults(self):
+    """Check that the job results of transformations which are no longer treated are removed."""
+    self.dra.treatProduction = Mock()
+    self.dra.sendNotification = Mock()
+    self.dra.productionsToIgnore = ['125']
+    self.dra.am_getWorkDirectory = Mock(return_value='/work/dir')
+    self.dra.getEligibleTransformations = Mock(return_value=S_OK({'124': dict(TransformationID=124),
+                                                                  '125': dict(TransformationID=125)}))
+    with patch('%s.pruneResultFiles' % MODULE_NAME) as pruneMock:
+      self.assertTrue(self.dra.execute()['OK'])
+      pruneMock.assert_not_called()
+      self.dra.useJobResultCache = True
+      self.assertTrue(self.dra.execute()['OK'])
+      pruneMock.assert_called_once_with('/work/dir', ['124'])
+
+  def test_checkJob_verdict(self):
+    """Check the return value of checkJob."""
+    tInfoMock = Mock(name='tInfoMock')
+    job = self.getTestMock()
+    job.tType = 'MCGeneration'
+    job.allFilesExist.return_value = True
+    job.status = 'Failed'
+    self.assertEqual(self.dra.checkJob(job, tInfoMock), "NoInputFiles: job 'Done' ")
+    job.status = 'Done'
+    job.allFilesMissing.return_value = False
+    self.assertEqual(self.dra.checkJob(job, tInfoMock), 'Consistent')
+
+  def test_getFileExistence(self):
+    """Check that getFileExistence checks every LFN once, in parallel chunks."""
+    self.dra.existsChunkSize = 3
+    self.dra.existsWorkers = 2
+    lfns = ['/lfn/%d' % index for index in range(10)]
+    self.dra.fcClient.exists.side_effect = lambda chunk: S_OK({'Successful': dict((lfn, lfn != '/lfn/3')
+                                                                               for lfn in chunk),
+                                                               'Failed': {}})
+    lfnExistence = self.dra.getFileExistence(lfns + lfns[:5])
+    self.assertEqual(len(lfnExistence), 10)
+    self.assertFalse(lfnExistence['/lfn/3'])
+    self.assertTrue(lfnExistence['/lfn/4'])
+    self.assertEqual(self.dra.fcClient.exists.call_count, 4)
+    self.assertEqual(sorted(lfn for call in self.dra.fcClient.exists.call_args_list for lfn in call[0][0]),
+                     sorted(lfns))
+    self.assertEqual(self.dra.getFileExistence([]), {})
+
+  def test_getFileExistence_retries(self):
+    """Check the retries of getFileExistence."""
+    self.dra.existsRetries = 2
+    self.dra.existsBackoff = 1
+    self.dra.fcClient.exists.side_effect = [S_ERROR('timeout'), S_OK({'Successful': {'/lfn/1': True}})]
+    with patch('%s.time.sleep' % MODULE_NAME) as sleepMock:
+      self.assertEqual(self.dra.getFileExistence(['/lfn/1']), {'/lfn/1': True})
+      sleepMock.assert_called_once_with(1)
+
+      self.dra.fcClient.exists.side_effect = None
+      self.dra.fcClient.exists.return_value = S_ERROR('timeout')
+      sleepMock.reset_mock()
+      with self.assertRaisesRegexp(RuntimeError, 'timeout'):
+        self.dra.getFileExistence(['/lfn/1'])
+      self.assertEqual([call[0][0] for call in sleepMock.call_args_list], [1, 2])
+
+  def test_treatProduction_existenceFails(self):
+    """Check that the production is treated again if the file existence cannot be checked."""
+    getJobMock = Mock(name="getJobMOck")
+    getJobMock.getJobs.return_value = (Mock(name="jobsMock"), 50, 50)
+    self.dra.checkAllJobs = Mock(side_effect=RuntimeError('Failed to check file existence'))
+    transInfoDict = dict(TransformationID=1234, TransformationName="TestProd12", Type="TestProd",
+                         AuthorDN='/some/cert/owner', AuthorGroup='Test_Prod')
+    with patch("%s.TransformationInfo" % MODULE_NAME, new=Mock(return_value=getJobMock)):
+      self.dra.treatProduction(1234, transInfoDict)
+    self.assertNotIn(1234, self.dra.jobCache)
+    self.dra.log.error.assert_any_call(MatchStringWith('Failed to check the jobs'), 'Failed to check file existence')
+
+  def test_setPendingRequests_status(self):
+    """Check that the status of the request objects is used if the requests are finished."""
+    mockJobs = dict((i, self.getTestMock(jobID=i)) for i in xrange(11))
+    requests = {}
+    for jobID, status in ((3, 'Done'), (4, 'Canceled'), (5, 'Waiting'), (6, 'Failed'), (99, 'Waiting')):
+      requests[jobID] = Mock(Status=status, RequestID=100 + jobID)
+    reqClient = Mock(name="reqMock", spec=DIRAC.RequestManagementSystem.Client.ReqClient.ReqClient)
+    reqClient.readRequestsForJobs.return_value = S_OK({'Successful': requests})
+    reqClient.getRequestStatus.side_effect = lambda requestID: S_OK('Canceled' if requestID == 105 else 'Failed')
+    self.dra.reqClient = reqClient
+    self.dra.setPendingRequests(mockJobs)
+    self.assertEqual([index for index, mj in mockJobs.items() if mj.pendingRequest], [6])
+    self.assertEqual(sorted(call[0][0] for call in reqClient.getRequestStatus.call_args_list), [105, 106])
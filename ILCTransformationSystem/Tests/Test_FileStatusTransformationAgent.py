@@ -2,12 +2,14 @@
 
 import unittest
 import sys
+import threading
+import time
+from collections import defaultdict
 from contextlib import contextmanager
 from mock import MagicMock, patch
 
 import ILCDIRAC.ILCTransformationSystem.Agent.FileStatusTransformationAgent as FST
 from ILCDIRAC.ILCTransformationSystem.Agent.FileStatusTransformationAgent import FileStatusTransformationAgent
-import DIRAC.Resources.Storage.StorageElement as SeModule
 
 from DIRAC import S_OK, S_ERROR, gLogger
 import DIRAC
@@ -144,19 +146,19 @@ class TestFSTAgent(unittest.TestCase):
     self.assertFalse(res['OK'])
 
     res = self.fstAgent.getTransformations(transID=self.fakeTransID)
-    self.fstAgent.tClient.getTransformation.called_once_with(condDict={'TransformationID': self.fakeTransID,
-                                                                       'Status': self.fstAgent.transformationStatuses,
-                                                                       'Type': self.fstAgent.transformationTypes})
+    self.fstAgent.tClient.getTransformations.assert_called_with(condDict={'TransformationID': self.fakeTransID,
+                                                                          'Status': self.fstAgent.transformationStatuses,
+                                                                          'Type': self.fstAgent.transformationTypes},
+                                                                extraParams=True)
 
-    transInfoDict = {'Status': 'Active', 'TransformationID': self.fakeTransID, 'Type': 'Replication'}
+    # SourceSE and TargetSE parameters are missing
+    transInfoDict = {'Status': 'Active', 'TransformationID': self.fakeTransID, 'Type': 'Replication', 'Body': ''}
     self.fstAgent.tClient.getTransformations.return_value = S_OK([transInfoDict])
-    self.fstAgent.tClient.getTransformationParameters.return_value = S_ERROR()
     self.fstAgent.execute()
     self.fstAgent.processTransformation.assert_not_called()
     self.fstAgent.sendNotification.assert_called()
 
-    self.fstAgent.tClient.getTransformationParameters.return_value = S_OK({'TargetSE': "['CERN-DST-EOS']",
-                                                                           'SourceSE': "['CERN-SRM']"})
+    transInfoDict.update({'TargetSE': "['CERN-DST-EOS']", 'SourceSE': "['CERN-SRM']"})
     self.fstAgent.processTransformation.reset_mock()
     self.fstAgent.getDataTransformationType.return_value = S_ERROR()
     self.fstAgent.execute()
@@ -168,6 +170,16 @@ class TestFSTAgent(unittest.TestCase):
     self.fstAgent.execute()
     self.fstAgent.processTransformation.assert_called_once_with(self.fakeTransID, ['CERN-SRM'], ['CERN-DST-EOS'],
                                                                 FST.REPLICATION_TRANS, transInfoDict)
+    self.fstAgent.getDataTransformationType.assert_called_with(self.fakeTransID, '')
+    self.fstAgent.tClient.getTransformationParameters.assert_not_called()
+
+  def test_get_se_list(self):
+    """ Test that the SourceSE and TargetSE transformation parameters are converted to lists """
+    self.assertEqual(self.fstAgent.getSEList("['CERN-SRM', 'DESY-SRM']"), ['CERN-SRM', 'DESY-SRM'])
+    self.assertEqual(self.fstAgent.getSEList("'CERN-SRM'"), ['CERN-SRM'])
+    self.assertEqual(self.fstAgent.getSEList("CERN-SRM, DESY-SRM"), ['CERN-SRM', 'DESY-SRM'])
+    self.assertEqual(self.fstAgent.getSEList(['CERN-SRM']), ['CERN-SRM'])
+    self.assertEqual(self.fstAgent.getSEList("__import__('os')"), ["__import__('os')"])
 
   def test_send_notification(self):
     """ Test for sendNotification function """
@@ -259,6 +271,12 @@ class TestFSTAgent(unittest.TestCase):
     res = self.fstAgent.getDataTransformationType(self.fakeTransID)['Value']
     self.assertEquals(res, FST.REPLICATION_TRANS)
 
+    # the Body is not obtained again if it is known
+    self.fstAgent.tClient.getTransformationParameters.reset_mock()
+    res = self.fstAgent.getDataTransformationType(self.fakeTransID, 'RemoveReplica:CERN-DST-EOS;ReplicateAndRegister')
+    self.assertEquals(res['Value'], FST.MOVING_TRANS)
+    self.fstAgent.tClient.getTransformationParameters.assert_not_called()
+
   def test_get_request_status(self):
     """ Test getRequestStatus function """
     taskID = 1
@@ -366,23 +384,73 @@ class TestFSTAgent(unittest.TestCase):
     se2Result = S_OK({'Successful': {fileExists: True, fileOneRepLost: False, fileAllRepLost: False},
                       'Failed': {fileFailed: 'permission denied'}})
 
-    SeModule.StorageElementItem.exists = MagicMock()
-    SeModule.StorageElementItem.exists.return_value = S_ERROR()
-    res = self.fstAgent.existsOnSE(storageElements, files, authorInfoDict)
-    self.assertFalse(res['OK'])
+    seResults = {se1: S_ERROR(), se2: S_ERROR()}
+    seObjects = {}
 
-    res = self.fstAgent.existsOnSE(storageElements, [], authorInfoDict)
-    self.assertTrue(res['OK'])
-    self.assertEquals(res['Value']['Successful'], {})
-    self.assertEquals(res['Value']['Failed'], {})
+    def storageElement(se, vo):
+      """ return a StorageElement mock for each created object """
+      self.assertEqual(vo, 'ilc')
+      seObject = MagicMock(name=se)
+      seObject.exists.side_effect = lambda _lfns: seResults[se]
+      seObjects.setdefault(se, []).append(seObject)
+      return seObject
+
+    with patch('ILCDIRAC.ILCTransformationSystem.Agent.FileStatusTransformationAgent.StorageElement',
+               new=MagicMock(side_effect=storageElement)):
+      res = self.fstAgent.existsOnSE(storageElements, files, authorInfoDict)
+      self.assertFalse(res['OK'])
+
+      res = self.fstAgent.existsOnSE(storageElements, [], authorInfoDict)
+      self.assertTrue(res['OK'])
+      self.assertEquals(res['Value']['Successful'], {})
+      self.assertEquals(res['Value']['Failed'], {})
 
-    SeModule.StorageElementItem.exists.side_effect = [se1Result, se2Result]
-    res = self.fstAgent.existsOnSE(storageElements, files, authorInfoDict)['Value']
+      seResults.update({se1: se1Result, se2: se2Result})
+      res = self.fstAgent.existsOnSE(storageElements, files, authorInfoDict)['Value']
 
     self.assertTrue(res['Successful'][fileExists])
     self.assertFalse(res['Successful'][fileAllRepLost])
     self.assertFalse(res['Successful'][fileOneRepLost])
-    self.assertTrue(len(res['Failed']), 1)
+    self.assertEqual(res['Failed'], {se1: {}, se2: {fileFailed: 'permission denied'}})
+    # the StorageElement objects are reused
+    self.assertEqual(len(seObjects[se1]), 1)
+    self.assertEqual(len(seObjects[se1][0].exists.mock_calls), 2)
+
+  @patch('ILCDIRAC.ILCTransformationSystem.Agent.FileStatusTransformationAgent.UserProxy', new=mockedUserProxy)
+  def test_check_files_on_SEs(self):
+    """ Test that the files are checked in chunks on all SEs, with at most SEWorkers checks per SE at once """
+    self.fstAgent.seChunkSize = 2
+    self.fstAgent.seWorkers = 2
+    lfnsPerSE = {'CERN-SRM': ['/ilc/file%d' % i for i in range(7)],
+                 'DESY-SRM': ['/ilc/file%d' % i for i in range(3)]}
+    lock = threading.Lock()
+    running = defaultdict(int)
+    maxRunning = defaultdict(int)
+
+    def storageElement(se, vo):
+      """ return a StorageElement mock recording the number of concurrent checks """
+      def exists(lfns):
+        """ all files exist, except file1 on DESY-SRM """
+        with lock:
+          running[se] += 1
+          maxRunning[se] = max(maxRunning[se], running[se])
+        time.sleep(0.01)
+        with lock:
+          running[se] -= 1
+        return S_OK({'Successful': dict((lfn, se != 'DESY-SRM' or lfn != '/ilc/file1') for lfn in lfns),
+                     'Failed': {}})
+      return MagicMock(exists=MagicMock(side_effect=exists))
+
+    with patch('ILCDIRAC.ILCTransformationSystem.Agent.FileStatusTransformationAgent.StorageElement',
+               new=MagicMock(side_effect=storageElement)) as seMock:
+      res = self.fstAgent.checkFilesOnSEs(lfnsPerSE, {'AuthorDN': 'A_DN', 'AuthorGroup': 'A_GROUP'})
+
+    self.assertTrue(res['OK'])
+    self.assertEqual(sorted(res['Value']['CERN-SRM']['Successful']), lfnsPerSE['CERN-SRM'])
+    self.assertEqual(res['Value']['DESY-SRM']['Successful'],
+                     {'/ilc/file0': True, '/ilc/file1': False, '/ilc/file2': True})
+    self.assertLessEqual(maxRunning['CERN-SRM'], 2)
+    self.assertLessEqual(seMock.call_count, 4)
 
   def test_exists_on_storage_element_failProxy(self):
     """Test when failing to get a proxy."""
@@ -417,7 +485,7 @@ class TestFSTAgent(unittest.TestCase):
     files = [fileExists, fileOneRepLostOnSE, fileAllRepLostOnSEs, fileRemoved]
 
     self.fstAgent.existsInFC = MagicMock()
-    self.fstAgent.existsOnSE = MagicMock()
+    self.fstAgent.checkFilesOnSEs = MagicMock()
 
     self.fstAgent.existsInFC.return_value = S_ERROR()
 
@@ -428,49 +496,64 @@ class TestFSTAgent(unittest.TestCase):
     self.fstAgent.existsInFC.return_value = S_OK({'Successful': {fileRemoved: False},
                                                   'Failed': {}})
     self.fstAgent.exists(storageElements, [fileRemoved], transInfoDict)
-    self.fstAgent.existsOnSE.not_called()
+    self.fstAgent.checkFilesOnSEs.assert_not_called()
 
     self.fstAgent.existsInFC.return_value = S_OK({'Successful': {fileExists: True, fileOneRepLostOnSE: True,
                                                                  fileAllRepLostOnSEs: True, fileRemoved: False},
                                                   'Failed': {}})
-    self.fstAgent.existsOnSE.return_value = S_ERROR()
+    self.fstAgent.checkFilesOnSEs.return_value = S_ERROR()
     res = self.fstAgent.exists(storageElements, files, transInfoDict)
     self.assertFalse(res['OK'])
 
-    self.fstAgent.existsOnSE.return_value = S_OK({'Successful': {},
-                                                  'Failed': {se1: {fileExists: "permission denied",
-                                                                   fileOneRepLostOnSE: "permission denied",
-                                                                   fileAllRepLostOnSEs: "permission denied"},
-                                                             se2: {}}})
+    self.fstAgent.checkFilesOnSEs.return_value = S_OK({se1: {'Successful': {},
+                                                             'Failed': {fileExists: "permission denied",
+                                                                        fileOneRepLostOnSE: "permission denied",
+                                                                        fileAllRepLostOnSEs: "permission denied"}},
+                                                       se2: {'Successful': {}, 'Failed': {}}})
     res = self.fstAgent.exists(storageElements, files, transInfoDict)
     self.assertFalse(res['OK'])
 
-    self.fstAgent.existsOnSE.return_value = S_OK({'Successful': {fileExists: True, fileOneRepLostOnSE: False,
-                                                                 fileAllRepLostOnSEs: False},
-                                                  'Failed': {se1: {}, se2: {}}})
+    self.fstAgent.checkFilesOnSEs.return_value = S_OK({se1: {'Successful': {fileExists: True,
+                                                                            fileOneRepLostOnSE: True,
+                                                                            fileAllRepLostOnSEs: False},
+                                                             'Failed': {}},
+                                                       se2: {'Successful': {fileExists: True,
+                                                                            fileOneRepLostOnSE: False,
+                                                                            fileAllRepLostOnSEs: False},
+                                                             'Failed': {}}})
     res = self.fstAgent.exists(storageElements, files, transInfoDict)['Value']['Successful']
+    self.assertEqual(self.fstAgent.checkFilesOnSEs.call_args[0][0],
+                     {se1: sorted([fileExists, fileOneRepLostOnSE, fileAllRepLostOnSEs]),
+                      se2: sorted([fileExists, fileOneRepLostOnSE, fileAllRepLostOnSEs])})
     self.assertTrue(res[fileExists])
     self.assertFalse(res[fileOneRepLostOnSE])
     self.assertFalse(res[fileAllRepLostOnSEs])
     self.assertFalse(res[fileRemoved])
 
-  def test_select_failed_requests(self):
-    """ Test if selectFailedRequests function returns True if transfile has a failed request """
-
-    transFileWithFailedReq = {'TransformationID': 400103, 'TaskID': 0, 'LFN': '/ilc/file1'}
-    transFileWithDoneReq = {'TransformationID': 400103, 'TaskID': 1, 'LFN': '/ilc/file2'}
-
+  def test_select_failed_request_files(self):
+    """ Test that selectFailedRequestFiles looks up the requests of all files in chunks and caches them """
+    self.fstAgent.taskChunkSize = 2
+    transFiles = [{'TransformationID': 400103, 'TaskID': taskID, 'LFN': '/ilc/file%s' % taskID}
+                  for taskID in (0, 1, 2, 2, None)]
+    tasks = {0: self.failedTask, 1: self.doneTask,
+             2: dict(self.failedTask, TaskID=2, ExternalID=2)}
+    self.fstAgent.tClient.getTransformationTasks.side_effect = \
+        lambda condDict: S_OK([tasks[taskID] for taskID in condDict['TaskID']])
+
+    res = self.fstAgent.selectFailedRequestFiles(400103, transFiles)
+    self.assertEqual(res, [transFiles[0], transFiles[2], transFiles[3]])
+    self.assertEqual([call[1]['condDict']['TaskID'] for call in
+                      self.fstAgent.tClient.getTransformationTasks.call_args_list], [[0, 1], [2]])
+
+    # statuses are cached until the next transformation is processed
+    res = self.fstAgent.getRequestStatus(400103, [1, 2])
+    self.assertEqual(res['Value'][2]['RequestID'], 2)
+    self.assertEqual(len(self.fstAgent.tClient.getTransformationTasks.call_args_list), 2)
+
+    self.fstAgent.requestStatusCache.clear()
+    self.fstAgent.tClient.getTransformationTasks.side_effect = None
     self.fstAgent.tClient.getTransformationTasks.return_value = S_ERROR()
-    res = self.fstAgent.selectFailedRequests(transFileWithFailedReq)
-    self.assertFalse(res)
-
-    self.fstAgent.tClient.getTransformationTasks.return_value = S_OK([self.failedTask])
-    res = self.fstAgent.selectFailedRequests(transFileWithFailedReq)
-    self.assertTrue(res)
-
-    self.fstAgent.tClient.getTransformationTasks.return_value = S_OK([self.doneTask])
-    res = self.fstAgent.selectFailedRequests(transFileWithDoneReq)
-    self.assertFalse(res)
+    self.assertEqual(self.fstAgent.selectFailedRequestFiles(400103, transFiles), [])
 
   def test_retry_strategy_for_files(self):
     """ Test if the request exists then retry strategy is resetting the request otherwise set the file to unused """
@@ -561,6 +644,10 @@ class TestFSTAgent(unittest.TestCase):
 
     return S_OK({'Successful': result})
 
+  def _existsForSEGroups(self, seGroups, lfns, transInfoDict):
+    """ returns lfns availability information for the source and target SEs """
+    return S_OK([self._exists(se, lfns, transInfoDict)['Value'] for se in seGroups])
+
   def test_trans_files_treatment(self):
     """ test transformation files are treated properly (set new status / reset request)
         for replication and moving transformations """
@@ -577,39 +664,52 @@ class TestFSTAgent(unittest.TestCase):
     transFiles = [fileNotAvailableOnSrc, fileNotAvailableOnDst, fileAvailable, fileNotAvailable]
 
     # all trans files have failed requests
-    self.fstAgent.selectFailedRequests = MagicMock(return_value={tFile['TaskID']: True for tFile in transFiles})
+    self.fstAgent.selectFailedRequestFiles = MagicMock(side_effect=lambda _transID, tFiles: tFiles)
 
     # no assosiated request in rms
     self.fstAgent.retryStrategyForFiles = MagicMock(return_value=S_OK(
         {tFile['TaskID']: {'Strategy': FST.SET_UNUSED} for tFile in transFiles}))
 
-    self.fstAgent.exists = MagicMock()
+    self.fstAgent.existsForSEGroups = MagicMock()
+
+    def getTransformationFiles(condDict, limit):
+      """ returns the transformation files with the first requested status """
+      self.assertEqual(limit, self.fstAgent.filesPageSize)
+      for tFile in transFiles:
+        tFile['Status'] = condDict['Status'][0]
+      return S_OK(transFiles)
 
-    # all file statuses should be processed even if getTransformationFiles returns an error for some status
+    # the files with all statuses are obtained at once
     self.fstAgent.transformationFileStatuses = ['Assigned', 'Problematic']
     self.fstAgent.tClient.getTransformationFiles.return_value = S_ERROR()
-    self.fstAgent.processTransformation(self.fakeTransID, self.sourceSE, self.targetSE, FST.REPLICATION_TRANS,
-                                        authorInfoDict)
-    self.assertEquals(len(self.fstAgent.tClient.getTransformationFiles.mock_calls), 2)
+    res = self.fstAgent.processTransformation(self.fakeTransID, self.sourceSE, self.targetSE, FST.REPLICATION_TRANS,
+                                              authorInfoDict)
+    self.assertFalse(res['OK'])
+    self.fstAgent.tClient.getTransformationFiles.assert_called_once_with(
+        condDict={'TransformationID': self.fakeTransID, 'Status': ['Assigned', 'Problematic']},
+        limit=self.fstAgent.filesPageSize)
+    self.fstAgent.sendNotification.assert_called_once()
 
     # all file statuses should be processed even if no transformation files are found for some status
     self.fstAgent.tClient.getTransformationFiles.reset_mock()
     self.fstAgent.tClient.getTransformationFiles.return_value = S_OK([])
-    self.fstAgent.processTransformation(self.fakeTransID, self.sourceSE, self.targetSE, FST.REPLICATION_TRANS,
-                                        authorInfoDict)
-    self.assertEquals(len(self.fstAgent.tClient.getTransformationFiles.mock_calls), 2)
+    res = self.fstAgent.processTransformation(self.fakeTransID, self.sourceSE, self.targetSE, FST.REPLICATION_TRANS,
+                                              authorInfoDict)
+    self.assertTrue(res['OK'])
+    self.assertIn(self.fakeTransID, self.fstAgent.cycleTimes)
+    self.assertEquals(len(self.fstAgent.tClient.getTransformationFiles.mock_calls), 1)
 
     # all file statuses should be processed even if we get a failure to determine if transformation files
     # with some status exists in FileCatalog and StorageElements
     self.fstAgent.tClient.getTransformationFiles.reset_mock()
-    self.fstAgent.tClient.getTransformationFiles.return_value = S_OK(transFiles)
-    self.fstAgent.exists.return_value = S_ERROR()
+    self.fstAgent.tClient.getTransformationFiles.return_value = None
+    self.fstAgent.tClient.getTransformationFiles.side_effect = getTransformationFiles
+    self.fstAgent.existsForSEGroups.return_value = S_ERROR()
     self.fstAgent.processTransformation(self.fakeTransID, self.sourceSE, self.targetSE, FST.REPLICATION_TRANS,
                                         authorInfoDict)
-    self.assertEquals(len(self.fstAgent.tClient.getTransformationFiles.mock_calls), 2)
+    self.assertEquals(len(self.fstAgent.tClient.getTransformationFiles.mock_calls), 1)
 
-    self.fstAgent.tClient.getTransformationFiles.return_value = S_OK(transFiles)
-    self.fstAgent.exists.side_effect = self._exists
+    self.fstAgent.existsForSEGroups.side_effect = self._existsForSEGroups
     self.fstAgent.transformationFileStatuses = ['Assigned']
 
     # check replication transformation treatment for assigned files
@@ -456,6 +456,14 @@ class TestJI( unittest.TestCase ):
     self.assertEqual(self.jbi.inputFiles, [])
 
 
+  def test_getJobInformation_withJDL( self ):
+    """ILCTransformation.Utilities.JobInfo.getJobInformation with given JDL............................"""
+    self.jbi.getJobInformation(self.diracILC, self.jobMon, jdlParameters=self.jdl1)
+    self.diracILC.getJobJDL.assert_not_called()
+    self.assertEqual( 10256, self.jbi.taskID )
+    self.assertTrue( self.jbi.hasJobInformation() )
+    self.assertEqual(self.jbi.inputFiles, ["/ilc/prod/clic/3tev/e1e1_o/gen/00006300/004/e1e1_o_gen_6300_4077.stdhep"])
+
   def test_getOutputFiles( self ):
     """ILCTransformation.Utilities.JobInfo.getOutputFiles..........................................."""
     ## singleLFN
@@ -0,0 +1,90 @@
+"""Test the JobResultCache"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import patch, MagicMock as Mock
+
+from ILCDIRAC.ILCTransformationSystem.Utilities.JobInfo import JobInfo
+from ILCDIRAC.ILCTransformationSystem.Utilities.JobResultCache import JobResultCache, pruneResultFiles, \
+    CONSISTENT, KEEP
+
+__RCSID__ = "$Id$"
+
+MODULE_NAME = 'ILCDIRAC.ILCTransformationSystem.Utilities.JobResultCache'
+
+
+class TestJobResultCache(unittest.TestCase):
+  """Test the JobResultCache"""
+
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.fileName = os.path.join(self.tmpdir, 'JobResults.json')
+    self.job = JobInfo(123, 'Done', 1234, 'MCSimulation')
+    self.job.inputFiles = ['/in/1']
+    self.job.outputFiles = ['/out/1', '/out/2']
+    self.job.taskID = 12
+    self.job.outputFileStatus = ['Exists', 'Exists']
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def test_settled(self):
+    cache = JobResultCache(self.fileName, maxAge=100)
+    self.assertFalse(cache.isSettled(self.job, 'abc'))
+    with patch('%s.time.time' % MODULE_NAME, new=Mock(return_value=1000)):
+      cache.setResult(self.job, CONSISTENT, 'abc')
+      self.assertTrue(cache.isSettled(self.job, 'abc'))
+      self.assertFalse(cache.isSettled(self.job, 'other'))
+      self.job.status = 'Failed'
+      self.assertFalse(cache.isSettled(self.job, 'abc'))
+      self.job.status = 'Done'
+    with patch('%s.time.time' % MODULE_NAME, new=Mock(return_value=1100)):
+      self.assertFalse(cache.isSettled(self.job, 'abc'))
+    cache.setResult(self.job, 'Output Exists --> Input Processed', 'abc')
+    self.assertFalse(cache.isSettled(self.job, 'abc'))
+    cache.setResult(self.job, KEEP, 'abc')
+    self.assertTrue(cache.isSettled(self.job, 'abc'))
+    self.assertEqual(cache.getVerdict(self.job), KEEP)
+    self.assertIsNone(cache.getVerdict(JobInfo(124, 'Done', 1234, 'MCSimulation')))
+
+  def test_save_load(self):
+    cache = JobResultCache(self.fileName)
+    cache.setResult(self.job, CONSISTENT, 'abc')
+    otherJob = JobInfo(124, 'Failed', 1234, 'MCSimulation')
+    cache.setResult(otherJob, 'PendingRequest', '')
+    cache.save([123])
+
+    cache = JobResultCache(self.fileName)
+    self.assertEqual(list(cache.results), ['123'])
+    newJob = JobInfo(123, 'Done', 1234, 'MCSimulation')
+    self.assertTrue(cache.fillJobInformation(newJob))
+    self.assertEqual(newJob.outputFiles, ['/out/1', '/out/2'])
+    self.assertEqual(newJob.inputFiles, ['/in/1'])
+    self.assertEqual(newJob.taskID, 12)
+    self.assertTrue(cache.isSettled(newJob, 'abc'))
+    self.assertFalse(cache.fillJobInformation(otherJob))
+
+  def test_broken_file(self):
+    with open(self.fileName, 'w') as cacheFile:
+      cacheFile.write('{"123": ')
+    cache = JobResultCache(self.fileName)
+    self.assertEqual(cache.results, {})
+
+  def test_prune(self):
+    for prodID in (1, 2, 3):
+      JobResultCache(os.path.join(self.tmpdir, 'JobResults_%08d.json' % prodID)).save()
+    with open(os.path.join(self.tmpdir, 'other.json'), 'w') as otherFile:
+      otherFile.write('{}')
+    pruneResultFiles(self.tmpdir, ['2', 3, 4])
+    self.assertEqual(sorted(os.listdir(self.tmpdir)), ['JobResults_00000002.json', 'JobResults_00000003.json',
+                                                       'other.json'])
+    with patch('%s.os.remove' % MODULE_NAME, new=Mock(side_effect=OSError('Permission denied'))):
+      pruneResultFiles(self.tmpdir, [])
+    self.assertEqual(len(os.listdir(self.tmpdir)), 3)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -99,6 +99,7 @@ def theChain(opsMock):
   params = Mock()
   params.additionalName = ''
   params.dryRun = True
+  params.workers = 1
   with patch("ILCDIRAC.ILCTransformationSystem.scripts.dirac-clic-make-productions.CLICDetProdChain.loadParameters",
              new=Mock()), \
        patch("DIRAC.ConfigurationSystem.Client.Helpers.Operations.Operations",
@@ -574,6 +575,62 @@ def test_createTransformations_2(theChain):
   theChain.createReconstructionProduction.assert_called_once_with(task, over=True)
 
 
+def test_createTransformations_concurrent(theChain):
+  """Test creating the productions of the same level at the same time."""
+  theChain.workers = 3
+  theChain.createMovingTransformation = Mock(name='MovingTrafo')
+  theChain.createGenerationProduction = Mock(name='GenTrafo',
+                                             side_effect=lambda task: {'ProdID': task.meta['ProdID'] + 100})
+  theChain.createReconstructionProduction = Mock(name='RecTrafo',
+                                                 side_effect=lambda task, over: {'ProdID': 2 if over else 1})
+  theChain.addSimTask = Mock(name='AddSim')
+  theChain._flags._rec = True
+  theChain._flags._over = True
+
+  tasks = [Task(metaInput={'ProdID': prodID, 'Energy': '350'}, parameterDict={}, eventsPerJob=10)
+           for prodID in range(5)]
+  taskDict = defaultdict(list)
+  taskDict['GEN'].extend(tasks)
+  taskDict['REC'].append(tasks[0])
+  theChain.createTransformations(taskDict)
+  assert [call[0][1] for call in theChain.addSimTask.call_args_list] == [{'ProdID': prodID + 100}
+                                                                        for prodID in range(5)]
+  assert taskDict['MOVE_GEN'] == [{'ProdID': prodID + 100} for prodID in range(5)]
+  assert taskDict['MOVE_REC'] == [{'ProdID': 1}]
+  assert taskDict['MOVE_OVER'] == [{'ProdID': 2}]
+  assert sorted((prodType, prodID) for prodType, prodID, _duration in theChain.productionTimes) == \
+      sorted([('GEN', prodID + 100) for prodID in range(5)] + [('REC', 1), ('OVER', 2)])
+  assert theChain.createMovingTransformation.call_count == 7
+  theChain.createMovingTransformation.assert_any_call({'ProdID': 2}, 'MCReconstruction_Overlay')
+
+
+def test_createAllTransformations(theChain):
+  """Test creating the chains for all processes and energies one after the other."""
+  theChain.workers = 2
+  theChain.energies = [100, 200, 300]
+  theChain.processes = ['p1', 'p2', 'p3']
+  theChain.createTaskDict = Mock(side_effect=lambda prodID, process, energy, *args: {'process': process})
+  theChain.createTransformations = Mock(name='createTrafos')
+  theChain.reportTimes = Mock(name='reportTimes')
+  theChain.createAllTransformations()
+  assert [call[0][0]['process'] for call in theChain.createTransformations.call_args_list] == ['p1', 'p2', 'p3']
+  theChain.reportTimes.assert_called_once()
+
+  theChain.createTransformations = Mock(name='createTrafos', side_effect=RuntimeError('Failed to create'))
+  with pytest.raises(RuntimeError, match='Failed to create'):
+    theChain.createAllTransformations()
+  theChain.createTransformations.assert_called_once()
+
+
+def test_getProductionJob(theChain, pMockMod):
+  """Test that the production jobs share the catalog cache."""
+  with patch("ILCDIRAC.Interfaces.API.NewInterface.ProductionJob.ProductionJob", new=pMockMod):
+    prodJob = theChain.getProductionJob()
+  assert prodJob.fc is theChain._catalogCache
+  theChain.productionTimes = [('GEN', 123, 1.5)]
+  theChain.reportTimes(2.0)
+
+
 def test_addSimTask(theChain):
   """Test adding sim task."""
   taskDict = defaultdict(list)
@@ -804,6 +861,7 @@ def test_params_init(theParams):
   assert not theParams.dumpConfigFile
   assert theParams.dryRun
   assert theParams.additionalName == ''
+  assert theParams.workers == theScript.PRODUCTION_WORKERS
 
 
 def test_params_settters(theParams):
@@ -818,3 +876,6 @@ def test_params_settters(theParams):
   assert not theParams.dryRun
   assert theParams.setAddName('addName')['OK']
   assert theParams.additionalName, 'addName'
+  assert theParams.setWorkers('8')['OK']
+  assert theParams.workers == 8
+  assert not theParams.setWorkers('many')['OK']
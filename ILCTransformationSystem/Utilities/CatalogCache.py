@@ -0,0 +1,87 @@
+"""Cache for the catalog lookups made while creating the productions of production chains.
+
+The productions of a chain, and of the other chains created by the same script, look up the same metadata fields,
+directories and directory metadata. These lookups are answered from the cache for the lifetime of the cache object,
+i.e., one run of the script creating the productions. The calls changing the catalog clear the cached directories
+and directory metadata, the calls changing the metadata fields clear the metadata fields as well. All other calls are
+passed on to the catalog without touching the cache.
+"""
+
+import json
+import threading
+from copy import deepcopy
+from functools import partial
+
+__RCSID__ = "$Id$"
+
+#: calls which only look up information in the catalog
+CACHED_CALLS = ('getMetadataFields', 'findDirectoriesByMetadata', 'getDirectoryUserMetadata')
+#: calls whose results do not change when the catalog content changes
+PERMANENT_CALLS = ('getMetadataFields',)
+#: calls which change the directories or their metadata
+MODIFYING_CALLS = ('createDirectory', 'removeDirectory', 'changePathMode', 'changePathOwner', 'changePathGroup',
+                   'setMetadata', 'setMetadataBulk', 'removeMetadata', 'addFile', 'removeFile')
+#: calls which change the metadata fields
+FIELD_CALLS = ('addMetadataField', 'deleteMetadataField')
+
+
+class CatalogCache(object):
+  """Wrap a catalog client, cache the successful results of the lookups, pass on all other calls."""
+
+  def __init__(self, catalog):
+    """Wrap the catalog.
+
+    :param catalog: the catalog client, e.g., :class:`~DIRAC.Resources.Catalog.FileCatalogClient.FileCatalogClient`
+    """
+    self.catalog = catalog
+    self.hits = 0
+    self.misses = 0
+    self._cache = {}
+    self._generation = 0
+    self._lock = threading.Lock()
+
+  def __getattr__(self, name):
+    """Return the cached version of the lookups, the modifying calls clear the cache."""
+    attribute = getattr(self.catalog, name)
+    if not callable(attribute):
+      return attribute
+    if name in CACHED_CALLS:
+      return partial(self._cachedCall, name, attribute)
+    if name in MODIFYING_CALLS or name in FIELD_CALLS:
+      return partial(self._modifyingCall, attribute, name not in FIELD_CALLS)
+    return attribute
+
+  def _cachedCall(self, name, function, *args, **kwargs):
+    """Return the result of the lookup from the cache, or call the catalog and keep the result if successful."""
+    key = (name, json.dumps([args, kwargs], sort_keys=True, default=str))
+    with self._lock:
+      if key in self._cache:
+        self.hits += 1
+        return deepcopy(self._cache[key])
+      self.misses += 1
+      generation = self._generation
+    result = function(*args, **kwargs)
+    if result['OK']:
+      with self._lock:
+        # do not keep results obtained while the catalog was changed
+        if generation == self._generation or name in PERMANENT_CALLS:
+          self._cache[key] = deepcopy(result)
+    return result
+
+  def _modifyingCall(self, function, keepPermanent, *args, **kwargs):
+    """Call the catalog and forget everything that might have been changed by the call."""
+    try:
+      return function(*args, **kwargs)
+    finally:
+      self.clear(keepPermanent=keepPermanent)
+
+  def clear(self, keepPermanent=False):
+    """Forget the cached results.
+
+    :param bool keepPermanent: if True keep the results of the calls that do not depend on the catalog content
+    """
+    with self._lock:
+      self._generation += 1
+      for key in list(self._cache):
+        if not keepPermanent or key[0] not in PERMANENT_CALLS:
+          del self._cache[key]
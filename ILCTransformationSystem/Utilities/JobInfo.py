@@ -122,8 +122,17 @@ class JobInfo( object ):
     LOG.notice(funcName + ':' + str(self.errorCounts))
     return any(errorCount > MAXRESET for errorCount in self.errorCounts)
 
-  def getJobInformation(self, dILC, jobMon):
-    """get all the information for the job"""
+  def hasJobInformation(self):
+    """Check if input files, output files and taskID are already known, so the JDL is not needed."""
+    return bool(self.inputFiles and self.outputFiles and self.taskID)
+
+  def getJobInformation(self, dILC, jobMon, jdlParameters=None):
+    """get all the information for the job
+
+    :param dILC: DiracILC instance used to get the JDL if it is not given
+    :param jobMon: JobMonitoringClient
+    :param dict jdlParameters: JDL of the job, if it was already obtained
+    """
 
     # # this is actually slower than just getting the jdl, because getting the jdl is one service call
     # # this is three service calls to three different DBs
@@ -139,9 +148,10 @@ class JobInfo( object ):
     #   if not self.outputFiles:
     #     LOG.verbose('Did not find outputFiles for', str(self))
 
-    if not (self.inputFiles and self.outputFiles and self.taskID):
-      LOG.verbose('Have to check JDL')
-      jdlParameters = self.__getJDL(dILC)
+    if not self.hasJobInformation():
+      if jdlParameters is None:
+        LOG.verbose('Have to check JDL')
+        jdlParameters = self.__getJDL(dILC)
       # get taskID from JobName, get inputfile(s) from DownloadInputdata
       self.__getOutputFiles(jdlParameters)
       self.__getTaskID(jdlParameters)
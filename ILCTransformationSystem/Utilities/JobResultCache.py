@@ -0,0 +1,130 @@
+"""Persistent results of the DataRecoveryAgent checks for the jobs of one transformation.
+
+For every job the information obtained from the JDL (input files, output files, taskID) is kept together with the job
+status, the existence of its files, a fingerprint of the transformation file status of its task and the outcome of the
+last check. A job is *settled* if the outcome of the last check is one of SETTLED_VERDICTS and neither the job status
+nor the file status of its task changed since, so it does not have to be checked again until the result is older than
+the maximum age.
+
+Besides CONSISTENT, the KEEP verdict settles a job: the job succeeded while other tasks processed the same input, its
+actions only confirm the job and its input, and checking it again gives the same outcome. The input files of settled
+KEEP jobs still have to be marked as processed in every cycle, so that the jobs of the other tasks are cleaned up. All
+other verdicts changed the job, its files or its task, or are waiting for something, e.g., pending requests, so these
+jobs are checked again in the next cycle.
+
+There is one file per transformation, the files of transformations which are no longer treated are removed with
+:func:`pruneResultFiles`.
+"""
+
+import glob
+import json
+import os
+import time
+
+from DIRAC import gLogger
+
+__RCSID__ = "$Id$"
+
+LOG = gLogger.getSubLogger(__name__)
+
+CONSISTENT = 'Consistent'
+KEEP = 'Other Tasks --> Keep'
+#: verdicts after which a job does not have to be checked again
+SETTLED_VERDICTS = (CONSISTENT, KEEP)
+#: name of the file for the results of one transformation
+RESULT_FILE = 'JobResults_%08d.json'
+
+
+def pruneResultFiles(directory, prodIDs):
+  """Remove the result files of all transformations except the given ones.
+
+  :param str directory: directory containing the result files
+  :param prodIDs: IDs of the transformations whose results are kept
+  """
+  keep = set(RESULT_FILE % int(prodID) for prodID in prodIDs)
+  for fileName in glob.glob(os.path.join(directory, RESULT_FILE.replace('%08d', '*'))):
+    if os.path.basename(fileName) in keep:
+      continue
+    try:
+      os.remove(fileName)
+      LOG.info('Removed the job results of a transformation which is no longer treated', fileName)
+    except OSError as err:
+      LOG.warn('Cannot remove the job results', '%s: %s' % (fileName, err))
+
+
+class JobResultCache(object):
+  """Store the results of the job checks in a json file."""
+
+  def __init__(self, fileName, maxAge=86400):
+    """Load the results from the file.
+
+    :param str fileName: path of the json file
+    :param int maxAge: time in seconds after which a settled job is checked again
+    """
+    self.fileName = fileName
+    self.maxAge = maxAge
+    self.results = {}
+    self.load()
+
+  def load(self):
+    """Read the results from the file, start from scratch if it cannot be read."""
+    if not os.path.exists(self.fileName):
+      return
+    try:
+      with open(self.fileName) as cacheFile:
+        self.results = json.load(cacheFile)
+    except (IOError, ValueError) as err:
+      LOG.warn('Cannot read the job results, checking all jobs', '%s: %s' % (self.fileName, err))
+      self.results = {}
+
+  def save(self, jobIDs=None):
+    """Write the results to the file.
+
+    :param jobIDs: if given, only the results for these jobs are kept
+    """
+    if jobIDs is not None:
+      jobIDs = set(str(jobID) for jobID in jobIDs)
+      self.results = dict((jobID, result) for jobID, result in self.results.items() if jobID in jobIDs)
+    tmpName = self.fileName + '.tmp'
+    try:
+      with open(tmpName, 'w') as cacheFile:
+        json.dump(self.results, cacheFile)
+      os.rename(tmpName, self.fileName)
+    except (IOError, OSError) as err:
+      LOG.error('Cannot write the job results', '%s: %s' % (self.fileName, err))
+
+  def fillJobInformation(self, job):
+    """Set the information from the JDL of the job, if it is known."""
+    result = self.results.get(str(job.jobID))
+    if not result:
+      return False
+    job.inputFiles = list(result['InputFiles'])
+    job.outputFiles = list(result['OutputFiles'])
+    job.taskID = result['TaskID']
+    return True
+
+  def isSettled(self, job, fingerprint):
+    """Check if the job does not need to be checked again."""
+    result = self.results.get(str(job.jobID))
+    return bool(result) and \
+        result['Verdict'] in SETTLED_VERDICTS and \
+        result['Status'] == job.status and \
+        result['Fingerprint'] == fingerprint and \
+        time.time() - result['Time'] < self.maxAge
+
+  def getVerdict(self, job):
+    """Return the outcome of the last check of the job, None if the job was not checked."""
+    result = self.results.get(str(job.jobID))
+    return result['Verdict'] if result else None
+
+  def setResult(self, job, verdict, fingerprint):
+    """Store the outcome of the check of the job."""
+    self.results[str(job.jobID)] = dict(InputFiles=job.inputFiles,
+                                        OutputFiles=job.outputFiles,
+                                        InputFileStatus=job.inputFileStatus,
+                                        OutputFileStatus=job.outputFileStatus,
+                                        TaskID=job.taskID,
+                                        Status=job.status,
+                                        Fingerprint=fingerprint,
+                                        Verdict=verdict,
+                                        Time=int(time.time()))
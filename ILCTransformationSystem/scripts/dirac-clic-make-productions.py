@@ -108,6 +108,10 @@ All attributes with a ``set`` method can be changed. See
 :mod:`~ILCDIRAC.Interfaces.API.NewInterface.Applications.OverlayInput`,
 :mod:`~ILCDIRAC.Interfaces.API.NewInterface.Applications.DDSim`.
 
+The production chains for the different processes and energies are created one after the other, the productions of
+the same level in a chain are created at the same time. The number of productions created at the same time can be
+changed with the ``--workers`` option, ``--workers=1`` creates them one after the other.
+
 
 
 :since: July 14, 2017
@@ -121,17 +125,23 @@ from __future__ import print_function
 from pprint import pformat
 from collections import defaultdict
 from copy import deepcopy
+from functools import partial
 from itertools import izip_longest
 import ConfigParser
 import os
+import time
 
 from DIRAC.Core.Base import Script
 from DIRAC import S_OK, S_ERROR, gLogger
 
+from ILCDIRAC.Core.Utilities.Concurrency import concurrentMap
 from ILCDIRAC.Core.Utilities.OverlayFiles import energyWithUnit, energyToInt
 from ILCDIRAC.Core.Utilities.Utilities import listify, lowerFirst
+from ILCDIRAC.ILCTransformationSystem.Utilities.CatalogCache import CatalogCache
 from ILCDIRAC.ILCTransformationSystem.Utilities.Utilities import Task
 
+#: default number of productions created at the same time
+PRODUCTION_WORKERS = 4
 PRODUCTION_PARAMETERS = 'Production Parameters'
 PP = PRODUCTION_PARAMETERS
 APPLICATION_LIST = ['Marlin', 'DDSim', 'Overlay', 'Whizard2']
@@ -170,6 +180,7 @@ class Params(object):
     self.dumpConfigFile = False
     self.dryRun = True
     self.additionalName = ''
+    self.workers = PRODUCTION_WORKERS
 
   def setProdConf(self,fileName):
     if not os.path.exists( fileName ):
@@ -185,12 +196,20 @@ class Params(object):
   def setAddName(self, addName):
     self.additionalName = addName
     return S_OK()
+  def setWorkers(self, workers):
+    try:
+      self.workers = max(1, int(workers))
+    except ValueError:
+      return S_ERROR("ERROR: Number of workers %r is not an integer" % workers)
+    return S_OK()
 
   def registerSwitches(self):
     Script.registerSwitch("f:", "configFile=", "Set config file for production", self.setProdConf)
     Script.registerSwitch("x", "enable", "create productions, if off dry-run", self.setEnable)
     Script.registerSwitch("p", "printConfigFile", "Print a config file to stdout", self.setDumpConf)
     Script.registerSwitch("", "additionalName=", "Name to add to the production", self.setAddName)
+    Script.registerSwitch("", "workers=", "Number of productions created at the same time, default %d" %
+                          PRODUCTION_WORKERS, self.setWorkers)
     Script.setUsageMessage("""%s --configFile=myProduction""" % ("dirac-clic-make-productions", ) )
 
 
@@ -368,7 +387,6 @@ MoveTypes = %(moveTypes)s
     self.overlayEvents = ''
 
     self.cliRecoOption = ''
-    self.cliReco = ''
 
     self.whizard2Version = self._ops.getValue('Production/CLIC/DefaultWhizard2Version')
     self.whizard2SinFile = []
@@ -379,6 +397,11 @@ MoveTypes = %(moveTypes)s
 
     self._flags = self.Flags()
 
+    from DIRAC.Resources.Catalog.FileCatalogClient import FileCatalogClient
+    self._catalogCache = CatalogCache(FileCatalogClient())
+    self.workers = params.workers
+    self.productionTimes = []
+
     self.loadParameters( params )
 
     self._flags._dryRun = params.dryRun #pylint: disable=protected-access
@@ -560,7 +583,7 @@ MoveGroupSize = %(moveGroupSize)s
 # taskNames =
 
 ## optional marlin CLI options
-# cliReco = %(cliReco)s
+# cliReco = %(cliRecoOption)s
 
 overlayEventType = %(overlayEventType)s
 ## optional energy to use for overlay: e.g. 3TeV
@@ -649,10 +672,10 @@ overlayEventType = %(overlayEventType)s
 
     raise NotImplementedError( 'unknown splitType: %s ' % splitType )
 
-  def addOverlayOptionsToMarlin( self, energy ):
-    """ add options to marlin that are needed for running with overlay """
+  def getOverlayOptionsForMarlin(self, energy):
+    """ return options for marlin that are needed for running with overlay """
     energyString = self.overlayEvents if self.overlayEvents else energyWithUnit( energy )
-    self.cliReco += ' --Config.Overlay=%s ' % energyString
+    return ' --Config.Overlay=%s ' % energyString
 
   def createWhizard2Application(self, task):
     """ create Whizard2 Application """
@@ -712,13 +735,12 @@ overlayEventType = %(overlayEventType)s
     marlin.detectortype = self.detectorModel
     marlin.setKeepRecFile(False)
 
+    cliReco = ''
     if over:
       energy = float(task.meta['Energy'])
-      self.addOverlayOptionsToMarlin( energy )
+      cliReco = self.getOverlayOptionsForMarlin(energy)
 
-    self.cliReco = ' '.join([self.cliRecoOption, self.cliReco, task.cliReco]).strip()
-    marlin.setExtraCLIArguments(self.cliReco)
-    self.cliReco = ''
+    marlin.setExtraCLIArguments(' '.join([self.cliRecoOption, cliReco, task.cliReco]).strip())
 
     marlin.setSteeringFile(self.marlinSteeringFile)
 
@@ -961,6 +983,7 @@ overlayEventType = %(overlayEventType)s
     prodJob.basepath = self.basepath
     prodJob.dryrun = self._flags.dryRun
     prodJob.maxFCFoldersToCheck = 1
+    prodJob.fc = self._catalogCache
     return prodJob
 
   def _setApplicationOptions(self, appName, app, optionsDict=None):
@@ -984,37 +1007,63 @@ overlayEventType = %(overlayEventType)s
         value = value.lower() == 'true'
       getattr(app, setterFunc)(value)
 
+  def _runConcurrently(self, calls):
+    """Run the calls, up to `workers` at the same time.
+
+    :param list calls: functions without arguments
+    :returns: list of the return values, in the order of the calls
+    """
+    return list(concurrentMap(lambda call: call(), calls, self.workers))
+
+  def _timeProduction(self, prodType, createProduction, *args, **kwargs):
+    """Create a production and report how long it took."""
+    start = time.time()
+    meta = createProduction(*args, **kwargs)
+    duration = time.time() - start
+    gLogger.notice("Created %s production %s in %.1f s" % (prodType, meta.get('ProdID'), duration))
+    self.productionTimes.append((prodType, meta.get('ProdID'), duration))
+    return meta
+
   def createTransformations(self, taskDict):
-    """Create all the transformations we want to create."""
+    """Create all the transformations we want to create.
+
+    The productions of the same level only depend on the productions of the previous level, so they are created at
+    the same time.
+    """
     for pType, createProduction in [('GEN', self.createGenerationProduction),
                                     ('SPLIT', self.createSplitProduction)]:
-      for task in taskDict.get(pType, []):
-        meta = createProduction(task)
+      tasks = taskDict.get(pType, [])
+      metas = self._runConcurrently([partial(self._timeProduction, pType, createProduction, task) for task in tasks])
+      for task, meta in zip(tasks, metas):
         self.addSimTask(taskDict, meta, originalTask=task)
         taskDict['MOVE_' + pType].append(dict(meta))
 
-    for task in taskDict.get('SIM', []):
-      if not self._flags.sim:
-        continue
+    simTasks = taskDict.get('SIM', []) if self._flags.sim else []
+    for task in simTasks:
       gLogger.notice("Creating task %s" % task)
-      simMeta = self.createSimulationProduction(task)
+    simMetas = self._runConcurrently([partial(self._timeProduction, 'SIM', self.createSimulationProduction, task)
+                                      for task in simTasks])
+    for task, simMeta in zip(simTasks, simMetas):
       self.addRecTask(taskDict, simMeta, originalTask=task)
       taskDict['MOVE_SIM'].append(dict(simMeta))
 
-    for task in taskDict.get('REC', []):
-      for name, over, enabled in [('REC', False, self._flags.rec),
-                                  ('OVER', True, self._flags.over)]:
-        if enabled:
-          recMeta = self.createReconstructionProduction(task, over=over)
-          taskDict['MOVE_' + name].append(dict(recMeta))
-
-    for name, pType in [('GEN', 'MCGeneration'),
-                        ('SPLIT', 'MCGeneration'),
-                        ('SIM', 'MCSimulation'),
-                        ('REC', 'MCReconstruction'),
-                        ('OVER', 'MCReconstruction_Overlay')]:
-      for meta in taskDict.get('MOVE_' + name, []):
-        self.createMovingTransformation(meta, pType)
+    recProductions = [(task, name, over) for task in taskDict.get('REC', [])
+                      for name, over, enabled in [('REC', False, self._flags.rec),
+                                                  ('OVER', True, self._flags.over)]
+                      if enabled]
+    recMetas = self._runConcurrently([partial(self._timeProduction, name, self.createReconstructionProduction,
+                                              task, over=over)
+                                      for task, name, over in recProductions])
+    for (_task, name, _over), recMeta in zip(recProductions, recMetas):
+      taskDict['MOVE_' + name].append(dict(recMeta))
+
+    self._runConcurrently([partial(self.createMovingTransformation, meta, pType)
+                           for name, pType in [('GEN', 'MCGeneration'),
+                                               ('SPLIT', 'MCGeneration'),
+                                               ('SIM', 'MCSimulation'),
+                                               ('REC', 'MCReconstruction'),
+                                               ('OVER', 'MCReconstruction_Overlay')]
+                           for meta in taskDict.get('MOVE_' + name, [])])
 
   def createTaskDict(self, prodID, process, energy, eventsPerJob, sinFile, nbTasks,
                      eventsPerBaseFile, taskName):
@@ -1104,13 +1153,28 @@ overlayEventType = %(overlayEventType)s
           taskList[index].applicationOptions[optionName] = value
 
   def createAllTransformations(self):
-    """Loop over the list of processes, energies and possibly prodIDs to create all the productions."""
+    """Loop over the list of processes, energies and possibly prodIDs to create all the productions.
+
+    The production chains for the different processes and energies are created one after the other, only the
+    productions within a level of a chain are created at the same time, so that at most `workers` productions are
+    created at once. The catalog lookups are shared between all chains.
+    """
+    start = time.time()
     for energy, process, prodID, eventsPerJob, eventsPerBaseFile, sinFile, nbTasks, taskName in \
         izip_longest(self.energies, self.processes, self.prodIDs, self.eventsPerJobs, self.eventsInSplitFiles,
                      self.whizard2SinFile, self.numberOfTasks, self.taskNames, fillvalue=None):
       taskDict = self.createTaskDict(prodID, process, energy, eventsPerJob, sinFile,
                                      nbTasks, eventsPerBaseFile, taskName)
       self.createTransformations(taskDict)
+    self.reportTimes(time.time() - start)
+
+  def reportTimes(self, totalTime):
+    """Print how long the creation of each production took."""
+    if not self.productionTimes:
+      return
+    lines = ['%-6s %-10s %8.1f s' % (prodType, prodID, duration) for prodType, prodID, duration in self.productionTimes]
+    gLogger.notice("*" * 80 + "\nCreated %d productions in %.1f s, %d catalog lookups from cache, %d from catalog:\n%s"
+                   % (len(lines), totalTime, self._catalogCache.hits, self._catalogCache.misses, '\n'.join(lines)))
 
 
 if __name__ == "__main__":
@@ -349,13 +349,15 @@ class Job(DiracJob):
     """ Private method to check the validity of the parameters
     """
 
-    # inspect.stack()[1][0] returns the frame object ([0]) of the caller
-    # function (stack()[1]).
-    # The frame object is required for getargvalues. Getargvalues returns
-    # a tuple with four items. The fourth item ([3]) contains the local
-    # variables in a dict.
+    # The local variables of the caller are taken directly from its frame,
+    # inspect.stack() would build the frame records of the whole stack and
+    # read the source code for each of them.
 
-    args = inspect.getargvalues( inspect.stack()[ 1 ][ 0 ] )[ 3 ]
+    frame = inspect.currentframe().f_back
+    try:
+      args = frame.f_locals
+    finally:
+      del frame
 
     #
 
@@ -378,14 +380,16 @@ class Job(DiracJob):
     """ Private method
     """
 
-    # Add one to stack level such that we take the caller function as the
-    # reference point for 'level'
+    # Go back one more frame than level, such that we take the caller
+    # function as the reference point for 'level'
 
-    level += 1
-
-    #
-
-    args = inspect.getargvalues( inspect.stack()[ level ][ 0 ] )
+    frame = inspect.currentframe()
+    try:
+      for _ in range( level + 1 ):
+        frame = frame.f_back
+      args = inspect.getargvalues( frame )
+    finally:
+      del frame
     adict = {}
 
     for arg in args[0]:
@@ -19,7 +19,6 @@ from collections import defaultdict
 from decimal import Decimal
 
 from DIRAC                                                  import S_OK, S_ERROR, gLogger
-from DIRAC.Core.Utilities.ReturnValues import returnSingleResult
 from DIRAC.ConfigurationSystem.Client.Helpers.Operations    import Operations
 from DIRAC.Core.Security.ProxyInfo                          import getProxyInfo
 from DIRAC.Core.Workflow.Module                             import ModuleDefinition
@@ -27,6 +26,8 @@ from DIRAC.Core.Workflow.Step                               import StepDefinitio
 from DIRAC.Resources.Catalog.FileCatalogClient              import FileCatalogClient
 from DIRAC.TransformationSystem.Client.TransformationClient import TransformationClient
 
+from ILCDIRAC.Core.Utilities.Concurrency import DEFAULT_WORKERS, concurrentMap
+from ILCDIRAC.Core.Utilities.MetadataFields import getMetadataFields
 from ILCDIRAC.ILCTransformationSystem.Client.Transformation import Transformation
 from ILCDIRAC.Interfaces.API.NewInterface.Job               import Job
 from ILCDIRAC.Interfaces.Utilities import JobHelpers
@@ -35,6 +36,32 @@ __RCSID__ = "$Id$"
 
 LOG = gLogger.getSubLogger(__name__)
 
+
+def _splitBulkResult(result, paths):
+  """Return the paths which succeeded and the errors for the paths which failed in a bulk catalog call.
+
+  :param dict result: S_OK/S_ERROR with the Successful and Failed dictionaries
+  :param list paths: paths given to the call
+  :returns: list of successful paths, dictionary of failed paths and their errors
+  """
+  if not result['OK']:
+    return [], dict((path, result['Message']) for path in paths)
+  successful = [path for path in paths if path in result['Value']['Successful']]
+  errors = dict((path, result['Value']['Failed'].get(path, 'No result for %s' % path))
+                for path in paths if path not in result['Value']['Successful'])
+  return successful, errors
+
+
+def _parentDirectories(path):
+  """Return the parent directories of path, without trailing slashes."""
+  parents = []
+  parent = os.path.dirname(path.rstrip('/'))
+  while parent and parent != '/':
+    parents.append(parent)
+    parent = os.path.dirname(parent)
+  return parents
+
+
 class ProductionJob(Job): #pylint: disable=too-many-public-methods, too-many-instance-attributes
   """ Production job class. Suitable for CLIC studies. Need to sub class and overload for other clients.
   """
@@ -568,8 +595,7 @@ class ProductionJob(Job): #pylint: disable=too-many-public-methods, too-many-ins
     infoString = '\n'.join(info)
     self.prodparameters['DetailedInfo'] = infoString
     
-    for name, val in self.prodparameters.iteritems():
-      result = self._setProdParameter(currtrans, name, val)
+    for _name, result in sorted(self._setProdParameters(currtrans, self.prodparameters).items()):
       if not result['OK']:
         LOG.error(result['Message'])
 
@@ -579,38 +605,62 @@ class ProductionJob(Job): #pylint: disable=too-many-public-methods, too-many-ins
       return res
     return S_OK()
 
-  def _createDirectory(self, path, failed, mode=0o775):
-    """Create the directory at path if it does not exist.
-
-    :param str path: path to check
-    :param list failed: list of failed paths
-    :param int mode: mode to set for directory
-    """
-    exists = returnSingleResult(self.fc.isDirectory(path))
-    if exists['OK'] and exists['Value']:
+  def _createDirectories(self, paths, failed, mode=0o775):
+    """Create the directories at paths which do not exist yet, with one bulk call for each step.
+
+    :param list paths: paths to check
+    :param dict failed: dictionary of failed paths and their errors
+    :param int mode: mode to set for the created directories
+    :returns: list of paths which exist
+    """
+    paths = sorted(set(paths))
+    if not paths:
+      return []
+    exists = self.fc.isDirectory(paths)
+    existing, _errors = _splitBulkResult(exists, paths)
+    existing = [path for path in existing if exists['Value']['Successful'][path]]
+    for path in existing:
       LOG.verbose('Directory already exists:', path)
-      return S_OK()
-    result = returnSingleResult(self.fc.createDirectory(path))
-    if not result['OK']:
-      LOG.error('Failed to create directory:', '%s: %s' % (path, result['Message']))
-      failed[path].append(result['Message'])
-      return S_ERROR()
-    LOG.verbose('Successfully created directory:', path)
-    res = self.fc.changePathMode({path: mode}, False)
-    if not res['OK']:
-      LOG.error(res['Message'])
-      failed[path].append(res['Message'])
-      return S_ERROR()
-    LOG.verbose('Successfully changed mode:', path)
-    return S_OK()
-
-  def _checkMetadata(self, path, metaCopy):
-    """Get existing metadata, if it is the same do not set it again, otherwise return error."""
-    existingMetadata = self.fc.getDirectoryUserMetadata(path.rstrip('/'))
-    if not existingMetadata['OK']:
+    missing = [path for path in paths if path not in existing]
+    if not missing:
+      return existing
+
+    created, errors = _splitBulkResult(self.fc.createDirectory(missing), missing)
+    for path, error in sorted(errors.items()):
+      LOG.error('Failed to create directory:', '%s: %s' % (path, error))
+      failed[path].append(error)
+    for path in created:
+      LOG.verbose('Successfully created directory:', path)
+    if not created:
+      return existing
+
+    changed, errors = _splitBulkResult(self.fc.changePathMode(dict((path, mode) for path in created), False), created)
+    for path, error in sorted(errors.items()):
+      LOG.error(error)
+      failed[path].append(error)
+    for path in changed:
+      LOG.verbose('Successfully changed mode:', path)
+    return sorted(existing + changed)
+
+  def _getExistingMetadata(self, paths):
+    """Return the metadata of the directories, getting the metadata of several directories at the same time.
+
+    :param list paths: directories to get the metadata for
+    :returns: dictionary of path to the existing metadata, None if the metadata could not be obtained
+    """
+    def getMetadata(path):
+      """Return the metadata of a single directory."""
+      result = self.fc.getDirectoryUserMetadata(path.rstrip('/'))
+      return result['Value'] if result['OK'] else None
+
+    return dict(zip(paths, concurrentMap(getMetadata, paths)))
+
+  def _checkMetadata(self, path, metaCopy, existingMetadata):
+    """If the existing metadata is the same do not set it again, otherwise return error."""
+    if existingMetadata is None:
       return S_OK()
     failure = False
-    for key, value in existingMetadata['Value'].iteritems():
+    for key, value in existingMetadata.iteritems():
       if key in metaCopy and metaCopy[key] != value:
         LOG.error('Metadata values for folder %s disagree for key %s: Existing(%r), new(%r)' %
                   (path, key, value, metaCopy[key]))
@@ -622,11 +672,34 @@ class ProductionJob(Job): #pylint: disable=too-many-public-methods, too-many-ins
       return S_ERROR('Error when setting new metadata, already existing metadata disagrees!')
     return S_OK()
 
+  def _setMetadata(self, metaToSet, failed, kind=''):
+    """Set the metadata of all directories with one bulk call.
+
+    :param dict metaToSet: dictionary of path to the metadata to set
+    :param dict failed: dictionary of failed paths and their errors
+    :param str kind: description of the metadata for the log messages
+    """
+    if not metaToSet:
+      return
+    bulkMeta = dict((path.rstrip('/'), meta) for path, meta in metaToSet.items())
+    _successful, errors = _splitBulkResult(self.fc.setMetadataBulk(bulkMeta), list(bulkMeta))
+    for path, meta in sorted(metaToSet.items()):
+      error = errors.get(path.rstrip('/'))
+      if error is None:
+        continue
+      LOG.error('Could not preset %smetadata' % kind, str(meta))
+      LOG.error('Could not preset %smetadata' % kind, error)
+      failed[path].append(error)
+
   def _registerMetadata(self):
     """Set metadata for given folders.
 
     Register path and metadata before the production actually runs. This allows for the definition
     of the full chain in 1 go.
+
+    The directories are checked and created, and the metadata is set, with bulk calls to the catalog. Only the
+    existing metadata has to be obtained for each directory, which is done concurrently. The metadata set on a parent
+    directory by this registration is taken into account as inherited by its sub directories.
     """
     prevent_registration = self.ops.getValue('Production/PreventMetadataRegistration', False)
 
@@ -637,36 +710,39 @@ class ProductionJob(Job): #pylint: disable=too-many-public-methods, too-many-ins
       return S_OK()
 
     failed = defaultdict(list)
-    for path, meta in sorted(self.finalMetaDict.items()):
-      res = self._createDirectory(path, failed)
-      if not res['OK']:
-        continue
+    directories = set(self._createDirectories(list(self.finalMetaDict) + list(self.finalMetaDictNonSearch), failed))
+
+    paths = [path for path, meta in sorted(self.finalMetaDict.items()) if path in directories and meta]
+    existingMetadata = self._getExistingMetadata(paths)
+    metaToSet = {}
+    newDirectoryMetadata = {}
+    for path in paths:
+      meta = self.finalMetaDict[path]
       LOG.verbose('Checking to set metadata:', meta)
       metaCopy = dict(meta)
-      res = self._checkMetadata(path, metaCopy)
+      pathMetadata = existingMetadata[path]
+      if pathMetadata is not None:
+        pathMetadata = dict(pathMetadata)
+        for parent in reversed(_parentDirectories(path)):
+          pathMetadata.update(newDirectoryMetadata.get(parent, {}))
+      res = self._checkMetadata(path, metaCopy, pathMetadata)
       if not res['OK']:
         return res
       if not metaCopy:
         LOG.verbose('No new metadata to set')
         continue
-
       LOG.notice('Setting metadata information: ', '%s: %s' % (path, metaCopy))
-      result = self.fc.setMetadata(path.rstrip('/'), metaCopy)
-      if not result['OK']:
-        LOG.error('Could not preset metadata', str(metaCopy))
-        LOG.error('Could not preset metadata', result['Message'])
-        failed[path].append(result['Message'])
+      metaToSet[path] = metaCopy
+      newDirectoryMetadata[path.rstrip('/')] = metaCopy
+    self._setMetadata(metaToSet, failed)
 
+    nonSearchToSet = {}
     for path, meta in sorted(self.finalMetaDictNonSearch.items()):
-      res = self._createDirectory(path, failed)
-      if not res['OK']:
+      if path not in directories:
         continue
       LOG.notice('Setting non searchable metadata information: ', '%s: %s' % (path, meta))
-      result = self.fc.setMetadata(path.rstrip('/'), meta)
-      if not result['OK']:
-        LOG.error('Could not preset non searchable metadata', str(meta))
-        LOG.error('Could not preset non searchable metadata', result['Message'])
-        failed[path].append(result['Message'])
+      nonSearchToSet[path] = meta
+    self._setMetadata(nonSearchToSet, failed, kind='non searchable ')
 
     if failed:
       return S_ERROR('Failed to register some metadata: %s' % dict(failed))
@@ -698,6 +774,20 @@ class ProductionJob(Job): #pylint: disable=too-many-public-methods, too-many-ins
       LOG.notice('Adding %s=%s to transformation' % (str(pname), str(pvalue)))
       result = S_OK()
     return result
+
+  def _setProdParameters(self, prodID, parameters):
+    """ Set all production parameters, several at the same time unless this is a dry run.
+
+    The transformation service has no call to set several parameters at once, so the calls are made concurrently.
+
+    :param prodID: ID of the production
+    :param dict parameters: names and values of the parameters
+    :returns: dictionary of parameter name to the S_OK/S_ERROR result of setting it
+    """
+    names = sorted(parameters)
+    results = concurrentMap(lambda name: self._setProdParameter(prodID, name, parameters[name]), names,
+                            workers=1 if self.dryrun else DEFAULT_WORKERS)
+    return dict(zip(names, results))
   
   def _jobSpecificParams(self, application):
     """ For production additional checks are needed: ask the user
@@ -873,25 +963,27 @@ class ProductionJob(Job): #pylint: disable=too-many-public-methods, too-many-ins
   def _checkMetaKeys( self, metakeys, extendFileMeta=False ):
     """ check if metadata keys are allowed to be metadata
 
+    The metadata fields are obtained from the catalog once for all productions, see
+    :func:`~ILCDIRAC.Core.Utilities.MetadataFields.getMetadataFields`.
+
     :param list metakeys: metadata keys for production metadata
     :param bool extendFileMeta: also use FileMetaFields for checking meta keys
     :returns: S_OK, S_ERROR
     """
 
-    res = self.fc.getMetadataFields()
+    res = getMetadataFields(self.fc)
     if not res['OK']:
       LOG.error("Could not contact File Catalog")
       return S_ERROR("Could not contact File Catalog")
-    metaFCkeys = res['Value']['DirectoryMetaFields'].keys()
-    if extendFileMeta:
-      metaFCkeys.extend( res['Value']['FileMetaFields'].keys() )
+    metaFields = res['Value']
 
     for key in metakeys:
-      for meta in metaFCkeys:
-        if meta != key and meta.lower() == key.lower():
-          return self._reportError("Key syntax error %r, should be %r" % (key, meta), name = self.__class__.__name__)
-      if key not in metaFCkeys:
-        return self._reportError("Key %r not found in metadata keys, allowed are %r" % (key, metaFCkeys))
+      fieldName = metaFields.getFieldName(key, includeFileFields=extendFileMeta)
+      if fieldName is None:
+        return self._reportError("Key %r not found in metadata keys, allowed are %r" %
+                                 (key, metaFields.getFieldNames(includeFileFields=extendFileMeta)))
+      if fieldName != key:
+        return self._reportError("Key syntax error %r, should be %r" % (key, fieldName), name = self.__class__.__name__)
 
     return S_OK()
 
@@ -0,0 +1,99 @@
+"""Benchmark the argument checks of the application setters.
+
+Creates Marlin and DDSim instances and calls some of their setters, once with the current implementation of
+Application._checkArgs and Application._getArgsDict, and once with the previous implementation, which used
+inspect.stack(). Reports the time per instance and checks that both implementations report the same errors.
+
+Usage::
+
+  python Benchmark_checkArgs.py [nInstances]
+
+"""
+
+from __future__ import print_function
+
+import inspect
+import sys
+import time
+
+from mock import patch
+
+from ILCDIRAC.Interfaces.API.NewInterface.Application import Application
+from ILCDIRAC.Interfaces.API.NewInterface.Applications import DDSim, Marlin
+
+__RCSID__ = "$Id$"
+
+
+def legacyCheckArgs(self, argNamesAndTypes):
+  """The previous implementation, getting the arguments of the caller from inspect.stack()."""
+  args = inspect.getargvalues(inspect.stack()[1][0])[3]
+  for argName, argType in argNamesAndTypes.iteritems():
+    if argName not in args:
+      self._reportError('Method does not contain argument \'%s\'' % argName, __name__, **self._getArgsDict(1))
+    if not isinstance(args[argName], argType):
+      self._reportError('Argument \'%s\' is not of type %s' % (argName, argType), __name__, **self._getArgsDict(1))
+
+
+def legacyGetArgsDict(self, level=0):  # pylint: disable=unused-argument
+  """The previous implementation, getting the arguments of the caller from inspect.stack()."""
+  level += 1
+  args = inspect.getargvalues(inspect.stack()[level][0])
+  adict = {}
+  for arg in args[0]:
+    if arg == "self":
+      continue
+    adict[arg] = args[3][arg]
+  return adict
+
+
+def createApplications(nInstances):
+  """Create Marlin and DDSim instances and call their setters, every 100th with a wrong type."""
+  errors = 0
+  for index in range(nInstances):
+    if index % 2:
+      app = Marlin()
+      app.setGearFile('gear_%d.xml' % index)
+      app.setOutputRecFile('rec_%d.slcio' % index)
+      app.setProcessorsToUse(['MyMarlinProcessor'])
+    else:
+      app = DDSim()
+      app.setRandomSeed(index if index % 100 else str(index))
+      app.setStartFrom(index)
+    app.setVersion('ILCSoft-2018-04-26_gcc62')
+    app.setSteeringFile('steering_%d.xml' % index)
+    app.setNumberOfEvents(100)
+    app.setEnergy(3000.)
+    errors += len(app._errorDict)  # pylint: disable=protected-access
+  return errors
+
+
+def runBenchmark(nInstances):
+  """Run both implementations and print the results."""
+  results = {}
+  for name in ('legacy', 'current'):
+    if name == 'legacy':
+      patches = [patch.object(Application, '_checkArgs', new=legacyCheckArgs),
+                 patch.object(Application, '_getArgsDict', new=legacyGetArgsDict)]
+    else:
+      patches = []
+    for thePatch in patches:
+      thePatch.start()
+    try:
+      start = time.time()
+      errors = createApplications(nInstances)
+      results[name] = (time.time() - start, errors)
+    finally:
+      for thePatch in patches:
+        thePatch.stop()
+    print('%-8s %8.2fs %8.1fus/instance %6d errors' % (name, results[name][0], results[name][0] / nInstances * 1e6,
+                                                        results[name][1]))
+  print('speedup  %8.1fx' % (results['legacy'][0] / results['current'][0]))
+  if results['legacy'][1] != results['current'][1]:
+    print('ERROR: the implementations reported different errors')
+    return 1
+  return 0
+
+
+if __name__ == '__main__':
+  NINSTANCES = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+  sys.exit(runBenchmark(NINSTANCES))
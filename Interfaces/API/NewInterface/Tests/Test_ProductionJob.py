@@ -9,6 +9,7 @@ from parameterized import parameterized
 
 from DIRAC import gLogger, S_OK, S_ERROR
 from DIRAC.Core.Security.ProxyInfo import getProxyInfo
+from ILCDIRAC.Core.Utilities.MetadataFields import clearMetadataFieldsCache
 from ILCDIRAC.Interfaces.API.NewInterface.ProductionJob import ProductionJob
 from ILCDIRAC.Interfaces.API.NewInterface.Applications.DDSim import DDSim
 from ILCDIRAC.Tests.Utilities.GeneralUtils import assertEqualsImproved, assertDiracFailsWith, \
@@ -29,6 +30,7 @@ class ProductionJobTestCase( unittest.TestCase ):
   def setUp(self):
     """set up the objects"""
     super(ProductionJobTestCase, self).setUp()
+    clearMetadataFieldsCache()
     with patch.object(ProductionJob, 'setPlatform', new=Mock(S_OK())):
       self.prodJob = ProductionJob()
     self.prodJob.trc = Mock(name="TRC")
@@ -40,7 +42,9 @@ class ProductionJobTestCase( unittest.TestCase ):
     self.prodJob.fc.getMetadataFields = Mock(name='getMeta')
     self.prodJob.fc.createDirectory = Mock(name='mkdir')
     self.prodJob.fc.changePathMode = Mock(name='chmod')
-    self.prodJob.fc.setMetadata = Mock(name='SMD')
+    self.prodJob.fc.setMetadataBulk = Mock(name='SMD')
+    self.prodJob.fc.setMetadataBulk.side_effect = lambda pathMeta: S_OK({'Successful': dict.fromkeys(pathMeta, True),
+                                                                         'Failed': {}})
     self.prodJob.fc.getDirectoryUserMetadata = Mock(name='GDUMD')
 
   def test_Energy250( self ):
@@ -80,6 +84,7 @@ class ProductionJobCompleteTestCase( unittest.TestCase ):
 
   def setUp( self ):
     super( ProductionJobCompleteTestCase, self ).setUp()
+    clearMetadataFieldsCache()
     with patch.object(ProductionJob, 'setPlatform', new=Mock(S_OK())):
       self.prodJob = ProductionJob()
 
@@ -491,6 +496,31 @@ class ProductionJobSetInputDataQuery( ProductionJobTestCase ):
     res = job.finalizeProd( 1387, testdict )
     assertDiracSucceeds( res, self )
 
+  def test_setProdParameters(self):
+    """Set all parameters and return the result for each of them."""
+    job = self.prodJob
+    job.trc.setTransformationParameter.side_effect = lambda prodID, name, value: (S_ERROR('Failed') if name == 'lumi'
+                                                                                  else S_OK())
+    parameters = {'JobType': ['mytest', 'other'], 'lumi': 12, 'NbInputFiles': 1, 'SWPackages': 'mytestpackages',
+                  'Energy': 350.0}
+    results = job._setProdParameters('1387', parameters)
+    assertEqualsImproved(sorted(results), sorted(parameters), self)
+    self.assertFalse(results['lumi']['OK'])
+    self.assertTrue(all(result['OK'] for name, result in results.items() if name != 'lumi'))
+    self.assertEqual(job.trc.setTransformationParameter.call_count, len(parameters))
+    job.trc.setTransformationParameter.assert_any_call(1387, 'JobType', 'mytest\nother')
+    job.trc.setTransformationParameter.assert_any_call(1387, 'lumi', '12')
+    job.trc.setTransformationParameter.assert_any_call(1387, 'Energy', '350.0')
+
+  def test_setProdParameters_dryrun(self):
+    """Do not set any parameter in a dry run."""
+    job = self.prodJob
+    job.dryrun = True
+    results = job._setProdParameters(1387, {'JobType': 'mytest', 'lumi': 12})
+    self.assertTrue(all(result['OK'] for result in results.values()))
+    assertEqualsImproved(sorted(results), ['JobType', 'lumi'], self)
+    job.trc.setTransformationParameter.assert_not_called()
+
   def test_finalizeProd_withparams( self ):
     job = self.prodJob
     job.slicesize = 0
@@ -570,7 +600,6 @@ class ProductionJobSetInputDataQuery( ProductionJobTestCase ):
 
   def test_finalizeProd_setMetaFails( self ):
     job = self.prodJob
-    job.fc.setMetadata = Mock(return_value=S_OK(True))
     job.slicesize = 0
     job.prodparameters = {'JobType': 'mytest', 'lumi': 12, 'NbInputFiles': 1,
                           'FCInputQuery': {'sampleKey': 'sampleValue'}, 'SWPackages': 'mytestpackages',
@@ -593,7 +622,7 @@ class ProductionJobSetInputDataQuery( ProductionJobTestCase ):
 
   def test_finalizeProd_setMetaFails_2(self):
     job = self.prodJob
-    job.fc.setMetadata = Mock(return_value=S_ERROR('Failed to set meta'))
+    job.fc.setMetadataBulk = Mock(return_value=S_ERROR('Failed to set meta'))
     job.slicesize = 0
     job.prodparameters = { 'JobType' : 'mytest', 'lumi' : 12, 'NbInputFiles' : 1,
                            'FCInputQuery' : { 'sampleKey' : 'sampleValue' }, 'SWPackages' : 'mytestpackages',
@@ -608,6 +637,65 @@ class ProductionJobSetInputDataQuery( ProductionJobTestCase ):
     assertDiracFailsWith(res, 'failed to set meta', self)
 
 
+  def test_registerMetadata_bulk(self):
+    """Create the directories and set the metadata with one call, taking into account the parent metadata."""
+    job = self.prodJob
+    job.finalMetaDict = {'/ilc/prod/clic/3tev/': {'Energy': '3tev'},
+                         '/ilc/prod/clic/3tev/ee/': {'Energy': '3tev', 'EvtType': 'ee'},
+                         '/ilc/prod/clic/3tev/ee/_exists_/': {'Energy': '3tev', 'EvtType': 'ee', 'Datatype': 'SIM'}}
+    job.finalMetaDictNonSearch = {'/ilc/prod/clic/3tev/ee/_exists_/': {'NumberOfEvents': 100}}
+    job.fc.createDirectory = Mock(side_effect=lambda paths: S_OK({'Successful': dict.fromkeys(paths, True),
+                                                                  'Failed': {}}))
+    job.fc.changePathMode = Mock(side_effect=lambda pathModes, _recursive: S_OK({'Successful': dict.fromkeys(pathModes),
+                                                                                 'Failed': {}}))
+    job.fc.getDirectoryUserMetadata = Mock(side_effect=lambda path: S_OK({'Energy': '3tev'} if '_exists_' in path
+                                                                         else {}))
+    assertDiracSucceeds(job._registerMetadata(), self)
+    job.fc.isDirectory.assert_called_once_with(sorted(job.finalMetaDict))
+    job.fc.createDirectory.assert_called_once_with(['/ilc/prod/clic/3tev/', '/ilc/prod/clic/3tev/ee/'])
+    job.fc.changePathMode.assert_called_once_with({'/ilc/prod/clic/3tev/': 0o775, '/ilc/prod/clic/3tev/ee/': 0o775},
+                                                  False)
+    self.assertEqual(job.fc.setMetadataBulk.call_count, 2)
+    assertEqualsImproved(job.fc.setMetadataBulk.call_args_list[0][0][0],
+                         {'/ilc/prod/clic/3tev': {'Energy': '3tev'},
+                          '/ilc/prod/clic/3tev/ee': {'EvtType': 'ee'},
+                          '/ilc/prod/clic/3tev/ee/_exists_': {'Datatype': 'SIM'}}, self)
+    assertEqualsImproved(job.fc.setMetadataBulk.call_args_list[1][0][0],
+                         {'/ilc/prod/clic/3tev/ee/_exists_': {'NumberOfEvents': 100}}, self)
+
+  def test_registerMetadata_parent_disagrees(self):
+    """Fail before setting any metadata if the metadata of the parent directory disagrees."""
+    job = self.prodJob
+    job.finalMetaDict = {'/ilc/prod/clic/_exists_/': {'Energy': '3tev'},
+                         '/ilc/prod/clic/_exists_/ee/_exists_/': {'Energy': '1.4tev', 'EvtType': 'ee'}}
+    job.fc.getDirectoryUserMetadata = Mock(return_value=S_OK({}))
+    assertDiracFailsWith(job._registerMetadata(), 'already existing metadata disagrees', self)
+    job.fc.createDirectory.assert_not_called()
+    job.fc.setMetadataBulk.assert_not_called()
+
+  def test_registerMetadata_failures(self):
+    """Report the errors for each directory."""
+    job = self.prodJob
+    job.finalMetaDict = {'/ilc/prod/clic/new/a/': {'EvtType': 'a'},
+                         '/ilc/prod/clic/new/b/': {'EvtType': 'b'},
+                         '/ilc/prod/clic/new/c/': {'EvtType': 'c'}}
+    job.fc.createDirectory = Mock(return_value=S_OK({'Successful': {'/ilc/prod/clic/new/b/': True,
+                                                                    '/ilc/prod/clic/new/c/': True},
+                                                     'Failed': {'/ilc/prod/clic/new/a/': 'Permission denied'}}))
+    job.fc.changePathMode = Mock(return_value=S_OK({'Successful': {'/ilc/prod/clic/new/b/': True,
+                                                                   '/ilc/prod/clic/new/c/': True},
+                                                    'Failed': {}}))
+    job.fc.getDirectoryUserMetadata = Mock(return_value=S_ERROR('No such directory'))
+    job.fc.setMetadataBulk = Mock(return_value=S_OK({'Successful': {'/ilc/prod/clic/new/b': True},
+                                                     'Failed': {'/ilc/prod/clic/new/c': 'Invalid metadata'}}))
+    res = job._registerMetadata()
+    assertDiracFailsWith(res, 'failed to register some metadata', self)
+    self.assertIn("'/ilc/prod/clic/new/a/': ['Permission denied']", res['Message'])
+    self.assertIn("'/ilc/prod/clic/new/c/': ['Invalid metadata']", res['Message'])
+    self.assertNotIn('/ilc/prod/clic/new/b/', res['Message'])
+    job.fc.setMetadataBulk.assert_called_once_with({'/ilc/prod/clic/new/b': {'EvtType': 'b'},
+                                                    '/ilc/prod/clic/new/c': {'EvtType': 'c'}})
+
   def test_getMetadata( self ):
     job = self.prodJob
     reference_dict = { '1' : {'test1' : 1, '09ksrt' : '123tgvda'}, '2' : {'vdunivi' : -135, 21 : 'sdfg',
@@ -955,34 +1043,56 @@ CHANGEPATH_DICT = { 'testpath123/a/b/c' : S_OK(),
                     'asd' : S_OK() }#, S_OK(), S_ERROR('this is a test. fail please.')}
 
 
-def isdir_sideeffect(path):
+def isdir_sideeffect(paths):
   """Return true or false."""
-  if '_exists_' in path:
-    return S_OK({'Successful': {path: True}, 'Failed': {}})
-  return S_OK({'Successful': {}, 'Failed': {path: 'Missing'}})
+  successful = dict((path, True) for path in paths if '_exists_' in path)
+  failed = dict((path, 'Missing') for path in paths if '_exists_' not in path)
+  return S_OK({'Successful': successful, 'Failed': failed})
 
 
-def createdir_sideeffect( value ):
-  """ Returns the appropriate return value of the createDir method for the given directory string
+def bulk_sideeffect(resultDict, paths):
+  """Combine the results for the single paths in resultDict into the result of a bulk call.
 
-  :param str value: directory to be created
-  :returns: S_OK/S_ERROR structure with the value in CREATEDIR_DICT
+  :param dict resultDict: S_OK/S_ERROR structure for each path
+  :param paths: paths given to the bulk call
+  :returns: S_OK with the Successful and Failed dictionaries
+  """
+  successful = {}
+  failed = {}
+  for path in paths:
+    result = resultDict[path]
+    if not result['OK']:
+      failed[path] = result['Message']
+    elif result['Value'] is None:
+      successful[path] = True
+    elif result['Value'].get('Failed'):
+      failed[path] = list(result['Value']['Failed'].values())[0]
+    elif result['Value'].get('Successful'):
+      successful[path] = True
+  return S_OK({'Successful': successful, 'Failed': failed})
+
+
+def createdir_sideeffect( paths ):
+  """ Returns the appropriate return value of the createDir method for the given directory strings
+
+  :param list paths: directories to be created
+  :returns: S_OK structure with the values in CREATEDIR_DICT
   :rtype: dict
 
   """
-  return CREATEDIR_DICT[value]
+  return bulk_sideeffect(CREATEDIR_DICT, paths)
 
 def changepath_sideeffect( val, bool_flag ): #pylint: disable=unused-argument
-  """ Returns the appropriate return value of the changePathMode method for the given directory string.
+  """ Returns the appropriate return value of the changePathMode method for the given directory strings.
   bool_flag is not used in this test version, but in the original method.
 
-  :param str val: path to be changed to
+  :param dict val: paths to be changed to
   :param bool bool_flag: ignored, used in the actual implementation
-  :returns: S_OK/S_ERROR structure with the value in CHANGEPATH_DICT
+  :returns: S_OK structure with the values in CHANGEPATH_DICT
   :rtype: dict
 
   """
-  return CHANGEPATH_DICT[val.iterkeys().next()]
+  return bulk_sideeffect(CHANGEPATH_DICT, val)
 
 def runTests():
   """Runs our tests"""
@@ -33,6 +33,8 @@ from DIRAC import gLogger, S_OK
 from DIRAC.Core.Utilities.List import uniqueElements
 from DIRAC.Resources.Catalog.FileCatalogClient import FileCatalogClient
 
+from ILCDIRAC.Core.Utilities.MetadataFields import getMetadataFields
+
 LOG = gLogger.getSubLogger('')
 
 __RCSID__ = "$Id$"
@@ -60,17 +62,15 @@ def _createQueryDict(argss):
   Create a proper dictionary, stolen from FC CLI
   """  
   
-  fileCatClient = FileCatalogClient()
-  result = fileCatClient.getMetadataFields()
+  result = getMetadataFields(FileCatalogClient())
 
   if not result['OK']:
     LOG.error("Failed checking for metadata fields")
     return None
-  if not result['Value']:
+  typeDict = result['Value'].getTypes()
+  if not typeDict:
     LOG.error('No meta data fields available')
     return None
-  typeDict = result['Value']['FileMetaFields']
-  typeDict.update(result['Value']['DirectoryMetaFields'])
   metaDict = {}
   contMode = False
   for arg in argss:
@@ -86,7 +86,9 @@ def _createQueryDict(argss):
         
       name,value = arg.split(operation)
       if name not in typeDict:
-        LOG.error("Error: metadata field %s not defined" % name)
+        fieldName = result['Value'].getFieldName(name, includeFileFields=True)
+        suggestion = ", did you mean %s?" % fieldName if fieldName else ''
+        LOG.error("Error: metadata field %s not defined%s" % (name, suggestion))
         return None
       mtype = typeDict[name]
     else:
@@ -8,23 +8,23 @@ __RCSID__ = "$Id$"
 
 from DIRAC.Core.Base.AgentModule                               import AgentModule
 from DIRAC                                                     import S_OK, gLogger
-from DIRAC.WorkloadManagementSystem.Client.JobMonitoringClient import JobMonitoringClient
 
 from ILCDIRAC.OverlaySystem.Client.OverlaySystemClient         import OverlaySystemClient
 
 AGENT_NAME = 'Overlay/ResetCounters'
 
 class ResetCounters ( AgentModule ):
-  """ Reset the number of jobs at all sites: some sites are not updated properly, so 
-  once in a while it's needed to restore the correct number of jobs.
-  It does not need to be exact, but enough to clear some of the jobs.
+  """ Free the slots of jobs that did not release them: every slot is a lease with an expiration time, the expired
+  leases are reclaimed at all sites. This is also done by the service when a site is full, so the agent only keeps
+  the numbers of idle sites up to date. The number of jobs at each site is then set to the number of its leases,
+  which frees the slots of jobs without lease and corrects any drift. The queue tickets of jobs that stopped waiting
+  are removed as well.
   """
   def initialize(self):
     """ Initialize the agent.
     """
     self.am_setOption( "PollingTime", 60 )
     self.ovc = OverlaySystemClient()
-    self.jobmon = JobMonitoringClient()
     return S_OK()
   
   def execute(self):
@@ -33,22 +33,19 @@ class ResetCounters ( AgentModule ):
     res = self.ovc.getSites()
     if not res['OK']:
       return res
-    sitedict = {}
     sites = res['Value']
-    gLogger.info("Will update info for sites %s" % sites)
+    gLogger.info("Will reclaim expired leases for sites %s" % sites)
     for site in sites:
-      attribdict = {"Site" : site, "ApplicationStatus": 'Getting overlay files'}
-      res = self.jobmon.getCurrentJobCounters(attribdict)
+      res = self.ovc.reclaimExpiredLeases(site)
       if not res['OK']:
+        gLogger.error("Failed to reclaim expired leases at %s" % site, res['Message'])
         continue
-      if 'Running' in res['Value']:
-        sitedict[site] = res['Value']['Running']
-      else:
-        sitedict[site] = 0
-    gLogger.info("Setting new values %s" % sitedict)    
-    res = self.ovc.setJobsAtSites(sitedict)
-    if not res['OK']:
-      gLogger.error(res['Message'])
-      return res
-    
+      if res['Value']:
+        gLogger.info("Reclaimed %d expired leases at %s" % (res['Value'], site))
+      res = self.ovc.reconcileJobsAtSite(site)
+      if not res['OK']:
+        gLogger.error("Failed to set the number of jobs at %s" % site, res['Message'])
+      res = self.ovc.purgeStaleTickets(site)
+      if not res['OK']:
+        gLogger.error("Failed to purge stale queue tickets at %s" % site, res['Message'])
     return S_OK()
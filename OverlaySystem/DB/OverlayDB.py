@@ -2,12 +2,31 @@
 """
 __RCSID__ = "$Id$"
 
+import re
+import time
+import uuid
+
 from DIRAC                                                             import gLogger, S_OK, S_ERROR
 from DIRAC.Core.Base.DB                                                import DB
 from DIRAC.ConfigurationSystem.Client.Helpers.Operations            import Operations
 
+#: format of the lease tokens, see :func:`OverlayDB._createLease`
+LEASE_RE = re.compile('^[0-9a-f]{32}$')
+
 class OverlayDB ( DB ):
   """ DB for OverlaySystem
+
+  The number of jobs per site is changed with single conditional UPDATE statements, so that acquiring or releasing a
+  slot is atomic in the database and does not need a SELECT beforehand.
+
+  Every slot is backed by a lease with an expiration time. Jobs renew their lease while they download files and
+  release it when they are done. Leases of jobs that crashed expire and are reclaimed when the site is full. The
+  number of jobs is regularly set to the number of leases by :func:`reconcileJobsAtSite`, which frees the slots of
+  jobs without lease and corrects any drift.
+
+  Jobs waiting for a slot take a ticket with :func:`enqueue` and ask for a slot with :func:`requestSlot`. Slots are
+  given to the tickets in the order they were taken at each site. Tickets of jobs that stopped asking for a slot are
+  ignored after `/Overlay/Queue/TicketTimeout` seconds.
   """
   def __init__( self ):
     """ 
@@ -21,20 +40,41 @@ class OverlayDB ( DB ):
                                                        },
                                             'PrimaryKey' : 'Site',
                                             'Indexes': {'Index':['Site']}
-                                          }
+                                          },
+                          "OverlayLeases" : { 'Fields' : { 'Lease' : "VARCHAR(32) NOT NULL",
+                                                           'Site' : "VARCHAR(255) NOT NULL",
+                                                           'JobID' : "INTEGER DEFAULT 0",
+                                                           'ExpirationTime' : "INTEGER NOT NULL"
+                                                         },
+                                              'PrimaryKey' : 'Lease',
+                                              'Indexes': {'SiteExpiration':['Site', 'ExpirationTime']}
+                                            },
+                          "OverlayQueue" : { 'Fields' : { 'Ticket' : "INTEGER NOT NULL AUTO_INCREMENT",
+                                                          'Site' : "VARCHAR(255) NOT NULL",
+                                                          'JobID' : "INTEGER DEFAULT 0",
+                                                          'LastSeen' : "INTEGER NOT NULL"
+                                                        },
+                                             'PrimaryKey' : 'Ticket',
+                                             'Indexes': {'SiteTicket':['Site', 'Ticket']}
+                                           }
                         }
                       )
-    limits = self.ops.getValue("/Overlay/MaxConcurrentRunning", 200)
+    self._initParameters()
+
+  def _initParameters( self ):
+    """ Set the cached parameters and read the configuration
+    """
     self.limits = {}
-    self.limits["default"] = limits
-    res = self.ops.getSections("/Overlay/Sites/")
-    sites = []
-    if res['OK']:
-      sites = res['Value']
-    for tempsite in sites:
-      res = self.ops.getValue("/Overlay/Sites/%s/MaxConcurrentRunning" % tempsite, 200)
-      self.limits[tempsite] = res
-    self.logger.info("Using the following restrictions : %s" % self.limits)
+    self.limitsTimestamp = 0
+    self.limitsCacheTime = self.ops.getValue("/Overlay/LimitsCacheTime", 300)
+    self.leaseTime = 1800
+    self.reclaimInterval = 60
+    self.ticketTimeout = 600
+    self.minPollTime = 5
+    self.maxPollTime = 120
+    self.lastReclaim = {}
+    self.knownSites = set()
+    self._refreshLimits()
 
   #####################################################################
   # Private methods
@@ -47,7 +87,32 @@ class OverlayDB ( DB ):
       return res['Value']
     gLogger.warn( "Failed to get MySQL connection", res['Message'] )
     return connection
-  
+
+  def _refreshLimits(self):
+    """ Read the maximum number of concurrent jobs for each site, the lease and queue times from the Operations section
+
+    The values are cached for `/Overlay/LimitsCacheTime` seconds, so that changes in the configuration are picked up
+    without restarting the service.
+    """
+    limits = {}
+    limits["default"] = self.ops.getValue("/Overlay/MaxConcurrentRunning", 200)
+    res = self.ops.getSections("/Overlay/Sites/")
+    sites = []
+    if res['OK']:
+      sites = res['Value']
+    for tempsite in sites:
+      limits[tempsite] = self.ops.getValue("/Overlay/Sites/%s/MaxConcurrentRunning" % tempsite, 200)
+    if limits != self.limits:
+      self.logger.info("Using the following restrictions : %s" % limits)
+    self.limits = limits
+    self.leaseTime = self.ops.getValue("/Overlay/LeaseTime", 1800)
+    self.reclaimInterval = self.ops.getValue("/Overlay/LeaseReclaimInterval", 60)
+    self.ticketTimeout = self.ops.getValue("/Overlay/Queue/TicketTimeout", 600)
+    self.minPollTime = self.ops.getValue("/Overlay/Queue/MinPollTime", 5)
+    self.maxPollTime = self.ops.getValue("/Overlay/Queue/MaxPollTime", 120)
+    self.limitsTimestamp = time.time()
+    return S_OK(limits)
+
   def _checkSite(self, site, connection = False ):
     """ Check the number of jobs running at a given site.
     """
@@ -62,32 +127,233 @@ class OverlayDB ( DB ):
     else:
       return S_ERROR("Could not find any site %s"%(site))
     
-  def _addSite(self, site, connection = False ):
-    """ Add a new site to the DB
+  def _addSite(self, site, nbjobs, connection = False ):
+    """ Add a new site to the DB with nbjobs running jobs
     """ 
     connection = self.__getConnection( connection )
-    req = "INSERT INTO OverlayData (Site,NumberOfJobs) VALUES ('%s',1);" % site
-    res = self._update( req, connection )
-    if not res['OK']:
-      return res
-    return res
+    req = "INSERT INTO OverlayData (Site,NumberOfJobs) VALUES ('%s',%d);" % (site, nbjobs)
+    return self._update( req, connection )
 
   def _limitForSite(self, site):
     """ Get the current limit of jobs for a given site.
     """
-    if site in self.limits.keys():
+    if time.time() - self.limitsTimestamp > self.limitsCacheTime:
+      self._refreshLimits()
+    if site in self.limits:
       return self.limits[site]   
     return self.limits['default']
 
-  def _addNewJob(self, site, nbjobs, connection = False ):
-    """ Add a new running job in the DB
+  def _addNewJob(self, site, limit, connection = False ):
+    """ Increment the number of jobs at the site if it is below the limit
+
+    :returns: S_OK with the number of changed rows, 1 if the job was added, 0 if the site is full or does not exist
+    """
+    connection = self.__getConnection( connection )
+    req = "UPDATE OverlayData SET NumberOfJobs=NumberOfJobs+1 WHERE Site='%s' AND NumberOfJobs<%d;" % (site, limit)
+    return self._update( req, connection )
+
+  def _removeJobs(self, site, nbjobs, connection = False ):
+    """ Decrement the number of jobs at the site by nbjobs, the number of jobs never goes below 0
+    """
+    connection = self.__getConnection( connection )
+    req = "UPDATE OverlayData SET NumberOfJobs=CASE WHEN NumberOfJobs>%d THEN NumberOfJobs-%d ELSE 0 END " \
+          "WHERE Site='%s';" % (nbjobs, nbjobs, site)
+    return self._update( req, connection )
+
+  def _acquireSlot(self, site, connection = False ):
+    """ Take a slot at the site if it is below its limit
+
+    A slot is taken with a single conditional UPDATE. Only if no row was changed and the site is not yet known to
+    this instance, the site is added to the DB.
+
+    :returns: S_OK with True if a slot was taken, False otherwise
+    """
+    limit = self._limitForSite(site)
+    res = self._addNewJob(site, limit, connection)
+    if not res['OK']:
+      return res
+    if res['Value']:
+      self.knownSites.add(site)
+      return S_OK(True)
+    if site in self.knownSites:
+      return S_OK(False)
+
+    res = self._addSite(site, 1 if limit > 0 else 0, connection)
+    self.knownSites.add(site)
+    if res['OK']:
+      return S_OK(limit > 0)
+    # the site was added concurrently, or already existed and is full
+    res = self._addNewJob(site, limit, connection)
+    if not res['OK']:
+      return res
+    return S_OK(bool(res['Value']))
+
+  def _createLease(self, site, jobID, connection = False ):
+    """ Register a lease for the slot taken at the site
+
+    :returns: S_OK with the lease token
+    """
+    connection = self.__getConnection( connection )
+    lease = uuid.uuid4().hex
+    req = "INSERT INTO OverlayLeases (Lease,Site,JobID,ExpirationTime) VALUES ('%s','%s',%d,%d);" % \
+          (lease, site, int(jobID), int(time.time()) + self.leaseTime)
+    res = self._update( req, connection )
+    if not res['OK']:
+      self._removeJobs(site, 1, connection)
+      return res
+    return S_OK(lease)
+
+  def _deleteLease(self, site, lease, connection = False ):
+    """ Remove the lease and free its slot, if the lease was not already reclaimed
+
+    :returns: S_OK with True if the lease existed
     """
+    if not LEASE_RE.match(lease):
+      return S_ERROR("Invalid lease %r" % lease)
     connection = self.__getConnection( connection )
-    nbjobs += 1  
-    req = "UPDATE OverlayData SET NumberOfJobs=%s WHERE Site='%s';" % (nbjobs, site)
-    self._update( req, connection )
+    req = "DELETE FROM OverlayLeases WHERE Lease='%s' AND Site='%s';" % (lease, site)
+    res = self._update( req, connection )
+    if not res['OK']:
+      return res
+    if not res['Value']:
+      # expired and reclaimed, or released concurrently, the slot was already freed
+      return S_OK(False)
+    res = self._removeJobs(site, 1, connection)
+    if not res['OK']:
+      return res
+    return S_OK(True)
+
+  def _reclaimExpiredLeases(self, site, connection = False, force = False ):
+    """ Remove the expired leases at the site and free their slots
+
+    Unless force is set, this is done at most once every `/Overlay/LeaseReclaimInterval` seconds per site.
+
+    :returns: S_OK with the number of reclaimed leases
+    """
+    now = time.time()
+    if not force and now - self.lastReclaim.get(site, 0) < self.reclaimInterval:
+      return S_OK(0)
+    self.lastReclaim[site] = now
+    connection = self.__getConnection( connection )
+    req = "DELETE FROM OverlayLeases WHERE Site='%s' AND ExpirationTime<%d;" % (site, int(now))
+    res = self._update( req, connection )
+    if not res['OK']:
+      return res
+    nbExpired = res['Value']
+    if not nbExpired:
+      return S_OK(0)
+    self.logger.info("Reclaimed %d expired leases at %s" % (nbExpired, site))
+    res = self._removeJobs(site, nbExpired, connection)
+    if not res['OK']:
+      return res
+    return S_OK(nbExpired)
+
+### Admission queue
+  def _retryAfter(self, position):
+    """ Time in seconds after which a job at the given position in the queue should ask again for a slot
+
+    The jobs at the front of the queue ask often, so that free slots are used quickly, jobs further back ask less often.
+    """
+    return min(self.maxPollTime, self.minPollTime * (1 + position / 10.))
+
+  def _touchTicket(self, site, ticket, jobID, connection = False ):
+    """ Mark the ticket as still waiting, re-insert it with its original number if it was purged
+    """
+    connection = self.__getConnection( connection )
+    now = int(time.time())
+    req = "UPDATE OverlayQueue SET LastSeen=%d WHERE Ticket=%d;" % (now, int(ticket))
+    res = self._update( req, connection )
+    if not res['OK']:
+      return res
+    if not res['Value']:
+      # the ticket was purged or already seen in this second, in the latter case the INSERT just fails
+      req = "INSERT INTO OverlayQueue (Ticket,Site,JobID,LastSeen) VALUES (%d,'%s',%d,%d);" % \
+            (int(ticket), site, int(jobID), now)
+      self._update( req, connection )
     return S_OK()
 
+  def _getQueueStatus(self, site, ticket, connection = False ):
+    """ Get the number of tickets waiting in front of the ticket and the number of jobs running at the site
+
+    :returns: S_OK with the tuple (position, running)
+    """
+    connection = self.__getConnection( connection )
+    req = "SELECT (SELECT COUNT(*) FROM OverlayQueue WHERE Site='%s' AND Ticket<%d AND LastSeen>=%d), " \
+          "(SELECT NumberOfJobs FROM OverlayData WHERE Site='%s');" % \
+          (site, int(ticket), int(time.time()) - self.ticketTimeout, site)
+    res = self._query( req, connection )
+    if not res['OK']:
+      return res
+    position, running = res['Value'][0]
+    return S_OK((int(position), int(running or 0)))
+
+  def enqueue(self, site, jobID = 0, connection = False ):
+    """ Take a ticket to wait for a slot at the site
+
+    :returns: S_OK with the ticket number
+    """
+    connection = self.__getConnection( connection )
+    req = "INSERT INTO OverlayQueue (Site,JobID,LastSeen) VALUES ('%s',%d,%d);" % (site, int(jobID), int(time.time()))
+    res = self._update( req, connection )
+    if not res['OK']:
+      return res
+    if not res.get('lastRowId'):
+      return S_ERROR("Could not get a ticket for site %s" % site)
+    return S_OK(res['lastRowId'])
+
+  def leaveQueue(self, ticket, connection = False ):
+    """ Remove the ticket from the queue
+    """
+    connection = self.__getConnection( connection )
+    req = "DELETE FROM OverlayQueue WHERE Ticket=%d;" % int(ticket)
+    res = self._update( req, connection )
+    if not res['OK']:
+      return res
+    return S_OK()
+
+  def getQueuePosition(self, site, ticket, connection = False ):
+    """ Get the number of tickets waiting in front of the ticket
+    """
+    res = self._getQueueStatus(site, ticket, connection)
+    if not res['OK']:
+      return res
+    return S_OK(res['Value'][0])
+
+  def requestSlot(self, site, ticket, jobID = 0, connection = False ):
+    """ Ask for a slot for the ticket
+
+    A slot is only requested if there are fewer tickets in front of this ticket than free slots at the site, or if
+    the ticket is the first one in the queue, in which case expired leases can be reclaimed.
+
+    :returns: S_OK with a dictionary with the `Lease` token or False, the `Position` in the queue and the time in
+              seconds after which the job should ask again in `RetryAfter`
+    """
+    connection = self.__getConnection( connection )
+    res = self._touchTicket(site, ticket, jobID, connection)
+    if not res['OK']:
+      return res
+    res = self._getQueueStatus(site, ticket, connection)
+    if not res['OK']:
+      return res
+    position, running = res['Value']
+    if position < max(self._limitForSite(site) - running, 1):
+      res = self.canRun(site, jobID, connection)
+      if not res['OK']:
+        return res
+      if res['Value']:
+        self.leaveQueue(ticket, connection)
+        return S_OK({'Lease': res['Value'], 'Position': 0, 'RetryAfter': 0})
+    return S_OK({'Lease': False, 'Position': position, 'RetryAfter': self._retryAfter(position)})
+
+  def purgeStaleTickets(self, site, connection = False ):
+    """ Remove the tickets of jobs that did not ask for a slot for `/Overlay/Queue/TicketTimeout` seconds
+
+    :returns: S_OK with the number of removed tickets
+    """
+    connection = self.__getConnection( connection )
+    req = "DELETE FROM OverlayQueue WHERE Site='%s' AND LastSeen<%d;" % (site, int(time.time()) - self.ticketTimeout)
+    return self._update( req, connection )
+
 ### Methods to fix the site
   def getSites(self, connection = False):
     """ Return the list of sites known to the service
@@ -102,17 +368,19 @@ class OverlayDB ( DB ):
       sites.append(row[0])
     return S_OK(sites)
 
-  def setJobsAtSites(self, sitedict, connection = False):
-    """ As name suggests: set the number of jobs running at the site.
+  def reconcileJobsAtSite(self, site, connection = False):
+    """ Set the number of jobs at the site to the number of its unexpired leases
+
+    This frees the slots of jobs that did not get a lease, e.g., jobs started before the leases existed, and corrects
+    the number of jobs if a lease could not be created or deleted together with its slot.
+
+    :returns: S_OK with the number of changed rows
     """
     connection = self.__getConnection( connection )
-    for site, nbjobs in sitedict.items():
-      req = "UPDATE OverlayData SET NumberOfJobs=%i WHERE Site='%s';" % (int(nbjobs), site)
-      res = self._update( req, connection )
-      if not res['OK']:
-        return S_ERROR("Could not set number of jobs at site %s" % site)
-      
-    return S_OK()
+    req = "UPDATE OverlayData SET NumberOfJobs=(SELECT COUNT(*) FROM OverlayLeases WHERE Site='%s' " \
+          "AND ExpirationTime>=%d) WHERE Site='%s';" % (site, int(time.time()), site)
+    return self._update( req, connection )
+
 ### Useful methods for the users
   
   def getJobsAtSite(self, site, connection = False ):
@@ -128,40 +396,75 @@ class OverlayDB ( DB ):
 
 ### Important methods
   
-  def canRun(self, site, connection = False ):
+  def canRun(self, site, jobID = 0, connection = False ):
     """ Can the job run at that site?
+
+    If the site is full, the expired leases of the site are reclaimed and the slot is requested again.
+
+    :param str site: the site the job runs at
+    :param int jobID: the ID of the job asking for the slot
+    :returns: S_OK with the lease token if the job can run, S_OK(False) otherwise
     """
     connection = self.__getConnection( connection )
-    res = self._checkSite(site, connection)
-    nbjobs = 0
+    res = self._acquireSlot(site, connection)
     if not res['OK']:
-      self._addSite(site, connection)
-      nbjobs = 1
-    else:
-      nbjobs = res['Value'][0][0]
-    if nbjobs < self._limitForSite(site):
-      res = self._addNewJob(site, nbjobs, connection)
+      return res
+    if not res['Value']:
+      res = self._reclaimExpiredLeases(site, connection)
+      if not res['OK'] or not res['Value']:
+        return S_OK(False)
+      res = self._acquireSlot(site, connection)
       if not res['OK']:
         return res
-      return S_OK(True)
-    else:
-      return S_OK(False)
-  
-  def jobDone(self, site, connection = False ):
-    """ Remove a job from the DB, should not remove a job from the DB 
-        if the Site does not exist, but this should never happen
+      if not res['Value']:
+        return S_OK(False)
+    return self._createLease(site, jobID, connection)
+
+  def renewLease(self, lease, connection = False ):
+    """ Extend the lifetime of the lease by `/Overlay/LeaseTime` seconds from now
     """
+    if not LEASE_RE.match(lease):
+      return S_ERROR("Invalid lease %r" % lease)
     connection = self.__getConnection( connection )
-    res = self._checkSite(site, connection)
+    req = "UPDATE OverlayLeases SET ExpirationTime=%d WHERE Lease='%s';" % (int(time.time()) + self.leaseTime, lease)
+    res = self._update( req, connection )
     if not res['OK']:
       return res
-    nbjobs = res['Value'][0][0]
-    if nbjobs == 1:
+    if res['Value']:
       return S_OK()
-    nbjobs -= 1
-    req = "UPDATE OverlayData SET NumberOfJobs=%s WHERE Site='%s';" % (nbjobs, site)
-    res = self._update( req, connection )
+    # no row is changed if the lease was already renewed within the same second
+    res = self._query( "SELECT Lease FROM OverlayLeases WHERE Lease='%s';" % lease, connection )
     if not res['OK']:
-      return res   
-    return S_OK()    
-  
\ No newline at end of file
+      return res
+    if not res['Value']:
+      return S_ERROR("Lease %s is unknown or expired" % lease)
+    return S_OK()
+
+  def reclaimExpiredLeases(self, site, connection = False ):
+    """ Remove the expired leases at the site and free their slots
+    """
+    return self._reclaimExpiredLeases(site, connection, force = True)
+
+  def jobDone(self, site, lease = None, connection = False ):
+    """ Release the slot of a job
+
+    Without a lease, which is only the case for jobs from before the leases existed, the lease expiring first
+    at the site is released. Jobs that started before the leases existed do not have a lease at all, their slots
+    are freed by :func:`reconcileJobsAtSite`.
+    """
+    connection = self.__getConnection( connection )
+    if lease:
+      res = self._deleteLease(site, lease, connection)
+      if not res['OK']:
+        return res
+      return S_OK()
+
+    req = "SELECT Lease FROM OverlayLeases WHERE Site='%s' AND JobID=0 ORDER BY ExpirationTime LIMIT 1;" % site
+    res = self._query( req, connection )
+    if not res['OK']:
+      return res
+    if res['Value']:
+      res = self._deleteLease(site, res['Value'][0][0], connection)
+      if not res['OK']:
+        return res
+    return S_OK()
@@ -0,0 +1,103 @@
+"""Benchmark the slot accounting of the OverlayDB against the SQLite stand-in.
+
+Runs many concurrent acquire/release cycles against the current lease based OverlayDB and against the previous
+read-modify-write implementation, and reports the throughput, number of statements and the maximum number of
+concurrently held slots, which must never exceed the limit.
+
+Usage::
+
+  python Benchmark_OverlayDB.py [nThreads] [nCycles] [limit]
+
+"""
+
+from __future__ import print_function
+
+import sys
+import threading
+import time
+
+from ILCDIRAC.Tests.Utilities.SQLiteOverlayDB import SQLiteOverlayDB
+
+__RCSID__ = "$Id$"
+
+SITE = 'LCG.Benchmark.ch'
+
+
+def legacyCanRun(odb, site):
+  """The previous implementation: SELECT, compare in python, UPDATE with the new value."""
+  res = odb._query("SELECT NumberOfJobs FROM OverlayData WHERE Site='%s';" % site)  # pylint: disable=protected-access
+  if not res['OK'] or not res['Value']:
+    odb._update("INSERT INTO OverlayData (Site,NumberOfJobs) VALUES ('%s',1);" % site)  # pylint: disable=protected-access
+    return True
+  nbjobs = res['Value'][0][0]
+  if nbjobs < odb._limitForSite(site):  # pylint: disable=protected-access
+    odb._update("UPDATE OverlayData SET NumberOfJobs=%s WHERE Site='%s';" % (nbjobs + 1, site))  # pylint: disable=protected-access
+    return True
+  return False
+
+
+def legacyJobDone(odb, site):
+  """The previous implementation: SELECT, UPDATE with the new value."""
+  res = odb._query("SELECT NumberOfJobs FROM OverlayData WHERE Site='%s';" % site)  # pylint: disable=protected-access
+  nbjobs = res['Value'][0][0]
+  if nbjobs > 0:
+    odb._update("UPDATE OverlayData SET NumberOfJobs=%s WHERE Site='%s';" % (nbjobs - 1, site))  # pylint: disable=protected-access
+
+
+def runBenchmark(canRun, jobDone, nThreads, nCycles, limit):
+  """Run nThreads threads each doing nCycles acquire/release cycles, return statistics."""
+  odb = SQLiteOverlayDB(defaultLimit=limit)
+  holding = [0, 0]  # current, maximum
+  holdLock = threading.Lock()
+  granted = [0]
+
+  def worker():
+    """Acquire and release slots."""
+    for _ in range(nCycles):
+      if not canRun(odb, SITE):
+        continue
+      with holdLock:
+        granted[0] += 1
+        holding[0] += 1
+        holding[1] = max(holding)
+      time.sleep(0)
+      with holdLock:
+        holding[0] -= 1
+      jobDone(odb, SITE)
+
+  threads = [threading.Thread(target=worker) for _ in range(nThreads)]
+  start = time.time()
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  elapsed = time.time() - start
+  return dict(elapsed=elapsed, granted=granted[0], statements=odb.statements, maxHeld=holding[1],
+              finalCounter=odb.getJobsAtSite(SITE)['Value'])
+
+
+def main(nThreads=200, nCycles=50, limit=20):
+  """Compare the legacy and the atomic implementation."""
+  leases = {}
+
+  def canRun(odb, site):
+    """Take a lease and remember it for this thread."""
+    lease = odb.canRun(site)['Value']
+    leases[threading.current_thread().ident] = lease
+    return lease
+
+  def jobDone(odb, site):
+    """Release the lease of this thread."""
+    odb.jobDone(site, leases.pop(threading.current_thread().ident))
+
+  atomic = runBenchmark(canRun, jobDone, nThreads, nCycles, limit)
+  legacy = runBenchmark(legacyCanRun, legacyJobDone, nThreads, nCycles, limit)
+  for name, stats in (('legacy', legacy), ('leases', atomic)):
+    print('%-7s: %6.2fs, %6d granted, %7d statements (%.2f per call), max held %3d (limit %d), final counter %d' %
+          (name, stats['elapsed'], stats['granted'], stats['statements'],
+           float(stats['statements']) / (nThreads * nCycles + stats['granted']),
+           stats['maxHeld'], limit, stats['finalCounter']))
+
+
+if __name__ == '__main__':
+  main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,139 @@
+"""Simulate many overlay jobs competing for the slots of one site.
+
+Replays thousands of jobs against the OverlayDB, using the SQLite stand-in and a simulated clock, once with the
+previous behaviour of OverlayInput, which asked with canRun every 60 seconds, and once with the admission queue, where
+the jobs take a ticket and ask again after the time given by requestSlot.
+
+For both cases the utilisation of the slots while jobs were waiting, the waiting times, the number of jobs which got
+a slot before a job which arrived earlier, and the number of service calls are printed.
+
+Usage::
+
+  python Simulate_OverlayQueue.py [nJobs] [limit] [arrivalWindow] [meanDownloadTime]
+
+"""
+
+from __future__ import print_function
+
+import heapq
+import random
+import sys
+
+from mock import patch
+
+from ILCDIRAC.Tests.Utilities.SQLiteOverlayDB import SQLiteOverlayDB
+
+__RCSID__ = "$Id$"
+
+SITE = 'LCG.Simulation.ch'
+
+
+class SimulatedClock(object):
+  """Replacement for the time module in the OverlayDB."""
+
+  def __init__(self):
+    self.now = 0.0
+
+  def time(self):
+    """Return the simulated time."""
+    return self.now
+
+
+class LegacyJob(object):
+  """Job asking for a slot with canRun every 60 seconds."""
+
+  def __init__(self, odb):
+    self.odb = odb
+    self.lease = None
+    self.calls = 0
+
+  def poll(self, _jobID):
+    """Ask for a slot, return True or the time after which to ask again."""
+    self.calls += 1
+    self.lease = self.odb.canRun(SITE)['Value']
+    return True if self.lease else 60
+
+  def done(self):
+    """Release the slot."""
+    self.calls += 1
+    self.odb.jobDone(SITE, self.lease)
+
+
+class QueuedJob(LegacyJob):
+  """Job waiting for a slot in the admission queue."""
+
+  def __init__(self, odb):
+    super(QueuedJob, self).__init__(odb)
+    self.ticket = None
+
+  def poll(self, jobID):
+    """Take a ticket if needed and ask for a slot."""
+    if self.ticket is None:
+      self.calls += 1
+      self.ticket = self.odb.enqueue(SITE, jobID)['Value']
+    self.calls += 1
+    result = self.odb.requestSlot(SITE, self.ticket, jobID)['Value']
+    self.lease = result['Lease']
+    return True if self.lease else result['RetryAfter']
+
+
+def simulate(jobClass, nJobs, limit, arrivalWindow, meanDownloadTime, seed=1234):
+  """Run the simulation for all jobs, return the statistics."""
+  rand = random.Random(seed)
+  clock = SimulatedClock()
+  with patch('ILCDIRAC.OverlaySystem.DB.OverlayDB.time', new=clock):
+    odb = SQLiteOverlayDB(defaultLimit=limit)
+    arrivals = sorted(rand.uniform(0, arrivalWindow) for _ in range(nJobs))
+    jobs = [jobClass(odb) for _ in range(nJobs)]
+    events = [(arrival, jobID, 'poll') for jobID, arrival in enumerate(arrivals)]
+    heapq.heapify(events)
+    waiting = set()
+    granted = {}
+    held = 0
+    busySlotTime = idleWhileWaiting = contentionTime = 0.0
+    overtakes = 0
+    while events:
+      eventTime, jobID, action = heapq.heappop(events)
+      elapsed = eventTime - clock.now
+      if waiting and elapsed > 0:
+        idleWhileWaiting += (limit - held) * elapsed
+        contentionTime += elapsed
+      busySlotTime += held * elapsed
+      clock.now = eventTime
+      if action == 'done':
+        jobs[jobID].done()
+        held -= 1
+        continue
+      waiting.add(jobID)
+      result = jobs[jobID].poll(jobID + 1)
+      if result is True:
+        waiting.discard(jobID)
+        if any(other < jobID for other in waiting):
+          overtakes += 1
+        granted[jobID] = eventTime - arrivals[jobID]
+        held += 1
+        heapq.heappush(events, (eventTime + max(1.0, rand.gauss(meanDownloadTime, meanDownloadTime / 5.)),
+                                jobID, 'done'))
+      else:
+        heapq.heappush(events, (eventTime + result, jobID, 'poll'))
+  waits = sorted(granted.values())
+  return dict(utilisation=1. - idleWhileWaiting / (limit * contentionTime) if contentionTime else 1.,
+              meanWait=sum(waits) / len(waits), medianWait=waits[len(waits) // 2], maxWait=waits[-1],
+              overtakes=overtakes, calls=sum(job.calls for job in jobs), makespan=clock.now,
+              busySlotTime=busySlotTime)
+
+
+def main(nJobs=3000, limit=200, arrivalWindow=3600, meanDownloadTime=300):
+  """Compare polling with canRun and the admission queue."""
+  print('%d jobs arriving within %ds, %d slots, %ds mean download time' %
+        (nJobs, arrivalWindow, limit, meanDownloadTime))
+  for name, jobClass in (('canRun polling', LegacyJob), ('queue', QueuedJob)):
+    stats = simulate(jobClass, nJobs, limit, arrivalWindow, meanDownloadTime)
+    print('%-15s: utilisation %5.1f%%, wait mean %6.0fs median %6.0fs max %6.0fs, %5d overtakes, '
+          '%7d calls, all done after %6.0fs' %
+          (name, 100 * stats['utilisation'], stats['meanWait'], stats['medianWait'], stats['maxWait'],
+           stats['overtakes'], stats['calls'], stats['makespan']))
+
+
+if __name__ == '__main__':
+  main(*[int(arg) for arg in sys.argv[1:]])
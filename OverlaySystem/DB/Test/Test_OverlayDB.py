@@ -12,6 +12,8 @@ from DIRAC import S_OK, S_ERROR
 __RCSID__ = "$Id$"
 
 MODULE_NAME = 'ILCDIRAC.OverlaySystem.DB.OverlayDB'
+LEASE = '0123456789abcdef0123456789abcdef'
+OTHER_LEASE = 'fedcba9876543210fedcba9876543210'
 
 # pylint: disable=no-member
 class TestOverlayDB( unittest.TestCase ):
@@ -22,7 +24,10 @@ class TestOverlayDB( unittest.TestCase ):
     from ILCDIRAC.OverlaySystem.DB.OverlayDB import OverlayDB
     from DIRAC.Core.Base.DB import DB
     value_dict = { '/Overlay/MaxConcurrentRunning' : 10, '/Overlay/Sites/testSite1/MaxConcurrentRunning' : 2,
-                   '/Overlay/Sites/myOtherSite/MaxConcurrentRunning' : 2 }
+                   '/Overlay/Sites/myOtherSite/MaxConcurrentRunning' : 2, '/Overlay/LimitsCacheTime' : 300,
+                   '/Overlay/LeaseTime' : 100, '/Overlay/LeaseReclaimInterval' : 60,
+                   '/Overlay/Queue/TicketTimeout' : 300, '/Overlay/Queue/MinPollTime' : 5,
+                   '/Overlay/Queue/MaxPollTime' : 60 }
     sections_dict = { '/Overlay/Sites/' : [ 'testSite1', 'myOtherSite' ] }
     self.ops_mock = Mock()
     self.ops_mock.getValue.side_effect = lambda x, _ : value_dict[x]
@@ -55,26 +60,14 @@ class TestOverlayDB( unittest.TestCase ):
          patch('%s.OverlayDB._query' % MODULE_NAME, new=Mock(return_value=S_ERROR('noconnection'))):
       assertDiracFailsWith( self.odb.getSites(), 'Could not get sites', self )
 
-  def test_setjobsatsites( self ):
+  def test_reconcilejobsatsite( self ):
     con_mock = Mock()
-    with patch('%s.OverlayDB._update' % MODULE_NAME, new=Mock(return_value=S_OK())) as update_mock:
-      assertDiracSucceeds( self.odb.setJobsAtSites( { 'MyTestSite1' : 1487, 'other_site' : '138', 'large_testsite' : 40913.2 }, con_mock ), self )
-      assertMockCalls( update_mock, [
-        ( "UPDATE OverlayData SET NumberOfJobs=1487 WHERE Site='MyTestSite1';", con_mock ),
-        ( "UPDATE OverlayData SET NumberOfJobs=138 WHERE Site='other_site';", con_mock ),
-        ( "UPDATE OverlayData SET NumberOfJobs=40913 WHERE Site='large_testsite';", con_mock ) ], self )
-
-  def test_setjobsatsites_nothingtodo( self ):
-    assertDiracSucceeds( self.odb.setJobsAtSites( {}, Mock() ), self )
-
-  def test_setjobsatsites_update_fails( self ):
-    def replace_update( request ):
-      """ Mocks the return value of the _update method """
-      if 'other_site' in request:
-        return S_ERROR()
-      return S_OK()
-    with patch('%s.OverlayDB._update' % MODULE_NAME, new=Mock(side_effect=lambda request, _ : replace_update( request ))):
-      assertDiracFailsWith( self.odb.setJobsAtSites( { 'MyTestSite1' : 1487, 'other_site' : '138', 'large_testsite' : 40913.2 }, Mock() ), 'could not set number of jobs at site', self )
+    with patch('%s.OverlayDB._update' % MODULE_NAME, new=Mock(return_value=S_OK(1))) as update_mock, \
+         patch('%s.time.time' % MODULE_NAME, new=Mock(return_value=1000)):
+      assertDiracSucceedsWith_equals( self.odb.reconcileJobsAtSite( 'MyTestSite1', con_mock ), 1, self )
+      update_mock.assert_called_once_with( "UPDATE OverlayData SET NumberOfJobs=(SELECT COUNT(*) FROM OverlayLeases "
+                                           "WHERE Site='MyTestSite1' AND ExpirationTime>=1000) "
+                                           "WHERE Site='MyTestSite1';", con_mock )
 
   def test_getjobsatsite( self ):
     con_mock = Mock()
@@ -94,53 +87,256 @@ class TestOverlayDB( unittest.TestCase ):
 
   def test_canrun_toomanyjobs( self ):
     con_mock = Mock()
-    with patch('%s.OverlayDB._query' % MODULE_NAME, new=Mock(return_value=S_OK([[2]]))) as query_mock:
-      assertDiracSucceedsWith_equals( self.odb.canRun( 'testSite1', con_mock ), False, self )
-      query_mock.assert_called_once_with( "SELECT NumberOfJobs FROM OverlayData WHERE Site='testSite1';",
-                                          con_mock )
+    self.odb.knownSites.add( 'testSite1' )
+    self.odb.lastReclaim[ 'testSite1' ] = 1000
+    with patch('%s.OverlayDB._update' % MODULE_NAME, new=Mock(return_value=S_OK(0))) as update_mock, \
+         patch('%s.time.time' % MODULE_NAME, new=Mock(return_value=1010)):
+      assertDiracSucceedsWith_equals( self.odb.canRun( 'testSite1', connection=con_mock ), False, self )
+      update_mock.assert_called_once_with(
+        "UPDATE OverlayData SET NumberOfJobs=NumberOfJobs+1 WHERE Site='testSite1' AND NumberOfJobs<2;", con_mock )
+
+  def test_canrun_reclaims_expired( self ):
+    con_mock = Mock()
+    self.odb.knownSites.add( 'testSite1' )
+    with patch('%s.OverlayDB._update' % MODULE_NAME,
+               new=Mock(side_effect=[S_OK(0), S_OK(2), S_OK(1), S_OK(1), S_OK(1)])) as update_mock, \
+         patch('%s.time.time' % MODULE_NAME, new=Mock(return_value=1000)), \
+         patch('%s.uuid.uuid4' % MODULE_NAME, new=Mock(return_value=Mock(hex=LEASE))):
+      assertDiracSucceedsWith_equals( self.odb.canRun( 'testSite1', 123, con_mock ), LEASE, self )
+      assertMockCalls( update_mock,
+                       [ ( "UPDATE OverlayData SET NumberOfJobs=NumberOfJobs+1 WHERE Site='testSite1' AND NumberOfJobs<2;",
+                           con_mock ),
+                         ( "DELETE FROM OverlayLeases WHERE Site='testSite1' AND ExpirationTime<1000;", con_mock ),
+                         ( "UPDATE OverlayData SET NumberOfJobs=CASE WHEN NumberOfJobs>2 THEN NumberOfJobs-2 ELSE 0 END "
+                           "WHERE Site='testSite1';", con_mock ),
+                         ( "UPDATE OverlayData SET NumberOfJobs=NumberOfJobs+1 WHERE Site='testSite1' AND NumberOfJobs<2;",
+                           con_mock ),
+                         ( "INSERT INTO OverlayLeases (Lease,Site,JobID,ExpirationTime) "
+                           "VALUES ('0123456789abcdef0123456789abcdef','testSite1',123,1100);", con_mock ) ], self )
+
+  def test_canrun( self ):
+    con_mock = Mock()
+    with patch('%s.OverlayDB._update' % MODULE_NAME, new=Mock(return_value=S_OK(1))) as update_mock, \
+         patch('%s.time.time' % MODULE_NAME, new=Mock(return_value=1000)), \
+         patch('%s.uuid.uuid4' % MODULE_NAME, new=Mock(return_value=Mock(hex=LEASE))):
+      assertDiracSucceedsWith_equals( self.odb.canRun( 'tenJobSite', 123, con_mock ), LEASE, self )
+      assertMockCalls( update_mock,
+                       [ ( "UPDATE OverlayData SET NumberOfJobs=NumberOfJobs+1 WHERE Site='tenJobSite' AND NumberOfJobs<10;",
+                           con_mock ),
+                         ( "INSERT INTO OverlayLeases (Lease,Site,JobID,ExpirationTime) "
+                           "VALUES ('0123456789abcdef0123456789abcdef','tenJobSite',123,1100);", con_mock ) ], self )
+    self.assertIn( 'tenJobSite', self.odb.knownSites )
+
+  def test_canrun_update_fails( self ):
+    con_mock = Mock()
+    with patch('%s.OverlayDB._update' % MODULE_NAME, new=Mock(return_value=S_ERROR('update_test_err'))):
+      assertDiracFailsWith( self.odb.canRun( 'tenJobSite', connection=con_mock ), 'update_test_err', self )
+
+  def test_canrun_lease_fails( self ):
+    con_mock = Mock()
+    with patch('%s.OverlayDB._update' % MODULE_NAME,
+               new=Mock(side_effect=[S_OK(1), S_ERROR('lease_test_err'), S_OK(1)])) as update_mock:
+      assertDiracFailsWith( self.odb.canRun( 'tenJobSite', connection=con_mock ), 'lease_test_err', self )
+      update_mock.assert_called_with( "UPDATE OverlayData SET NumberOfJobs=CASE WHEN NumberOfJobs>1 THEN "
+                                      "NumberOfJobs-1 ELSE 0 END WHERE Site='tenJobSite';", con_mock )
 
   def test_canrun_add_to_new_site( self ):
     con_mock = Mock()
-    with patch('%s.OverlayDB._query' % MODULE_NAME, new=Mock(return_value=S_ERROR())), \
-         patch('%s.OverlayDB._update' % MODULE_NAME, new=Mock(return_value=S_OK())) as update_mock:
-      assertDiracSucceedsWith_equals( self.odb.canRun( 'tenJobSite', con_mock ), True, self )
+    with patch('%s.OverlayDB._update' % MODULE_NAME, new=Mock(side_effect=[S_OK(0), S_OK(1), S_OK(1)])) as update_mock:
+      self.assertTrue( self.odb.canRun( 'tenJobSite', connection=con_mock )['Value'] )
       assertMockCalls( update_mock,
-                       [ ( "INSERT INTO OverlayData (Site,NumberOfJobs) VALUES ('tenJobSite',1);", con_mock ),
-                         ( "UPDATE OverlayData SET NumberOfJobs=2 WHERE Site='tenJobSite';", con_mock ) ], self )
+                       [ ( "UPDATE OverlayData SET NumberOfJobs=NumberOfJobs+1 WHERE Site='tenJobSite' AND NumberOfJobs<10;",
+                           con_mock ),
+                         ( "INSERT INTO OverlayData (Site,NumberOfJobs) VALUES ('tenJobSite',1);", con_mock ) ], self,
+                       only_these_calls = False )
 
   def test_canrun_addsite_fails( self ):
     con_mock = Mock()
-    with patch('%s.OverlayDB._query' % MODULE_NAME, new=Mock(return_value=S_ERROR())), \
-         patch('%s.OverlayDB._update' % MODULE_NAME, new=Mock(side_effect=[S_ERROR('update_test_err'), S_OK()])) as update_mock:
-      assertDiracSucceedsWith_equals( self.odb.canRun( 'tenJobSite', con_mock ), True, self )
+    with patch('%s.OverlayDB._update' % MODULE_NAME,
+               new=Mock(side_effect=[S_OK(0), S_ERROR('update_test_err'), S_OK(1), S_OK(1)])) as update_mock:
+      self.assertTrue( self.odb.canRun( 'tenJobSite', connection=con_mock )['Value'] )
       assertMockCalls( update_mock,
-                       [ ( "INSERT INTO OverlayData (Site,NumberOfJobs) VALUES ('tenJobSite',1);", con_mock ),
-                         ( "UPDATE OverlayData SET NumberOfJobs=2 WHERE Site='tenJobSite';", con_mock ) ], self )
+                       [ ( "UPDATE OverlayData SET NumberOfJobs=NumberOfJobs+1 WHERE Site='tenJobSite' AND NumberOfJobs<10;",
+                           con_mock ),
+                         ( "INSERT INTO OverlayData (Site,NumberOfJobs) VALUES ('tenJobSite',1);", con_mock ),
+                         ( "UPDATE OverlayData SET NumberOfJobs=NumberOfJobs+1 WHERE Site='tenJobSite' AND NumberOfJobs<10;",
+                           con_mock ) ], self, only_these_calls = False )
 
-  def test_jobdone( self ):
+  def test_renewlease( self ):
     con_mock = Mock()
-    with patch('%s.OverlayDB._query' % MODULE_NAME, new=Mock(return_value=S_OK([[148]]))) as query_mock, \
-         patch('%s.OverlayDB._update' % MODULE_NAME, new=Mock(return_value=S_OK())) as update_mock:
-      assertDiracSucceeds( self.odb.jobDone( 'my_TestSite1', con_mock ), self )
-      query_mock.assert_called_once_with( "SELECT NumberOfJobs FROM OverlayData WHERE Site='my_TestSite1';",
-                                          con_mock )
-      update_mock.assert_called_once_with( "UPDATE OverlayData SET NumberOfJobs=147 WHERE Site='my_TestSite1';",
+    with patch('%s.OverlayDB._update' % MODULE_NAME, new=Mock(return_value=S_OK(1))) as update_mock, \
+         patch('%s.time.time' % MODULE_NAME, new=Mock(return_value=1000)):
+      assertDiracSucceeds( self.odb.renewLease( LEASE, con_mock ), self )
+      update_mock.assert_called_once_with( "UPDATE OverlayLeases SET ExpirationTime=1100 WHERE Lease='%s';" % LEASE,
                                            con_mock )
 
-  def test_jobdone_checksite_fails( self ):
+  def test_renewlease_expired( self ):
+    with patch('%s.OverlayDB._update' % MODULE_NAME, new=Mock(return_value=S_OK(0))), \
+         patch('%s.OverlayDB._query' % MODULE_NAME, new=Mock(return_value=S_OK(()))):
+      assertDiracFailsWith( self.odb.renewLease( LEASE, Mock() ), 'unknown or expired', self )
+
+  def test_renewlease_same_second( self ):
     con_mock = Mock()
-    with patch('%s.OverlayDB._query' % MODULE_NAME, new=Mock(return_value=S_ERROR())):
-      assertDiracFailsWith( self.odb.jobDone( 'my_TestSite1', con_mock ), 'Could not get site', self )
+    with patch('%s.OverlayDB._update' % MODULE_NAME, new=Mock(return_value=S_OK(0))), \
+         patch('%s.OverlayDB._query' % MODULE_NAME, new=Mock(return_value=S_OK(((LEASE,),)))) as query_mock:
+      assertDiracSucceeds( self.odb.renewLease( LEASE, con_mock ), self )
+      query_mock.assert_called_once_with( "SELECT Lease FROM OverlayLeases WHERE Lease='%s';" % LEASE, con_mock )
+
+  def test_invalid_lease( self ):
+    with patch('%s.OverlayDB._update' % MODULE_NAME) as update_mock:
+      assertDiracFailsWith( self.odb.renewLease( "x' OR '1'='1", Mock() ), 'invalid lease', self )
+      assertDiracFailsWith( self.odb.jobDone( 'my_TestSite1', "x' OR '1'='1", Mock() ), 'invalid lease', self )
+      self.assertFalse( update_mock.called )
+
+  def test_limits_refreshed( self ):
+    self.assertEquals( self.odb._limitForSite( 'testSite1' ), 2 ) #pylint: disable=protected-access
+    self.assertEquals( self.odb._limitForSite( 'unknownSite' ), 10 ) #pylint: disable=protected-access
+    self.ops_mock.getSections.side_effect = lambda x : S_OK( [] )
+    self.assertEquals( self.odb._limitForSite( 'testSite1' ), 2 ) #pylint: disable=protected-access
+    self.odb.limitsTimestamp = 0
+    self.assertEquals( self.odb._limitForSite( 'testSite1' ), 10 ) #pylint: disable=protected-access
+
+  def test_jobdone( self ):
+    con_mock = Mock()
+    with patch('%s.OverlayDB._update' % MODULE_NAME, new=Mock(return_value=S_OK(1))) as update_mock:
+      assertDiracSucceeds( self.odb.jobDone( 'my_TestSite1', LEASE, con_mock ), self )
+      assertMockCalls( update_mock,
+                       [ ( "DELETE FROM OverlayLeases WHERE Lease='%s' AND Site='my_TestSite1';" % LEASE, con_mock ),
+                         ( "UPDATE OverlayData SET NumberOfJobs=CASE WHEN NumberOfJobs>1 THEN NumberOfJobs-1 ELSE 0 END "
+                           "WHERE Site='my_TestSite1';", con_mock ) ], self )
 
-  def test_jobdone_nojobs( self ):
+  def test_jobdone_lease_reclaimed( self ):
     con_mock = Mock()
-    with patch('%s.OverlayDB._query' % MODULE_NAME, new=Mock(return_value=S_OK([[1]]))) as query_mock:
-      assertDiracSucceeds( self.odb.jobDone( 'my_TestSite1', con_mock ), self )
-      query_mock.assert_called_once_with( "SELECT NumberOfJobs FROM OverlayData WHERE Site='my_TestSite1';",
-                                          con_mock )
+    with patch('%s.OverlayDB._update' % MODULE_NAME, new=Mock(return_value=S_OK(0))) as update_mock:
+      assertDiracSucceeds( self.odb.jobDone( 'my_TestSite1', LEASE, con_mock ), self )
+      update_mock.assert_called_once_with( "DELETE FROM OverlayLeases WHERE Lease='%s' AND Site='my_TestSite1';" % LEASE,
+                                           con_mock )
+
+  def test_jobdone_nolease( self ):
+    con_mock = Mock()
+    with patch('%s.OverlayDB._query' % MODULE_NAME, new=Mock(return_value=S_OK([[OTHER_LEASE]]))) as query_mock, \
+         patch('%s.OverlayDB._update' % MODULE_NAME, new=Mock(return_value=S_OK(1))) as update_mock:
+      assertDiracSucceeds( self.odb.jobDone( 'my_TestSite1', connection=con_mock ), self )
+      query_mock.assert_called_once_with( "SELECT Lease FROM OverlayLeases WHERE Site='my_TestSite1' AND JobID=0 "
+                                          "ORDER BY ExpirationTime LIMIT 1;", con_mock )
+      self.assertEqual( update_mock.call_count, 2 )
+
+  def test_jobdone_nolease_nojobs( self ):
+    with patch('%s.OverlayDB._query' % MODULE_NAME, new=Mock(return_value=S_OK([]))), \
+         patch('%s.OverlayDB._update' % MODULE_NAME) as update_mock:
+      assertDiracSucceeds( self.odb.jobDone( 'my_TestSite1', connection=Mock() ), self )
+      self.assertFalse( update_mock.called )
 
   def test_jobdone_update_fails( self ):
     con_mock = Mock()
-    with patch('%s.OverlayDB._query' % MODULE_NAME, new=Mock(return_value=S_OK([[148]]))), \
-         patch('%s.OverlayDB._update' % MODULE_NAME, new=Mock(return_value=S_ERROR('update_test_err'))):
-      assertDiracFailsWith( self.odb.jobDone( 'my_TestSite1', con_mock ), 'update_test_err', self )
+    with patch('%s.OverlayDB._update' % MODULE_NAME, new=Mock(return_value=S_ERROR('update_test_err'))):
+      assertDiracFailsWith( self.odb.jobDone( 'my_TestSite1', LEASE, con_mock ), 'update_test_err', self )
+
+
+class TestOverlayDBSQLite( unittest.TestCase ):
+  """Run the slot accounting against a real database"""
+  def setUp( self ):
+    from ILCDIRAC.Tests.Utilities.SQLiteOverlayDB import SQLiteOverlayDB
+    self.odb = SQLiteOverlayDB( defaultLimit=3, siteLimits={ 'smallSite' : 1 }, leaseTime=100, reclaimInterval=0,
+                                options={ '/Overlay/Queue/TicketTimeout' : 60 } )
+
+  def test_slots( self ):
+    leases = [ self.odb.canRun( 'bigSite', jobID )['Value'] for jobID in range( 3 ) ]
+    self.assertTrue( all( leases ) )
+    self.assertEqual( len( set( leases ) ), 3 )
+    assertDiracSucceedsWith_equals( self.odb.canRun( 'bigSite' ), False, self )
+    assertDiracSucceedsWith_equals( self.odb.getJobsAtSite( 'bigSite' ), 3, self )
+    assertDiracSucceeds( self.odb.jobDone( 'bigSite', leases[0] ), self )
+    assertDiracSucceeds( self.odb.jobDone( 'bigSite', leases[0] ), self )
+    assertDiracSucceedsWith_equals( self.odb.getJobsAtSite( 'bigSite' ), 2, self )
+    self.assertTrue( self.odb.canRun( 'bigSite' )['Value'] )
+    self.assertTrue( self.odb.canRun( 'smallSite' )['Value'] )
+    assertDiracSucceedsWith_equals( self.odb.canRun( 'smallSite' ), False, self )
+
+  def test_reconcile( self ):
+    with patch('%s.time.time' % MODULE_NAME, new=Mock(return_value=1000)):
+      leases = [ self.odb.canRun( 'bigSite', jobID )['Value'] for jobID in range( 2 ) ]
+    # a slot taken without lease, and a lease whose slot was already freed
+    assertDiracSucceeds( self.odb._addNewJob( 'bigSite', 3 ), self ) #pylint: disable=protected-access
+    assertDiracSucceeds( self.odb._removeJobs( 'bigSite', 2 ), self ) #pylint: disable=protected-access
+    assertDiracSucceedsWith_equals( self.odb.getJobsAtSite( 'bigSite' ), 1, self )
+    with patch('%s.time.time' % MODULE_NAME, new=Mock(return_value=1050)):
+      assertDiracSucceeds( self.odb.reconcileJobsAtSite( 'bigSite' ), self )
+    assertDiracSucceedsWith_equals( self.odb.getJobsAtSite( 'bigSite' ), 2, self )
+    with patch('%s.time.time' % MODULE_NAME, new=Mock(return_value=1050)):
+      assertDiracSucceeds( self.odb.renewLease( leases[0] ), self )
+    with patch('%s.time.time' % MODULE_NAME, new=Mock(return_value=1120)):
+      assertDiracSucceeds( self.odb.reconcileJobsAtSite( 'bigSite' ), self )
+    assertDiracSucceedsWith_equals( self.odb.getJobsAtSite( 'bigSite' ), 1, self )
+
+  def test_renew_twice( self ):
+    lease = self.odb.canRun( 'bigSite' )['Value']
+    with patch('%s.time.time' % MODULE_NAME, new=Mock(return_value=1000)):
+      assertDiracSucceeds( self.odb.renewLease( lease ), self )
+      assertDiracSucceeds( self.odb.renewLease( lease ), self )
+
+  def test_jobdone_without_lease( self ):
+    assertDiracSucceeds( self.odb.jobDone( 'bigSite' ), self )
+    self.assertTrue( self.odb.canRun( 'bigSite' )['Value'] )
+    for _ in range( 3 ):
+      assertDiracSucceeds( self.odb.jobDone( 'bigSite' ), self )
+    assertDiracSucceedsWith_equals( self.odb.getJobsAtSite( 'bigSite' ), 0, self )
+
+  def test_expired_leases( self ):
+    with patch('%s.time.time' % MODULE_NAME, new=Mock(return_value=1000)):
+      leases = [ self.odb.canRun( 'bigSite', jobID )['Value'] for jobID in range( 3 ) ]
+    with patch('%s.time.time' % MODULE_NAME, new=Mock(return_value=1050)):
+      assertDiracSucceedsWith_equals( self.odb.canRun( 'bigSite', 4 ), False, self )
+      assertDiracSucceeds( self.odb.renewLease( leases[0] ), self )
+    with patch('%s.time.time' % MODULE_NAME, new=Mock(return_value=1101)):
+      newLeases = [ self.odb.canRun( 'bigSite', jobID )['Value'] for jobID in range( 4, 7 ) ]
+      assertDiracFailsWith( self.odb.renewLease( leases[1] ), 'unknown or expired', self )
+      assertDiracSucceeds( self.odb.jobDone( 'bigSite', leases[1] ), self )
+    self.assertTrue( all( newLeases[:2] ) )
+    self.assertFalse( newLeases[2] )
+    assertDiracSucceedsWith_equals( self.odb.getJobsAtSite( 'bigSite' ), 3, self )
+
+  def test_queue_fifo( self ):
+    leases = [ self.odb.canRun( 'bigSite', jobID )['Value'] for jobID in range( 3 ) ]
+    tickets = [ self.odb.enqueue( 'bigSite', jobID )['Value'] for jobID in range( 3, 7 ) ]
+    self.assertEqual( tickets, sorted( tickets ) )
+    assertDiracSucceedsWith_equals( self.odb.getQueuePosition( 'bigSite', tickets[2] ), 2, self )
+    result = self.odb.requestSlot( 'bigSite', tickets[2], 5 )
+    self.assertFalse( result['Value']['Lease'] )
+    self.assertEqual( result['Value']['Position'], 2 )
+    self.assertEqual( result['Value']['RetryAfter'], 6 )
+    assertDiracSucceeds( self.odb.jobDone( 'bigSite', leases[0] ), self )
+    # one slot is free, only the first ticket gets it
+    self.assertFalse( self.odb.requestSlot( 'bigSite', tickets[1], 4 )['Value']['Lease'] )
+    self.assertTrue( self.odb.requestSlot( 'bigSite', tickets[0], 3 )['Value']['Lease'] )
+    self.assertFalse( self.odb.requestSlot( 'bigSite', tickets[1], 4 )['Value']['Lease'] )
+    assertDiracSucceedsWith_equals( self.odb.getQueuePosition( 'bigSite', tickets[3] ), 2, self )
+    assertDiracSucceeds( self.odb.leaveQueue( tickets[1] ), self )
+    assertDiracSucceeds( self.odb.jobDone( 'bigSite', leases[1] ), self )
+    self.assertTrue( self.odb.requestSlot( 'bigSite', tickets[2], 5 )['Value']['Lease'] )
+    assertDiracSucceedsWith_equals( self.odb.getQueuePosition( 'bigSite', tickets[3] ), 0, self )
+
+  def test_queue_stale_tickets( self ):
+    with patch('%s.time.time' % MODULE_NAME, new=Mock(return_value=1000)):
+      leases = [ self.odb.canRun( 'bigSite', jobID )['Value'] for jobID in range( 3 ) ]
+      tickets = [ self.odb.enqueue( 'bigSite', jobID )['Value'] for jobID in range( 3, 5 ) ]
+    with patch('%s.time.time' % MODULE_NAME, new=Mock(return_value=1090)):
+      assertDiracSucceeds( self.odb.jobDone( 'bigSite', leases[0] ), self )
+      # the first ticket was not seen for too long, the second ticket gets the slot
+      self.assertTrue( self.odb.requestSlot( 'bigSite', tickets[1], 4 )['Value']['Lease'] )
+      assertDiracSucceedsWith_equals( self.odb.purgeStaleTickets( 'bigSite' ), 1, self )
+      # the purged ticket comes back with its number when the job asks again
+      self.assertFalse( self.odb.requestSlot( 'bigSite', tickets[0], 3 )['Value']['Lease'] )
+      assertDiracSucceedsWith_equals( self.odb.purgeStaleTickets( 'bigSite' ), 0, self )
+
+  def test_concurrent_slots( self ):
+    import threading
+    results = []
+    threads = [ threading.Thread( target=lambda: results.append( self.odb.canRun( 'bigSite' )['Value'] ) )
+                for _ in range( 20 ) ]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEqual( len( [ lease for lease in results if lease ] ), 3 )
+    assertDiracSucceedsWith_equals( self.odb.getJobsAtSite( 'bigSite' ), 3, self )
@@ -0,0 +1,77 @@
+""" Cache of the overlay file listings served by the Overlay service
+
+Every job using overlay asks for the list of background files of the same few samples. The listings are kept in memory
+for `/Overlay/FileListCacheTime` seconds, so that the FileCatalog is only queried once per sample and period. If the
+same listing is requested while it is being obtained, the request waits for the result instead of querying the
+FileCatalog again.
+"""
+
+import threading
+import time
+
+from DIRAC import gLogger, S_OK
+
+__RCSID__ = "$Id$"
+
+LOG = gLogger.getSubLogger(__name__)
+
+
+class FileListCache(object):
+  """ Listings of files found by metadata queries, keyed on the metadata dictionary and path
+
+  :param fcClient: FileCatalogClient used to look up the files
+  :param int cacheTime: time in seconds the listings are valid
+  """
+
+  def __init__(self, fcClient, cacheTime=3600):
+    self.fcc = fcClient
+    self.cacheTime = cacheTime
+    self._lock = threading.Lock()
+    self._keyLocks = {}
+    self._listings = {}
+
+  @staticmethod
+  def cacheKey(meta, path):
+    """ Return the key for the metadata query, independent of the order and the types of the metadata values """
+    return (path, tuple(sorted((str(key), str(value)) for key, value in meta.items())))
+
+  def getFiles(self, meta, path='/'):
+    """ Return the listing for the metadata query
+
+    :param dict meta: metadata to look for
+    :param str path: directory to look in
+    :returns: S_OK with a dictionary with the list of `LFNs` and the `Version` of the listing, which is the time it was
+              obtained
+    """
+    key = self.cacheKey(meta, path)
+    with self._lock:
+      keyLock = self._keyLocks.setdefault(key, threading.Lock())
+
+    with keyLock:
+      listing = self._listings.get(key)
+      if listing and listing['Expiration'] > time.time():
+        return S_OK(dict(LFNs=listing['LFNs'], Version=listing['Version']))
+
+      res = self.fcc.findFilesByMetadata(meta, path)
+      if not res['OK']:
+        if listing:
+          LOG.warn('Could not refresh the file listing, using the expired one', res['Message'])
+          return S_OK(dict(LFNs=listing['LFNs'], Version=listing['Version']))
+        return res
+
+      now = time.time()
+      listing = dict(LFNs=res['Value'], Version=int(now), Expiration=now + self.cacheTime)
+      if res['Value']:
+        # empty listings are not kept, the files of a sample might be registered soon
+        self._listings[key] = listing
+      LOG.verbose('Found %d files for %s' % (len(res['Value']), str(key)))
+    self._removeExpired()
+    return S_OK(dict(LFNs=listing['LFNs'], Version=listing['Version']))
+
+  def _removeExpired(self):
+    """ Forget listings which expired more than one cache period ago """
+    limit = time.time() - self.cacheTime
+    with self._lock:
+      for key in [key for key, listing in self._listings.items() if listing['Expiration'] < limit]:
+        del self._listings[key]
+        self._keyLocks.pop(key, None)
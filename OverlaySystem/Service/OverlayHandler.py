@@ -1,12 +1,15 @@
 """ Services for Overlay System
 """
 
-from types import StringTypes, DictType
+from types import StringTypes, DictType, IntType, LongType
 
 from DIRAC                                              import S_OK
+from DIRAC.ConfigurationSystem.Client.Helpers.Operations import Operations
 from DIRAC.Core.DISET.RequestHandler                    import RequestHandler
+from DIRAC.Resources.Catalog.FileCatalogClient          import FileCatalogClient
 
 from ILCDIRAC.OverlaySystem.DB.OverlayDB                import OverlayDB
+from ILCDIRAC.OverlaySystem.Service.FileListCache       import FileListCache
 
 __RCSID__ = "$Id$"
 
@@ -14,30 +17,84 @@ __RCSID__ = "$Id$"
 
 # This is a global instance of the OverlayDB class
 OVERLAY_DB = False
+# Global cache of the overlay file listings
+FILE_LIST_CACHE = False
 
 def initializeOverlayHandler( serviceInfo ):
   """ Global initialize for the Overlay service handler
   """
-  global OVERLAY_DB
+  global OVERLAY_DB, FILE_LIST_CACHE
   OVERLAY_DB = OverlayDB()
+  FILE_LIST_CACHE = FileListCache(FileCatalogClient(),
+                                  Operations().getValue('/Overlay/FileListCacheTime', 3600))
   return S_OK()
 
 class OverlayHandler(RequestHandler):
   """ Service for Overlay
   """
   types_canRun = [StringTypes]
-  def export_canRun(self, site):
-    """ Check if current job can access the data
+  def export_canRun(self, site, jobID = 0):
+    """ Check if current job can access the data, returns the lease token if it can
     """
-    return OVERLAY_DB.canRun(site)
+    return OVERLAY_DB.canRun(site, jobID)
+
+  types_enqueue = [StringTypes]
+  def export_enqueue(self, site, jobID = 0):
+    """ Take a ticket to wait for a slot at the site
+    """
+    return OVERLAY_DB.enqueue(site, jobID)
+
+  types_requestSlot = [StringTypes, (IntType, LongType)]
+  def export_requestSlot(self, site, ticket, jobID = 0):
+    """ Ask for a slot for a ticket, the slots are given in the order of the tickets
+    """
+    return OVERLAY_DB.requestSlot(site, ticket, jobID)
+
+  types_getQueuePosition = [StringTypes, (IntType, LongType)]
+  def export_getQueuePosition(self, site, ticket):
+    """ Get the number of tickets waiting in front of the ticket
+    """
+    return OVERLAY_DB.getQueuePosition(site, ticket)
+
+  types_leaveQueue = [(IntType, LongType)]
+  def export_leaveQueue(self, ticket):
+    """ Remove the ticket of a job that stopped waiting
+    """
+    return OVERLAY_DB.leaveQueue(ticket)
+
+  types_renewLease = [StringTypes]
+  def export_renewLease(self, lease):
+    """ Extend the lifetime of the lease of a job still downloading files
+    """
+    return OVERLAY_DB.renewLease(lease)
 
   types_jobDone = [StringTypes]
-  def export_jobDone(self, site):
+  def export_jobDone(self, site, lease = None):
     """ report that a given job is done downloading the 
     files at a given site
     """
-    return OVERLAY_DB.jobDone(site)
+    return OVERLAY_DB.jobDone(site, lease)
+
+  types_reclaimExpiredLeases = [StringTypes]
+  def export_reclaimExpiredLeases(self, site):
+    """ Free the slots of the expired leases at the site:
+    called from the ResetCounter agent
+    """
+    return OVERLAY_DB.reclaimExpiredLeases(site)
+
+  types_purgeStaleTickets = [StringTypes]
+  def export_purgeStaleTickets(self, site):
+    """ Remove the tickets of jobs that stopped waiting for a slot at the site:
+    called from the ResetCounter agent
+    """
+    return OVERLAY_DB.purgeStaleTickets(site)
   
+  types_getOverlayFiles = [DictType]
+  def export_getOverlayFiles(self, meta, path = '/'):
+    """ Get the list of overlay files matching the metadata, from the cache if possible
+    """
+    return FILE_LIST_CACHE.getFiles(meta, path)
+
   types_getJobsAtSite =  [StringTypes]
   def export_getJobsAtSite(self, site):
     """ Get the jobs running at a given site
@@ -50,10 +107,9 @@ class OverlayHandler(RequestHandler):
     """
     return OVERLAY_DB.getSites()
   
-  types_setJobsAtSites = [ DictType ]
-  def export_setJobsAtSites(self, sitedict):
-    """ Set the number of jobs running at each site: 
+  types_reconcileJobsAtSite = [StringTypes]
+  def export_reconcileJobsAtSite(self, site):
+    """ Set the number of jobs running at the site to the number of its leases:
     called from the ResetCounter agent
     """
-    return OVERLAY_DB.setJobsAtSites(sitedict)
-  
\ No newline at end of file
+    return OVERLAY_DB.reconcileJobsAtSite(site)
@@ -0,0 +1,69 @@
+""" Test the cache of overlay file listings """
+
+import unittest
+
+from mock import patch, MagicMock as Mock
+
+from DIRAC import S_OK, S_ERROR
+
+from ILCDIRAC.OverlaySystem.Service.FileListCache import FileListCache
+from ILCDIRAC.Tests.Utilities.GeneralUtils import assertDiracSucceedsWith_equals, assertDiracFailsWith
+
+__RCSID__ = "$Id$"
+
+MODULE_NAME = 'ILCDIRAC.OverlaySystem.Service.FileListCache'
+
+
+class TestFileListCache(unittest.TestCase):
+  """ Test the FileListCache """
+
+  def setUp(self):
+    self.fcc = Mock()
+    self.fcc.findFilesByMetadata.return_value = S_OK(['/ilc/f1.slcio', '/ilc/f2.slcio'])
+    self.cache = FileListCache(self.fcc, cacheTime=100)
+    self.meta = {'Energy': '3000', 'EvtType': 'gghad', 'ProdID': 1234}
+
+  def test_cached(self):
+    with patch('%s.time.time' % MODULE_NAME, new=Mock(return_value=1000)):
+      assertDiracSucceedsWith_equals(self.cache.getFiles(self.meta),
+                                     {'LFNs': ['/ilc/f1.slcio', '/ilc/f2.slcio'], 'Version': 1000}, self)
+      # same query with different order and types of the values
+      res = self.cache.getFiles({'ProdID': '1234', 'EvtType': 'gghad', 'Energy': '3000'})
+    self.assertEqual(res['Value']['Version'], 1000)
+    self.fcc.findFilesByMetadata.assert_called_once_with(self.meta, '/')
+    self.cache.getFiles(self.meta, '/ilc/user')
+    self.assertEqual(self.fcc.findFilesByMetadata.call_count, 2)
+
+  def test_expired(self):
+    with patch('%s.time.time' % MODULE_NAME, new=Mock(return_value=1000)):
+      self.cache.getFiles(self.meta)
+    with patch('%s.time.time' % MODULE_NAME, new=Mock(return_value=1101)):
+      self.fcc.findFilesByMetadata.return_value = S_OK(['/ilc/f3.slcio'])
+      assertDiracSucceedsWith_equals(self.cache.getFiles(self.meta), {'LFNs': ['/ilc/f3.slcio'], 'Version': 1101},
+                                     self)
+    self.assertEqual(self.fcc.findFilesByMetadata.call_count, 2)
+
+  def test_refresh_fails(self):
+    with patch('%s.time.time' % MODULE_NAME, new=Mock(return_value=1000)):
+      self.cache.getFiles(self.meta)
+    self.fcc.findFilesByMetadata.return_value = S_ERROR('catalog down')
+    with patch('%s.time.time' % MODULE_NAME, new=Mock(return_value=1150)):
+      self.assertEqual(self.cache.getFiles(self.meta)['Value']['Version'], 1000)
+    assertDiracFailsWith(self.cache.getFiles({'EvtType': 'other'}), 'catalog down', self)
+
+  def test_empty_not_cached(self):
+    self.fcc.findFilesByMetadata.return_value = S_OK([])
+    self.cache.getFiles(self.meta)
+    self.cache.getFiles(self.meta)
+    self.assertEqual(self.fcc.findFilesByMetadata.call_count, 2)
+
+  def test_expired_removed(self):
+    with patch('%s.time.time' % MODULE_NAME, new=Mock(return_value=1000)):
+      self.cache.getFiles(self.meta)
+    with patch('%s.time.time' % MODULE_NAME, new=Mock(return_value=1300)):
+      self.cache.getFiles({'EvtType': 'other'})
+    self.assertEqual(len(self.cache._listings), 1)  # pylint: disable=protected-access
+
+
+if __name__ == '__main__':
+  unittest.main()
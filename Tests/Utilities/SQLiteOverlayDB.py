@@ -0,0 +1,91 @@
+"""SQLite backed stand-in for the :class:`~ILCDIRAC.OverlaySystem.DB.OverlayDB.OverlayDB`.
+
+Uses the SQL statements of the real OverlayDB against a local SQLite database, so that the slot accounting can be
+tested and benchmarked without a MySQL server.
+"""
+
+import sqlite3
+import threading
+
+from DIRAC import S_OK, S_ERROR, gLogger
+
+from ILCDIRAC.OverlaySystem.DB.OverlayDB import OverlayDB
+
+__RCSID__ = "$Id$"
+
+
+class LimitsOperations(object):
+  """Minimal replacement for the Operations helper, returning the overlay limits."""
+
+  def __init__(self, defaultLimit=200, siteLimits=None, leaseTime=1800, reclaimInterval=60, options=None):
+    self.values = {'/Overlay/MaxConcurrentRunning': defaultLimit,
+                   '/Overlay/LeaseTime': leaseTime,
+                   '/Overlay/LeaseReclaimInterval': reclaimInterval,
+                  }
+    self.values.update(options or {})
+    self.siteLimits = dict(siteLimits or {})
+    for site, limit in self.siteLimits.items():
+      self.values['/Overlay/Sites/%s/MaxConcurrentRunning' % site] = limit
+
+  def getValue(self, path, defValue=None):
+    """Return the value for path or the default."""
+    return self.values.get(path, defValue)
+
+  def getSections(self, _path):
+    """Return the sites with their own limits."""
+    return S_OK(list(self.siteLimits))
+
+
+class SQLiteOverlayDB(OverlayDB):
+  """OverlayDB using SQLite instead of MySQL.
+
+  All statements are serialised with a lock, like a single database server would do, every statement is counted in
+  ``statements``.
+  """
+
+  def __init__(self, dbPath=':memory:', defaultLimit=200, siteLimits=None, leaseTime=1800,
+               reclaimInterval=60, options=None):  # pylint: disable=super-init-not-called
+    self.ops = LimitsOperations(defaultLimit, siteLimits, leaseTime, reclaimInterval, options)
+    self.dbname = 'OverlayDB'
+    self.logger = gLogger.getSubLogger('SQLiteOverlayDB')
+    self.lock = threading.Lock()
+    self.statements = 0
+    self.connection = sqlite3.connect(dbPath, check_same_thread=False)
+    self.connection.isolation_level = None
+    self.connection.execute("CREATE TABLE IF NOT EXISTS OverlayData (Site VARCHAR(255) UNIQUE NOT NULL PRIMARY KEY, "
+                            "NumberOfJobs INTEGER DEFAULT 0);")
+    self.connection.execute("CREATE TABLE IF NOT EXISTS OverlayLeases (Lease VARCHAR(32) NOT NULL PRIMARY KEY, "
+                            "Site VARCHAR(255) NOT NULL, JobID INTEGER DEFAULT 0, ExpirationTime INTEGER NOT NULL);")
+    self.connection.execute("CREATE INDEX IF NOT EXISTS SiteExpiration ON OverlayLeases (Site, ExpirationTime);")
+    self.connection.execute("CREATE TABLE IF NOT EXISTS OverlayQueue (Ticket INTEGER PRIMARY KEY AUTOINCREMENT, "
+                            "Site VARCHAR(255) NOT NULL, JobID INTEGER DEFAULT 0, LastSeen INTEGER NOT NULL);")
+    self.connection.execute("CREATE INDEX IF NOT EXISTS SiteTicket ON OverlayQueue (Site, Ticket);")
+    self._initParameters()
+
+  def _getConnection(self):
+    return S_OK(self.connection)
+
+  def _execute(self, cmd, connection, fetch=False):
+    """Execute the statement, return the rows if fetch is True, or the number of changed rows and the last row ID."""
+    with self.lock:
+      self.statements += 1
+      cursor = connection.execute(cmd)
+      if fetch:
+        return tuple(tuple(row) for row in cursor.fetchall())
+      return cursor.rowcount, cursor.lastrowid
+
+  def _query(self, cmd, conn=None):
+    try:
+      return S_OK(self._execute(cmd, conn or self.connection, fetch=True))
+    except sqlite3.Error as err:
+      return S_ERROR('Query failed: %s' % err)
+
+  def _update(self, cmd, conn=None):
+    try:
+      rowcount, lastRowId = self._execute(cmd, conn or self.connection)
+    except sqlite3.Error as err:
+      return S_ERROR('Update failed: %s' % err)
+    result = S_OK(rowcount)
+    if lastRowId:
+      result['lastRowId'] = lastRowId
+    return result
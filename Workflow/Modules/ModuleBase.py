@@ -15,13 +15,12 @@ import shutil
 import string
 import sys
 import urllib
-from collections import defaultdict
+from collections import defaultdict, deque
 from pprint import pformat
 from random import choice
 
 from DIRAC                                                import S_OK, S_ERROR, gLogger
 from DIRAC.Core.Security.ProxyInfo                        import getProxyInfoAsString
-from DIRAC.Core.Utilities.Adler                           import fileAdler
 from DIRAC.Core.Utilities.Subprocess                      import shellCall
 from DIRAC.TransformationSystem.Client.FileReport         import FileReport
 from DIRAC.WorkloadManagementSystem.Client.JobReport      import JobReport
@@ -33,12 +32,16 @@ from DIRAC.RequestManagementSystem.Client.Operation       import Operation
 from DIRAC.RequestManagementSystem.Client.File            import File
 
 from ILCDIRAC.Core.Utilities.CombinedSoftwareInstallation import getSoftwareFolder, checkCVMFS
+from ILCDIRAC.Core.Utilities.FileChecksum                 import getChecksums
 from ILCDIRAC.Core.Utilities.FindSteeringFileDir          import getSteeringFileDir
 from ILCDIRAC.Core.Utilities.InputFilesUtilities          import getNumberOfEvents
 
 __RCSID__ = '$Id$'
 LOG = gLogger.getSubLogger(__name__)
 
+#: number of messages from stderr kept for the error report
+STDERR_TAIL_LENGTH = 1000
+
 
 def generateRandomString(length=8, chars = string.letters + string.digits):
   """Return random string of 8 chars, used by :mod:`~ILCDIRAC.Workflow.Modules.PythiaAnalysis` and :mod:`~ILCDIRAC.Workflow.Modules.MokkaAnalysis`
@@ -64,6 +67,11 @@ class ModuleBase(object):
 
     self.ops = Operations()
 
+    self._logFile = None
+    self._logFileName = ''
+    self._eventMatcher = None
+    self._eventMatcherKey = None
+    self._stdErrorTail = deque(maxlen=STDERR_TAIL_LENGTH)
     self.platform = ''
     self.applicationLog = ''
     self.applicationVersion = ''
@@ -295,12 +303,13 @@ class ModuleBase(object):
       candidateFiles[pfn]['GUID'] = guid
 
     #Get all additional metadata about the file necessary for requests
+    checksums = getChecksums(candidateFiles.keys())
     final = {}
     for fileName, metadata in candidateFiles.items():
       fileDict = {}
       fileDict['LFN'] = metadata['lfn']
       fileDict['Size'] = os.path.getsize(fileName)
-      adlerChecksum = fileAdler(fileName)
+      adlerChecksum = checksums[fileName]
       fileDict['Addler'] = adlerChecksum
       fileDict['ADLER32'] = adlerChecksum
       fileDict['Checksum'] = adlerChecksum
@@ -478,6 +487,7 @@ class ModuleBase(object):
         LOG.verbose("Found local copy of %s" % self.SteeringFile)
 
     appres = self.runIt()
+    self.closeApplicationLog()
     if not appres["OK"]:
       LOG.error("Somehow the application did not exit properly")
 
@@ -498,7 +508,10 @@ class ModuleBase(object):
 
   def finalStatusReport(self, status):
     """ Catch the resulting application status, and return corresponding workflow status
+
+    The application log is written and closed first, also for modules overriding :func:`execute`.
     """
+    self.closeApplicationLog()
     message = '%s %s Successful' % (self.applicationName, self.applicationVersion)
     if status:
       LOG.error("==================================\n StdError:\n")
@@ -574,6 +587,51 @@ class ModuleBase(object):
     LOG.notice("Request After: %s" % pformat(request))
     return S_OK()
 
+  @property
+  def applicationLog(self):
+    """Name of the application log file.
+
+    Pending output of :func:`redirectLogOutput` is written and the file is closed before the name is returned, so
+    everything reading, checking or removing the log file sees its complete content.
+    """
+    self.closeApplicationLog()
+    return self._logFileName
+
+  @applicationLog.setter
+  def applicationLog(self, logFileName):
+    """Set the name of the application log file."""
+    self.closeApplicationLog()
+    self._logFileName = logFileName
+
+  @property
+  def stdError(self):
+    """The last ``STDERR_TAIL_LENGTH`` messages the application wrote to stderr."""
+    return ''.join(self._stdErrorTail)
+
+  @stdError.setter
+  def stdError(self, message):
+    """Reset the stderr messages to ``message``."""
+    self._stdErrorTail.clear()
+    if message:
+      self._stdErrorTail.append(message)
+
+  def closeApplicationLog(self):
+    """Write the buffered application log and close the file, it is opened again by the next message."""
+    logFile = getattr(self, '_logFile', None)
+    if logFile is not None:
+      self._logFile = None
+      logFile.close()
+
+  def _getEventMatcher(self):
+    """Return the compiled expression matching any of the ``self.eventstring``, or None if nothing matches."""
+    eventKey = tuple(self.eventstring)
+    if eventKey != self._eventMatcherKey:
+      self._eventMatcherKey = eventKey
+      self._eventMatcher = None
+      if eventKey and eventKey[0]:
+        self._eventMatcher = re.compile('|'.join(re.escape(eventString) for eventString in eventKey))
+    return self._eventMatcher
+
   def redirectLogOutput(self, fd, message):
     """Catch the output from the application
     print ``message`` to stdout and to the ``self.applicationLog`` file
@@ -582,40 +640,39 @@ class ModuleBase(object):
     * If it is an empty list, an empty string, or an empty string in a list print nothing
     * If it is a string or a list of strings print only matching strings
 
+    The log file is kept open and buffered between calls, it is written whenever ``self.applicationLog`` is accessed.
+
     :param int fd: if 1 append message to ``self.stdError``
     :param str message: message string
     :returns: None
     """
-    sys.stdout.flush()
     if not message:
       return
     if fd == 1:
-      self.stdError += message
+      self._stdErrorTail.append(message)
 
     if isinstance(self.eventstring, basestring):
       self.eventstring = [self.eventstring]
 
+    matched = False
     if self.eventstring is None:
       print(message)
+      sys.stdout.flush()
+    else:
+      eventMatcher = self._getEventMatcher()
+      matched = eventMatcher is not None and eventMatcher.search(message) is not None
+      if matched:
+        print(message)
+        sys.stdout.flush()
 
-    elif self.eventstring and self.eventstring[0]:
-      for mystring in self.eventstring:
-        if re.search(re.escape(mystring), message):
-          print(message)
-          break
-
-    if not self.applicationLog:
+    if not self._logFileName:
       LOG.error("Application Log file not defined")
       return
 
-    with open(self.applicationLog, 'a') as log:
-      if self.excludeAllButEventString and self.eventstring is not None and len(self.eventstring) and len(self.eventstring[0]):
-        for mystring in self.eventstring:
-          if re.search(re.escape(mystring), message):
-            log.write(message+'\n')
-            break
-      elif not self.excludeAllButEventString:
-        log.write(message+'\n')
+    if self._logFile is None:
+      self._logFile = open(self._logFileName, 'a')
+    if matched or not self.excludeAllButEventString:
+      self._logFile.write(message + '\n')
 
   def addRemovalRequests(self, lfnList):
     """Create removalRequests for lfns in lfnList and add it to the common request"""
@@ -11,6 +11,7 @@ import glob
 import os
 import random
 import subprocess
+import threading
 import time
 from math import ceil
 
@@ -23,8 +24,8 @@ from DIRAC.ConfigurationSystem.Client.Helpers.Operations     import Operations
 from DIRAC                                                   import S_OK, S_ERROR, gLogger
 
 from ILCDIRAC.Workflow.Modules.ModuleBase                    import ModuleBase
-from ILCDIRAC.Core.Utilities.WasteCPU                        import wasteCPUCycles
 from ILCDIRAC.Core.Utilities.OverlayFiles                    import energyWithLowerCaseUnit
+from ILCDIRAC.Core.Utilities.OverlayFileCache import OverlayFileCache
 from ILCDIRAC.Core.Utilities.Configuration import getOptionValue
 from ILCDIRAC.OverlaySystem.Client.OverlaySystemClient import OverlaySystemClient
 
@@ -85,6 +86,8 @@ class OverlayInput (ModuleBase):
     self.machine = 'clic_cdr'
     self.pathToOverlayFiles = ''
     self.processorName = ''
+    self.fileCache = None
+    self._logLock = threading.Lock()
 
   def applicationSpecificInputs(self):
 
@@ -205,14 +208,29 @@ class OverlayInput (ModuleBase):
       meta['ProdID'] = self.prodid
     LOG.info("Using %s as metadata" % (meta))
 
-    return self.fcc.findFilesByMetadata(meta)
+    return self.__findFiles(meta)
 
 
   def __getFilesFromPath(self):
     """ Get the list of files from the FileCatalog via the user specified path.
     """
     meta = {}
-    return self.fcc.findFilesByMetadata(meta, self.pathToOverlayFiles)
+    return self.__findFiles(meta, self.pathToOverlayFiles)
+
+  def __findFiles(self, meta, path=None):
+    """ Get the list of files from the cached listings of the Overlay service, or from the FileCatalog if the service
+    cannot provide it
+    """
+    res = OverlaySystemClient().getOverlayFiles(meta, path or '/')
+    if res['OK']:
+      LOG.info('Got %d files from the overlay file listing of %s' % (len(res['Value']['LFNs']),
+                                                                     time.ctime(res['Value']['Version'])))
+      return S_OK(res['Value']['LFNs'])
+    LOG.warn('Could not get the overlay file listing from the Overlay service, querying the FileCatalog',
+             res['Message'])
+    if path is None:
+      return self.fcc.findFilesByMetadata(meta)
+    return self.fcc.findFilesByMetadata(meta, path)
 
   def __getFilesFromLyon(self, meta):
     """ List the files present at Lyon, not used.
@@ -297,29 +315,10 @@ class OverlayInput (ModuleBase):
     self.__disableWatchDog()
     overlaymon = OverlaySystemClient()
     ##Now need to check that there are not that many concurrent jobs getting the overlay at the same time
-    error_count = 0
-    count = 0
-    while 1:
-      if error_count > 10 :
-        LOG.error('OverlayDB returned too many errors')
-        return S_ERROR('Failed to get number of concurrent overlay jobs')
-
-      res = overlaymon.canRun(self.site)
-      if not res['OK']:
-        error_count += 1
-        time.sleep(60)
-        continue
-      error_count = 0
-      #if running < max_concurrent_running:
-      if res['Value']:
-        break
-      else:
-        count += 1
-        if count > 300:
-          return S_ERROR("Waited too long: 5h, so marking job as failed")
-        if count % 10 == 0 :
-          self.setApplicationStatus("Overlay standby number %s" % count)
-        time.sleep(60)
+    res = self.__waitForSlot(overlaymon)
+    if not res['OK']:
+      return res
+    lease = res['Value']
 
     self.__enableWatchDog()
 
@@ -327,63 +326,12 @@ class OverlayInput (ModuleBase):
 
     LOG.info('Will obtain %s files for overlay' % totnboffilestoget)
 
+    self.fileCache = OverlayFileCache.fromConfig(self.ops, self.site)
+
     os.mkdir("./overlayinput_" + self.metaEventType)
     os.chdir("./overlayinput_" + self.metaEventType)
-    filesobtained = []
-    usednumbers = []
-    fail = False
-    fail_count = 0
-
-    max_fail_allowed = self.ops.getValue("/Overlay/MaxFailedAllowed", 20)
-    while not len(filesobtained) == totnboffilestoget:
-      if fail_count > max_fail_allowed:
-        fail = True
-        break
-
-      fileindex = random.randrange(nbfiles)
-      if fileindex in usednumbers:
-        continue
-
-      usednumbers.append(fileindex)
-
-      triedDataManager = False
-
-      if self.site == 'LCG.CERN.ch':
-        res = self.getEOSFile(self.lfns[fileindex])
-      elif self.site == 'LCG.IN2P3-CC.fr':
-        res = self.getLyonFile(self.lfns[fileindex])
-      elif self.site == 'LCG.UKI-LT2-IC-HEP.uk':
-        res = self.getImperialFile(self.lfns[fileindex])
-      elif self.site == 'LCG.RAL-LCG2.uk':
-        res = self.getRALFile(self.lfns[fileindex])
-      elif self.site == 'LCG.KEK.jp':
-        res = self.getKEKFile(self.lfns[fileindex])
-      else:
-        self.__disableWatchDog()
-        res = self.datMan.getFile(self.lfns[fileindex])
-        triedDataManager = True
-
-      # In case the specific copying did not work (mostly because the files do
-      # not exist locally) try again to get the file via the DataManager
-      if (not res['OK']) and (not triedDataManager):
-        res = self.datMan.getFile(self.lfns[fileindex])
-
-      if not res['OK']:
-        LOG.warn('Could not obtain %s' % self.lfns[fileindex])
-        fail_count += 1
-        # Wait for a random time around 3 minutes
-        LOG.verbose("Waste happily some CPU time (on average 3 minutes)")
-        resWaste = wasteCPUCycles(60 * random.gauss(3, 0.1))
-        if not resWaste['OK']:
-          LOG.error("Could not waste as much CPU time as wanted, but whatever!")
-        continue
-
-      filesobtained.append(self.lfns[fileindex])
-
-      # If no file could be obtained, need to make sure the job fails
-      if len(usednumbers) == nbfiles and not filesobtained:
-        fail = True
-        break
+    res = self.__downloadFiles(totnboffilestoget, overlaymon, lease)
+    fail = not res['OK']
 
     ## Remove all scripts remaining
     scripts = glob.glob("*.sh")
@@ -395,16 +343,185 @@ class OverlayInput (ModuleBase):
     LOG.info("List of Overlay files:")
     LOG.info("\n".join(mylist))
     os.chdir(self.curdir)
-    res = overlaymon.jobDone(self.site)
+    res = overlaymon.jobDone(self.site, lease)
     if not res['OK']:
       LOG.error("Could not declare the job as finished getting the files")
+    if self.fileCache is not None:
+      self.setJobParameter('OverlayInput cache', 'hits:%d misses:%d' % (self.fileCache.hits, self.fileCache.misses))
     if fail:
       LOG.error("Did not manage to get all files needed, too many errors")
       return S_ERROR("Failed to get files")
     LOG.info('Got all files needed.')
     return S_OK()
 
-  def getCASTORFile(self, lfn):
+  def __downloadFiles(self, nbFilesToGet, overlaymon, lease):
+    """ Download nbFilesToGet random files from the list of LFNs into the current directory
+
+    Up to `/Overlay/Sites/<Site>/ParallelDownloads` (or `/Overlay/ParallelDownloads`) files are downloaded at the
+    same time. The default is one download per job: the slots given by the overlay service are limited by
+    MaxConcurrentRunning to protect the storage elements, so sites have to opt in to more parallel downloads. When a
+    download fails, or raises an exception, the worker directly continues with another random file. The download
+    time for each file is reported as a job parameter.
+
+    :returns: S_OK with the list of obtained LFNs, S_ERROR if not enough files could be obtained
+    """
+    nbParallel = self.ops.getValue("/Overlay/Sites/%s/ParallelDownloads" % self.site,
+                                   self.ops.getValue("/Overlay/ParallelDownloads", 1))
+    nbParallel = max(1, min(int(nbParallel), nbFilesToGet))
+    maxFailAllowed = self.ops.getValue("/Overlay/MaxFailedAllowed", 20)
+    candidates = list(range(len(self.lfns)))
+    random.shuffle(candidates)
+    lock = threading.Lock()
+    status = dict(obtained=[], inFlight=0, failCount=0, exceptions=0, timings=[])
+    LOG.info('Downloading overlay files with %d parallel downloads' % nbParallel)
+
+    def worker(workerIndex):
+      """ Download files until enough are obtained or too many downloads failed """
+      scriptName = 'overlayinput_%d.sh' % workerIndex if nbParallel > 1 else 'overlayinput.sh'
+      while True:
+        with lock:
+          if len(status['obtained']) + status['inFlight'] >= nbFilesToGet or \
+             status['failCount'] > maxFailAllowed or not candidates:
+            return
+          lfn = self.lfns[candidates.pop()]
+          status['inFlight'] += 1
+        startTime = time.time()
+        try:
+          res = self.__getFile(lfn, scriptName)
+        except Exception as exc:  # pylint: disable=broad-except
+          LOG.exception('Exception while getting %s' % lfn, lException=exc)
+          res = S_ERROR('Exception while getting %s: %r' % (lfn, exc))
+          with lock:
+            status['exceptions'] += 1
+        duration = time.time() - startTime
+        with lock:
+          status['inFlight'] -= 1
+          status['timings'].append('%s:%.1fs%s' % (os.path.basename(lfn), duration, '' if res['OK'] else '(failed)'))
+          if res['OK']:
+            status['obtained'].append(lfn)
+          else:
+            LOG.warn('Could not obtain %s' % lfn)
+            status['failCount'] += 1
+        self.__renewLease(overlaymon, lease)
+
+    downloadStart = time.time()
+    workers = [threading.Thread(target=worker, args=(index,)) for index in range(nbParallel)]
+    for thread in workers:
+      thread.start()
+    for thread in workers:
+      thread.join()
+
+    self.setJobParameter('OverlayInput download times',
+                         'total:%.1fs %s' % (time.time() - downloadStart, ' '.join(status['timings'])))
+    if len(status['obtained']) < nbFilesToGet:
+      LOG.error('Obtained %d of %d files, %d downloads failed, %d with an exception' %
+                (len(status['obtained']), nbFilesToGet, status['failCount'], status['exceptions']))
+      return S_ERROR('Failed to get files')
+    return S_OK(status['obtained'])
+
+  def redirectLogOutput(self, fd, message):
+    """ Write the output of the download scripts to the log, one parallel download at a time """
+    with self._logLock:
+      super(OverlayInput, self).redirectLogOutput(fd, message)
+
+  def __getFile(self, lfn, scriptName):
+    """ Get one file, from the node local overlay cache if it is configured, otherwise download it """
+    if self.fileCache is None:
+      return self.__downloadFile(lfn, scriptName)
+    return self.fileCache.getFile(lfn, os.getcwd(), lambda: self.__downloadFile(lfn, scriptName))
+
+  def __downloadFile(self, lfn, scriptName):
+    """ Download one file, with the site specific method if there is one, otherwise or if that fails with the
+    DataManager
+    """
+    triedDataManager = False
+    if self.site == 'LCG.CERN.ch':
+      res = self.getEOSFile(lfn, scriptName)
+    elif self.site == 'LCG.IN2P3-CC.fr':
+      res = self.getLyonFile(lfn, scriptName)
+    elif self.site == 'LCG.UKI-LT2-IC-HEP.uk':
+      res = self.getImperialFile(lfn, scriptName)
+    elif self.site == 'LCG.RAL-LCG2.uk':
+      res = self.getRALFile(lfn, scriptName)
+    elif self.site == 'LCG.KEK.jp':
+      res = self.getKEKFile(lfn, scriptName)
+    else:
+      self.__disableWatchDog()
+      res = self.__getFileWithDataManager(lfn)
+      triedDataManager = True
+
+    # In case the specific copying did not work (mostly because the files do
+    # not exist locally) try again to get the file via the DataManager
+    if (not res['OK']) and (not triedDataManager):
+      res = self.__getFileWithDataManager(lfn)
+    return res
+
+  def __getFileWithDataManager(self, lfn):
+    """ Download the file with the DataManager, which returns S_OK even if the file failed """
+    res = self.datMan.getFile(lfn)
+    if not res['OK']:
+      return res
+    if lfn not in res['Value'].get('Successful', {}):
+      return S_ERROR(res['Value'].get('Failed', {}).get(lfn, 'Failed to get %s' % lfn))
+    return S_OK(res['Value']['Successful'][lfn])
+
+  def __waitForSlot(self, overlaymon):
+    """ Queue for a slot to download the overlay files at our site
+
+    The service tells us after how many seconds we should ask again, the jobs at the front of the queue ask more often.
+
+    :returns: S_OK with the lease for the slot
+    """
+    maxWaitingTime = 5 * 3600
+    errorCount = 0
+    ticket = None
+    startTime = time.time()
+    lastStatusUpdate = startTime
+    while True:
+      if errorCount > 10:
+        LOG.error('OverlayDB returned too many errors')
+        if ticket is not None:
+          overlaymon.leaveQueue(ticket)
+        return S_ERROR('Failed to get number of concurrent overlay jobs')
+
+      if ticket is None:
+        res = overlaymon.enqueue(self.site, int(self.jobID))
+        if not res['OK']:
+          errorCount += 1
+          time.sleep(60)
+          continue
+        ticket = res['Value']
+
+      res = overlaymon.requestSlot(self.site, ticket, int(self.jobID))
+      if not res['OK']:
+        errorCount += 1
+        time.sleep(60)
+        continue
+      errorCount = 0
+      if res['Value']['Lease']:
+        LOG.info('Got a slot for overlay after %d seconds' % (time.time() - startTime))
+        return S_OK(res['Value']['Lease'])
+
+      now = time.time()
+      if now - startTime > maxWaitingTime:
+        overlaymon.leaveQueue(ticket)
+        return S_ERROR("Waited too long: 5h, so marking job as failed")
+      if now - lastStatusUpdate > 600:
+        lastStatusUpdate = now
+        self.setApplicationStatus("Overlay standby, position %s" % res['Value']['Position'])
+      time.sleep(res['Value']['RetryAfter'])
+
+  @staticmethod
+  def __renewLease(overlaymon, lease):
+    """ Extend the lease of our overlay slot, so it is not reclaimed while we are still downloading files
+    """
+    if not isinstance(lease, basestring):
+      return
+    res = overlaymon.renewLease(lease)
+    if not res['OK']:
+      LOG.warn("Could not renew the lease for the overlay slot", res['Message'])
+
+  def getCASTORFile(self, lfn, scriptName = "overlayinput.sh"):
     """ USe xrdcp or rfcp to get the files from castor
     """
     prependpath = "/castor/cern.ch/grid"
@@ -417,9 +534,9 @@ class OverlayInput (ModuleBase):
 
     basename = os.path.basename(lfile)
 
-    if os.path.exists("overlayinput.sh"):
-      os.unlink("overlayinput.sh")
-    with open("overlayinput.sh","w") as script:
+    if os.path.exists(scriptName):
+      os.unlink(scriptName)
+    with open(scriptName, "w") as script:
       script.write('#!/bin/sh \n')
       script.write('###############################\n')
       script.write('# Dynamically generated scrip #\n')
@@ -437,9 +554,9 @@ if [ ! -s %s ]; then
 fi\n""" % (basename, lfile))
       script.write('declare -x appstatus=$?\n')
       script.write('exit $appstatus\n')
-    os.chmod("overlayinput.sh", 0o755)
-    comm = 'sh -c "./overlayinput.sh"'
-    self.result = shellCall(600, comm, callbackFunction = self.redirectLogOutput, bufferLimit = 20971520)
+    os.chmod(scriptName, 0o755)
+    comm = 'sh -c "./%s"' % scriptName
+    shellCall(600, comm, callbackFunction = self.redirectLogOutput, bufferLimit = 20971520)
 
     localfile = os.path.basename(lfile)
     if os.path.exists(localfile):
@@ -447,7 +564,7 @@ fi\n""" % (basename, lfile))
 
     return S_ERROR("Failed")
 
-  def getEOSFile(self, lfn):
+  def getEOSFile(self, lfn, scriptName = "overlayinput.sh"):
     """ Use xrdcp to get the files from EOS
     """
     prependpath = "/eos/experiment/clicdp/grid"
@@ -457,9 +574,9 @@ fi\n""" % (basename, lfile))
       lfile = lfn
     LOG.info("Getting %s" % lfile)
 
-    if os.path.exists("overlayinput.sh"):
-      os.unlink("overlayinput.sh")
-    with open("overlayinput.sh","w") as script:
+    if os.path.exists(scriptName):
+      os.unlink(scriptName)
+    with open(scriptName, "w") as script:
       script.write('#!/bin/sh \n')
       script.write('################################\n')
       script.write('# Dynamically generated script #\n')
@@ -469,9 +586,9 @@ fi\n""" % (basename, lfile))
       script.write("xrdcp -s root://eospublic.cern.ch/%s ./ \n" % lfile.rstrip() )
       script.write('declare -x appstatus=$?\n')
       script.write('exit $appstatus\n')
-    os.chmod("overlayinput.sh", 0o755)
-    comm = 'sh -c "./overlayinput.sh"'
-    self.result = shellCall(600, comm, callbackFunction = self.redirectLogOutput, bufferLimit = 20971520)
+    os.chmod(scriptName, 0o755)
+    comm = 'sh -c "./%s"' % scriptName
+    shellCall(600, comm, callbackFunction = self.redirectLogOutput, bufferLimit = 20971520)
 
     localfile = os.path.basename(lfile)
     if os.path.exists(localfile):
@@ -479,7 +596,7 @@ fi\n""" % (basename, lfile))
 
     return S_ERROR("Failed")
 
-  def getLyonFile(self, lfn):
+  def getLyonFile(self, lfn, scriptName = "overlayinput.sh"):
     """ Use xrdcp to get the files from Lyon
     """
     prependpath = '/pnfs/in2p3.fr/data'
@@ -492,9 +609,9 @@ fi\n""" % (basename, lfile))
     #comm = []
     #comm.append("cp $X509_USER_PROXY /tmp/x509up_u%s"%os.getuid())
 
-    if os.path.exists("overlayinput.sh"):
-      os.unlink("overlayinput.sh")
-    with open("overlayinput.sh", "w") as script:
+    if os.path.exists(scriptName):
+      os.unlink(scriptName)
+    with open(scriptName, "w") as script:
       script.write('#!/bin/sh \n')
       script.write('###############################\n')
       script.write('# Dynamically generated scrip #\n')
@@ -509,9 +626,9 @@ fi\n""" % (basename, lfile))
 #fi\n"""%(basename,lfile))
       script.write('declare -x appstatus=$?\n')
       script.write('exit $appstatus\n')
-    os.chmod("overlayinput.sh", 0o755)
-    comm = 'sh -c "./overlayinput.sh"'
-    self.result = shellCall(600, comm, callbackFunction = self.redirectLogOutput, bufferLimit = 20971520)
+    os.chmod(scriptName, 0o755)
+    comm = 'sh -c "./%s"' % scriptName
+    shellCall(600, comm, callbackFunction = self.redirectLogOutput, bufferLimit = 20971520)
 
     localfile = os.path.basename(lfile)
     if os.path.exists(localfile):
@@ -519,7 +636,7 @@ fi\n""" % (basename, lfile))
 
     return S_ERROR("Failed")
 
-  def getImperialFile(self, lfn):
+  def getImperialFile(self, lfn, scriptName = "overlayinput.sh"):
     """ USe dccp to get the files from the Imperial SE
     """
     prependpath = '/pnfs/hep.ph.ic.ac.uk/data'
@@ -531,9 +648,9 @@ fi\n""" % (basename, lfile))
     ###Don't check for CPU time as other wise, job can get killed
     self.__disableWatchDog()
 
-    if os.path.exists("overlayinput.sh"):
-      os.unlink("overlayinput.sh")
-    with open("overlayinput.sh","w") as script:
+    if os.path.exists(scriptName):
+      os.unlink(scriptName)
+    with open(scriptName, "w") as script:
       script.write('#!/bin/sh \n')
       script.write('###############################\n')
       script.write('# Dynamically generated scrip #\n')
@@ -546,9 +663,9 @@ fi\n""" % (basename, lfile))
 #fi\n"""%(basename,lfile))
       script.write('declare -x appstatus=$?\n')
       script.write('exit $appstatus\n')
-    os.chmod("overlayinput.sh", 0o755)
-    comm = 'sh -c "./overlayinput.sh"'
-    self.result = shellCall(600, comm, callbackFunction = self.redirectLogOutput, bufferLimit = 20971520)
+    os.chmod(scriptName, 0o755)
+    comm = 'sh -c "./%s"' % scriptName
+    shellCall(600, comm, callbackFunction = self.redirectLogOutput, bufferLimit = 20971520)
 
     localfile = os.path.basename(lfile)
     if os.path.exists(localfile):
@@ -556,7 +673,7 @@ fi\n""" % (basename, lfile))
 
     return S_ERROR("Failed")
 
-  def getRALFile(self, lfn):
+  def getRALFile(self, lfn, scriptName = "overlayinput.sh"):
     """ Use rfcp to get the files from RAL castor
     """
     prependpath = '/castor/ads.rl.ac.uk/prod'
@@ -592,9 +709,9 @@ fi\n""" % (basename, lfile))
 #      print res
     basename = os.path.basename(lfile)
 
-    if os.path.exists("overlayinput.sh"):
-      os.unlink("overlayinput.sh")
-    with open("overlayinput.sh","w") as script:
+    if os.path.exists(scriptName):
+      os.unlink(scriptName)
+    with open(scriptName, "w") as script:
       script.write('#!/bin/sh \n')
       script.write('###############################\n')
       script.write('# Dynamically generated scrip #\n')
@@ -602,9 +719,9 @@ fi\n""" % (basename, lfile))
       script.write("/usr/bin/rfcp 'rfio://cgenstager.ads.rl.ac.uk:9002?svcClass=ilcTape&path=%s' %s\n" % (lfile, basename))
       script.write('declare -x appstatus=$?\n')
       script.write('exit $appstatus\n')
-    os.chmod("overlayinput.sh", 0o755)
-    comm = 'sh -c "./overlayinput.sh"'
-    self.result = shellCall(600, comm, callbackFunction = self.redirectLogOutput, bufferLimit = 20971520)
+    os.chmod(scriptName, 0o755)
+    comm = 'sh -c "./%s"' % scriptName
+    shellCall(600, comm, callbackFunction = self.redirectLogOutput, bufferLimit = 20971520)
 
     localfile = os.path.basename(lfile)
     if os.path.exists(localfile):
@@ -612,7 +729,7 @@ fi\n""" % (basename, lfile))
 
     return S_ERROR("Failed")
 
-  def getKEKFile(self, lfn):
+  def getKEKFile(self, lfn, scriptName = "overlayinput.sh"):
     """ Use cp to get the files from kek-se
     """
     prependpath = '/grid'
@@ -620,9 +737,9 @@ fi\n""" % (basename, lfile))
     LOG.info("Getting %s" % lfile)
     self.__disableWatchDog()
 
-    if os.path.exists("overlayinput.sh"):
-      os.unlink("overlayinput.sh")
-    with open("overlayinput.sh", "w") as script:
+    if os.path.exists(scriptName):
+      os.unlink(scriptName)
+    with open(scriptName, "w") as script:
       script.write('#!/bin/sh \n')
       script.write('###############################\n')
       script.write('# Dynamically generated scrip #\n')
@@ -631,9 +748,9 @@ fi\n""" % (basename, lfile))
       script.write('declare -x appstatus=$?\n')
       script.write('exit $appstatus\n')
 
-    os.chmod("overlayinput.sh", 0o755)
-    comm = 'sh -c "./overlayinput.sh"'
-    self.result = shellCall(600, comm, callbackFunction = self.redirectLogOutput, bufferLimit = 20971520)
+    os.chmod(scriptName, 0o755)
+    comm = 'sh -c "./%s"' % scriptName
+    shellCall(600, comm, callbackFunction = self.redirectLogOutput, bufferLimit = 20971520)
 
     localfile = os.path.basename(lfile)
     if os.path.exists(localfile):
@@ -686,6 +803,7 @@ fi\n""" % (basename, lfile))
 
 
     res = self.__getFilesLocaly()
+    self.closeApplicationLog()
     ###Now that module is finished,resume CPU time checks
     self.__enableWatchDog()
 
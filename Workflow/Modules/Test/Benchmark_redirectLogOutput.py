@@ -0,0 +1,113 @@
+"""Benchmark ModuleBase.redirectLogOutput for applications with large logs.
+
+Replays a synthetic application log, similar to the output of Marlin or DDSim, through the current and the previous
+implementation of redirectLogOutput and reports the time per line. Both implementations have to produce the same log
+file.
+
+Usage::
+
+  python Benchmark_redirectLogOutput.py [nLines] [stderrFraction]
+
+"""
+
+from __future__ import print_function
+
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+from mock import patch, MagicMock as Mock
+
+from ILCDIRAC.Workflow.Modules.ModuleBase import ModuleBase
+
+__RCSID__ = "$Id$"
+
+MODULE_NAME = 'ILCDIRAC.Workflow.Modules.ModuleBase'
+
+LINES = ['[ MESSAGE "Marlin"] ---- Event  %(index)d ( %(index)d ) in run 0',
+         '[ VERBOSE "MyDDMarlinPandora"] Processing %(index)d calorimeter hits',
+         '[ DEBUG "MyTruthTrackFinder"] Found %(index)d tracks in the event',
+         'BeginEvent   INFO  Event %(index)d   Detector model CLIC_o3_v14',
+         ]
+
+
+def legacyRedirectLogOutput(module, fd, message):
+  """The previous implementation: open the log file and search for all event strings for every line."""
+  sys.stdout.flush()
+  if not message:
+    return
+  if fd == 1:
+    module.legacyStdError += message
+  if isinstance(module.eventstring, basestring):
+    module.eventstring = [module.eventstring]
+  if module.eventstring is None:
+    print(message)
+  elif module.eventstring and module.eventstring[0]:
+    for mystring in module.eventstring:
+      if re.search(re.escape(mystring), message):
+        print(message)
+        break
+  with open(module.legacyLog, 'a') as log:
+    if module.excludeAllButEventString and module.eventstring is not None and len(module.eventstring) and \
+       len(module.eventstring[0]):
+      for mystring in module.eventstring:
+        if re.search(re.escape(mystring), message):
+          log.write(message + '\n')
+          break
+    elif not module.excludeAllButEventString:
+      log.write(message + '\n')
+
+
+def makeLog(nLines, stderrFraction):
+  """Create the synthetic application output as a list of (fd, message)."""
+  every = max(1, int(round(1. / stderrFraction)))
+  return [(1 if index % every == 0 else 0, LINES[index % len(LINES)] % dict(index=index)) for index in range(nLines)]
+
+
+def runBenchmark(nLines, stderrFraction):
+  """Run both implementations and print the results."""
+  with patch('%s.getProxyInfoAsString' % MODULE_NAME, new=Mock(return_value={'OK': True, 'Value': ''})), \
+       patch('%s.Operations' % MODULE_NAME, new=Mock()):
+    module = ModuleBase()
+  module.eventstring = ['---- Event', 'Detector model']
+  logLines = makeLog(nLines, stderrFraction)
+
+  tempdir = tempfile.mkdtemp()
+  module.applicationLog = os.path.join(tempdir, 'current.log')
+  module.legacyLog = os.path.join(tempdir, 'legacy.log')
+  module.legacyStdError = ''
+  results = {}
+  stdout = sys.stdout
+  try:
+    for name, function in (('legacy', lambda fd, message: legacyRedirectLogOutput(module, fd, message)),
+                           ('current', module.redirectLogOutput)):
+      with open(os.devnull, 'w') as sys.stdout:
+        start = time.time()
+        for fd, message in logLines:
+          function(fd, message)
+        module.closeApplicationLog()
+        results[name] = time.time() - start
+      sys.stdout = stdout
+      print('%-8s %8.2fs %8.2fus/line' % (name, results[name], results[name] / nLines * 1e6))
+    print('speedup  %8.1fx' % (results['legacy'] / results['current']))
+    with open(module.legacyLog) as legacyLog, open(module.applicationLog) as currentLog:
+      identical = legacyLog.read() == currentLog.read()
+  finally:
+    sys.stdout = stdout
+    shutil.rmtree(tempdir)
+  if not identical:
+    print('ERROR: the implementations wrote different log files')
+    return 1
+  if not module.legacyStdError.endswith(module.stdError):
+    print('ERROR: stdError is not the tail of the application stderr')
+    return 1
+  return 0
+
+
+if __name__ == '__main__':
+  NLINES = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+  FRACTION = float(sys.argv[2]) if len(sys.argv) > 2 else 0.01
+  sys.exit(runBenchmark(NLINES, FRACTION))
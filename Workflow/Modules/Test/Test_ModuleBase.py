@@ -366,7 +366,7 @@ class ModuleBaseTestCase( unittest.TestCase ): #pylint: disable=too-many-public-
     adler_dict = { 'testfile_allworks.stdhep' : '9803531', 'myothertest_file' : 'checksum1230#' }
     with patch('%s.makeGuid' % MODULE_NAME, new=Mock(side_effect=lambda path: guid_dict[path])) as guid_mock, \
          patch('%s.os.path.getsize' % MODULE_NAME, new=Mock(side_effect=lambda path: size_dict[path])), \
-         patch('%s.fileAdler' % MODULE_NAME, new=Mock(side_effect=lambda path: adler_dict[path])), \
+         patch('%s.getChecksums' % MODULE_NAME, new=Mock(side_effect=lambda paths: adler_dict)), \
          patch('%s.os.getcwd' % MODULE_NAME, new=Mock(return_value='/cur/working/test/')):
       candidateFiles = { 'testfile_allworks.stdhep' : {
         'lfn': 'testfile_allworks.stdhep', 'path' : '/test/clic/ilc/mytestfile.txt',
@@ -547,6 +547,18 @@ class ModuleBaseTestCase( unittest.TestCase ): #pylint: disable=too-many-public-
       appstat_mock.assert_called_once_with( ' exited With Status 1' )
       self.assertTrue(self.log_mock.error.called)
 
+  def test_finalstatusreport_closeslog( self ):
+    self.moba.eventstring = None
+    self.moba.applicationLog = 'appLog.txt'
+    with patch('sys.stdout', new_callable=StringIO), \
+         patch('%s.open' % MODULE_NAME, mock_open()) as open_mock, \
+         patch('%s.ModuleBase.setApplicationStatus' % MODULE_NAME):
+      self.moba.redirectLogOutput( 0, 'mytestmessage' )
+      self.assertFalse( open_mock().close.called )
+      assertDiracSucceeds( self.moba.finalStatusReport( 0 ), self )
+      open_mock().close.assert_called_once_with()
+      self.assertIsNone( self.moba._logFile ) #pylint: disable=protected-access
+
   def test_generatefailover( self ):
     container_mock = Mock()
     container_mock.__len__.return_value = 1
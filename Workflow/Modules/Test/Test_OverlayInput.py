@@ -5,6 +5,8 @@ from __future__ import print_function
 import os
 import shutil
 import tempfile
+import time
+import threading
 import unittest
 from mock import patch, mock_open, call, MagicMock as Mock
 
@@ -362,6 +364,11 @@ class TestOverlayExecute( unittest.TestCase ):
   """ Tests the Execute method of the  Overlayinput class
   """
   def setUp( self ):
+    self.overlaymon = Mock()
+    self.overlaymon.getOverlayFiles.return_value = S_ERROR( 'no service' )
+    clientPatch = patch('%s.OverlaySystemClient' % MODULE_NAME, new=Mock(return_value=self.overlaymon))
+    clientPatch.start()
+    self.addCleanup( clientPatch.stop )
     self.over = OverlayInput()
     self.over.detectormodel = 'testdetectorv2000'
     self.over.energytouse = '200TeV'
@@ -379,7 +386,10 @@ class TestOverlayExecute( unittest.TestCase ):
                                       'testfile2.ppt' : ['KEK'] }, 'Failed' : ''} )
   def test_execute( self ):
     rpc_mock = Mock()
-    rpc_mock.canRun.return_value = S_OK(1)
+    rpc_mock.enqueue.return_value = S_OK(1)
+    rpc_mock.requestSlot.return_value = S_OK({'Lease': 'lease1', 'Position': 0, 'RetryAfter': 0})
+    rpc_mock.renewLease.return_value = S_OK()
+    rpc_mock.getOverlayFiles.return_value = S_ERROR('no service')
     with patch('%s.Operations.getValue' % MODULE_NAME, new=Mock(return_value=2)), \
          patch('%s.FileCatalogClient.findFilesByMetadata' % MODULE_NAME, new=Mock(return_value=S_OK(['file1.txt', 'file2.ppt']))), \
          patch('%s.os.path.exists' % MODULE_NAME, new=Mock(return_value = True)), \
@@ -388,9 +398,9 @@ class TestOverlayExecute( unittest.TestCase ):
          patch("%s.OverlaySystemClient" % MODULE_NAME, new=Mock(return_value=rpc_mock)), \
          patch('%s.os.mkdir' % MODULE_NAME, new=Mock(return_value = True)), \
          patch('%s.os.chdir' % MODULE_NAME, new=Mock(return_value = True)), \
-         patch('%s.DataManager.getFile' % MODULE_NAME, new=Mock(return_value=S_OK('Nothing'))), \
-         patch('%s.random.randrange' % MODULE_NAME, new=Mock(side_effect=[0, 0, 1, 1])), \
-         patch('%s.wasteCPUCycles' % MODULE_NAME):
+         patch('%s.OverlayFileCache.fromConfig' % MODULE_NAME, new=Mock(return_value=None)), \
+         patch('%s.DataManager.getFile' % MODULE_NAME, new=Mock(side_effect=lambda lfn: S_OK({'Successful': {lfn: lfn},
+                                                                                           'Failed': {}}))):
       result = self.over.execute()
       assertDiracSucceedsWith_equals( result, 'OverlayInput finished successfully', self )
       assertEqualsImproved( self.over.applicationLog, os.getcwd() + '/Overlay_input.log', self )
@@ -426,6 +436,156 @@ class TestOverlayExecute( unittest.TestCase ):
       assertDiracFailsWith( self.over.execute(), 'failed to get files locally', self )
 
   #pylint: disable=protected-access,no-member
+  def test_waitforslot( self ):
+    rpc_mock = Mock()
+    rpc_mock.enqueue.return_value = S_OK(42)
+    rpc_mock.requestSlot.side_effect = [ S_ERROR('timeout'),
+                                         S_OK({'Lease': False, 'Position': 3, 'RetryAfter': 6.5}),
+                                         S_OK({'Lease': 'lease1', 'Position': 0, 'RetryAfter': 0}) ]
+    with patch('%s.time.sleep' % MODULE_NAME) as sleep_mock:
+      assertDiracSucceedsWith_equals( self.over._OverlayInput__waitForSlot( rpc_mock ), 'lease1', self )
+    rpc_mock.enqueue.assert_called_once_with( self.over.site, 0 )
+    rpc_mock.requestSlot.assert_called_with( self.over.site, 42, 0 )
+    sleep_mock.assert_has_calls( [ call(60), call(6.5) ] )
+    self.assertFalse( rpc_mock.leaveQueue.called )
+
+  def test_waitforslot_toolong( self ):
+    rpc_mock = Mock()
+    rpc_mock.enqueue.return_value = S_OK(42)
+    rpc_mock.requestSlot.return_value = S_OK({'Lease': False, 'Position': 3, 'RetryAfter': 60})
+    with patch('%s.time.sleep' % MODULE_NAME), \
+         patch('%s.time.time' % MODULE_NAME, new=Mock(side_effect=[0, 100, 5 * 3600 + 1])):
+      assertDiracFailsWith( self.over._OverlayInput__waitForSlot( rpc_mock ), 'waited too long', self )
+    rpc_mock.leaveQueue.assert_called_once_with( 42 )
+
+  def test_waitforslot_errors( self ):
+    rpc_mock = Mock()
+    rpc_mock.enqueue.return_value = S_ERROR('no service')
+    with patch('%s.time.sleep' % MODULE_NAME):
+      assertDiracFailsWith( self.over._OverlayInput__waitForSlot( rpc_mock ),
+                            'failed to get number of concurrent overlay jobs', self )
+    self.assertEqual( rpc_mock.enqueue.call_count, 11 )
+
+  def test_downloadfiles( self ):
+    self.over.lfns = [ '/ilc/overlay/file%d.slcio' % index for index in range( 10 ) ]
+    self.over.site = 'LCG.CERN.ch'
+    ops_mock = Mock()
+    ops_mock.getValue.side_effect = lambda key, default: { '/Overlay/ParallelDownloads' : 3 }.get( key, default )
+    self.over.ops = ops_mock
+    rpc_mock = Mock()
+    def slowDownload( *_args ):
+      """take some time, so that all workers are downloading"""
+      time.sleep( 0.05 )
+      return S_OK( 'file' )
+    with patch('%s.OverlayInput.getEOSFile' % MODULE_NAME, new=Mock(side_effect=slowDownload)) as eos_mock, \
+         patch('%s.OverlayInput.setJobParameter' % MODULE_NAME) as param_mock:
+      result = self.over._OverlayInput__downloadFiles( 5, rpc_mock, 'lease1' )
+    assertDiracSucceeds( result, self )
+    self.assertEqual( len( set( result['Value'] ) ), 5 )
+    self.assertEqual( eos_mock.call_count, 5 )
+    self.assertEqual( set( call_args[0][1] for call_args in eos_mock.call_args_list ),
+                      set( [ 'overlayinput_0.sh', 'overlayinput_1.sh', 'overlayinput_2.sh' ] ) )
+    self.assertEqual( rpc_mock.renewLease.call_count, 5 )
+    self.assertEqual( param_mock.call_args[0][0], 'OverlayInput download times' )
+
+  def test_downloadfiles_sequential_by_default( self ):
+    self.over.lfns = [ '/ilc/overlay/file%d.slcio' % index for index in range( 10 ) ]
+    self.over.site = 'LCG.CERN.ch'
+    self.over.ops = Mock()
+    self.over.ops.getValue.side_effect = lambda key, default: default
+    with patch('%s.OverlayInput.getEOSFile' % MODULE_NAME, new=Mock(return_value=S_OK( 'file' ))) as eos_mock, \
+         patch('%s.OverlayInput.setJobParameter' % MODULE_NAME):
+      assertDiracSucceeds( self.over._OverlayInput__downloadFiles( 3, Mock(), 'lease1' ), self )
+    self.assertEqual( set( call_args[0][1] for call_args in eos_mock.call_args_list ), set( [ 'overlayinput.sh' ] ) )
+
+  def test_downloadfiles_replaces_failed( self ):
+    self.over.lfns = [ '/ilc/overlay/file%d.slcio' % index for index in range( 10 ) ]
+    self.over.site = 'SomeSite'
+    self.over.ops = Mock()
+    self.over.ops.getValue.side_effect = lambda key, default: default
+    datman_mock = Mock()
+    datman_mock.getFile.side_effect = lambda lfn: S_OK( { 'Successful' : {}, 'Failed' : { lfn : 'broken' } } ) \
+                                                 if lfn.endswith( ( '3.slcio', '7.slcio' ) ) \
+                                                 else S_OK( { 'Successful' : { lfn : lfn }, 'Failed' : {} } )
+    self.over.datMan = datman_mock
+    # keep the order of the files, so that both broken files are tried before the eighth good one
+    with patch('%s.OverlayInput.setJobParameter' % MODULE_NAME), \
+         patch('%s.random.shuffle' % MODULE_NAME), \
+         patch('%s.OverlayInput._OverlayInput__disableWatchDog' % MODULE_NAME):
+      result = self.over._OverlayInput__downloadFiles( 8, Mock(), 'lease1' )
+    assertDiracSucceeds( result, self )
+    self.assertEqual( len( result['Value'] ), 8 )
+    self.assertEqual( datman_mock.getFile.call_count, 10 )
+
+  def test_downloadfiles_toomanyfailures( self ):
+    self.over.lfns = [ '/ilc/overlay/file%d.slcio' % index for index in range( 100 ) ]
+    self.over.site = 'LCG.KEK.jp'
+    self.over.ops = Mock()
+    self.over.ops.getValue.side_effect = lambda key, default: default
+    datman_mock = Mock()
+    datman_mock.getFile.return_value = S_ERROR( 'broken' )
+    self.over.datMan = datman_mock
+    with patch('%s.OverlayInput.getKEKFile' % MODULE_NAME, new=Mock(return_value=S_ERROR('Failed'))) as kek_mock, \
+         patch('%s.OverlayInput.setJobParameter' % MODULE_NAME):
+      assertDiracFailsWith( self.over._OverlayInput__downloadFiles( 5, Mock(), 'lease1' ), 'failed to get files', self )
+    self.assertEqual( kek_mock.call_count, datman_mock.getFile.call_count )
+    self.assertTrue( 21 <= kek_mock.call_count <= 24 )
+
+  def test_downloadfiles_exception( self ):
+    self.over.lfns = [ '/ilc/overlay/file%d.slcio' % index for index in range( 10 ) ]
+    self.over.site = 'LCG.CERN.ch'
+    self.over.ops = Mock()
+    self.over.ops.getValue.side_effect = lambda key, default: { '/Overlay/ParallelDownloads' : 2 }.get( key, default )
+    def brokenDownload( lfn, _scriptName ):
+      """raise for one of the files"""
+      if lfn.endswith( '3.slcio' ):
+        raise OSError( 'No space left on device' )
+      return S_OK( 'file' )
+    with patch('%s.OverlayInput.getEOSFile' % MODULE_NAME, new=Mock(side_effect=brokenDownload)) as eos_mock, \
+         patch('%s.OverlayInput.setJobParameter' % MODULE_NAME), \
+         patch('%s.random.shuffle' % MODULE_NAME):
+      result = self.over._OverlayInput__downloadFiles( 8, Mock(), 'lease1' )
+    assertDiracSucceeds( result, self )
+    self.assertEqual( len( result['Value'] ), 8 )
+    self.assertNotIn( '/ilc/overlay/file3.slcio', result['Value'] )
+    self.assertEqual( eos_mock.call_count, 9 )
+
+  def test_redirectlogoutput_parallel( self ):
+    """the output of parallel downloads is written line by line"""
+    tmpdir = tempfile.mkdtemp()
+    self.addCleanup( shutil.rmtree, tmpdir )
+    self.over.applicationLog = os.path.join( tmpdir, 'testOver.log' )
+    self.over.eventstring = ''
+    def writeLines( index ):
+      """write some lines"""
+      for line in range( 200 ):
+        self.over.redirectLogOutput( 0, 'worker%d line%d' % ( index, line ) )
+    workers = [ threading.Thread( target=writeLines, args=( index, ) ) for index in range( 4 ) ]
+    for thread in workers:
+      thread.start()
+    for thread in workers:
+      thread.join()
+    with open( self.over.applicationLog ) as logFile:
+      lines = logFile.read().splitlines()
+    self.assertEqual( len( lines ), 800 )
+    self.assertEqual( len( set( lines ) ), 800 )
+
+  def test_getfile_uses_cache( self ):
+    self.over.site = 'SomeSite'
+    cache_mock = Mock()
+    cache_mock.getFile.return_value = S_OK( '/job/file1.slcio' )
+    self.over.fileCache = cache_mock
+    datman_mock = Mock()
+    datman_mock.getFile.return_value = S_OK( { 'Successful' : { '/ilc/file1.slcio' : 'file1.slcio' }, 'Failed' : {} } )
+    self.over.datMan = datman_mock
+    assertDiracSucceedsWith_equals( self.over._OverlayInput__getFile( '/ilc/file1.slcio', 'overlayinput.sh' ),
+                                    '/job/file1.slcio', self )
+    datman_mock.getFile.assert_not_called()
+    self.assertEqual( cache_mock.getFile.call_args[0][:2], ( '/ilc/file1.slcio', os.getcwd() ) )
+    with patch('%s.OverlayInput._OverlayInput__disableWatchDog' % MODULE_NAME):
+      assertDiracSucceeds( cache_mock.getFile.call_args[0][2](), self )
+    datman_mock.getFile.assert_called_once_with( '/ilc/file1.slcio' )
+
   def test_getfcfiles( self ):
     ops_dict = { '/Overlay/clic_cdr/200TeV/testdetectorv2000/myTestBkgEvt/ProdID' : 98421,
                  '/Overlay/clic_cdr/200TeV/testdetectorv2000/myTestBkgEvt/NbEvts' : 482,
@@ -485,6 +645,22 @@ class TestOverlayExecute( unittest.TestCase ):
       { 'Energy' : '9842', 'EvtType' : None, 'Datatype' : 'SIM', 'DetectorModel' : 'myTestDetectorv021',
         'Machine' : 'clic', 'ProdID' : '1245' } )
 
+  def test_getfilesfromFC_cachedlisting( self ):
+    ops_mock = Mock()
+    ops_mock.getValue.side_effect = [ '1245', 2849, None ]
+    self.over.ops = ops_mock
+    self.over.fcc = Mock()
+    self.over.machine = 'clic_cdr'
+    self.over.detector = 'overlaydetector'
+    self.overlaymon.getOverlayFiles.return_value = S_OK( { 'LFNs' : [ '/ilc/f1.slcio', '/ilc/f2.slcio' ],
+                                                           'Version' : 1500000000 } )
+    assertDiracSucceedsWith_equals( self.over._OverlayInput__getFilesFromFC(), [ '/ilc/f1.slcio', '/ilc/f2.slcio' ],
+                                    self )
+    self.overlaymon.getOverlayFiles.assert_called_once_with(
+      { 'EvtType' : None, 'Datatype' : 'SIM', 'Machine' : 'clic', 'ProdID' : '1245',
+        'DetectorModel' : 'testdetectorv2000' }, '/' )
+    self.over.fcc.findFilesByMetadata.assert_not_called()
+
   def test_getfilesfromlyon( self ):
     import subprocess
     popen_mock = Mock()
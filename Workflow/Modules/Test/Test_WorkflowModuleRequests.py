@@ -423,6 +423,40 @@ class TestModuleBase( ModulesTestCase ):
       self.assertEqual( logF.read().strip().splitlines(), message )
     self.assertEqual( message, out.getvalue().strip().splitlines() )
 
+  def test_MB_redirectLogOutput_reopen( self ):
+    """ModuleBase: redirectLogOutput keeps the log open until the name is used......................"""
+    gLogger.setLevel("ERROR")
+    self.mbase.eventstring = "+++ Event String"
+    self.mbase.applicationLog = "grailDiary.log"
+    out = StringIO()
+    sys.stdout = out
+    self.mbase.redirectLogOutput(0, "first message")
+    self.assertIsNotNone(self.mbase._logFile)
+    os.remove(self.mbase.applicationLog)
+    self.assertIsNone(self.mbase._logFile)
+    self.mbase.redirectLogOutput(0, "+++ Event String second message")
+    self.mbase.eventstring = ["other", "second"]
+    self.mbase.redirectLogOutput(0, "third message")
+    self.mbase.redirectLogOutput(0, "fourth message, second event")
+    with open(self.mbase.applicationLog, "r") as logF:
+      self.assertEqual(logF.read().splitlines(), ["+++ Event String second message", "third message",
+                                                  "fourth message, second event"])
+    self.assertEqual(["+++ Event String second message", "fourth message, second event"],
+                     out.getvalue().strip().splitlines())
+
+  def test_MB_redirectLogOutput_stdError( self ):
+    """ModuleBase: redirectLogOutput keeps the tail of stderr......................................."""
+    gLogger.setLevel("ERROR")
+    self.mbase.eventstring = []
+    self.mbase.applicationLog = "grailDiary.log"
+    self.mbase.stdError = ''
+    for index in range(5000):
+      self.mbase.redirectLogOutput(1, "error %d;" % index)
+    self.mbase.redirectLogOutput(0, "not an error")
+    self.assertEqual(self.mbase.stdError, "".join("error %d;" % index for index in range(4000, 5000)))
+    self.mbase.stdError = ''
+    self.assertEqual(self.mbase.stdError, '')
+
   def test_MB_treatConfigPackage( self ):
     """ModuleBase: treatConfigPackage..............................................................."""
     gLogger.setLevel("ERROR")
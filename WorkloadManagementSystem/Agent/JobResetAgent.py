@@ -1,7 +1,8 @@
 """
 Job Reset Agent takes care of the following cases
 
-* Finds jobs stuck in staging status and reschedules them if associated files are already staged
+* Finds jobs stuck in staging status and reschedules them if all associated files are already staged at their tape
+  storage elements
 * Finds production jobs in completed status:
 
   * Marks a Job Done if request status is Done
@@ -22,14 +23,19 @@ Job Reset Agent takes care of the following cases
   * Marks a Job Done if request status is Done
   * Resets requests if the request status is other than Done
   * Unregister files if a new file is supposed to be registered
+
+The requests and job statuses are read in chunks of JobChunkSize jobs, and the new job statuses of a chunk are set at
+the end of the chunk, with concurrent calls to the JobStateUpdate service.
 """
 
 from collections import defaultdict
 from datetime import datetime, timedelta
+from functools import partial
 from pprint import pformat
 
 from DIRAC import S_OK, S_ERROR
 from DIRAC.Core.Base.AgentModule import AgentModule
+from DIRAC.Core.Utilities.List import breakListIntoChunks
 from DIRAC.Core.Utilities.PrettyPrint import printTable
 from DIRAC.Core.Utilities.Proxy import UserProxy
 from DIRAC.Core.Base.Client import Client
@@ -43,6 +49,7 @@ from DIRAC.DataManagementSystem.Client.DataManager import DataManager
 from DIRAC.Resources.Catalog.FileCatalogFactory import FileCatalogFactory
 
 from ILCDIRAC.Core.Utilities.LFNPathUtilities import cleanUpLFNPath
+from ILCDIRAC.Core.Utilities.Concurrency import concurrentMap
 
 __RCSID__ = "$Id$"
 
@@ -74,6 +81,18 @@ class JobResetAgent(AgentModule):
 
     self.accounting = defaultdict(list)
     self.errors = []
+    self.jobChunkSize = 1000
+    # minor and application status of the jobs being checked
+    self.jobStatuses = {}
+    # jobs to mark, per status, minor status and application; None if jobs are marked one at a time
+    self.jobsToMark = None
+    # number of accounting entries per job type before a job to mark was added, to remove the entries added for
+    # marking the job if it cannot be marked
+    self.accountingBeforeMark = {}
+    self.stagingChunkSize = 100
+    self.stagingWorkers = 4
+    # True/False for storage elements known to be tape/disk storage
+    self.tapeSEs = {}
 
     self.nClient = NotificationClient()
     self.reqClient = ReqClient()
@@ -119,7 +138,11 @@ class JobResetAgent(AgentModule):
     self.addressFrom = self.am_getOption('MailFrom', self.addressFrom)
     self.userJobTypes = self.am_getOption('UserJobs', self.userJobTypes)
     self.prodJobTypes = self.am_getOption('ProdJobs', self.prodJobTypes)
+    self.jobChunkSize = self.am_getOption('JobChunkSize', self.jobChunkSize)
+    self.stagingChunkSize = self.am_getOption('StagingChunkSize', self.stagingChunkSize)
+    self.stagingWorkers = self.am_getOption('StagingWorkers', self.stagingWorkers)
     self.accounting.clear()
+    self.tapeSEs.clear()
 
     return S_OK()
 
@@ -180,23 +203,41 @@ class JobResetAgent(AgentModule):
     jobIDs = map(int, res['Value'])
     return S_OK(jobIDs)
 
+  def getJobStatuses(self, jobIDs):
+    """ returns the minor status and application status for a list of jobs """
+    jobStatuses = defaultdict(dict)
+    for jobChunk in breakListIntoChunks(jobIDs, self.jobChunkSize):
+      res = self.jobMonClient.getJobsMinorStatus(jobChunk)
+      if not res['OK']:
+        self.logError("Failure to get Minor Status", "Job IDs: %s, Message: %s" % (jobChunk, res['Message']))
+        return res
+
+      for jobID, status in res['Value'].iteritems():
+        jobStatuses[jobID]['MinorStatus'] = status['MinorStatus']
+
+      res = self.jobMonClient.getJobsApplicationStatus(jobChunk)
+      if not res['OK']:
+        self.logError("Failure to get Application Status", "Job IDs: %s, Message: %s" % (jobChunk, res['Message']))
+        return res
+
+      for jobID, status in res['Value'].iteritems():
+        jobStatuses[jobID]['ApplicationStatus'] = status['ApplicationStatus']
+
+    return S_OK(dict(jobStatuses))
+
   def treatUserJobWithNoReq(self, jobID):
     """ treatment for user jobs in completed status which don't have a request in RMS """
 
     self.log.notice("No request found for job: %s" % jobID)
-    res = self.jobMonClient.getJobsMinorStatus([jobID])
-    if not res['OK']:
-      self.logError("Failure to get Minor Status", "Job ID: %s, Message: %s" % (jobID, res['Message']))
-      return res
-
-    minorStatus = res['Value'][jobID]['MinorStatus']
-
-    res = self.jobMonClient.getJobsApplicationStatus([jobID])
-    if not res['OK']:
-      self.logError("Failure to get Application Status", "Job ID: %s, Message: %s" % (jobID, res['Message']))
-      return res
+    jobStatus = self.jobStatuses.get(jobID)
+    if jobStatus is None:
+      res = self.getJobStatuses([jobID])
+      if not res['OK']:
+        return res
+      jobStatus = res['Value'].get(jobID, {})
 
-    appStatus = res['Value'][jobID]['ApplicationStatus']
+    minorStatus = jobStatus.get('MinorStatus')
+    appStatus = jobStatus.get('ApplicationStatus')
 
     if minorStatus in FINAL_MINOR_STATES and appStatus in FINAL_APP_STATES:
       res = self.markJob(jobID, "Done")
@@ -396,76 +437,157 @@ class JobResetAgent(AgentModule):
 
       return S_OK()
 
-  def checkJobs(self, jobIDs, treatJobWithNoReq, treatJobWithReq):
-    """ executes treatment functions for jobs with and without requests """
+  def checkJobs(self, jobIDs, treatJobWithNoReq, treatJobWithReq, getJobStatuses=False):
+    """ executes treatment functions for jobs with and without requests
 
-    res = self.reqClient.readRequestsForJobs(jobIDs)
-    if not res['OK']:
-      self.logError('Failure to read requests for jobs', res['Message'])
-      return res
+    The jobs are treated in chunks of JobChunkSize jobs: the requests of all jobs in a chunk are read at once and the
+    jobs are marked at the end of each chunk.
 
-    result = res['Value']
-    for jobID in jobIDs:
-      if ((jobID not in result['Successful'] and jobID not in result['Failed']) or (jobID in result['Failed'] \
-          and 'Request not found' in result['Failed'][jobID])):
-        self.log.notice("No request found for job: %s" % jobID)
-        treatJobWithNoReq(jobID)
+    :param bool getJobStatuses: if True get the minor and application status of all jobs without request at once
+    """
+    for jobChunk in breakListIntoChunks(jobIDs, self.jobChunkSize):
+      res = self.reqClient.readRequestsForJobs(jobChunk)
+      if not res['OK']:
+        self.logError('Failure to read requests for jobs', res['Message'])
+        return res
 
-      elif jobID in result['Successful']:
-        self.log.notice("Found the request for Job: %s " % jobID)
-        request = result['Successful'][jobID]
-        treatJobWithReq(jobID, request)
+      result = res['Value']
+      jobsWithNoReq = set(jobID for jobID in jobChunk
+                          if ((jobID not in result['Successful'] and jobID not in result['Failed']) or
+                              (jobID in result['Failed'] and 'Request not found' in result['Failed'][jobID])))
+
+      self.jobStatuses = {}
+      if getJobStatuses and jobsWithNoReq:
+        res = self.getJobStatuses(sorted(jobsWithNoReq))
+        if res['OK']:
+          self.jobStatuses = res['Value']
+
+      self.jobsToMark = defaultdict(list)
+      try:
+        for jobID in jobChunk:
+          if jobID in jobsWithNoReq:
+            self.log.notice("No request found for job: %s" % jobID)
+            treatJobWithNoReq(jobID)
+
+          elif jobID in result['Successful']:
+            self.log.notice("Found the request for Job: %s " % jobID)
+            request = result['Successful'][jobID]
+            treatJobWithReq(jobID, request)
+      finally:
+        self.markJobs()
+        self.jobsToMark = None
+        self.accountingBeforeMark = {}
+        self.jobStatuses = {}
 
     return S_OK()
 
+  def isTapeSE(self, seName, voName):
+    """ returns True if the storage element is a tape storage, None if its status cannot be obtained
+
+    Only successfully obtained statuses are cached, the status is obtained again for the next file otherwise.
+    """
+    if seName not in self.tapeSEs:
+      res = StorageElement(seName, vo=voName).getStatus()
+      if not res['OK']:
+        self.logError("Failure to get status of Storage Element", "%s: %s" % (seName, res['Message']))
+        return None
+      self.tapeSEs[seName] = bool(res['Value'].get('TapeSE'))
+    return self.tapeSEs[seName]
+
   def getStagedFiles(self, lfns):
-    """ returns a list of staged files """
+    """ returns a list of staged files
+
+    The cache status of the files is checked at all tape storage elements holding a replica, in chunks of
+    StagingChunkSize files with StagingWorkers concurrent calls. Files without a tape replica do not have to be staged.
+    Replicas at storage elements whose status cannot be obtained are ignored, so files only stored there are not
+    considered staged.
+    """
     if not lfns:
       self.log.notice("No LFNs passed to check staging status")
       return S_OK()
 
     voName = lfns[0].split('/')[1]
-    se = StorageElement("CERN-SRM", vo=voName)
-    res = se.getFileMetadata(lfns)
-    if not res["OK"]:
-      self.logError("Failure to getFileMetadata for LFNs", "%s" % lfns)
-      return res
+    stagedFiles = set()
+    lfnsPerSE = defaultdict(list)
+    for lfnChunk in breakListIntoChunks(lfns, self.jobChunkSize):
+      res = self.fcClient.getReplicas(lfnChunk)
+      if not res["OK"]:
+        self.logError("Failure to get replicas for LFNs", res['Message'])
+        return res
 
-    stagedFiles = [lfn for lfn, val in res["Value"]["Successful"].iteritems() if val["Cached"] > 0]
-    return S_OK(stagedFiles)
+      for lfn, reason in res["Value"]["Failed"].iteritems():
+        self.logError("Failure to get replicas for LFN", "%s: %s" % (lfn, reason))
+
+      for lfn, replicas in res["Value"]["Successful"].iteritems():
+        seIsTape = dict((seName, self.isTapeSE(seName, voName)) for seName in replicas)
+        tapeSEs = [seName for seName, isTape in seIsTape.iteritems() if isTape]
+        if not tapeSEs and False in seIsTape.values():
+          stagedFiles.add(lfn)
+        for seName in tapeSEs:
+          lfnsPerSE[seName].append(lfn)
+
+    chunks = [(seName, lfnChunk) for seName, seLFNs in lfnsPerSE.iteritems()
+              for lfnChunk in breakListIntoChunks(seLFNs, self.stagingChunkSize)]
+    if not chunks:
+      return S_OK(sorted(stagedFiles))
+
+    def getFileMetadata(seAndChunk):
+      """ returns the metadata of a chunk of files at one storage element """
+      seName, lfnChunk = seAndChunk
+      return seName, StorageElement(seName, vo=voName).getFileMetadata(lfnChunk)
+
+    for seName, res in concurrentMap(getFileMetadata, chunks, self.stagingWorkers, unordered=True):
+      if not res["OK"]:
+        self.logError("Failure to getFileMetadata for LFNs", "%s: %s" % (seName, res['Message']))
+        continue
+      stagedFiles.update(lfn for lfn, val in res["Value"]["Successful"].iteritems() if val.get("Cached", 0) > 0)
+
+    return S_OK(sorted(stagedFiles))
 
   def getInputDataForJobs(self, jobList):
-    """ returns the input data for a given list of jobIDs """
+    """ returns the input data for a given list of jobIDs
+
+    The input data of the jobs is obtained from the JobMonitoring service, with StagingWorkers concurrent calls. Empty
+    entries are ignored.
+    """
+    def getInputData(jobID):
+      """ returns the input data of one job """
+      return jobID, self.jobMonClient.getInputData(jobID)
+
     inputData = defaultdict(list)
-    for jobID in jobList:
-      res = self.jobMonClient.getInputData(jobID)
+    for jobID, res in concurrentMap(getInputData, jobList, self.stagingWorkers):
       if not res['OK']:
         self.logError("Failure to get input data for", "JobID: %s, Message: %s" % (jobID, res["Message"]))
         continue
 
       for lfn in res['Value']:
-        lfn = cleanUpLFNPath(lfn)
-        inputData[lfn].append(jobID)
+        if lfn and lfn.strip():
+          inputData[jobID].append(cleanUpLFNPath(lfn))
 
-    return S_OK(inputData)
+    return S_OK(dict(inputData))
 
   def rescheduleJobs(self, jobsToReschedule):
-    """ resets a list of jobs """
+    """ resets a list of jobs, JobChunkSize jobs at a time """
     result = dict(Failed=[], Successful=[])
-    for job in jobsToReschedule:
-      res = self.jobManagerClient.resetJob(job)
+    for jobChunk in breakListIntoChunks(sorted(jobsToReschedule), self.jobChunkSize):
+      res = self.jobManagerClient.resetJob(jobChunk)
       if res['OK']:
-        result['Successful'].append(job)
-      else:
-        self.logError("Failed to reset job", "%s: %s" % (job, res['Message']))
-        result['Failed'].append(job)
+        result['Successful'].extend(jobChunk)
+        continue
+
+      failedJobs = set(res.get('InvalidJobIDs', []) + res.get('NonauthorizedJobIDs', []) + res.get('FailedJobIDs', []))
+      if not failedJobs:
+        failedJobs = set(jobChunk)
+      self.logError("Failed to reset jobs", "%s: %s" % (sorted(failedJobs), res['Message']))
+      for job in jobChunk:
+        result['Failed' if job in failedJobs else 'Successful'].append(job)
 
     self.log.info("Reset jobs: %s" % result)
     return S_OK(result)
 
   def checkStagingJobs(self, jobList):
     """ gets input data and stager status, then reschedules jobs whose
-        associated files are already staged """
+        associated files are all staged """
 
     res = self.getInputDataForJobs(jobList)
     inputData = res['Value']
@@ -475,23 +597,20 @@ class JobResetAgent(AgentModule):
       return S_OK()
 
     self.log.notice("Input Data found: %s" % inputData)
-    res = self.getStagedFiles(inputData.keys())
+    res = self.getStagedFiles(sorted(set(lfn for lfns in inputData.itervalues() for lfn in lfns)))
     if not res['OK']:
       return res
 
-    stagedFiles = res['Value']
-
-    jobsToReschedule = set()
-    for lfn in stagedFiles:
-      jobsToReschedule.add(inputData[lfn])
-      self.log.notice("Jobs to be rescheduled: %s" % jobsToReschedule)
+    stagedFiles = set(res['Value'])
+    jobsToReschedule = sorted(jobID for jobID, lfns in inputData.iteritems() if stagedFiles.issuperset(lfns))
+    self.log.notice("Jobs to be rescheduled: %s" % jobsToReschedule)
 
-      if self.enabled and jobsToReschedule:
-        res = self.rescheduleJobs(jobsToReschedule)
-        if res["OK"]:
-          for jobID in res["Value"]["Successful"]:
-            self.accounting["Staging"].append({"JobID": jobID, "JobStatus": "Staging", "Treatment": (
-                                               "Job Rescheduled because associated files are already Staged")})
+    if self.enabled and jobsToReschedule:
+      res = self.rescheduleJobs(jobsToReschedule)
+      if res["OK"]:
+        for jobID in res["Value"]["Successful"]:
+          self.accounting["Staging"].append({"JobID": jobID, "JobStatus": "Staging", "Treatment": (
+                                             "Job Rescheduled because associated files are already Staged")})
 
     return S_OK()
 
@@ -520,6 +639,12 @@ class JobResetAgent(AgentModule):
     if not self.enabled:
       return S_OK()
 
+    if self.jobsToMark is not None:
+      self.jobsToMark[(status, minorStatus, application)].append(jobID)
+      self.accountingBeforeMark.setdefault(jobID, dict((jobType, len(jobs))
+                                                       for jobType, jobs in self.accounting.iteritems()))
+      return S_OK()
+
     res = self.jobStateUpdateClient.setJobStatus(jobID, status, minorStatus, application)
     if not res["OK"]:
       self.logError("Failed to mark ", "Job: %s as %s, Error: %s" % (jobID, status, res['Message']))
@@ -528,6 +653,37 @@ class JobResetAgent(AgentModule):
     self.log.notice("Job %s is successfully maked as %s" % (jobID, status))
     return S_OK()
 
+  def markJobs(self):
+    """ marks the jobs collected by markJob, making several calls to the JobStateUpdate service at the same time
+
+    The jobs are marked with JobStateUpdateClient.setJobStatus like markJob does, so the application given to markJob
+    is only used as the source of the logging record. The accounting entries added after a job was collected are
+    removed from the notification if the job could not be marked.
+    """
+    failedJobs = set()
+    for (status, minorStatus, source), jobIDs in self.jobsToMark.iteritems():
+      markedJobs = []
+      for jobID, res in concurrentMap(partial(self._setJobStatus, status, minorStatus, source), jobIDs):
+        if not res['OK']:
+          self.logError("Failed to mark ", "Job: %s as %s, Error: %s" % (jobID, status, res['Message']))
+          failedJobs.add(jobID)
+          continue
+        markedJobs.append(jobID)
+      if markedJobs:
+        self.log.notice("Jobs %s are successfully marked as %s" % (markedJobs, status))
+
+    for jobType, jobs in self.accounting.items():
+      self.accounting[jobType] = [job for index, job in enumerate(jobs)
+                                  if job['JobID'] not in failedJobs or
+                                  index < self.accountingBeforeMark[job['JobID']].get(jobType, 0)]
+    self.jobsToMark.clear()
+    self.accountingBeforeMark = {}
+    return S_OK()
+
+  def _setJobStatus(self, status, minorStatus, source, jobID):
+    """ sets the status of one job, returns the jobID and the result """
+    return jobID, self.jobStateUpdateClient.setJobStatus(jobID, status, minorStatus, source)
+
   def execute(self):
     """ main execution loop of Agent """
 
@@ -560,7 +716,8 @@ class JobResetAgent(AgentModule):
       if completedUserJobs:
         self.checkJobs(jobIDs=completedUserJobs,
                        treatJobWithNoReq=self.treatUserJobWithNoReq,
-                       treatJobWithReq=self.treatUserJobWithReq)
+                       treatJobWithReq=self.treatUserJobWithReq,
+                       getJobStatuses=True)
       else:
         self.log.notice("No user jobs found with Completed status")
 
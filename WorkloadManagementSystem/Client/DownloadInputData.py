@@ -11,6 +11,8 @@
 import os
 import tempfile
 import random
+import threading
+from collections import defaultdict
 
 from DIRAC                                                          import S_OK, S_ERROR, gLogger
 from DIRAC.Core.Base.Client import Client
@@ -18,19 +20,12 @@ from DIRAC.Resources.Storage.StorageElement                         import Stora
 from DIRAC.Core.Utilities.Os                                        import getDiskSpace
 from DIRAC.DataManagementSystem.Utilities.DMSHelpers                import DMSHelpers
 
+from ILCDIRAC.Core.Utilities.Concurrency                            import concurrentMap
+
 __RCSID__ = "$Id$"
 
 COMPONENT_NAME = 'DownloadInputData'
 
-def _isCached( lfn, seName ):
-  result = StorageElement( seName ).getFileMetadata( lfn )
-  if not result['OK']:
-    return False
-  if lfn in result['Value']['Failed']:
-    return False
-  metadata = result['Value']['Successful'][lfn]
-  return metadata.get( 'Cached', metadata['Accessible'] )
-
 class DownloadInputData( object ):
   """
    retrieve InputData LFN from localSEs (if available) or from elsewhere.
@@ -50,7 +45,11 @@ class DownloadInputData( object ):
     self.inputDataDirectory = argumentsDict.get( 'InputDataDirectory', 'PerFile' )
     self.jobID = None
     self.counter = 1
+    self.counterLock = threading.Lock()
     self.availableSEs = DMSHelpers().getStorageElements()
+    # status of the storage elements and the storage metadata of the files, obtained once per job
+    self.seStatus = {}
+    self.seMetadata = defaultdict(dict)
 
   #############################################################################
   def execute( self, dataToResolve = None ):
@@ -82,7 +81,7 @@ class DownloadInputData( object ):
     diskSEs = set()
     tapeSEs = set()
     for localSE in [se for se in localSEList if se]:
-      seStatus = StorageElement( localSE ).getStatus()
+      seStatus = self._getSEStatus( localSE )
       if not seStatus['OK']:
         return seStatus
       seStatus = seStatus['Value']
@@ -91,6 +90,8 @@ class DownloadInputData( object ):
       elif seStatus['Read'] and seStatus['TapeSE']:
         tapeSEs.add( localSE )
 
+    # files without disk replica, per tape SE holding a replica
+    tapeReplicas = defaultdict(list)
     for lfn, reps in replicas.iteritems():
       if lfn not in self.inputData:
         self.log.verbose( 'LFN %s is not in requested input data to download' )
@@ -117,9 +118,15 @@ class DownloadInputData( object ):
       # If no disk replicas, take tape replicas
       if not downloadReplicas[lfn]['SE']:
         for seName in tapeSEs:
-          if seName in reps and _isCached( lfn, seName ):
-            # Only consider replicas that are cached
-            downloadReplicas[lfn]['SE'].append( seName )
+          if seName in reps:
+            tapeReplicas[seName].append( lfn )
+
+    # Only consider tape replicas that are cached
+    for seName, lfns in tapeReplicas.iteritems():
+      self._prefetchMetadata( seName, lfns )
+      for lfn in lfns:
+        if self._isCached( lfn, seName ):
+          downloadReplicas[lfn]['SE'].append( seName )
 
     totalSize = 0
     verbose = self.log.verbose( 'Replicas to download are:' )
@@ -158,66 +165,36 @@ class DownloadInputData( object ):
       self.__setJobParam( COMPONENT_NAME, report )
       return S_OK( { 'Failed': self.inputData, 'Successful': {}} )
 
-    resolvedData = {}
-    localSECount = 0
+    # Get the storage metadata of all files at once for each SE they are downloaded from
+    lfnsPerSE = defaultdict(list)
     for lfn, info in downloadReplicas.iteritems():
-      seName = info['SE']
-      guid = info['GUID']
-      reps = replicas.get( lfn, {} )
-      if seName:
-        result = StorageElement( seName ).getFileMetadata( lfn )
-        if not result['OK']:
-          self.log.error( "Error getting metadata", result['Message'] )
-          failedReplicas.add( lfn )
-          continue
-        if lfn in result['Value']['Failed']:
-          self.log.error( 'Could not get Storage Metadata for %s at %s: %s' % ( lfn, seName, result['Value']['Failed'][lfn] ) )
-          failedReplicas.add( lfn )
-          continue
-        metadata = result['Value']['Successful'][lfn]
-        if metadata.get( 'Lost', False ):
-          error = "PFN has been Lost by the StorageElement"
-        elif metadata.get( 'Unavailable', False ):
-          error = "PFN is declared Unavailable by the StorageElement"
-        elif seName in tapeSEs and not metadata.get( 'Cached', metadata['Accessible'] ):
-          error = "PFN is no longer in StorageElement Cache"
-        else:
-          error = ''
-        if error:
-          self.log.error( error, lfn )
-          failedReplicas.add( lfn )
-          continue
+      if info['SE']:
+        lfnsPerSE[info['SE']].append( lfn )
+    for seName, lfns in lfnsPerSE.iteritems():
+      self._prefetchMetadata( seName, lfns )
 
-        self.log.info( 'Preliminary checks OK, download %s from %s:' % ( lfn, seName ) )
-        result = self._downloadFromSE( lfn, seName, reps, guid )
-        if not result['OK']:
-          self.log.error( "Download failed", "Tried downloading from SE %s: %s" % ( seName, result['Message'] ) )
-      else:
-        result = {'OK':False}
+    resolvedData = {}
+    localSECount = 0
+    lfns = sorted( downloadReplicas )
+    downloads = list( concurrentMap( lambda lfn: self._downloadFile( lfn, downloadReplicas[lfn],
+                                                                     replicas.get( lfn, {} ), tapeSEs ),
+                                     lfns ) )
 
+    for lfn, result, fromLocalSE in downloads:
       if not result['OK']:
-        reps.pop( seName, None )
-        # Check the other SEs
-        if reps:
-          self.log.info( 'Trying to download from any SE' )
-          result = self._downloadFromBestSE( lfn, reps, guid )
-          if not result['OK']:
-            self.log.error( "Download from best SE failed", "Tried downloading %s: %s" % ( lfn, result['Message'] ) )
-            failedReplicas.add( lfn )
-        else:
-          failedReplicas.add( lfn )
-      else:
+        failedReplicas.add( lfn )
+        continue
+      if fromLocalSE:
         localSECount += 1
-      if result['OK']:
-        # Rename file if downloaded FileName does not match the LFN... How can this happen?
-        lfnName = os.path.basename( lfn )
-        oldPath = result['Value']['path']
-        fileName = os.path.basename( oldPath )
-        if lfnName != fileName:
-          newPath = os.path.join( os.path.dirname( oldPath ), lfnName )
-          os.rename( oldPath, newPath )
-          result['Value']['path'] = newPath
-        resolvedData[lfn] = result['Value']
+      # Rename file if downloaded FileName does not match the LFN... How can this happen?
+      lfnName = os.path.basename( lfn )
+      oldPath = result['Value']['path']
+      fileName = os.path.basename( oldPath )
+      if lfnName != fileName:
+        newPath = os.path.join( os.path.dirname( oldPath ), lfnName )
+        os.rename( oldPath, newPath )
+        result['Value']['path'] = newPath
+      resolvedData[lfn] = result['Value']
 
     # Report datasets that could not be downloaded
     report = ''
@@ -239,6 +216,94 @@ class DownloadInputData( object ):
 
     return S_OK( {'Successful': resolvedData, 'Failed':failedReplicas} )
 
+  #############################################################################
+  def _downloadFile( self, lfn, info, reps, tapeSEs ):
+    """ Download a single LFN from the selected SE, or from any other SE if that fails.
+
+    :param str lfn: LFN to download
+    :param dict info: selected SE, size and GUID of the file
+    :param dict reps: replicas of the file
+    :param set tapeSEs: local tape SEs
+    :returns: tuple of lfn, result of the download and True if the file was downloaded from the selected SE
+    """
+    seName = info['SE']
+    guid = info['GUID']
+    if seName:
+      result = self._getFileMetadata( lfn, seName )
+      if not result['OK']:
+        self.log.error( 'Could not get Storage Metadata for %s at %s: %s' % ( lfn, seName, result['Message'] ) )
+        return lfn, result, False
+      metadata = result['Value']
+      if metadata.get( 'Lost', False ):
+        error = "PFN has been Lost by the StorageElement"
+      elif metadata.get( 'Unavailable', False ):
+        error = "PFN is declared Unavailable by the StorageElement"
+      elif seName in tapeSEs and not metadata.get( 'Cached', metadata['Accessible'] ):
+        error = "PFN is no longer in StorageElement Cache"
+      else:
+        error = ''
+      if error:
+        self.log.error( error, lfn )
+        return lfn, S_ERROR( error ), False
+
+      self.log.info( 'Preliminary checks OK, download %s from %s:' % ( lfn, seName ) )
+      result = self._downloadFromSE( lfn, seName, reps, guid )
+      if result['OK']:
+        return lfn, result, True
+      self.log.error( "Download failed", "Tried downloading from SE %s: %s" % ( seName, result['Message'] ) )
+
+    reps.pop( seName, None )
+    # Check the other SEs
+    if not reps:
+      return lfn, S_ERROR( "No other SE to download the file from" ), False
+    self.log.info( 'Trying to download from any SE' )
+    result = self._downloadFromBestSE( lfn, reps, guid )
+    if not result['OK']:
+      self.log.error( "Download from best SE failed", "Tried downloading %s: %s" % ( lfn, result['Message'] ) )
+    return lfn, result, False
+
+  #############################################################################
+  def _getSEStatus( self, seName ):
+    """ Return the status of the Storage Element, it is obtained only once per job.
+    """
+    if seName not in self.seStatus:
+      result = StorageElement( seName ).getStatus()
+      if not result['OK']:
+        return result
+      self.seStatus[seName] = result['Value']
+    return S_OK( self.seStatus[seName] )
+
+  def _prefetchMetadata( self, seName, lfns ):
+    """ Get the storage metadata of all lfns from the Storage Element in one call.
+    """
+    lfns = [lfn for lfn in lfns if lfn not in self.seMetadata[seName]]
+    if not lfns:
+      return
+    result = StorageElement( seName ).getFileMetadata( lfns )
+    if not result['OK']:
+      self.log.error( "Error getting metadata", "%s: %s" % ( seName, result['Message'] ) )
+      return
+    for lfn, metadata in result['Value']['Successful'].iteritems():
+      self.seMetadata[seName][lfn] = S_OK( metadata )
+    for lfn, error in result['Value']['Failed'].iteritems():
+      self.seMetadata[seName][lfn] = S_ERROR( error )
+
+  def _getFileMetadata( self, lfn, seName ):
+    """ Return the storage metadata of the lfn at the Storage Element, unless it was already obtained.
+    """
+    if lfn not in self.seMetadata[seName]:
+      self._prefetchMetadata( seName, [lfn] )
+    return self.seMetadata[seName].get( lfn, S_ERROR( "Could not get metadata from %s" % seName ) )
+
+  def _isCached( self, lfn, seName ):
+    """ Check if the file is accessible, or staged for a tape Storage Element.
+    """
+    result = self._getFileMetadata( lfn, seName )
+    if not result['OK']:
+      return False
+    metadata = result['Value']
+    return metadata.get( 'Cached', metadata['Accessible'] )
+
   #############################################################################
   def __checkDiskSpace( self, totalSize ):
     """Compare available disk space to the file size reported from the catalog
@@ -262,9 +327,11 @@ class DownloadInputData( object ):
 
   def __getDownloadDir( self, incrementCounter = True ):
     if self.inputDataDirectory == "PerFile":
-      if incrementCounter:
-        self.counter += 1
-      return tempfile.mkdtemp( prefix = 'InputData_%s' % ( self.counter ), dir = os.getcwd() )
+      with self.counterLock:
+        if incrementCounter:
+          self.counter += 1
+        counter = self.counter
+      return tempfile.mkdtemp( prefix = 'InputData_%s' % ( counter ), dir = os.getcwd() )
     elif self.inputDataDirectory == "CWD":
       return os.getcwd()
     else:
@@ -279,7 +346,11 @@ class DownloadInputData( object ):
     diskSEs = set()
     tapeSEs = set()
     for seName in reps:
-      seStatus = StorageElement( seName ).status()
+      seStatus = self._getSEStatus( seName )
+      if not seStatus['OK']:
+        self.log.warn( "Cannot get the status of the SE", "%s: %s" % ( seName, seStatus['Message'] ) )
+        continue
+      seStatus = seStatus['Value']
       # FIXME: This is simply terrible - this notion of "DiskSE" vs "TapeSE" should NOT be used here!
       if seStatus['Read'] and seStatus['DiskSE']:
         diskSEs.add( seName )
@@ -287,7 +358,7 @@ class DownloadInputData( object ):
         tapeSEs.add( seName )
 
     for seName in list( diskSEs ) + list( tapeSEs ):
-      if seName in diskSEs or _isCached( lfn, seName ):
+      if seName in diskSEs or self._isCached( lfn, seName ):
         # On disk or cached from tape
         result = self._downloadFromSE( lfn, seName, reps, guid )
         if result['OK']:
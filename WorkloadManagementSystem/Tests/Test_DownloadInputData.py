@@ -0,0 +1,112 @@
+"""Tests for DownloadInputData."""
+# pylint: disable=protected-access, redefined-outer-name
+import os
+
+import pytest
+from mock import MagicMock
+
+from DIRAC import S_OK, S_ERROR
+
+import ILCDIRAC.WorkloadManagementSystem.Client.DownloadInputData as DID
+
+__RCSID__ = "$Id$"
+
+SE_STATUS = {'DISK-SE': {'Read': True, 'DiskSE': True, 'TapeSE': False},
+             'TAPE-SE': {'Read': True, 'DiskSE': False, 'TapeSE': True},
+             'REMOTE-SE': {'Read': True, 'DiskSE': True, 'TapeSE': False},
+             }
+
+
+@pytest.fixture
+def storageElements(mocker):
+  """Mock StorageElements, which download every file except the ones in failingDownloads."""
+  seMocks = {}
+
+  def getFile(lfn, localPath):
+    """Write the file to the localPath."""
+    with open(os.path.join(localPath, os.path.basename(lfn)), 'w') as localFile:
+      localFile.write(lfn)
+    return S_OK({'Successful': {lfn: 1}, 'Failed': {}})
+
+  def makeSE(seName):
+    """Return the mock for the SE, create it on first use."""
+    if seName not in seMocks:
+      seMock = MagicMock(name=seName)
+      seMock.getStatus.return_value = S_OK(SE_STATUS[seName])
+      seMock.getFileMetadata.side_effect = lambda lfns: S_OK({'Successful': dict((lfn, {'Accessible': True,
+                                                                                     'Cached': 1})
+                                                                                    for lfn in lfns),
+                                                               'Failed': {}})
+      seMock.getFile.side_effect = getFile
+      seMocks[seName] = seMock
+    return seMocks[seName]
+  mocker.patch.object(DID, 'StorageElement', new=MagicMock(side_effect=makeSE))
+  return seMocks
+
+
+@pytest.fixture
+def did(mocker, tmpdir):
+  """Return a DownloadInputData instance working in a temporary directory."""
+  mocker.patch.object(DID, 'getDiskSpace', new=MagicMock(return_value=100000))
+  mocker.patch.object(DID, 'DMSHelpers', new=MagicMock())
+  DID.DMSHelpers.return_value.getStorageElements.return_value = list(SE_STATUS)
+  cwd = os.getcwd()
+  os.chdir(str(tmpdir))
+  replicas = {'/ilc/sim/file1.slcio': {'DISK-SE': 'pfn1', 'Size': 10, 'GUID': 'G1'},
+              '/ilc/sim/file2.slcio': {'DISK-SE': 'pfn2', 'REMOTE-SE': 'rpfn2', 'Size': 10, 'GUID': 'G2'},
+              '/ilc/sim/file3.slcio': {'TAPE-SE': 'pfn3', 'Size': 10, 'GUID': 'G3'},
+              }
+  theDID = DID.DownloadInputData({'InputData': sorted(replicas),
+                                  'Configuration': {'LocalSEList': ['DISK-SE', 'TAPE-SE']},
+                                  'FileCatalog': S_OK({'Successful': replicas, 'Failed': {}}),
+                                  })
+  yield theDID
+  os.chdir(cwd)
+
+
+def test_execute(did, storageElements):
+  """Download all files, getting the metadata and status once per SE."""
+  res = did.execute()
+  assert res['OK']
+  assert sorted(res['Value']['Successful']) == ['/ilc/sim/file1.slcio', '/ilc/sim/file2.slcio',
+                                                 '/ilc/sim/file3.slcio']
+  assert res['Value']['Failed'] == []
+  assert res['Value']['Successful']['/ilc/sim/file3.slcio']['se'] == 'TAPE-SE'
+  for lfn, fileDict in res['Value']['Successful'].items():
+    assert os.path.basename(fileDict['path']) == os.path.basename(lfn)
+    assert os.path.exists(fileDict['path'])
+  storageElements['DISK-SE'].getFileMetadata.assert_called_once_with(['/ilc/sim/file1.slcio',
+                                                                      '/ilc/sim/file2.slcio'])
+  storageElements['TAPE-SE'].getFileMetadata.assert_called_once_with(['/ilc/sim/file3.slcio'])
+  storageElements['DISK-SE'].getStatus.assert_called_once_with()
+  storageElements['TAPE-SE'].getStatus.assert_called_once_with()
+
+
+def test_execute_fallback(did, storageElements):
+  """Download from another SE if the download from the local SE fails, fail files not found anywhere."""
+  DID.StorageElement('DISK-SE').getFile.side_effect = lambda lfn, localPath: S_ERROR('Download failed')
+  DID.StorageElement('TAPE-SE').getFileMetadata.side_effect = None
+  DID.StorageElement('TAPE-SE').getFileMetadata.return_value = S_OK({'Successful': {'/ilc/sim/file3.slcio': {
+      'Accessible': True, 'Cached': 0}}, 'Failed': {}})
+  res = did.execute()
+  assert res['OK']
+  assert list(res['Value']['Successful']) == ['/ilc/sim/file2.slcio']
+  assert res['Value']['Successful']['/ilc/sim/file2.slcio']['se'] == 'REMOTE-SE'
+  assert res['Value']['Failed'] == ['/ilc/sim/file1.slcio', '/ilc/sim/file3.slcio']
+  storageElements['REMOTE-SE'].getStatus.assert_called_once_with()
+  storageElements['TAPE-SE'].getFileMetadata.assert_called_once_with(['/ilc/sim/file3.slcio'])
+
+
+def test_get_file_metadata(did, storageElements):
+  """Get the metadata in bulk, and for single files not obtained yet."""
+  storageElements['DISK-SE'] = MagicMock()
+  storageElements['DISK-SE'].getFileMetadata.return_value = S_OK({'Successful': {'/a': {'Accessible': False}},
+                                                                   'Failed': {'/b': 'No such file'}})
+  did._prefetchMetadata('DISK-SE', ['/a', '/b'])
+  assert did._getFileMetadata('/a', 'DISK-SE')['OK']
+  assert not did._isCached('/a', 'DISK-SE')
+  assert not did._getFileMetadata('/b', 'DISK-SE')['OK']
+  storageElements['DISK-SE'].getFileMetadata.assert_called_once_with(['/a', '/b'])
+  storageElements['DISK-SE'].getFileMetadata.return_value = S_ERROR('Connection lost')
+  assert not did._getFileMetadata('/c', 'DISK-SE')['OK']
+  storageElements['DISK-SE'].getFileMetadata.assert_called_with(['/c'])
@@ -1,5 +1,6 @@
 """Tests for JobResetAgent."""
 # pylint: disable=protected-access
+from collections import defaultdict
 from contextlib import contextmanager
 from datetime import datetime, timedelta
 
@@ -9,7 +10,6 @@ from mock import MagicMock, call
 
 import ILCDIRAC.WorkloadManagementSystem.Agent.JobResetAgent as JRA
 
-import DIRAC.Resources.Storage.StorageElement as SeModule
 from DIRAC.RequestManagementSystem.Client.File import File
 from DIRAC.RequestManagementSystem.Client.Request import Request
 from DIRAC.RequestManagementSystem.Client.Operation import Operation
@@ -418,38 +418,131 @@ def test_check_jobs(jobResetAgent):
   dummy_treatJobWithReq.assert_has_calls([call(jobIDs[0], req1), call(jobIDs[1], req2)])
 
 
-def test_get_staged_files(jobResetAgent):
+def test_check_jobs_batched(jobResetAgent):
+  """Test that checkJobs reads requests and job statuses and marks jobs for a chunk of jobs at once."""
+  jobIDs = [1, 2, 3, 4, 5]
+  jobResetAgent.jobChunkSize = 3
+  jobResetAgent.reqClient.readRequestsForJobs.side_effect = lambda jobChunk: S_OK({'Successful': {},
+                                                                                   'Failed': {}})
+  jobResetAgent.jobMonClient.getJobsMinorStatus.side_effect = lambda jobChunk: S_OK(
+      dict((jobID, {'MinorStatus': JRA.FINAL_MINOR_STATES[0], 'JobID': jobID}) for jobID in jobChunk))
+  jobResetAgent.jobMonClient.getJobsApplicationStatus.side_effect = lambda jobChunk: S_OK(
+      dict((jobID, {'ApplicationStatus': JRA.FINAL_APP_STATES[0] if jobID != 2 else 'Running', 'JobID': jobID})
+           for jobID in jobChunk))
+  jobResetAgent.jobStateUpdateClient.setJobStatus.return_value = S_OK()
+
+  res = jobResetAgent.checkJobs(jobIDs, treatJobWithNoReq=jobResetAgent.treatUserJobWithNoReq,
+                                treatJobWithReq=MagicMock(), getJobStatuses=True)
+  assert res['OK']
+  jobResetAgent.reqClient.readRequestsForJobs.assert_has_calls([call([1, 2, 3]), call([4, 5])])
+  jobResetAgent.jobMonClient.getJobsMinorStatus.assert_has_calls([call([1, 2, 3]), call([4, 5])])
+  assert len(jobResetAgent.jobMonClient.getJobsApplicationStatus.mock_calls) == 2
+  assert sorted(args for args, _kwargs in jobResetAgent.jobStateUpdateClient.setJobStatus.call_args_list) == \
+      [(jobID, 'Done', 'Requests Done', 'CompletedJobChecker') for jobID in [1, 3, 4, 5]]
+  jobResetAgent.jobDB.setJobAttributes.assert_not_called()
+  assert [job['JobID'] for job in jobResetAgent.accounting['User']] == [1, 3, 4, 5]
+  assert jobResetAgent.jobsToMark is None
+
+
+def test_mark_jobs_failure(jobResetAgent):
+  """Test that the entries for jobs which could not be marked are removed from the notification."""
+  jobResetAgent.jobsToMark = defaultdict(list)
+  jobResetAgent.accounting['User'].append({'JobID': 2, 'JobStatus': 'Completed', 'Treatment': 'Unregistered LFN'})
+  for jobID in [1, 2, 3]:
+    assert jobResetAgent.markJob(jobID, 'Done')['OK']
+    jobResetAgent.accounting['User'].append({'JobID': jobID, 'JobStatus': 'Completed', 'Treatment': 'Marked Done'})
+  jobResetAgent.jobStateUpdateClient.setJobStatus.side_effect = lambda jobID, *_args: \
+      S_ERROR('Service down') if jobID != 3 else S_OK()
+  res = jobResetAgent.markJobs()
+  assert res['OK']
+  assert [(job['JobID'], job['Treatment']) for job in jobResetAgent.accounting['User']] == \
+      [(2, 'Unregistered LFN'), (3, 'Marked Done')]
+  assert len(jobResetAgent.errors) == 2
+  jobResetAgent.jobDB.setJobAttributes.assert_not_called()
+  assert jobResetAgent.jobsToMark == {}
+  assert jobResetAgent.accountingBeforeMark == {}
+
+
+def test_get_staged_files(jobResetAgent, mocker):
   """Test for getStagedFiles function."""
   stagedFile = "/ilc/fake/lfn1/staged"
   nonStagedFile = "/ilc/fake/lfn2/nonStaged"
-  lfns = [stagedFile, nonStagedFile]
+  stagedElsewhere = "/ilc/fake/lfn3/stagedAtDESY"
+  diskFile = "/ilc/fake/lfn4/disk"
+  lfns = [stagedFile, nonStagedFile, stagedElsewhere, diskFile]
+  jobResetAgent.stagingChunkSize = 1
 
   res = jobResetAgent.getStagedFiles([])
   assert res["OK"]
 
-  SeModule.StorageElementItem.getFileMetadata = MagicMock(return_value=S_ERROR())
+  jobResetAgent._fcClient.getReplicas = MagicMock(return_value=S_ERROR())
   res = jobResetAgent.getStagedFiles(lfns)
   assert not res["OK"]
 
-  SeModule.StorageElementItem.getFileMetadata.return_value = S_OK({'Successful': {stagedFile: {'Cached': 1},
-                                                                                  nonStagedFile: {'Cached': 0}}})
+  jobResetAgent._fcClient.getReplicas.return_value = S_OK({'Successful': {stagedFile: {'CERN-SRM': 'pfn'},
+                                                                          nonStagedFile: {'CERN-SRM': 'pfn',
+                                                                                          'CERN-DST-EOS': 'pfn'},
+                                                                          stagedElsewhere: {'DESY-SRM': 'pfn'},
+                                                                          diskFile: {'CERN-DST-EOS': 'pfn'}},
+                                                           'Failed': {}})
+  metadata = {stagedFile: {'Cached': 1}, nonStagedFile: {'Cached': 0}, stagedElsewhere: {'Cached': 1}}
+  seMocks = {}
+
+  def storageElement(seName, vo):
+    """Return a mocked StorageElement."""
+    assert vo == 'ilc'
+    if seName not in seMocks:
+      seMocks[seName] = MagicMock(name=seName)
+      seMocks[seName].getStatus.return_value = S_OK({'TapeSE': seName.endswith('SRM'),
+                                                     'DiskSE': seName.endswith('EOS')})
+      seMocks[seName].getFileMetadata.side_effect = lambda lfns: S_OK({'Successful': dict((lfn, metadata[lfn])
+                                                                                          for lfn in lfns),
+                                                                       'Failed': {}})
+    return seMocks[seName]
+  mocker.patch('ILCDIRAC.WorkloadManagementSystem.Agent.JobResetAgent.StorageElement', side_effect=storageElement)
+
+  res = jobResetAgent.getStagedFiles(lfns)
+  assert res["Value"] == [stagedFile, stagedElsewhere, diskFile]
+  assert jobResetAgent.tapeSEs == {'CERN-SRM': True, 'DESY-SRM': True, 'CERN-DST-EOS': False}
+  assert len(seMocks['CERN-SRM'].getFileMetadata.mock_calls) == 2
+  seMocks['DESY-SRM'].getFileMetadata.assert_called_once_with([stagedElsewhere])
+  seMocks['CERN-DST-EOS'].getFileMetadata.assert_not_called()
+
+  # files are not staged if the metadata cannot be obtained
+  seMocks['DESY-SRM'].getFileMetadata.side_effect = None
+  seMocks['DESY-SRM'].getFileMetadata.return_value = S_ERROR()
+  res = jobResetAgent.getStagedFiles(lfns)
+  assert res["Value"] == [stagedFile, diskFile]
+
+  # files are not staged if the status of their storage element cannot be obtained, the status is not cached
+  jobResetAgent.tapeSEs.clear()
+  seMocks['CERN-DST-EOS'].getStatus.return_value = S_ERROR('SE down')
+  seMocks['DESY-SRM'].getStatus.return_value = S_ERROR('SE down')
   res = jobResetAgent.getStagedFiles(lfns)
   assert res["Value"] == [stagedFile]
+  assert jobResetAgent.tapeSEs == {'CERN-SRM': True}
+  assert len(seMocks['DESY-SRM'].getStatus.mock_calls) == 2
 
 
 def test_get_input_data_for_jobs(jobResetAgent):
   """Test for getInputDataForJobs function."""
-  jobIDs = [1, 2]
+  jobIDs = [1, 2, 3]
   lfn1 = "lfn:/ilc/fake/lfn1"
   lfn2 = "/ilc/fake/lfn2"
   jobResetAgent.jobMonClient.getInputData.return_value = S_ERROR()
 
   res = jobResetAgent.getInputDataForJobs(jobIDs)
   assert res["Value"] == {}
+  assert len(jobResetAgent.errors) == 3
 
-  jobResetAgent.jobMonClient.getInputData.return_value = S_OK([lfn1, lfn2])
+  inputData = {1: S_OK([lfn1, lfn2]), 2: S_OK([lfn2, '', ' ']), 3: S_OK([])}
+  jobResetAgent.jobMonClient.getInputData.reset_mock()
+  jobResetAgent.jobMonClient.getInputData.side_effect = inputData.get
   res = jobResetAgent.getInputDataForJobs(jobIDs)
-  assert res["Value"] == {lfn1[4:]: jobIDs, lfn2: jobIDs}
+  assert res["Value"] == {1: [lfn1[4:], lfn2], 2: [lfn2]}
+  assert sorted(args for args, _kwargs in jobResetAgent.jobMonClient.getInputData.call_args_list) == \
+      [(1,), (2,), (3,)]
+  jobResetAgent.jobDB._query.assert_not_called()
 
 
 def test_reschedule_jobs(jobResetAgent):
@@ -458,11 +551,23 @@ def test_reschedule_jobs(jobResetAgent):
   jobShouldSuccessfullyReset = 2
   jobsToReschedule = [jobShouldFailToReset, jobShouldSuccessfullyReset]
 
-  jobResetAgent.jobManagerClient.resetJob.side_effect = [S_ERROR(), S_OK()]
+  resetError = S_ERROR('Some jobs failed resetting')
+  resetError['FailedJobIDs'] = [jobShouldFailToReset]
+  jobResetAgent.jobManagerClient.resetJob.return_value = resetError
   res = jobResetAgent.rescheduleJobs(jobsToReschedule)
   assert res['OK']
   assert res["Value"]["Successful"] == [jobShouldSuccessfullyReset]
   assert res["Value"]["Failed"] == [jobShouldFailToReset]
+  jobResetAgent.jobManagerClient.resetJob.assert_called_once_with(jobsToReschedule)
+
+  # all jobs of the chunk failed
+  jobResetAgent.jobChunkSize = 1
+  jobResetAgent.jobManagerClient.resetJob.reset_mock()
+  jobResetAgent.jobManagerClient.resetJob.side_effect = [S_ERROR(), S_OK()]
+  res = jobResetAgent.rescheduleJobs(jobsToReschedule)
+  assert res["Value"] == {"Successful": [jobShouldSuccessfullyReset], "Failed": [jobShouldFailToReset]}
+  jobResetAgent.jobManagerClient.resetJob.assert_has_calls([call([jobShouldFailToReset]),
+                                                            call([jobShouldSuccessfullyReset])])
 
 
 def test_check_staging_jobs(jobResetAgent):
@@ -483,14 +588,14 @@ def test_check_staging_jobs(jobResetAgent):
   jobResetAgent.getInputDataForJobs.assert_called_once_with(jobIDs)
   jobResetAgent.getStagedFiles.assert_not_called()
 
-  jobsToReschedule = set()
-  jobsToReschedule.add(jobShouldBeRescheduled)
+  # only jobs with all input files staged are rescheduled, all at once
   jobResetAgent.getInputDataForJobs.reset_mock()
-  jobResetAgent.getInputDataForJobs.return_value = S_OK({stagedFile: jobShouldBeRescheduled,
-                                                         notStagedFile: jobShouldNotBeResecheduled})
+  jobResetAgent.getInputDataForJobs.return_value = S_OK({jobShouldBeRescheduled: [stagedFile],
+                                                         jobShouldNotBeResecheduled: [stagedFile, notStagedFile]})
   jobResetAgent.getStagedFiles.return_value = S_OK([stagedFile])
   jobResetAgent.checkStagingJobs(jobIDs)
-  jobResetAgent.rescheduleJobs.assert_called_once_with(jobsToReschedule)
+  jobResetAgent.getStagedFiles.assert_called_once_with([notStagedFile, stagedFile])
+  jobResetAgent.rescheduleJobs.assert_called_once_with([jobShouldBeRescheduled])
 
 
 def test_reset_request(jobResetAgent):
@@ -555,7 +660,7 @@ def test_execute(jobResetAgent):
   failedProdJobCall = call(jobIDs=jobIDs, treatJobWithNoReq=jobResetAgent.treatFailedProdWithNoReq,
                            treatJobWithReq=jobResetAgent.treatFailedProdWithReq)
   completedUserJob = call(jobIDs=jobIDs, treatJobWithNoReq=jobResetAgent.treatUserJobWithNoReq,
-                          treatJobWithReq=jobResetAgent.treatUserJobWithReq)
+                          treatJobWithReq=jobResetAgent.treatUserJobWithReq, getJobStatuses=True)
   calls = [completedProdJobCall, failedProdJobCall, completedUserJob]
   jobResetAgent.checkJobs.assert_has_calls(calls)
   jobResetAgent.checkStagingJobs.assert_called_once_with(jobIDs)